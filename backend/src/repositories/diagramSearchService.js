@@ -1,6 +1,27 @@
 // services/diagramSearchService.js
+const axios = require('axios');
 const Diagram = require('../models/Diagram');
 
+const FLASK_API_URL = process.env.FLASK_API_URL;
+// Term suggestions are skipped rather than waited for past this
+const TERM_SUGGESTIONS_TIMEOUT_MS = 250;
+
+/**
+ * Suggestions from titles, then terms found inside diagrams that no title
+ * suggestion already shows. Terms get up to half the slots, or more when
+ * there are fewer titles.
+ * @param {Array} titles - Atlas autocomplete results
+ * @param {Array} terms - Term suggestions
+ * @param {number} limit - Maximum number of suggestions
+ * @returns {Array} - Merged suggestions
+ */
+function mergeSuggestions(titles, terms, limit) {
+  const shown = new Set(titles.map((suggestion) => (suggestion.title || '').toLowerCase()));
+  const extra = terms.filter((suggestion) => !shown.has(suggestion.title));
+  const termSlots = Math.min(extra.length, Math.max(Math.floor(limit / 2), limit - titles.length));
+  return [...titles.slice(0, limit - termSlots), ...extra.slice(0, termSlots)];
+}
+
 /**
  * Service for handling Atlas Search queries on the Diagram collection
  */
@@ -380,7 +401,44 @@ class DiagramSearchService {
       }
     ];
 
-    return await Diagram.aggregate(pipeline);
+    // Titles from Atlas and terms from the analysis service's in-memory
+    // index, in parallel
+    const [titles, terms] = await Promise.all([
+      Diagram.aggregate(pipeline),
+      this.getTermSuggestions(prefix, limit)
+    ]);
+    return mergeSuggestions(titles, terms, limit);
+  }
+
+  /**
+   * Terms found inside stored diagrams (OCR text, labels, symbols) that
+   * complete a prefix, from the analysis service's /autocomplete. Returns
+   * no suggestions, rather than failing, when the service is unavailable.
+   * @param {string} prefix - The prefix to get suggestions for
+   * @param {number} limit - Maximum number of suggestions
+   * @returns {Promise<Array>} - Suggestions shaped like title suggestions
+   */
+  async getTermSuggestions(prefix, limit = 5) {
+    if (!FLASK_API_URL) {
+      return [];
+    }
+    try {
+      const response = await axios.get(`${FLASK_API_URL}/autocomplete`, {
+        params: { prefix, limit },
+        timeout: TERM_SUGGESTIONS_TIMEOUT_MS
+      });
+      return response.data.suggestions.map((suggestion) => ({
+        _id: `term:${suggestion.term}`,
+        title: suggestion.term,
+        score: suggestion.count,
+        kinds: suggestion.kinds,
+        fuzzy: suggestion.fuzzy,
+        source: 'diagram_text'
+      }));
+    } catch (error) {
+      console.error('Term suggestions unavailable:', error.message);
+      return [];
+    }
   }
 
   /**
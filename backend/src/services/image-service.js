@@ -7,7 +7,36 @@ const multer = require("multer");
 const Diagram = require("../models/Diagram"); // Use correct Mongoose model
 
 const FLASK_API_URL = process.env.FLASK_API_URL;
-const { extractTextWithTextractBuffer } = require("../textract");
+
+// Textract text through the analysis service's /ocr, which pools the client,
+// limits concurrent calls and caches results by image content
+async function extractTextWithTextractBuffer(buffer, filename, contentType) {
+  const form = new FormData();
+  form.append("image", buffer, { filename, contentType });
+  const response = await axios.post(`${FLASK_API_URL}/ocr`, form, {
+    headers: form.getHeaders(),
+    maxContentLength: Infinity,
+    maxBodyLength: Infinity,
+  });
+  return response.data.text || "";
+}
+// Terms found inside a diagram (Textract and analysis text, symbols) for
+// /diagram/autocomplete. Not awaited: suggestions work without them, so a
+// failure is only logged
+function indexDiagramTerms(diagramId, textractText, analysis) {
+  const line = JSON.stringify({
+    id: String(diagramId),
+    text: [textractText, analysis.text_result].filter((text) => typeof text === "string").join("\n"),
+    symbols: Array.isArray(analysis.symbols_result) ? analysis.symbols_result : [],
+  });
+  axios
+    .post(`${FLASK_API_URL}/autocomplete/upsert`, `${line}\n`, {
+      headers: { "Content-Type": "application/x-ndjson" },
+      timeout: 10000,
+    })
+    .catch((err) => console.error("❌ Autocomplete indexing failed:", err.message));
+}
+
 // ✅ Function to Save Analysis Data to MongoDB
 async function saveAnalysisData(imageData, analysisData) {
   console.log("🚀 ~ saveAnalysisData ~ imageData:", analysisData);
@@ -112,7 +141,7 @@ const processImage = async (file, imageMetadata) => {
 
     let textractText = "";
       try {
-        textractText = await extractTextWithTextractBuffer(file.buffer);
+        textractText = await extractTextWithTextractBuffer(file.buffer, file.originalname, file.mimetype);
          console.log("✅ Textract text:", textractText.slice(0,100));
       } catch(err) {
          console.error("❌ Textract failed:", err);
@@ -181,6 +210,7 @@ const processImage = async (file, imageMetadata) => {
 
     // 4️⃣ **Save Data to MongoDB**
     const savedData = await saveAnalysisData(imageData, flaskResponse.data);
+    indexDiagramTerms(savedData._id, textractText, flaskResponse.data);
 
     // 5️⃣ **Return Final Response**
     return {
@@ -0,0 +1,135 @@
+# image-analysis-service/benchmarks/cloud_ocr.py
+"""
+Cloud OCR client (utils/cloud_ocr.py) against the local Textract stub
+(textract_stub.py), which throttles every few calls.
+
+Sends --requests reads of --unique distinct images from --threads threads
+through one TextractClient and checks that:
+
+- each unique image is sent to the API once (plus throttling retries), and
+  concurrent reads of the same image wait for that one call
+- no more than --concurrency calls are in flight at the stub
+- every throttled call is retried and all reads succeed
+- images beyond the API limits are downscaled before upload
+- a second client on the same cache directory (another worker process)
+  makes no calls at all
+
+Reports wall time against the time the same reads would take uncached at
+the same concurrency.
+
+Exits non-zero if a check fails.
+
+Examples:
+    python benchmarks/cloud_ocr.py
+    python benchmarks/cloud_ocr.py --threads 32 --requests 400 --latency 0.2
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+from denoise_gate import diagram
+from textract_stub import start_stub
+
+SERVICE_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(SERVICE_ROOT, 'src'))
+
+from utils.cloud_ocr import TEXTRACT_MAX_BYTES, TEXTRACT_MAX_SIDE, TextractClient  # noqa: E402
+
+
+def images(count):
+    """Distinct small PNG diagrams"""
+    result = []
+    for i in range(count):
+        image = diagram(640, 480)
+        cv2.putText(image, f"#{i}", (20, 460), cv2.FONT_HERSHEY_SIMPLEX, 0.8, 0, 2)
+        result.append(cv2.imencode('.png', image)[1].tobytes())
+    return result
+
+
+def oversized():
+    """A too-long panorama and an incompressible photo over the byte limit"""
+    wide = np.full((600, TEXTRACT_MAX_SIDE + 2000), 255, np.uint8)
+    photo = np.random.default_rng(0).integers(0, 255, (2600, 2600, 3), dtype=np.uint8)
+    return [cv2.imencode('.png', wide)[1].tobytes(), cv2.imencode('.png', photo)[1].tobytes()]
+
+
+def client(endpoint, cache_dir, concurrency):
+    return TextractClient(
+        region='us-east-1', endpoint_url=endpoint, max_concurrency=concurrency,
+        max_attempts=6, cache_dir=cache_dir, backoff_base=0.02, backoff_max=0.2
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--unique', type=int, default=20)
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--latency', type=float, default=0.1, help="Stub seconds per call")
+    parser.add_argument('--throttle-every', type=int, default=5)
+    args = parser.parse_args()
+
+    # The stub ignores signatures, but botocore needs some credentials to sign with
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'stub')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'stub')
+
+    server, state, endpoint = start_stub(latency=args.latency, throttle_every=args.throttle_every)
+    failures = []
+    with tempfile.TemporaryDirectory() as cache_dir:
+        ocr = client(endpoint, cache_dir, args.concurrency)
+        corpus = images(args.unique)
+        reads = [corpus[i % args.unique] for i in range(args.requests)]
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(args.threads) as pool:
+            results = list(pool.map(ocr.detect_text, reads))
+        elapsed = time.perf_counter() - start
+        stats, stub = ocr.stats(), state.stats()
+        print(f"{args.requests} reads of {args.unique} images from {args.threads} threads: {elapsed:.2f}s "
+              f"(uncached at the same concurrency: {args.requests * args.latency / args.concurrency:.2f}s)")
+        print(f"client: {stats}")
+        print(f"stub:   {stub}")
+
+        if stub['calls'] - stub['throttled'] != args.unique:
+            failures.append(f"{stub['calls'] - stub['throttled']} successful API calls for {args.unique} images")
+        if stub['peak_active'] > args.concurrency:
+            failures.append(f"{stub['peak_active']} concurrent calls, limit {args.concurrency}")
+        if stub['throttled'] and stats['retries'] < stub['throttled']:
+            failures.append(f"{stub['throttled']} throttled calls but {stats['retries']} retries")
+        if not all(result.text for result in results):
+            failures.append("some reads returned no text")
+
+        for data in oversized():
+            result = ocr.detect_text(data)
+            width, height = (int(v) for v in result.text.split()[0].split('x'))
+            print(f"{len(data) / 1e6:.1f} MB upload sent as {width}x{height}")
+        stub = state.stats()
+        if stub['max_side'] > TEXTRACT_MAX_SIDE or stub['max_bytes'] > TEXTRACT_MAX_BYTES:
+            failures.append(f"upload over the API limits: {stub['max_side']} px, {stub['max_bytes']} bytes")
+
+        calls = stub['calls']
+        second = client(endpoint, cache_dir, args.concurrency)
+        start = time.perf_counter()
+        for data in corpus:
+            second.detect_text(data)
+        print(f"second client, shared cache: {args.unique} reads in {time.perf_counter() - start:.3f}s, "
+              f"{state.stats()['calls'] - calls} API calls")
+        if state.stats()['calls'] != calls:
+            failures.append("second client did not use the shared cache")
+    server.shutdown()
+
+    for failure in failures:
+        print(failure)
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+# image-analysis-service/benchmarks/denoise_gate.py
+"""
+Time saved by noise-gated denoising, per image class.
+
+Builds synthetic images of the classes the service sees (clean digital
+exports, JPEG exports, scans with light and heavy noise, a large scan,
+color charts) and denoises each one twice: always with NL-means, as
+before, and with utils.preprocessor.apply_denoising(), which estimates the
+noise first and picks no denoising, a bilateral filter or NL-means matched
+to the noise. Reports the branch chosen, both times and the PSNR of each
+output against the noise-free image.
+
+Exits non-zero if a clean class is denoised at all, or the gated output of
+a noisy class is worse than its input or more than --max-psnr-loss dB worse
+than NL-means.
+
+Examples:
+    python benchmarks/denoise_gate.py
+    python benchmarks/denoise_gate.py --repeat 3
+"""
+import argparse
+import os
+import sys
+import time
+
+import cv2
+import numpy as np
+
+SERVICE_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(SERVICE_ROOT, 'src'))
+
+from utils.preprocessor import DENOISE_NONE, apply_denoising, decide_denoising  # noqa: E402
+
+# Classes whose gated output must be untouched
+CLEAN_CLASSES = ('clean_export', 'jpeg_export', 'color_chart')
+
+
+def diagram(width, height, background=255, color=False):
+    """Boxes, connectors and text on a flat background"""
+    image = np.full((height, width, 3), background, np.uint8)
+    rng = np.random.default_rng(7)
+    for _ in range(max(4, width * height // 40000)):
+        x, y = int(rng.integers(0, width - 160)), int(rng.integers(0, height - 80))
+        fill = tuple(int(c) for c in rng.integers(40, 220, 3)) if color else (background,) * 3
+        cv2.rectangle(image, (x, y), (x + 140, y + 60), fill, -1)
+        cv2.rectangle(image, (x, y), (x + 140, y + 60), (30, 30, 30), 2)
+        cv2.putText(image, 'x+y=2', (x + 10, y + 40), cv2.FONT_HERSHEY_SIMPLEX, 0.9, (20, 20, 20), 2)
+        cv2.line(image, (x + 140, y + 30), (min(width - 1, x + 260), y + 30), (30, 30, 30), 2)
+    return image if color else cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+
+
+def noisy(image, sigma, seed=0):
+    rng = np.random.default_rng(seed)
+    return np.clip(image + rng.normal(0, sigma, image.shape), 0, 255).astype(np.uint8)
+
+
+def image_classes():
+    """(name, noisy image, noise-free reference)"""
+    clean = diagram(1600, 1200)
+    jpeg = cv2.imdecode(cv2.imencode('.jpg', clean, [cv2.IMWRITE_JPEG_QUALITY, 80])[1], cv2.IMREAD_GRAYSCALE)
+    scan = diagram(1600, 1200, background=232)
+    large_scan = diagram(4000, 3000, background=232)
+    chart = diagram(1600, 1200, color=True)
+    return [
+        ('clean_export', clean, clean),
+        ('jpeg_export', jpeg, clean),
+        ('color_chart', chart, chart),
+        ('light_scan', noisy(scan, 3), scan),
+        ('noisy_scan', noisy(scan, 12), scan),
+        ('large_noisy_scan', noisy(large_scan, 12), large_scan),
+    ]
+
+
+def always_nl_means(image):
+    """Denoising as it was before gating"""
+    if image.ndim == 2:
+        return cv2.fastNlMeansDenoising(image, None, 7, 7, 21)
+    return cv2.fastNlMeansDenoisingColored(image, None, 7, 7, 7, 21)
+
+
+def timed(fn, image, repeat):
+    best, output = None, None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        output = fn(image)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, output
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=1, help="Best of N timings")
+    parser.add_argument('--max-psnr-loss', type=float, default=3.5)
+    args = parser.parse_args()
+
+    failures = []
+    print(f"{'class':<18}{'branch':<10}{'sigma':>7}{'before':>9}{'gated':>9}{'saved':>8}{'PSNR before':>13}{'gated':>8}")
+    for name, image, reference in image_classes():
+        gray = image if image.ndim == 2 else cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        decision = decide_denoising(gray)
+        before, legacy = timed(always_nl_means, image, args.repeat)
+        gated_time, gated = timed(apply_denoising, image, args.repeat)
+        psnr_before, psnr_gated = cv2.PSNR(legacy, reference), cv2.PSNR(gated, reference)
+        print(f"{name:<18}{decision.branch:<10}{decision.noise_sigma:>7.2f}{before:>8.2f}s{gated_time:>8.2f}s"
+              f"{before - gated_time:>7.2f}s{psnr_before:>12.1f}dB{psnr_gated:>6.1f}dB")
+
+        if name in CLEAN_CLASSES and decision.branch != DENOISE_NONE:
+            failures.append(f"{name}: clean image denoised with {decision.branch}")
+        if name not in CLEAN_CLASSES and psnr_gated < cv2.PSNR(image, reference):
+            failures.append(f"{name}: gated output is worse than the noisy input")
+        if name not in CLEAN_CLASSES and psnr_gated < psnr_before - args.max_psnr_loss:
+            failures.append(f"{name}: gated output {psnr_before - psnr_gated:.1f} dB worse than NL-means")
+
+    for failure in failures:
+        print(failure)
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+# image-analysis-service/benchmarks/diagram_features.py
+"""
+Time saved by running the diagram_features stage on a reduced decode.
+
+For each image, decodes it at full resolution and at
+DIAGRAM_FEATURES_REQUIREMENT (JPEGs reduced in the DCT domain, other
+formats resized after decoding), then runs extract_diagram_features() on
+each. Reports the decoded size, decode and feature times and the diagram
+type found at both scales.
+
+Without image arguments, synthetic 12 MP inputs are written to a temporary
+directory: a flow chart as PNG and JPEG, and a textured photo as JPEG.
+
+Exits non-zero if the reduced run is slower than the full-resolution run
+for an image the requirement reduces.
+
+Examples:
+    python benchmarks/diagram_features.py
+    python benchmarks/diagram_features.py uploads/scan.png uploads/photo.jpg
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import cv2
+import numpy as np
+
+SERVICE_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(SERVICE_ROOT, 'src'))
+
+from utils import diagram_features  # noqa: E402
+from utils.decode import FULL_COLOR, decode_image  # noqa: E402
+
+
+def flow_chart(width, height):
+    """Boxes, connectors and labels on white"""
+    image = np.full((height, width, 3), 255, np.uint8)
+    rng = np.random.default_rng(3)
+    for _ in range(max(4, width * height // 200000)):
+        x, y = int(rng.integers(0, width - 400)), int(rng.integers(0, height - 200))
+        cv2.rectangle(image, (x, y), (x + 360, y + 160), (40, 40, 40), 4)
+        cv2.putText(image, 'x+y=2', (x + 30, y + 100), cv2.FONT_HERSHEY_SIMPLEX, 2.0, (20, 20, 20), 4)
+        cv2.arrowedLine(image, (x + 360, y + 80), (min(width - 1, x + 600), y + 80), (40, 40, 40), 4)
+    return image
+
+
+def textured_photo(width, height):
+    """Smooth shading under fine noise, the hardest case for the detectors"""
+    rng = np.random.default_rng(5)
+    shading = cv2.resize(rng.integers(0, 256, (12, 16, 3), dtype=np.uint8), (width, height),
+                         interpolation=cv2.INTER_CUBIC)
+    noise = rng.normal(0, 10, (height, width, 3))
+    return np.clip(shading + noise, 0, 255).astype(np.uint8)
+
+
+def synthetic_images(directory):
+    chart = flow_chart(4000, 3000)
+    photo = textured_photo(4000, 3000)
+    paths = []
+    for name, image, params in [('flow_chart.png', chart, []),
+                                ('flow_chart.jpg', chart, [cv2.IMWRITE_JPEG_QUALITY, 90]),
+                                ('photo.jpg', photo, [cv2.IMWRITE_JPEG_QUALITY, 90])]:
+        path = os.path.join(directory, name)
+        cv2.imwrite(path, image, params)
+        paths.append(path)
+    return paths
+
+
+def run(path, requirement):
+    """(decoded image, decode seconds, feature seconds, DiagramFeatures) at one requirement"""
+    start = time.perf_counter()
+    decoded = decode_image(path, requirement)
+    decoded_at = time.perf_counter()
+    # The stage views the decode at DIAGRAM_FEATURES_REQUIREMENT; set it to
+    # the requirement measured so the full-resolution run stays full
+    saved = diagram_features.DIAGRAM_FEATURES_REQUIREMENT
+    diagram_features.DIAGRAM_FEATURES_REQUIREMENT = requirement
+    try:
+        features = diagram_features.extract_diagram_features(path, decoded=decoded)
+    finally:
+        diagram_features.DIAGRAM_FEATURES_REQUIREMENT = saved
+    return decoded, decoded_at - start, time.perf_counter() - decoded_at, features
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('images', nargs='*', help="Images to measure (default: synthetic 12 MP inputs)")
+    args = parser.parse_args()
+
+    reduced_requirement = diagram_features.DIAGRAM_FEATURES_REQUIREMENT
+    failures = []
+    with tempfile.TemporaryDirectory() as directory:
+        paths = args.images or synthetic_images(directory)
+        print(f"{'image':<24}{'scale':>6}{'decoded':>10}{'decode':>9}{'features':>10}  type")
+        for path in paths:
+            name = os.path.basename(path)[-24:]
+            times = {}
+            for label, requirement in (('full', FULL_COLOR), ('reduced', reduced_requirement)):
+                decoded, decode_time, feature_time, features = run(path, requirement)
+                view = decoded.view(requirement)
+                times[label] = (view.scale, decode_time + feature_time)
+                print(f"{name:<24}{'1/' + str(view.scale):>6}{decoded.nbytes / 1e6:>8.0f}MB{decode_time:>8.2f}s"
+                      f"{feature_time:>9.2f}s  {features.diagram_type.value} ({features.type_confidence:.2f})")
+            reduced_scale, reduced_time = times['reduced']
+            if reduced_scale > 1 and reduced_time > times['full'][1]:
+                failures.append(f"{name}: reduced run slower than full resolution "
+                                f"({reduced_time:.2f}s vs {times['full'][1]:.2f}s)")
+
+    for failure in failures:
+        print(failure)
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,353 @@
+# image-analysis-service/benchmarks/load_test.py
+"""
+Load-test harness for the image analysis service.
+
+Starts the Flask service in a local subprocess (unless --url is given), drives
+it with images from a local corpus at one or more concurrency levels, and
+writes a JSON report that can be compared against earlier runs.
+
+Examples:
+    python benchmarks/load_test.py run --corpus ./corpus --concurrency 1 2 4 8
+    python benchmarks/load_test.py run --corpus ./corpus --rate 5 --duration 60
+    python benchmarks/load_test.py compare results/a.json results/b.json
+"""
+import argparse
+import json
+import mimetypes
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import requests
+
+SERVICE_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.tif', '.tiff', '.gif', '.webp', '.svg', '.pdf')
+
+
+def load_corpus(corpus_dir):
+    """Read every image in the corpus into memory so disk I/O is not measured"""
+    corpus = []
+    for root, _, files in os.walk(corpus_dir):
+        for name in sorted(files):
+            if name.lower().endswith(IMAGE_EXTENSIONS):
+                path = os.path.join(root, name)
+                with open(path, 'rb') as f:
+                    corpus.append((name, f.read()))
+    if not corpus:
+        raise SystemExit(f"No images found in {corpus_dir}")
+    return corpus
+
+
+def start_service(port, extra_env=None):
+    """Launch `src/app.py` in a subprocess and wait until /health answers"""
+    env = dict(os.environ)
+    env['PORT'] = str(port)
+    env.update(extra_env or {})
+    log_path = os.path.join(SERVICE_ROOT, f'load_test_service_{port}.log')
+    log_file = open(log_path, 'w')
+    process = subprocess.Popen(
+        [sys.executable, os.path.join('src', 'app.py')],
+        cwd=SERVICE_ROOT, env=env, stdout=log_file, stderr=subprocess.STDOUT
+    )
+    base_url = f"http://127.0.0.1:{port}"
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise SystemExit(f"Service exited early, see {log_path}")
+        try:
+            if requests.get(f"{base_url}/health", timeout=1).status_code < 500:
+                return process, base_url
+        except requests.RequestException:
+            pass
+        time.sleep(0.25)
+    process.terminate()
+    raise SystemExit(f"Service did not become healthy, see {log_path}")
+
+
+def stop_service(process):
+    process.terminate()
+    try:
+        process.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+
+
+def send_analyze(session, base_url, name, payload, timeout):
+    """Synchronous request against /analyze"""
+    content_type = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+    response = session.post(
+        f"{base_url}/analyze",
+        files={'image': (name, payload, content_type)},
+        timeout=timeout
+    )
+    return response.status_code, response
+
+
+def send_job(session, base_url, name, payload, timeout):
+    """Submit to /jobs and long-poll /jobs/<id> until the job finishes"""
+    content_type = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+    response = session.post(
+        f"{base_url}/jobs",
+        files={'image': (name, payload, content_type)},
+        timeout=timeout
+    )
+    if response.status_code != 202:
+        return response.status_code, response
+    job_url = f"{base_url}/jobs/{response.json()['job_id']}"
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        response = session.get(job_url, params={'wait': 30}, timeout=timeout)
+        if response.status_code != 200:
+            return response.status_code, response
+        status = response.json().get('status')
+        if status == 'completed':
+            return 200, response
+        if status == 'failed':
+            return 500, response
+    return 599, None
+
+
+SENDERS = {
+    'analyze': send_analyze,
+    'jobs': send_job,
+}
+
+
+class RunRecorder:
+    """Collects per-request samples and periodic server metric snapshots"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = []
+        self.server_metrics = []
+
+    def add(self, started, latency, status):
+        with self.lock:
+            self.samples.append((started, latency, status))
+
+
+def poll_server_metrics(base_url, recorder, stop_event, interval):
+    while not stop_event.wait(interval):
+        try:
+            snapshot = requests.get(f"{base_url}/metrics", timeout=5).json()
+            with recorder.lock:
+                recorder.server_metrics.append(snapshot)
+        except (requests.RequestException, ValueError):
+            pass
+
+
+def run_step(base_url, corpus, mode, concurrency, rate, duration, timeout, metrics_interval, seed):
+    """
+    Run one load step.
+
+    With rate == 0 the step is closed-loop: `concurrency` clients send back to
+    back. With rate > 0 requests arrive as a Poisson process at `rate` per
+    second and `concurrency` caps the number of outstanding requests.
+    """
+    sender = SENDERS[mode]
+    recorder = RunRecorder()
+    rng = random.Random(seed)
+    stop_event = threading.Event()
+    sessions = threading.local()
+
+    def one_request():
+        if not hasattr(sessions, 'session'):
+            sessions.session = requests.Session()
+        name, payload = corpus[rng.randrange(len(corpus))]
+        started = time.time()
+        try:
+            status, _ = sender(sessions.session, base_url, name, payload, timeout)
+        except requests.RequestException:
+            status = 0
+        recorder.add(started, time.time() - started, status)
+
+    poller = threading.Thread(
+        target=poll_server_metrics, args=(base_url, recorder, stop_event, metrics_interval), daemon=True
+    )
+    poller.start()
+    step_start = time.time()
+    end_time = step_start + duration
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        if rate > 0:
+            slots = threading.BoundedSemaphore(concurrency)
+            next_arrival = step_start
+            while True:
+                next_arrival += rng.expovariate(rate)
+                if next_arrival >= end_time:
+                    break
+                time.sleep(max(0.0, next_arrival - time.time()))
+                if not slots.acquire(blocking=False):
+                    # Client-side saturation: count as a dropped arrival
+                    recorder.add(time.time(), 0.0, -1)
+                    continue
+                future = pool.submit(one_request)
+                future.add_done_callback(lambda _: slots.release())
+        else:
+            def client_loop():
+                while time.time() < end_time:
+                    one_request()
+            for _ in range(concurrency):
+                pool.submit(client_loop)
+
+    stop_event.set()
+    poller.join(timeout=1)
+    return summarize(recorder, step_start, time.time(), concurrency, rate)
+
+
+def summarize(recorder, step_start, step_end, concurrency, rate):
+    samples = recorder.samples
+    completed = [s for s in samples if s[2] != -1]
+    ok = [s for s in completed if 200 <= s[2] < 300]
+    latencies = np.array([s[1] for s in ok]) * 1000.0
+    elapsed = max(step_end - step_start, 1e-9)
+
+    status_counts = {}
+    for s in samples:
+        status_counts[str(s[2])] = status_counts.get(str(s[2]), 0) + 1
+
+    timeline = {}
+    for started, latency, status in completed:
+        second = int(started + latency - step_start)
+        bucket = timeline.setdefault(second, {'completed': 0, 'errors': 0, 'latencies': []})
+        bucket['completed'] += 1
+        if 200 <= status < 300:
+            bucket['latencies'].append(latency * 1000.0)
+        else:
+            bucket['errors'] += 1
+    timeline_out = []
+    for second in sorted(timeline):
+        bucket = timeline[second]
+        entry = {'t': second, 'completed': bucket['completed'], 'errors': bucket['errors']}
+        if bucket['latencies']:
+            entry['p50_ms'] = round(float(np.percentile(bucket['latencies'], 50)), 1)
+        timeline_out.append(entry)
+
+    summary = {
+        'concurrency': concurrency,
+        'arrival_rate': rate,
+        'duration_s': round(elapsed, 2),
+        'requests': len(completed),
+        'dropped_arrivals': len(samples) - len(completed),
+        'successes': len(ok),
+        'error_rate': round(1 - len(ok) / len(completed), 4) if completed else 0.0,
+        'throughput_rps': round(len(ok) / elapsed, 3),
+        'status_counts': status_counts,
+        'timeline': timeline_out,
+        'server_metrics': recorder.server_metrics,
+    }
+    if latencies.size:
+        p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+        summary['latency_ms'] = {
+            'mean': round(float(latencies.mean()), 1),
+            'p50': round(float(p50), 1),
+            'p95': round(float(p95), 1),
+            'p99': round(float(p99), 1),
+            'max': round(float(latencies.max()), 1),
+        }
+    return summary
+
+
+def print_step(step):
+    latency = step.get('latency_ms', {})
+    print(
+        f"c={step['concurrency']:<3} rate={step['arrival_rate']:<5} "
+        f"rps={step['throughput_rps']:<7} err={step['error_rate']:<6} "
+        f"p50={latency.get('p50', '-')}ms p95={latency.get('p95', '-')}ms p99={latency.get('p99', '-')}ms"
+    )
+
+
+def command_run(args):
+    corpus = load_corpus(args.corpus)
+    process = None
+    base_url = args.url
+    if base_url is None:
+        process, base_url = start_service(args.port)
+    try:
+        steps = []
+        for concurrency in args.concurrency:
+            step = run_step(
+                base_url, corpus, args.mode, concurrency, args.rate, args.duration,
+                args.timeout, args.metrics_interval, args.seed
+            )
+            print_step(step)
+            steps.append(step)
+            if args.cooldown:
+                time.sleep(args.cooldown)
+        final_metrics = requests.get(f"{base_url}/metrics", timeout=5).json()
+    finally:
+        if process is not None:
+            stop_service(process)
+
+    sustained = [s for s in steps if s['error_rate'] <= args.max_error_rate]
+    report = {
+        'label': args.label,
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'mode': args.mode,
+        'corpus': {'path': os.path.abspath(args.corpus), 'images': len(corpus)},
+        'cpu_count': os.cpu_count(),
+        'steps': steps,
+        'max_sustained_rps': max((s['throughput_rps'] for s in sustained), default=0.0),
+        'final_server_metrics': final_metrics,
+    }
+    os.makedirs(args.output_dir, exist_ok=True)
+    output_path = os.path.join(args.output_dir, f"{args.label}-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    with open(output_path, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Max sustained throughput: {report['max_sustained_rps']} req/s")
+    print(f"Report written to {output_path}")
+
+
+def command_compare(args):
+    reports = []
+    for path in args.reports:
+        with open(path) as f:
+            reports.append(json.load(f))
+    baseline = reports[0]
+    for report in reports:
+        delta = ''
+        if report is not baseline and baseline['max_sustained_rps']:
+            change = report['max_sustained_rps'] / baseline['max_sustained_rps'] - 1
+            delta = f" ({change:+.1%} vs {baseline['label']})"
+        print(f"{report['label']} [{report['created_at']}]: max sustained {report['max_sustained_rps']} req/s{delta}")
+        for step in report['steps']:
+            print('  ', end='')
+            print_step(step)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    run = subparsers.add_parser('run', help='Run a load test')
+    run.add_argument('--corpus', required=True, help='Directory of images to send')
+    run.add_argument('--mode', choices=sorted(SENDERS), default='analyze', help='Endpoint family to exercise')
+    run.add_argument('--concurrency', type=int, nargs='+', default=[1, 2, 4, 8], help='Concurrency levels to step through')
+    run.add_argument('--rate', type=float, default=0.0, help='Poisson arrival rate in req/s (0 = closed loop)')
+    run.add_argument('--duration', type=float, default=30.0, help='Seconds per concurrency step')
+    run.add_argument('--cooldown', type=float, default=2.0, help='Pause between steps')
+    run.add_argument('--timeout', type=float, default=900.0, help='Per-request timeout in seconds')
+    run.add_argument('--metrics-interval', type=float, default=5.0, help='Seconds between /metrics polls')
+    run.add_argument('--max-error-rate', type=float, default=0.01, help='Error rate tolerated for "sustained" throughput')
+    run.add_argument('--url', help='Use an already running service instead of starting one')
+    run.add_argument('--port', type=int, default=5099, help='Port for the spawned service')
+    run.add_argument('--label', default='run', help='Name used in the report file')
+    run.add_argument('--output-dir', default=os.path.join(SERVICE_ROOT, 'benchmarks', 'results'))
+    run.add_argument('--seed', type=int, default=0)
+    run.set_defaults(func=command_run)
+
+    compare = subparsers.add_parser('compare', help='Compare saved reports (first one is the baseline)')
+    compare.add_argument('reports', nargs='+')
+    compare.set_defaults(func=command_compare)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
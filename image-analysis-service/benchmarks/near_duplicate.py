@@ -0,0 +1,161 @@
+# image-analysis-service/benchmarks/near_duplicate.py
+"""
+Near-duplicate index (utils/near_duplicate.py): matching and lookup speed.
+
+Matching: a synthetic diagram is fingerprinted and stored, then queried
+with copies that should reuse its result (JPEG re-saves, downscales and
+upscales, a PNG re-save) and with edits that must not (one changed label,
+an extra box, a different diagram). Reports the hash distance and detail
+mismatch of each.
+
+Scale: --entries random fingerprints are bulk loaded into an on-disk
+index (about 9.2 KB each, mostly detail masks), then queried with random
+hashes (misses) and with stored hashes with a few bits flipped (hits).
+Reports load time and lookup latency percentiles, checks the hits against
+a brute-force scan, and reloads the index from disk.
+
+Exits non-zero on a wrong match decision, a missed hit, or a p99 lookup
+latency above --max-lookup-ms.
+
+Examples:
+    python benchmarks/near_duplicate.py
+    python benchmarks/near_duplicate.py --entries 1000000 --queries 5000
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import cv2
+import numpy as np
+
+from denoise_gate import diagram
+
+SERVICE_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(SERVICE_ROOT, 'src'))
+
+from utils.near_duplicate import (  # noqa: E402
+    DETAIL_BYTES, ImageFingerprint, NearDuplicateIndex, detail_mismatch, fingerprint_image, hamming_distances
+)
+
+
+def _reencode(image, extension, *params):
+    return cv2.imdecode(cv2.imencode(extension, image, list(params))[1], cv2.IMREAD_GRAYSCALE)
+
+
+def _resize(image, factor):
+    interpolation = cv2.INTER_AREA if factor < 1 else cv2.INTER_CUBIC
+    return cv2.resize(image, None, fx=factor, fy=factor, interpolation=interpolation)
+
+
+def variants(original):
+    """(name, image, should match)"""
+    # First box of diagram(): same generator and seed
+    rng = np.random.default_rng(7)
+    x, y = int(rng.integers(0, original.shape[1] - 160)), int(rng.integers(0, original.shape[0] - 80))
+    relabeled = original.copy()
+    cv2.rectangle(relabeled, (x + 8, y + 15), (x + 130, y + 48), 255, -1)
+    cv2.putText(relabeled, 'k*m>7', (x + 10, y + 40), cv2.FONT_HERSHEY_SIMPLEX, 0.9, 20, 2)
+    extra = original.copy()
+    cv2.rectangle(extra, (60, 1000), (200, 1060), 30, 2)
+    other = diagram(1600, 1200, background=245)
+    cv2.line(other, (0, 600), (1600, 600), 0, 3)
+    return [
+        ('jpeg q85', _reencode(original, '.jpg', cv2.IMWRITE_JPEG_QUALITY, 85), True),
+        ('jpeg q50', _reencode(original, '.jpg', cv2.IMWRITE_JPEG_QUALITY, 50), True),
+        ('png re-save', _reencode(original, '.png'), True),
+        ('downscaled 0.5 + jpeg', _reencode(_resize(original, 0.5), '.jpg', cv2.IMWRITE_JPEG_QUALITY, 80), True),
+        ('upscaled 1.5', _resize(original, 1.5), True),
+        ('one label changed', relabeled, False),
+        ('extra box', extra, False),
+        ('other diagram', other, False),
+    ]
+
+
+def check_matching(failures):
+    original = diagram(1600, 1200)
+    index = NearDuplicateIndex()
+    stored = fingerprint_image(original, *original.shape[::-1])
+    index.add(stored, {'file_info': {'filename': 'original.png'}})
+    print(f"{'variant':<24}{'distance':>9}{'mismatch':>9}  match")
+    for name, image, expected in variants(original):
+        fingerprint = fingerprint_image(image, *image.shape[::-1])
+        if fingerprint is None:
+            print(f"{name:<24}not fingerprinted")
+            failures.append(f"{name}: not fingerprinted")
+            continue
+        distance = int(hamming_distances(np.array([stored.hash], np.uint64), fingerprint.hash)[0])
+        matched = index.lookup(fingerprint) is not None
+        print(f"{name:<24}{distance:>9}{detail_mismatch(stored.detail, fingerprint.detail):>9}  {matched}")
+        if matched != expected:
+            failures.append(f"{name}: {'reused' if matched else 'not reused'}")
+
+
+def random_fingerprints(rng, count, start=0):
+    hashes = rng.integers(0, 2 ** 63, count, dtype=np.uint64) * np.uint64(2) + rng.integers(0, 2, count, dtype=np.uint64)
+    detail = bytes(DETAIL_BYTES)
+    return hashes, ((ImageFingerprint(int(h), 1600, 1200, 1.33, detail), {'id': start + i}) for i, h in enumerate(hashes))
+
+
+def check_scale(args, failures):
+    rng = np.random.default_rng(0)
+    with tempfile.TemporaryDirectory() as directory:
+        index = NearDuplicateIndex(directory)
+        start = time.perf_counter()
+        hashes = []
+        for batch_start in range(0, args.entries, 100000):
+            batch, items = random_fingerprints(rng, min(100000, args.entries - batch_start), batch_start)
+            index.add_many(items)
+            hashes.append(batch)
+        hashes = np.concatenate(hashes)
+        print(f"\nbulk load of {args.entries} entries: {time.perf_counter() - start:.1f}s")
+
+        for label, queries in (
+            ('misses', [int(v) for v in rng.integers(0, 2 ** 63, args.queries, dtype=np.uint64)]),
+            ('hits', [int(hashes[i]) ^ (1 << int(rng.integers(64))) ^ (1 << int(rng.integers(64)))
+                      for i in rng.integers(0, args.entries, args.queries)]),
+        ):
+            timings = []
+            for value in queries:
+                fingerprint = ImageFingerprint(value, 1600, 1200, 1.33, bytes(DETAIL_BYTES))
+                begin = time.perf_counter()
+                match = index.lookup(fingerprint)
+                timings.append((time.perf_counter() - begin) * 1000)
+                if label == 'hits' and match is None:
+                    failures.append(f"missed a stored hash at distance <= 2: {value:016x}")
+            p50, p99 = np.percentile(timings, [50, 99])
+            print(f"lookups ({label}): p50 {p50:.3f} ms, p99 {p99:.3f} ms")
+            if p99 > args.max_lookup_ms:
+                failures.append(f"p99 lookup ({label}) {p99:.3f} ms over {args.max_lookup_ms} ms")
+
+        for value in [int(v) for v in rng.integers(0, 2 ** 63, 20, dtype=np.uint64)]:
+            expected = set(np.flatnonzero(hamming_distances(hashes, value) <= index.max_distance).tolist())
+            if set(index.nearest(value)[0].tolist()) != expected:
+                failures.append(f"nearest({value:016x}) differs from a brute-force scan")
+
+        start = time.perf_counter()
+        reloaded = NearDuplicateIndex(directory)
+        print(f"reload from disk: {time.perf_counter() - start:.2f}s, {len(reloaded)} entries")
+        if len(reloaded) != args.entries:
+            failures.append(f"reloaded {len(reloaded)} entries, stored {args.entries}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--entries', type=int, default=200000)
+    parser.add_argument('--queries', type=int, default=2000)
+    parser.add_argument('--max-lookup-ms', type=float, default=1.0)
+    args = parser.parse_args()
+
+    failures = []
+    check_matching(failures)
+    check_scale(args, failures)
+    for failure in failures:
+        print(failure)
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,144 @@
+# image-analysis-service/benchmarks/ocr_engines.py
+"""
+Throughput and accuracy of the OCR engines (utils/ocr_engines.py) on a
+synthetic labeled corpus, to pick the fastest engine that is accurate enough.
+
+The corpus is one-line diagram labels (words, numbers, formulas) rendered
+in three fonts at tiny, normal and large sizes, on white and on a noisy
+scan background, each cropped and rescaled the way region OCR crops them
+(utils/text_regions.region_crops()). For every installed engine it reports:
+
+- load: seconds to import the package and load models (paid once per
+  worker process, see OCR_WARM_ENGINES)
+- batched: crops per second through read_lines(), as region OCR calls it
+- single: crops per second with one read() per crop, for comparison
+- accuracy: 1 - character error rate over the corpus, from read_lines()
+
+Engines whose package is missing (or Tesseract without its binary) are
+skipped. The recommendation is the engine with the highest batched
+throughput among those with at least --min-accuracy.
+
+Exits non-zero if engines were measured and none reached --min-accuracy.
+
+Examples:
+    python benchmarks/ocr_engines.py
+    python benchmarks/ocr_engines.py --engines tesseract,paddleocr --min-accuracy 0.9
+"""
+import argparse
+import os
+import shutil
+import sys
+import time
+
+import cv2
+import numpy as np
+
+from denoise_gate import noisy
+
+SERVICE_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(SERVICE_ROOT, 'src'))
+
+from utils.ocr_engines import ENGINE_CLASSES, TESSERACT, available_engines, get_engine  # noqa: E402
+from utils.text_regions import TextRegion, measure_glyph_height, region_config, region_crops  # noqa: E402
+
+LABELS = (
+    'Input', 'Output 42', 'x+y=2', 'f(x) = 3x - 1', 'Node 17', 'a/b < 5',
+    'Total 1250', 'Step 3: merge', 'sum = 99', 'Cache hit', 'y = mx + b', 'Queue 8',
+)
+FONTS = (cv2.FONT_HERSHEY_SIMPLEX, cv2.FONT_HERSHEY_DUPLEX, cv2.FONT_HERSHEY_COMPLEX)
+# (font scale, thickness): tiny, normal and large labels
+SIZES = ((0.45, 1), (0.9, 2), (2.2, 4))
+
+
+def corpus():
+    """(crop, expected text) for every label, font, size and background"""
+    samples = []
+    for background, sigma in ((255, 0), (232, 8)):
+        for font in FONTS:
+            for scale, thickness in SIZES:
+                for label in LABELS:
+                    (width, height), baseline = cv2.getTextSize(label, font, scale, thickness)
+                    page = np.full((height + baseline + 40, width + 40), background, np.uint8)
+                    cv2.putText(page, label, (20, 20 + height), font, scale, 20, thickness)
+                    if sigma:
+                        page = noisy(page, sigma)
+                    # Padded crop, rescaled by its glyph height as region OCR does
+                    region = TextRegion(16, 16, width + 8, height + baseline + 8, measure_glyph_height(page) or 0.0)
+                    samples.append((region_crops(page, [region])[0], label))
+    return samples
+
+
+def edit_distance(a, b):
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        current = [i]
+        for j, cb in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ca != cb)))
+        previous = current
+    return previous[-1]
+
+
+def accuracy(texts, expected):
+    """1 - character error rate, ignoring whitespace differences"""
+    errors = sum(edit_distance(" ".join(t.split()), e) for t, e in zip(texts, expected))
+    return max(0.0, 1.0 - errors / float(sum(len(e) for e in expected)))
+
+
+def measure(name, samples, repeat):
+    crops, expected = [crop for crop, _ in samples], [text for _, text in samples]
+    config = region_config()
+    start = time.perf_counter()
+    engine = get_engine(name)
+    load = time.perf_counter() - start
+
+    batched, results = None, None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        results = engine.read_lines(crops, config)
+        elapsed = time.perf_counter() - start
+        batched = elapsed if batched is None else min(batched, elapsed)
+
+    start = time.perf_counter()
+    for crop in crops:
+        engine.read(crop, config)
+    single = time.perf_counter() - start
+    return load, len(crops) / batched, len(crops) / single, accuracy([r.text for r in results], expected)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--engines', default=",".join(ENGINE_CLASSES), help="Comma-separated engine names")
+    parser.add_argument('--min-accuracy', type=float, default=0.85)
+    parser.add_argument('--repeat', type=int, default=1, help="Best of N batched timings")
+    args = parser.parse_args()
+
+    samples = corpus()
+    print(f"{len(samples)} labeled crops\n")
+    installed = available_engines()
+    measured = {}
+    print(f"{'engine':<12}{'load':>8}{'batched':>12}{'single':>12}{'accuracy':>10}")
+    for name in args.engines.split(','):
+        if not installed.get(name):
+            print(f"{name:<12}skipped: {ENGINE_CLASSES[name].package if name in ENGINE_CLASSES else name} not installed")
+            continue
+        if name == TESSERACT and shutil.which('tesseract') is None:
+            print(f"{name:<12}skipped: tesseract not on the PATH")
+            continue
+        load, batched, single, score = measure(name, samples, args.repeat)
+        measured[name] = (batched, score)
+        print(f"{name:<12}{load:>7.2f}s{batched:>8.1f}/s  {single:>8.1f}/s  {score:>9.1%}")
+
+    if not measured:
+        print("\nNo engine could be measured")
+        return
+    accurate = [name for name, (_, score) in measured.items() if score >= args.min_accuracy]
+    if not accurate:
+        print(f"\nNo engine reached {args.min_accuracy:.0%} accuracy")
+        sys.exit(1)
+    best = max(accurate, key=lambda name: measured[name][0])
+    print(f"\nFastest engine with at least {args.min_accuracy:.0%} accuracy: {best}"
+          f" (set OCR_ENGINE={best} or name it in OCR_FIDELITY_ENGINES)")
+
+
+if __name__ == '__main__':
+    main()
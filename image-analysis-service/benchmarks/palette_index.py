@@ -0,0 +1,171 @@
+# image-analysis-service/benchmarks/palette_index.py
+"""
+Palette search (utils/palette_index.py): match quality and query speed.
+
+Quality: synthetic charts in distinct color schemes are analyzed with
+analyze_color_distribution() and stored; JPEG re-saves of each are
+analyzed again and queried. Checks that each finds its own chart first
+and reports the palette distances of copies and of other charts.
+
+Scale: --palettes synthetic palettes shaped like real ones (a white or
+tinted background, dark ink in most, one to three accent colors) are bulk
+loaded with rebuild(), then queried three ways: an accent color plus white
+(selective bins), a stored palette with small color changes, and white
+plus black (the most common bins). Reports latency percentiles
+per kind and recall@10 against an exact CIEDE2000 scan of every palette
+(a result counts if it is no farther than the exact 10th: at this scale
+many palettes tie).
+
+Exits non-zero on a chart not found first, recall below --min-recall, or
+p99 latency above --max-search-ms.
+
+Examples:
+    python benchmarks/palette_index.py
+    python benchmarks/palette_index.py --palettes 1000000
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import cv2
+import numpy as np
+
+SERVICE_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(SERVICE_ROOT, 'src'))
+
+from utils.image_processing import analyze_color_distribution  # noqa: E402
+from utils.palette_index import (  # noqa: E402
+    PaletteIndex, bgr_to_lab, document_palette, palette_distances
+)
+
+
+def chart(rng, colors, background):
+    image = np.full((600, 800, 3), background, np.uint8)
+    for i, color in enumerate(colors):
+        top = int(rng.integers(100, 400))
+        cv2.rectangle(image, (80 + i * 160, top), (200 + i * 160, 560), color, -1)
+    cv2.line(image, (60, 560), (760, 560), (20, 20, 20), 3)
+    return image
+
+
+def palette_result(image):
+    return {'color_analysis': analyze_color_distribution(image)}
+
+
+def check_quality(failures):
+    rng = np.random.default_rng(3)
+    index = PaletteIndex()
+    charts = []
+    for number in range(24):
+        colors = [tuple(int(c) for c in rng.integers(0, 256, 3)) for _ in range(int(rng.integers(1, 4)))]
+        background = (255, 255, 255) if number % 3 else tuple(int(c) for c in rng.integers(200, 256, 3))
+        charts.append(chart(rng, colors, background))
+    index.upsert_many((str(number), palette_result(image), None) for number, image in enumerate(charts))
+
+    copies, others = [], []
+    for number, image in enumerate(charts):
+        copy = cv2.imdecode(cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, 70])[1], cv2.IMREAD_COLOR)
+        matches = index.search(document_palette(palette_result(copy)), k=5, max_distance=100)
+        if not matches or matches[0].id != str(number):
+            failures.append(f"chart #{number}: found {[match.to_dict() for match in matches[:2]]}")
+            continue
+        copies.append(matches[0].distance)
+        others.extend(match.distance for match in matches[1:])
+    print(f"{len(charts)} charts: {len(copies)} found first; copy distance max {max(copies or [0]):.2f},"
+          f" nearest other chart min {min(others or [0]):.2f}")
+
+
+def synthetic_palettes(rng, count):
+    """BGR palettes (count x 5 x 3) and how many colors each has"""
+    palettes = np.zeros((count, 5, 3), np.float32)
+    sizes = np.zeros(count, np.int64)
+    tinted = rng.random(count) < 0.2
+    palettes[:, 0] = np.where(tinted[:, None], rng.integers(200, 256, (count, 3)), 255 - rng.integers(0, 6, (count, 1)))
+    sizes[:] = 1
+    ink = rng.random(count) < 0.7
+    palettes[ink, 1] = rng.integers(0, 60, (int(ink.sum()), 1))
+    sizes[ink] += 1
+    for _ in range(3):
+        accent = rng.random(count) < 0.6
+        rows = np.flatnonzero(accent)
+        palettes[rows, sizes[rows]] = rng.integers(0, 256, (len(rows), 3))
+        sizes[rows] += 1
+    return palettes, sizes
+
+
+def exact_top(lab, counts, query, k, max_distance, block=100000):
+    """Exact k nearest distances within max_distance, by a CIEDE2000 scan of every palette"""
+    distances = np.concatenate([
+        palette_distances(lab[:, start:start + block], counts[start:start + block], query)
+        for start in range(0, len(counts), block)
+    ])
+    top = np.sort(np.partition(distances, k)[:k] if len(distances) > k else distances)
+    return top[top <= max_distance]
+
+
+def check_scale(args, failures):
+    rng = np.random.default_rng(0)
+    palettes, sizes = synthetic_palettes(rng, args.palettes)
+    with tempfile.TemporaryDirectory() as directory:
+        index = PaletteIndex(directory)
+        start = time.perf_counter()
+        index.rebuild(
+            (str(i), {'color_analysis': {'color_stats': {'dominant_colors': palettes[i, :sizes[i]].tolist()}}}, None)
+            for i in range(args.palettes)
+        )
+        print(f"\nrebuild of {args.palettes} palettes: {time.perf_counter() - start:.1f}s")
+
+        white = bgr_to_lab([[255, 255, 255]])
+        queries = {
+            'accent + white': [np.concatenate([white, bgr_to_lab(rng.integers(0, 256, (1, 3)))])
+                               for _ in range(args.queries)],
+            'jittered stored': [bgr_to_lab(np.clip(palettes[i, :sizes[i]] + rng.normal(0, 6, (sizes[i], 3)), 0, 255))
+                                for i in rng.integers(0, args.palettes, args.queries)],
+            'white + black': [bgr_to_lab([[255, 255, 255], [int(v)] * 3]) for v in rng.integers(0, 40, args.queries)],
+        }
+        lab, counts = index._lab[:, :index._count], index._counts[:index._count]
+        hits = total = 0
+        for kind, kind_queries in queries.items():
+            timings = []
+            for number, query in enumerate(kind_queries):
+                begin = time.perf_counter()
+                matches = index.search(query, k=10)
+                timings.append(1000 * (time.perf_counter() - begin))
+                if number < args.exact_queries:
+                    # By distance: many synthetic palettes tie, so which ids are the top 10 is arbitrary
+                    expected = exact_top(lab, counts, query, 10, index.max_distance)
+                    total += len(expected)
+                    if len(expected):
+                        hits += min(len(expected), sum(match.distance <= expected[-1] + 1e-6 for match in matches))
+            p50, p99 = np.percentile(timings, [50, 99])
+            print(f"{kind:<16} p50 {p50:.2f} ms, p99 {p99:.2f} ms")
+            if p99 > args.max_search_ms:
+                failures.append(f"{kind}: p99 {p99:.2f} ms over {args.max_search_ms} ms")
+        recall = hits / float(max(1, total))
+        print(f"recall@10 vs exact CIEDE2000 scan: {recall:.3f} of {total}")
+        if recall < args.min_recall:
+            failures.append(f"recall@10 {recall:.3f} below {args.min_recall}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--palettes', type=int, default=1000000)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--exact-queries', type=int, default=5)
+    parser.add_argument('--min-recall', type=float, default=0.9)
+    parser.add_argument('--max-search-ms', type=float, default=50.0)
+    args = parser.parse_args()
+
+    failures = []
+    check_quality(failures)
+    check_scale(args, failures)
+    for failure in failures:
+        print(failure)
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
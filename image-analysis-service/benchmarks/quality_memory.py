@@ -0,0 +1,200 @@
+# image-analysis-service/benchmarks/quality_memory.py
+"""
+Peak-RSS regression check for the quality metric kernels.
+
+Runs the full-resolution quality kernels (blur with a full-frame FFT,
+contrast, brightness, noise, sharpness, edge density, detail, color
+statistics) on a synthetic 24 MP image in a fresh interpreter, once with
+the float32 kernels from utils/image_processing.py and once with the
+float64 kernels they replaced (kept below as the reference). Reports both
+peak RSS growths and checks that the scores agree within
+QUALITY_SCORE_TOLERANCE.
+
+Synthetic sizes are round; pass real files with --compare-image (camera
+JPEGs, exported PNGs at odd sizes) to check the scores on them as well.
+
+Exits non-zero if the current kernels grow RSS past --max-growth-mb or the
+scores disagree.
+
+Examples:
+    python benchmarks/quality_memory.py
+    python benchmarks/quality_memory.py --megapixels 48 --max-growth-mb 640
+    python benchmarks/quality_memory.py --compare-image photo.jpg --compare-image export.png
+"""
+import argparse
+import json
+import math
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import cv2
+import numpy as np
+
+from tiled_quality import RssSampler, current_rss_mb, synthetic_band
+
+SERVICE_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(SERVICE_ROOT, 'src'))
+
+# Absolute tolerance for scores that are close to zero (edge density, contrasts)
+ABSOLUTE_TOLERANCE = 1e-6
+
+
+def reference_scores(image):
+    """The float64 kernels as they were before the float32 rewrite"""
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    f = np.fft.fftshift(np.fft.fft2(gray))
+    blur = (cv2.Laplacian(gray, cv2.CV_64F).var() + np.mean(20 * np.log(np.abs(f)))) / 2
+    del f
+    contrast = (gray.std() + np.sqrt(np.mean(np.square(gray - np.mean(gray))))) / 2
+    hsv = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
+    noise = np.mean([np.std(cv2.GaussianBlur(gray, (3, 3), s) - gray) for s in [1.0, 2.0, 3.0]])
+    dx = cv2.Sobel(gray, cv2.CV_64F, 1, 0)
+    dy = cv2.Sobel(gray, cv2.CV_64F, 0, 1)
+    sharpness = np.mean(np.sqrt(dx * dx + dy * dy))
+    del dx, dy
+    lab = cv2.cvtColor(image, cv2.COLOR_BGR2LAB)
+    return {
+        'blur': float(blur),
+        'contrast': float(contrast),
+        'brightness': float(np.mean(hsv[:, :, 2])),
+        'noise': float(noise),
+        'sharpness': float(sharpness),
+        'edge_density': float(np.mean(cv2.Canny(gray, 100, 200) > 0)),
+        'detail': float(np.mean([np.std(cv2.resize(gray, None, fx=s, fy=s)) for s in (0.5, 1.0, 2.0)])),
+        'saturation': float(np.mean(hsv[:, :, 1])),
+        'value_variance': float(np.var(hsv[:, :, 2])),
+        'mean_rgb': image.mean(axis=(0, 1)).tolist(),
+        'std_rgb': image.std(axis=(0, 1)).tolist(),
+        'mean_lab': lab.mean(axis=(0, 1)).tolist(),
+    }
+
+
+def current_scores(image):
+    """The same quantities from utils/image_processing.py"""
+    from utils.image_processing import (
+        analyze_color_distribution,
+        calculate_blur,
+        calculate_brightness,
+        calculate_contrast,
+        calculate_detail_score,
+        calculate_edge_density,
+        calculate_noise,
+        calculate_sharpness,
+        to_gray,
+    )
+
+    gray = to_gray(image)
+    color = analyze_color_distribution(image, refine_colors=False)
+    return {
+        'blur': float(calculate_blur(gray)),
+        'contrast': float(calculate_contrast(gray)),
+        'brightness': float(calculate_brightness(image)),
+        'noise': float(calculate_noise(gray)),
+        'sharpness': float(calculate_sharpness(gray)),
+        'edge_density': float(calculate_edge_density(gray)),
+        'detail': float(calculate_detail_score(gray)),
+        'saturation': float(color['color_stats']['saturation']),
+        'value_variance': float(color['color_stats']['value_variance']),
+        'mean_rgb': color['color_distribution']['mean_rgb'],
+        'std_rgb': color['color_distribution']['std_rgb'],
+        'mean_lab': color['color_distribution']['mean_lab'],
+    }
+
+
+def child(args):
+    """Runs in a fresh interpreter so only the kernels are measured"""
+    kernels = reference_scores if args.kernels == 'reference' else current_scores
+    image = cv2.imread(args.image, cv2.IMREAD_COLOR)
+    if args.kernels == 'current':
+        # Import outside the measured window
+        import utils.image_processing  # noqa: F401
+    baseline = current_rss_mb()
+    sampler = RssSampler()
+    sampler.start()
+    start = time.time()
+    scores = kernels(image)
+    sampler.stop()
+    print(json.dumps({
+        'seconds': round(time.time() - start, 2),
+        'rss_growth_mb': round(sampler.peak - baseline, 1),
+        'scores': scores,
+    }))
+
+
+def run_child(image, kernels):
+    output = subprocess.check_output([
+        sys.executable, os.path.abspath(__file__), '--child', '--image', image, '--kernels', kernels
+    ])
+    return json.loads(output.decode().strip().splitlines()[-1])
+
+
+def compare(reference, current, tolerance):
+    """Scores (or score components) that differ by more than `tolerance`, relative"""
+    mismatches = {}
+    for name, expected in reference.items():
+        actual = current[name]
+        pairs = zip(expected, actual) if isinstance(expected, list) else [(expected, actual)]
+        for want, got in pairs:
+            if not math.isclose(want, got, rel_tol=tolerance, abs_tol=ABSOLUTE_TOLERANCE):
+                mismatches[name] = (expected, actual)
+    return mismatches
+
+
+def main():
+    from utils.image_processing import QUALITY_SCORE_TOLERANCE
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--megapixels', type=float, default=24)
+    parser.add_argument('--aspect', type=float, default=3 / 2, help="width / height")
+    parser.add_argument('--max-growth-mb', type=float, default=320)
+    parser.add_argument('--compare-image', action='append', default=[],
+                        help="real image to compare scores on (repeatable)")
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--image', help=argparse.SUPPRESS)
+    parser.add_argument('--kernels', choices=('reference', 'current'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args)
+        return
+
+    height = int(math.sqrt(args.megapixels * 1e6 / args.aspect))
+    width = int(args.megapixels * 1e6 / height)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, 'synthetic.png')
+        cv2.imwrite(path, synthetic_band(0, height, width))
+        reports = {kernels: run_child(path, kernels) for kernels in ('reference', 'current')}
+
+    for kernels, report in reports.items():
+        print(f"{kernels:>9}: {report['seconds']:.2f}s, peak RSS growth {report['rss_growth_mb']:.0f} MB")
+    mismatches = compare(reports['reference']['scores'], reports['current']['scores'], QUALITY_SCORE_TOLERANCE)
+    if mismatches:
+        print(f"Scores outside the {QUALITY_SCORE_TOLERANCE:g} tolerance: {json.dumps(mismatches)}")
+    else:
+        print(f"{width}x{height}: scores agree within {QUALITY_SCORE_TOLERANCE:g}")
+
+    for path in args.compare_image:
+        image = cv2.imread(path, cv2.IMREAD_COLOR)
+        if image is None:
+            print(f"{path}: not readable")
+            mismatches[path] = None
+            continue
+        reference, current = reference_scores(image), current_scores(image)
+        worst = abs(current['blur'] - reference['blur']) / abs(reference['blur'])
+        found = compare(reference, current, QUALITY_SCORE_TOLERANCE)
+        print(f"{os.path.basename(path)} ({image.shape[1]}x{image.shape[0]}): blur score off by {worst:.1e},"
+              f" {'outside' if found else 'within'} {QUALITY_SCORE_TOLERANCE:g}"
+              + (f": {json.dumps(found)}" if found else ""))
+        mismatches.update({f"{path}: {name}": values for name, values in found.items()})
+
+    growth = reports['current']['rss_growth_mb']
+    if growth > args.max_growth_mb or mismatches:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
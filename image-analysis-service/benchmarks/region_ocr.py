@@ -0,0 +1,154 @@
+# image-analysis-service/benchmarks/region_ocr.py
+"""
+Whole-image OCR against text-region OCR (utils/text_regions.py).
+
+For sparse diagrams of several sizes, diagrams with tiny and with very
+large labels, and a dense text page, reports the median glyph height, how
+long region detection takes, how many regions and sheets it produces, and
+how many pixels Tesseract is given relative to the image (crops are
+rescaled to OCR_TARGET_GLYPH_HEIGHT, so tiny labels can exceed their own
+area). With Tesseract on the PATH it also times one variant both ways
+(image_to_data + image_to_string on the whole image, as extract_text()
+did, against one image_to_data call per sheet) and prints both texts'
+lengths.
+
+A textured 12 MP photo must be left to whole-image OCR, and merging the
+word boxes of photo-like speckle (--speckle-boxes small boxes and a few
+tall ones) must take under --max-merge-seconds.
+
+Exits non-zero if the sparse diagrams do not use region OCR, if the dense
+page or the photo does, if merging is too slow, or (with Tesseract) if
+region OCR is not faster on the sparse diagrams.
+
+Examples:
+    python benchmarks/region_ocr.py
+"""
+import argparse
+import os
+import shutil
+import sys
+import time
+
+import cv2
+import numpy as np
+
+from denoise_gate import diagram
+
+SERVICE_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(SERVICE_ROOT, 'src'))
+
+from utils.ocr_engines import pack_sheets  # noqa: E402
+from utils.text_regions import (  # noqa: E402
+    TextRegion, find_text_regions, measure_glyph_height, merge_regions, ocr_regions, region_crops
+)
+
+SPARSE_SIZES = ((1600, 1200), (3200, 2400), (4000, 3000))
+
+
+def dense_page(width=1700, height=2200):
+    """A page of body text"""
+    page = np.full((height, width), 255, np.uint8)
+    for y in range(80, height - 60, 34):
+        cv2.putText(page, 'The quick brown fox jumps over the lazy dog 0123456789 x+y=z',
+                    (60, y), cv2.FONT_HERSHEY_SIMPLEX, 0.95, 0, 2)
+    return page
+
+
+def labels(font_scale, thickness, width=2400, height=1500):
+    """Scattered one-line labels of one size"""
+    image = np.full((height, width), 255, np.uint8)
+    for i in range(8):
+        cv2.putText(image, 'Label x+y=2', (80 + i * 290 % 1900, 140 + i * 160),
+                    cv2.FONT_HERSHEY_SIMPLEX, font_scale, 0, thickness)
+    return image
+
+
+def photo(width=4000, height=3000):
+    """Grayscale texture at several scales, like foliage or gravel"""
+    rng = np.random.default_rng(0)
+    image = np.zeros((height, width), np.float32)
+    for scale, weight in ((3, 1.0), (8, 1.0), (64, 0.6), (512, 0.6)):
+        noise = rng.normal(0, 1, (height // scale + 1, width // scale + 1)).astype(np.float32)
+        image += weight * cv2.resize(noise, (width, height), interpolation=cv2.INTER_CUBIC)
+    return cv2.normalize(image, None, 0, 255, cv2.NORM_MINMAX).astype(np.uint8)
+
+
+def speckle_boxes(count, width=4000, height=3000):
+    """Scattered glyph-sized boxes that mostly do not merge, and a few tall ones"""
+    rng = np.random.default_rng(1)
+    boxes = []
+    for _ in range(count):
+        box_width, box_height = int(rng.integers(4, 12)), int(rng.integers(5, 12))
+        boxes.append(TextRegion(int(rng.integers(0, width - box_width)), int(rng.integers(0, height - box_height)),
+                                box_width, box_height))
+    boxes += [TextRegion(int(rng.integers(0, width - 60)), int(rng.integers(0, height - 300)), 60, 300)
+              for _ in range(5)]
+    return boxes
+
+
+def whole_image_ocr(gray):
+    import pytesseract
+    data = pytesseract.image_to_data(gray, output_type=pytesseract.Output.DICT)
+    return pytesseract.image_to_string(gray).strip(), data
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--speckle-boxes', type=int, default=20000)
+    parser.add_argument('--max-merge-seconds', type=float, default=1.0)
+    args = parser.parse_args()
+    has_tesseract = shutil.which('tesseract') is not None
+    if not has_tesseract:
+        print("tesseract not on the PATH: reporting region detection and OCR area only\n")
+
+    cases = [(f"sparse {w}x{h}", diagram(w, h), True) for w, h in SPARSE_SIZES]
+    cases.append(("tiny labels", labels(0.4, 1), True))
+    cases.append(("large labels", labels(3.0, 6), True))
+    cases.append(("dense page", dense_page(), False))
+    cases.append(("photo 4000x3000", photo(), False))
+
+    failures = []
+    print(f"{'image':<20}{'glyph':>6}{'detect':>8}{'regions':>9}{'sheets':>8}{'OCR area':>10}{'whole':>9}{'regions':>9}")
+    for name, gray, sparse in cases:
+        glyph = f"{measure_glyph_height(gray) or 0:.0f}px"
+        start = time.perf_counter()
+        regions = find_text_regions(gray)
+        detect = time.perf_counter() - start
+        if regions is None:
+            print(f"{name:<20}{glyph:>6}{detect:>7.3f}s{'-':>9}{'-':>8}{'100%':>10}")
+            if sparse:
+                failures.append(f"{name}: region OCR not used")
+            continue
+        if not sparse:
+            failures.append(f"{name}: should use whole-image OCR")
+        sheets = pack_sheets(region_crops(gray, regions))
+        area = sum(sheet.size for sheet, _ in sheets) / gray.size
+        line = f"{name:<20}{glyph:>6}{detect:>7.3f}s{len(regions):>9}{len(sheets):>8}{area:>9.0%}"
+        if has_tesseract:
+            start = time.perf_counter()
+            whole_text, _ = whole_image_ocr(gray)
+            whole = time.perf_counter() - start
+            start = time.perf_counter()
+            region_text = ocr_regions(gray, regions).text
+            region = time.perf_counter() - start + detect
+            line += f"{whole:>8.2f}s{region:>8.2f}s  ({len(whole_text)} vs {len(region_text)} chars)"
+            if region >= whole:
+                failures.append(f"{name}: region OCR {region:.2f}s is not faster than {whole:.2f}s")
+        print(line)
+
+    boxes = speckle_boxes(args.speckle_boxes)
+    start = time.perf_counter()
+    merged = merge_regions(boxes)
+    seconds = time.perf_counter() - start
+    print(f"\nmerging {len(boxes)} speckle boxes: {seconds:.2f}s ({len(merged)} boxes after)")
+    if seconds > args.max_merge_seconds:
+        failures.append(f"merging speckle boxes took {seconds:.2f}s, over {args.max_merge_seconds}s")
+
+    for failure in failures:
+        print(failure)
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,220 @@
+# image-analysis-service/benchmarks/similarity_index.py
+"""
+Similar-diagram search (utils/visual_embedding.py, utils/similarity_index.py):
+embedding quality and search latency.
+
+Quality: synthetic diagrams of several kinds (box-and-arrow, bar charts in
+color and gray, pie charts, scatter plots, text pages) are embedded and
+stored; re-encoded, rescaled and re-margined copies of each are then
+queried. Reports how often the original is the top match and how often it
+is within --max-rank (scatter plots of random points, and the two renders
+of the same box-and-arrow layout, are near-identical to each other), the
+similarity of copies and of different diagrams of the same and other
+kinds, and the embedding time per image.
+
+Scale: --vectors synthetic embeddings (clusters around random prototypes,
+non-negative and unit length like real ones) are bulk loaded into an
+on-disk index, which switches to IVF-PQ at --ivf-min-vectors. Queries are
+near the stored vectors. Reports load time, IVF-PQ latency percentiles and
+recall@10 against an exact float32 scan, exhaustive search latency on the
+same vectors, and reload time.
+
+Exits non-zero if a copy ranks its original below --max-rank, recall@10 falls
+below --min-recall, or p99 IVF-PQ latency exceeds --max-search-ms.
+
+Examples:
+    python benchmarks/similarity_index.py
+    python benchmarks/similarity_index.py --vectors 1000000 --queries 500
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import cv2
+import numpy as np
+
+from denoise_gate import diagram
+from symbol_detect import page
+
+SERVICE_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(SERVICE_ROOT, 'src'))
+
+from utils.similarity_index import SimilarityIndex  # noqa: E402
+from utils.visual_embedding import EMBEDDING_DIM, compute_embedding, embedding_vector  # noqa: E402
+
+
+def bar_chart(seed, color=True):
+    rng = np.random.default_rng(seed)
+    image = np.full((900, 1200, 3), 255, np.uint8)
+    cv2.line(image, (80, 820), (1150, 820), (0, 0, 0), 2)
+    cv2.line(image, (80, 820), (80, 60), (0, 0, 0), 2)
+    for i in range(int(rng.integers(4, 10))):
+        fill = tuple(int(c) for c in rng.integers(0, 220, 3)) if color else (90, 90, 90)
+        cv2.rectangle(image, (120 + i * 100, 820 - int(rng.integers(100, 700))), (180 + i * 100, 820), fill, -1)
+    return image
+
+
+def pie_chart(seed):
+    rng = np.random.default_rng(seed)
+    image = np.full((900, 900, 3), 255, np.uint8)
+    start = 0
+    for _ in range(int(rng.integers(3, 7))):
+        end = start + int(rng.integers(30, 120))
+        fill = tuple(int(c) for c in rng.integers(0, 255, 3))
+        cv2.ellipse(image, (450, 450), (350, 350), 0, start, end, fill, -1)
+        start = end
+    cv2.ellipse(image, (450, 450), (350, 350), 0, start, 360, (200, 200, 200), -1)
+    return image
+
+
+def scatter_plot(seed):
+    rng = np.random.default_rng(seed)
+    image = np.full((800, 1000), 255, np.uint8)
+    for _ in range(int(rng.integers(80, 300))):
+        cv2.circle(image, (int(rng.integers(50, 950)), int(rng.integers(50, 750))), 4, 0, -1)
+    return image
+
+
+def corpus():
+    """(kind, image)"""
+    rng = np.random.default_rng(1)
+    images = [('flow', diagram(1600, 1200)), ('flow', diagram(1200, 900, background=240))]
+    images += [('bars', bar_chart(seed)) for seed in range(3)]
+    images += [('bars_gray', bar_chart(seed, color=False)) for seed in range(3, 6)]
+    images += [('pie', pie_chart(seed)) for seed in range(3)]
+    images += [('scatter', scatter_plot(seed)) for seed in range(3)]
+    images += [('text', page(20, rng)[0]) for _ in range(3)]
+    return images
+
+
+def copies(image):
+    """(name, copy) the original should be found from"""
+    def reencode(img, quality):
+        return cv2.imdecode(cv2.imencode('.jpg', img, [cv2.IMWRITE_JPEG_QUALITY, quality])[1], cv2.IMREAD_UNCHANGED)
+    margin = cv2.copyMakeBorder(image, 120, 120, 200, 200, cv2.BORDER_CONSTANT, value=(255, 255, 255))
+    return [
+        ('jpeg q60', reencode(image, 60)),
+        ('half size', cv2.resize(image, None, fx=0.5, fy=0.5, interpolation=cv2.INTER_AREA)),
+        ('double size', cv2.resize(image, None, fx=2, fy=2, interpolation=cv2.INTER_CUBIC)),
+        ('wider margin', margin),
+    ]
+
+
+def check_quality(args, failures):
+    index = SimilarityIndex()
+    images = corpus()
+    seconds = []
+    for number, (kind, image) in enumerate(images):
+        start = time.perf_counter()
+        embedding = compute_embedding(image)
+        seconds.append(time.perf_counter() - start)
+        index.upsert(str(number), embedding_vector(embedding), {'kind': kind})
+
+    vectors = np.array([index.vector(str(number)) for number in range(len(images))])
+    kinds = [kind for kind, _ in images]
+    same = [float(vectors[i] @ vectors[j]) for i in range(len(images)) for j in range(i) if kinds[i] == kinds[j]]
+    other = [float(vectors[i] @ vectors[j]) for i in range(len(images)) for j in range(i) if kinds[i] != kinds[j]]
+
+    first, within, copy_scores = 0, 0, []
+    total = 0
+    for number, (kind, image) in enumerate(images):
+        for name, copy in copies(image):
+            total += 1
+            matches = index.search(embedding_vector(compute_embedding(copy)), k=args.max_rank)
+            ids = [match.id for match in matches]
+            first += ids[0] == str(number)
+            if str(number) in ids:
+                within += 1
+                copy_scores.append(matches[ids.index(str(number))].score)
+            else:
+                failures.append(f"{kind} #{number} {name}: original not in the top {args.max_rank}"
+                                f" (best {matches[0].meta['kind']} #{matches[0].id})")
+    print(f"{len(images)} diagrams, {total} copies: original ranked first for {first},"
+          f" within the top {args.max_rank} for {within}")
+    print(f"similarity: copies min {min(copy_scores or [0]):.3f}, same kind mean {np.mean(same):.3f},"
+          f" other kinds mean {np.mean(other):.3f} (max {max(other):.3f})")
+    print(f"embedding: {1000 * np.mean(seconds):.0f} ms per image (p99 {1000 * np.percentile(seconds, 99):.0f} ms)")
+
+
+def synthetic_vectors(rng, prototypes, count, spread=0.35):
+    """Unit, non-negative vectors around random prototypes"""
+    vectors = prototypes[rng.integers(0, len(prototypes), count)]
+    vectors = np.abs(vectors + rng.normal(0, spread / np.sqrt(EMBEDDING_DIM), vectors.shape).astype(np.float32))
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def timed_searches(index, queries, k=10):
+    results, timings = [], []
+    for query in queries:
+        start = time.perf_counter()
+        results.append(index.search(query, k=k))
+        timings.append(1000 * (time.perf_counter() - start))
+    return results, np.percentile(timings, [50, 99])
+
+
+def check_scale(args, failures):
+    rng = np.random.default_rng(0)
+    prototypes = np.abs(rng.normal(size=(max(1, args.vectors // 200), EMBEDDING_DIM))).astype(np.float32)
+    prototypes /= np.linalg.norm(prototypes, axis=1, keepdims=True)
+    with tempfile.TemporaryDirectory() as directory:
+        index = SimilarityIndex(directory, ivf_min_vectors=args.ivf_min_vectors, probes=args.probes)
+        start = time.perf_counter()
+        for batch_start in range(0, args.vectors, 100000):
+            count = min(100000, args.vectors - batch_start)
+            vectors = synthetic_vectors(rng, prototypes, count)
+            index.upsert_many((str(batch_start + i), vectors[i], None) for i in range(count))
+        stats = index.stats()
+        print(f"\nbulk load of {args.vectors} vectors: {time.perf_counter() - start:.1f}s"
+              f" ({stats['search']}, {stats['lists']} lists)")
+
+        queries = synthetic_vectors(rng, prototypes, args.queries)
+        results, (p50, p99) = timed_searches(index, queries)
+        stored = np.asarray(index._matrix(), np.float32)
+        exact = np.argsort(-(stored @ queries.T), axis=0)[:10].T
+        recall = np.mean([
+            len({int(match.id) for match in found} & set(truth.tolist())) / 10.0
+            for found, truth in zip(results, exact)
+        ])
+        print(f"{stats['search']}: p50 {p50:.2f} ms, p99 {p99:.2f} ms, recall@10 {recall:.3f}")
+        if recall < args.min_recall:
+            failures.append(f"recall@10 {recall:.3f} below {args.min_recall}")
+        if p99 > args.max_search_ms:
+            failures.append(f"p99 search {p99:.2f} ms over {args.max_search_ms} ms")
+
+        exhaustive = SimilarityIndex(directory, ivf_min_vectors=args.vectors + 1)
+        exhaustive._quantizer = None
+        _, (p50, p99) = timed_searches(exhaustive, queries[:max(1, args.queries // 10)])
+        print(f"exhaustive: p50 {p50:.2f} ms, p99 {p99:.2f} ms")
+
+        start = time.perf_counter()
+        reloaded = SimilarityIndex(directory, ivf_min_vectors=args.ivf_min_vectors, probes=args.probes)
+        print(f"reload from disk: {time.perf_counter() - start:.2f}s, {len(reloaded)} vectors"
+              f" ({reloaded.stats()['search']})")
+        if len(reloaded) != args.vectors:
+            failures.append(f"reloaded {len(reloaded)} vectors, stored {args.vectors}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--max-rank', type=int, default=3)
+    parser.add_argument('--vectors', type=int, default=200000)
+    parser.add_argument('--queries', type=int, default=500)
+    parser.add_argument('--ivf-min-vectors', type=int, default=50000)
+    parser.add_argument('--probes', type=int, default=16)
+    parser.add_argument('--min-recall', type=float, default=0.9)
+    parser.add_argument('--max-search-ms', type=float, default=20.0)
+    args = parser.parse_args()
+
+    failures = []
+    check_quality(args, failures)
+    check_scale(args, failures)
+    for failure in failures:
+        print(failure)
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,186 @@
+# image-analysis-service/benchmarks/symbol_detect.py
+"""
+Accuracy and speed of the connected-component symbol detector
+(utils/symbol_detect.py) on synthetic formula pages.
+
+Each page holds a few lines of words and numbers in OpenCV's Hershey fonts
+mixed with math symbols, at one text height. Symbols are drawn from the
+detector's own stroke descriptions, but with stroke widths and slants
+between those of its templates and after resampling to the page scale,
+so the symbols of SYMBOL_SHAPES are scored on shapes close to what they
+were built from; '+-*/=<>' also come from the fonts. Pages cover several
+text heights, with and without scan noise.
+
+For each page set it reports, against the symbols placed on the page:
+
+- precision and recall of the symbols reported without OCR
+- recall once ambiguous glyphs are counted as found (an upper bound for
+  the OCR fallback)
+- ambiguous glyphs per page (glyphs the OCR fallback has to read)
+- false symbols per page on pages of text only
+- detection time per page, and legacy multi-variant OCR time when
+  Tesseract is installed
+
+Exits non-zero if precision or recall falls below --min-precision or
+--min-recall, or text-only pages average more than --max-false false
+symbols.
+
+Examples:
+    python benchmarks/symbol_detect.py
+    python benchmarks/symbol_detect.py --pages 40 --heights 14,24,40
+"""
+import argparse
+import os
+import shutil
+import string
+import sys
+import time
+
+import cv2
+import numpy as np
+
+from denoise_gate import noisy
+
+SERVICE_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(SERVICE_ROOT, 'src'))
+
+from utils.symbol_detect import (  # noqa: E402
+    _TEMPLATE_SCALE, SYMBOL_ALIASES, SYMBOL_SHAPES, _draw_shape, detect_symbols
+)
+from utils.ocr_engines import get_engine  # noqa: E402
+from utils.text_extract import MATH_SYMBOLS_PATTERN, _ocr_math_symbols, preprocess_image_for_ocr  # noqa: E402
+
+ALPHANUMERIC = string.ascii_letters + string.digits
+WORDS = ('x', 'y', 'f(x)', 'a', 'b', 'n', '2', '10', 'k', 'sin', 'log', 'Node', 'i', 'j', 'sum', '42', 'T', 'p')
+FONTS = (cv2.FONT_HERSHEY_SIMPLEX, cv2.FONT_HERSHEY_DUPLEX, cv2.FONT_HERSHEY_COMPLEX)
+# Off-template stroke widths (units of text height) and slants
+STROKES = (0.09, 0.13)
+SLANTS = (0.0, 0.08)
+
+
+def _font_scale(font, height, thickness):
+    """Font scale giving capital letters `height` pixels"""
+    return height / float(cv2.getTextSize('H', font, 1.0, thickness)[0][1])
+
+
+def page(height, rng, lines=4, tokens=9, symbol_rate=0.4):
+    """(grayscale page, set of symbols on it)"""
+    width = int(tokens * height * 2.6)
+    image = np.full((int(lines * height * 3 + height), width), 255, np.uint8)
+    symbols = set()
+    font = FONTS[rng.integers(len(FONTS))]
+    thickness = max(1, int(round(height / 12.0)))
+    scale = _font_scale(font, height, thickness)
+    shapes = list(SYMBOL_SHAPES)
+    for line in range(lines):
+        baseline = int((line + 1) * height * 3)
+        x = height
+        for _ in range(tokens):
+            if rng.random() < symbol_rate:
+                char = shapes[rng.integers(len(shapes))]
+                mask = _draw_shape(SYMBOL_SHAPES[char], STROKES[rng.integers(2)], SLANTS[rng.integers(2)])
+                factor = height / float(_TEMPLATE_SCALE)
+                mask = cv2.resize(mask, None, fx=factor, fy=factor, interpolation=cv2.INTER_AREA)
+                glyph_h, glyph_w = mask.shape
+                top = int(baseline - height / 2.0 - glyph_h / 2.0)
+                if x + glyph_w >= width or top < 0:
+                    break
+                region = image[top:top + glyph_h, x:x + glyph_w]
+                np.minimum(region, 255 - mask, out=region)
+                symbols.add(SYMBOL_ALIASES.get(char, char))
+                x += glyph_w + int(height * 0.5)
+            else:
+                word = WORDS[rng.integers(len(WORDS))]
+                if rng.random() < 0.5:
+                    word = ''.join(rng.choice(list(ALPHANUMERIC), rng.integers(1, 8)))
+                elif symbol_rate and rng.random() < 0.4:
+                    word = '+-*/=<>'[rng.integers(7)]
+                    symbols.add(word)
+                text_w = cv2.getTextSize(word, font, scale, thickness)[0][0]
+                if x + text_w >= width:
+                    break
+                cv2.putText(image, word, (x, baseline), font, scale, 0, thickness, cv2.LINE_AA)
+                x += text_w + int(height * 0.5)
+    return image, symbols
+
+
+def score(pages, detect):
+    """Counts over pages: true/false positives, misses, misses covered by ambiguous glyphs"""
+    counts = {'tp': 0, 'fp': 0, 'fn': 0, 'ambiguous': 0, 'seconds': 0.0}
+    for image, expected in pages:
+        start = time.perf_counter()
+        detection = detect(image)
+        counts['seconds'] += time.perf_counter() - start
+        found = set(detection.symbols) if detection else set()
+        counts['tp'] += len(found & expected)
+        counts['fp'] += len(found - expected)
+        counts['fn'] += len(expected - found)
+        counts['ambiguous'] += len(detection.ambiguous) if detection else 0
+    return counts
+
+
+def legacy_seconds(pages):
+    """Seconds per page for the previous multi-variant OCR path, or None"""
+    if shutil.which('tesseract') is None:
+        return None
+    start = time.perf_counter()
+    for image, _ in pages:
+        _ocr_math_symbols(preprocess_image_for_ocr(None, image=image), None, get_engine(None))
+    return (time.perf_counter() - start) / len(pages)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--pages', type=int, default=20, help="Pages per text height and noise level")
+    parser.add_argument('--heights', default='12,20,32', help="Comma-separated text heights in pixels")
+    parser.add_argument('--min-precision', type=float, default=0.9)
+    parser.add_argument('--min-recall', type=float, default=0.8)
+    parser.add_argument('--max-false', type=float, default=0.5, help="False symbols per text-only page")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    missing = [c for c in MATH_SYMBOLS_PATTERN[1:-1].replace('\\', '') if c not in SYMBOL_SHAPES
+               and c not in SYMBOL_ALIASES.values()]
+    if missing:
+        print(f"No template for: {''.join(missing)}")
+
+    rng = np.random.default_rng(args.seed)
+    detect_symbols(np.full((64, 64), 255, np.uint8))  # build templates outside the timings
+    failures = []
+    print(f"{'height':>6} {'noise':>5} {'precision':>10} {'recall':>7} {'+ambig':>7} {'ambig/page':>11}"
+          f" {'ms/page':>8} {'legacy ms':>10}")
+    for height in (int(h) for h in args.heights.split(',')):
+        for sigma in (0, 12):
+            pages = []
+            for i in range(args.pages):
+                image, expected = page(height, rng)
+                pages.append((noisy(image, sigma, seed=i) if sigma else image, expected))
+            counts = score(pages, detect_symbols)
+            precision = counts['tp'] / float(max(1, counts['tp'] + counts['fp']))
+            recall = counts['tp'] / float(max(1, counts['tp'] + counts['fn']))
+            upper = min(1.0, (counts['tp'] + counts['ambiguous']) / float(max(1, counts['tp'] + counts['fn'])))
+            legacy = legacy_seconds(pages)
+            print(f"{height:>6} {sigma:>5} {precision:>10.1%} {recall:>7.1%} {upper:>7.1%}"
+                  f" {counts['ambiguous'] / float(len(pages)):>11.1f} {1000 * counts['seconds'] / len(pages):>8.1f}"
+                  f" {'-' if legacy is None else f'{1000 * legacy:.0f}':>10}")
+            if precision < args.min_precision:
+                failures.append(f"height {height}, noise {sigma}: precision {precision:.1%}")
+            if recall < args.min_recall:
+                failures.append(f"height {height}, noise {sigma}: recall {recall:.1%}")
+
+    print(f"\n{'height':>6} {'false symbols/text-only page':>30}")
+    for height in (int(h) for h in args.heights.split(',')):
+        counts = score([page(height, rng, symbol_rate=0) for _ in range(args.pages)], detect_symbols)
+        false_rate = counts['fp'] / float(args.pages)
+        print(f"{height:>6} {false_rate:>30.2f}")
+        if false_rate > args.max_false:
+            failures.append(f"height {height}: {false_rate:.2f} false symbols per text-only page")
+
+    for failure in failures:
+        print(failure)
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
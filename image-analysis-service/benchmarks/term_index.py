@@ -0,0 +1,213 @@
+# image-analysis-service/benchmarks/term_index.py
+"""
+Autocomplete (utils/term_index.py): suggestion accuracy and lookup speed.
+
+--documents synthetic diagram texts (Zipf-distributed words from a
+generated vocabulary, on lines of one to four words, plus symbols) are
+loaded with rebuild() (terms and snapshot in a process pool of --workers),
+then queried with prefixes of stored terms, one to eight characters, picked
+by how common the terms are. Suggestions are checked against counts taken
+directly from the documents (same terms and counts, same order). Fuzzy
+queries are stored words with one letter replaced or two swapped, typed to
+six characters; reports how often the word is suggested.
+
+Then --updates documents are upserted one at a time and some deleted
+(changes since the snapshot), checked again, the index reloaded from its
+memory-mapped files and checked once more.
+
+Exits non-zero on a suggestion that differs from the direct counts, p99
+prefix lookup above --max-suggest-ms, or fuzzy hits below --min-fuzzy-hits.
+
+Examples:
+    python benchmarks/term_index.py
+    python benchmarks/term_index.py --documents 1000000 --workers 8
+"""
+import argparse
+import bisect
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+SERVICE_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(SERVICE_ROOT, 'src'))
+
+from utils.term_index import TermIndex, document_terms  # noqa: E402
+
+SYLLABLES = [c + v for c in 'bcdfghklmnprstvz' for v in 'aeiou'] + ['tion', 'ment', 'er', 'in', 'al']
+SYMBOLS = ['∑', '∫', '√', 'π', '≤', '≥', '→', 'α', 'β', 'Δ', '∞', '±']
+
+
+def vocabulary(rng, size):
+    words = set()
+    while len(words) < size:
+        words.add(''.join(rng.choice(SYLLABLES, int(rng.integers(1, 5)))))
+    words = sorted(words)
+    rng.shuffle(words)
+    return words
+
+
+class Corpus:
+    def __init__(self, rng, words):
+        self.rng = rng
+        self.words = np.array(words)
+        weights = np.cumsum(1.0 / np.arange(1, len(words) + 1) ** 1.1)
+        self.cumulative = weights / weights[-1]
+
+    def document(self):
+        lines = []
+        for _ in range(int(self.rng.integers(5, 25))):
+            picks = np.searchsorted(self.cumulative, self.rng.random(int(self.rng.integers(1, 5))))
+            lines.append(' '.join(self.words[picks]).capitalize())
+        symbols = sorted(set(self.rng.choice(SYMBOLS, int(self.rng.integers(0, 3)))))
+        return {'text': '\n'.join(lines), 'symbols': symbols}
+
+
+class DirectCounts:
+    """Term counts kept straight from the documents"""
+
+    def __init__(self):
+        self.counts = {}
+        self.documents = {}
+        self._sorted = None
+
+    def set(self, item_id, document):
+        for term in self.documents.pop(item_id, ()):
+            self.counts[term] -= 1
+        terms = set(document_terms(document)) if document else set()
+        if terms:
+            self.documents[item_id] = terms
+        for term in terms:
+            self.counts[term] = self.counts.get(term, 0) + 1
+        self._sorted = None
+
+    def suggest(self, prefix, limit):
+        if self._sorted is None:
+            self._sorted = sorted(term for term, count in self.counts.items() if count > 0)
+        start = bisect.bisect_left(self._sorted, prefix)
+        end = bisect.bisect_left(self._sorted, prefix + '\U0010ffff')
+        ranked = sorted(self._sorted[start:end], key=lambda term: (-self.counts[term], term))
+        return [(term, self.counts[term]) for term in ranked[:limit]]
+
+
+def prefixes(rng, direct, count):
+    terms = [term for term, number in direct.counts.items() if number > 0]
+    weights = np.array([direct.counts[term] for term in terms], np.float64)
+    picks = rng.choice(len(terms), count, p=weights / weights.sum())
+    return [terms[i][:int(rng.integers(1, 9))] for i in picks]
+
+
+def check_exact(index, direct, queries, label, failures):
+    wrong = 0
+    for prefix in queries:
+        found = [(match.term, match.count) for match in index.suggest(prefix, 10, fuzzy=False)]
+        expected = direct.suggest(prefix, 10)
+        if found != expected:
+            wrong += 1
+            if wrong <= 3:
+                failures.append(f"{label}: {prefix!r} suggested {found[:4]}, counts give {expected[:4]}")
+    print(f"{label}: {len(queries) - wrong} of {len(queries)} prefixes match the direct counts")
+
+
+def timed(index, queries, **options):
+    timings, results = [], []
+    for prefix in queries:
+        start = time.perf_counter()
+        results.append(index.suggest(prefix, 10, **options))
+        timings.append(1000 * (time.perf_counter() - start))
+    return results, np.percentile(timings, [50, 99])
+
+
+def typo(rng, word, typed):
+    """The first `typed` letters of a word, with one letter replaced or two swapped after the first"""
+    letters = list(word[:typed])
+    position = int(rng.integers(1, typed - 1))
+    if rng.random() < 0.5:
+        letters[position], letters[position + 1] = letters[position + 1], letters[position]
+    else:
+        letters[position] = 'x' if letters[position] != 'x' else 'q'
+    return ''.join(letters)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--documents', type=int, default=200000)
+    parser.add_argument('--vocabulary', type=int, default=200000)
+    parser.add_argument('--queries', type=int, default=2000)
+    parser.add_argument('--exact-queries', type=int, default=300)
+    parser.add_argument('--updates', type=int, default=2000)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--max-suggest-ms', type=float, default=1.0)
+    parser.add_argument('--min-fuzzy-hits', type=float, default=0.9)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    corpus = Corpus(rng, vocabulary(rng, args.vocabulary))
+    documents = [corpus.document() for _ in range(args.documents)]
+    direct = DirectCounts()
+    for number, document in enumerate(documents):
+        direct.set(str(number), document)
+    failures = []
+
+    with tempfile.TemporaryDirectory() as directory:
+        index = TermIndex(directory)
+        start = time.perf_counter()
+        index.rebuild(((str(number), document) for number, document in enumerate(documents)), workers=args.workers)
+        sizes = sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory)
+                    if not name.startswith('document'))
+        print(f"rebuild of {args.documents} documents with {args.workers} workers:"
+              f" {time.perf_counter() - start:.1f}s, {index.stats()['terms']} terms,"
+              f" snapshot {sizes / 2 ** 20:.1f} MiB")
+
+        queries = prefixes(rng, direct, args.queries)
+        _, (p50, p99) = timed(index, queries, fuzzy=False)
+        print(f"prefix lookups: p50 {p50:.3f} ms, p99 {p99:.3f} ms")
+        if p99 > args.max_suggest_ms:
+            failures.append(f"p99 prefix lookup {p99:.3f} ms over {args.max_suggest_ms} ms")
+        check_exact(index, direct, queries[:args.exact_queries], "snapshot", failures)
+
+        words = [word for word in corpus.words[:5000] if len(word) >= 7]
+        targets = [words[i] for i in rng.integers(0, len(words), min(args.queries, 500))]
+        results, (p50, p99) = timed(index, [typo(rng, word, 6) for word in targets])
+        hits = np.mean([target in {match.term for match in found} for target, found in zip(targets, results)])
+        print(f"fuzzy lookups: p50 {p50:.3f} ms, p99 {p99:.3f} ms, word suggested for {hits:.1%}")
+        if hits < args.min_fuzzy_hits:
+            failures.append(f"fuzzy hits {hits:.3f} below {args.min_fuzzy_hits}")
+
+        timings = []
+        for number in range(args.updates):
+            item_id = f"new-{number}"
+            document = corpus.document()
+            if number % 4 == 0:
+                # New words, absent from the snapshot
+                document['text'] += f"\nNovel{number} term{number} diagram"
+            begin = time.perf_counter()
+            index.upsert(item_id, document)
+            if number % 5 == 0:
+                index.delete(str(number))
+            timings.append(1000 * (time.perf_counter() - begin))
+            direct.set(item_id, document)
+            if number % 5 == 0:
+                direct.set(str(number), None)
+        print(f"upserts: p50 {np.percentile(timings, 50):.3f} ms, p99 {np.percentile(timings, 99):.3f} ms"
+              f" ({index.stats()['changed_terms']} terms changed since the snapshot)")
+        queries = prefixes(rng, direct, args.queries) + ['novel', 'term1']
+        _, (p50, p99) = timed(index, queries, fuzzy=False)
+        print(f"prefix lookups with changes: p50 {p50:.3f} ms, p99 {p99:.3f} ms")
+        check_exact(index, direct, queries[:args.exact_queries] + queries[-2:], "with changes", failures)
+
+        start = time.perf_counter()
+        reloaded = TermIndex(directory)
+        print(f"reload: {time.perf_counter() - start:.2f}s, {len(reloaded)} documents")
+        check_exact(reloaded, direct, queries[:args.exact_queries] + queries[-2:], "reloaded", failures)
+
+    for failure in failures:
+        print(failure)
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
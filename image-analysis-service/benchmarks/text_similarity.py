@@ -0,0 +1,178 @@
+# image-analysis-service/benchmarks/text_similarity.py
+"""
+Similar-text search (utils/text_similarity.py): match quality and speed.
+
+Quality: synthetic diagram texts (labels drawn from a vocabulary plus a
+few equations, with their symbols) are stored, then queried with redrawn
+versions (same labels in another order), OCR-noisy versions (3% of the
+letters swapped for confusable ones, one label dropped) and unrelated
+texts. Reports the estimated similarity of each kind and checks that every
+redrawn or noisy version finds its original and no unrelated text is
+returned.
+
+Scale: --documents synthetic texts are loaded with rebuild() (signatures in
+a process pool of --workers), then queried with noisy versions of stored
+texts. Reports rebuild time, query latency percentiles and recall against
+an exact scan of the signatures, incremental insert and delete latency,
+and reload time.
+
+Exits non-zero on a missed or false match, recall below --min-recall, or
+p99 query latency above --max-search-ms.
+
+Examples:
+    python benchmarks/text_similarity.py
+    python benchmarks/text_similarity.py --documents 1000000 --workers 8
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+SERVICE_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(SERVICE_ROOT, 'src'))
+
+from utils.text_similarity import TextSimilarityIndex, document_signature  # noqa: E402
+
+WORDS = (
+    "input output layer hidden node edge graph tree root leaf queue stack buffer cache server client request "
+    "response database index table row column key value hash map filter sort merge split join loop branch "
+    "start end decision process data flow control signal clock memory cpu register bus network packet router "
+    "switch cell membrane nucleus protein enzyme light energy glucose oxygen carbon force mass velocity "
+    "acceleration time distance angle triangle circle radius area volume matrix vector gradient loss weight"
+).split()
+EQUATIONS = ['E = mc^2', 'F = ma', 'a^2 + b^2 = c^2', 'y = mx + b', 'sum x_i / n', 'dy/dx = 2x', 'x <= 10',
+             'P(A|B)', 'sqrt(2)', 'pi r^2', 'v = d / t', 'alpha + beta', 'lim n -> inf']
+SYMBOLS = ['∑', '∫', '√', 'π', '≤', '≥', '→', 'α', 'β', 'Δ', '∞', '±', '×', '÷', '^']
+CONFUSABLE = {'l': '1', 'o': '0', 'i': 'l', 's': '5', 'e': 'c', 'b': '6', 'g': '9', 'a': 'o'}
+
+
+def random_document(rng):
+    labels = [' '.join(rng.choice(WORDS, int(rng.integers(1, 4)))) for _ in range(int(rng.integers(4, 14)))]
+    labels += list(rng.choice(EQUATIONS, int(rng.integers(0, 3)), replace=False))
+    symbols = sorted(set(rng.choice(SYMBOLS, int(rng.integers(0, 5)))))
+    return labels, symbols
+
+
+def as_document(labels, symbols):
+    return {'text_result': '\n'.join(labels), 'symbols_result': list(symbols)}
+
+
+def redrawn(rng, labels, symbols):
+    """Same labels read in another order"""
+    return [labels[i] for i in rng.permutation(len(labels))], symbols
+
+
+def ocr_noise(rng, labels, symbols, rate=0.03):
+    """Characters swapped for a confusable one at `rate` and one label dropped"""
+    noisy = []
+    for label in labels:
+        noisy.append(''.join(
+            CONFUSABLE[char] if char in CONFUSABLE and rng.random() < rate else char for char in label
+        ))
+    if len(noisy) > 4:
+        del noisy[int(rng.integers(len(noisy)))]
+    return noisy, symbols
+
+
+def check_quality(failures):
+    rng = np.random.default_rng(1)
+    index = TextSimilarityIndex()
+    originals = [random_document(rng) for _ in range(300)]
+    index.insert_many((str(number), as_document(*document), None) for number, document in enumerate(originals))
+    scores = {'redrawn': [], 'ocr noise': [], 'unrelated': []}
+    for number, (labels, symbols) in enumerate(originals[:100]):
+        for kind, variant in (('redrawn', redrawn(rng, labels, symbols)),
+                              ('ocr noise', ocr_noise(rng, *redrawn(rng, labels, symbols)))):
+            matches = index.search(document_signature(as_document(*variant)), k=3)
+            found = [match for match in matches if match.id == str(number)]
+            if not found:
+                failures.append(f"{kind} #{number}: original not found ({[m.to_dict() for m in matches]})")
+            else:
+                scores[kind].append(found[0].similarity)
+        unrelated = random_document(rng)
+        matches = index.search(document_signature(as_document(*unrelated)), k=1, min_similarity=0)
+        scores['unrelated'].append(matches[0].similarity if matches else 0.0)
+        if index.search(document_signature(as_document(*unrelated)), k=1):
+            failures.append(f"unrelated text #{number} matched {matches[0].to_dict()}")
+    for kind, values in scores.items():
+        values = values or [0.0]
+        print(f"{kind:<10} similarity: min {min(values):.3f}, mean {np.mean(values):.3f}, max {max(values):.3f}")
+
+
+def check_scale(args, failures):
+    rng = np.random.default_rng(0)
+    originals = [random_document(rng) for _ in range(args.documents)]
+    with tempfile.TemporaryDirectory() as directory:
+        index = TextSimilarityIndex(directory)
+        start = time.perf_counter()
+        stored, _ = index.rebuild(
+            ((str(number), as_document(*document), None) for number, document in enumerate(originals)),
+            workers=args.workers
+        )
+        print(f"\nrebuild of {stored} documents with {args.workers} workers: {time.perf_counter() - start:.1f}s")
+
+        picks = rng.integers(0, args.documents, args.queries)
+        queries = [document_signature(as_document(*ocr_noise(rng, *redrawn(rng, *originals[i])))) for i in picks]
+        timings, results = [], []
+        for signature in queries:
+            begin = time.perf_counter()
+            results.append(index.search(signature, k=10))
+            timings.append(1000 * (time.perf_counter() - begin))
+        p50, p99 = np.percentile(timings, [50, 99])
+        print(f"queries: p50 {p50:.3f} ms, p99 {p99:.3f} ms")
+        if p99 > args.max_search_ms:
+            failures.append(f"p99 query {p99:.3f} ms over {args.max_search_ms} ms")
+
+        # Exact: every stored signature scored against the first queries
+        signatures = np.asarray(index._signatures())
+        hits = total = 0
+        for signature, found in zip(queries[:args.exact_queries], results):
+            similarities = (signatures == signature).mean(axis=1)
+            expected = set(np.flatnonzero(similarities >= index.min_similarity).tolist())
+            total += len(expected)
+            hits += len(expected & {int(match.id) for match in found})
+        recall = hits / float(max(1, total))
+        print(f"recall vs exact scan (similarity >= {index.min_similarity}): {recall:.3f} of {total}")
+        if recall < args.min_recall:
+            failures.append(f"recall {recall:.3f} below {args.min_recall}")
+
+        timings = []
+        for number in range(200):
+            labels, symbols = random_document(rng)
+            begin = time.perf_counter()
+            index.insert(f"new-{number}", as_document(labels, symbols))
+            index.delete(str(number))
+            timings.append(1000 * (time.perf_counter() - begin))
+        print(f"insert + delete: p50 {np.percentile(timings, 50):.3f} ms, p99 {np.percentile(timings, 99):.3f} ms")
+
+        start = time.perf_counter()
+        reloaded = TextSimilarityIndex(directory)
+        print(f"reload from disk: {time.perf_counter() - start:.2f}s, {len(reloaded)} documents")
+        if len(reloaded) != len(index):
+            failures.append(f"reloaded {len(reloaded)} documents, stored {len(index)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--documents', type=int, default=200000)
+    parser.add_argument('--queries', type=int, default=1000)
+    parser.add_argument('--exact-queries', type=int, default=100)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--min-recall', type=float, default=0.95)
+    parser.add_argument('--max-search-ms', type=float, default=5.0)
+    args = parser.parse_args()
+
+    failures = []
+    check_quality(failures)
+    check_scale(args, failures)
+    for failure in failures:
+        print(failure)
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+# image-analysis-service/benchmarks/textract_stub.py
+"""
+Local stand-in for AWS Textract's DetectDocumentText, for running the cloud
+OCR client (utils/cloud_ocr.py) without an AWS account.
+
+Speaks the JSON protocol boto3 uses (POST with X-Amz-Target). Each call
+answers, after --latency seconds, one LINE block with the size of the image
+it received and a hash of its bytes, so callers can check what was
+uploaded. Every --throttle-every'th call fails with ThrottlingException.
+GET /stats returns call counts, the peak number of concurrent calls and the
+largest upload seen.
+
+Examples:
+    python benchmarks/textract_stub.py --port 4566
+    TEXTRACT_ENDPOINT_URL=http://localhost:4566 python src/app.py
+"""
+import argparse
+import base64
+import hashlib
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import cv2
+import numpy as np
+
+
+class StubState:
+    def __init__(self, latency=0.05, throttle_every=0):
+        self.latency = latency
+        self.throttle_every = throttle_every
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.throttled = 0
+        self.active = 0
+        self.peak_active = 0
+        self.max_bytes = 0
+        self.max_side = 0
+
+    def stats(self):
+        with self.lock:
+            return {
+                'calls': self.calls, 'throttled': self.throttled, 'peak_active': self.peak_active,
+                'max_bytes': self.max_bytes, 'max_side': self.max_side,
+            }
+
+
+def make_handler(state):
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def _send(self, status, body):
+            payload = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/x-amz-json-1.1')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def do_GET(self):
+            self._send(200, state.stats())
+
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+            if self.headers.get('X-Amz-Target') != 'Textract.DetectDocumentText':
+                self._send(400, {'__type': 'UnknownOperationException', 'message': 'Not supported by the stub'})
+                return
+            data = base64.b64decode(body['Document']['Bytes'])
+            with state.lock:
+                state.calls += 1
+                throttle = state.throttle_every and state.calls % state.throttle_every == 0
+                state.throttled += bool(throttle)
+                state.active += 1
+                state.peak_active = max(state.peak_active, state.active)
+            try:
+                time.sleep(state.latency)
+                if throttle:
+                    self._send(400, {'__type': 'ThrottlingException', 'message': 'Rate exceeded'})
+                    return
+                image = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_UNCHANGED)
+                if image is None:
+                    self._send(400, {'__type': 'UnsupportedDocumentException', 'message': 'Bad image'})
+                    return
+                height, width = image.shape[:2]
+                with state.lock:
+                    state.max_bytes = max(state.max_bytes, len(data))
+                    state.max_side = max(state.max_side, width, height)
+                text = f"{width}x{height} {hashlib.sha256(data).hexdigest()[:12]}"
+                self._send(200, {
+                    'DocumentMetadata': {'Pages': 1},
+                    'Blocks': [
+                        {'BlockType': 'PAGE', 'Id': 'page'},
+                        {'BlockType': 'LINE', 'Id': 'line-1', 'Text': text, 'Confidence': 99.0},
+                    ],
+                })
+            finally:
+                with state.lock:
+                    state.active -= 1
+
+    return Handler
+
+
+def start_stub(port=0, latency=0.05, throttle_every=0):
+    """Serve the stub on a background thread; returns (server, state, endpoint URL)"""
+    state = StubState(latency, throttle_every)
+    server = ThreadingHTTPServer(('127.0.0.1', port), make_handler(state))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, state, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port', type=int, default=4566)
+    parser.add_argument('--latency', type=float, default=0.3, help="Seconds per call")
+    parser.add_argument('--throttle-every', type=int, default=0, help="Throttle every Nth call (0 = never)")
+    args = parser.parse_args()
+    server, _, url = start_stub(args.port, args.latency, args.throttle_every)
+    print(f"Textract stub on {url}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,299 @@
+# image-analysis-service/benchmarks/tiled_quality.py
+"""
+Memory-ceiling check for the tiled quality analysis.
+
+Writes a synthetic drawing-like image band by band (so the generator itself
+never holds the full image) as PPM, deflate TIFF in strips and PNG, plus a
+JPEG encoded from the PPM (the only step that holds the full image, in this
+process). Each file is analyzed in a fresh interpreter and the peak RSS
+growth compared against the configured ceiling. Expected outcomes:
+
+  - PPM is read straight from disk, TIFF strip by strip;
+  - JPEG is decoded at reduced scale if it would not fit, and reports it;
+  - PNG is refused if its decode would not fit.
+
+Small images are analyzed with both the in-memory and the tiled path to
+check that the merged metrics agree.
+
+Exits non-zero if the ceiling is exceeded, a file is refused or decoded at
+reduced scale unexpectedly, or the metrics disagree.
+
+Examples:
+    python benchmarks/tiled_quality.py --megapixels 200 --max-memory-mb 512
+    python benchmarks/tiled_quality.py --megapixels 50 --formats ppm,tiff --keep /tmp/synthetic
+"""
+import argparse
+import json
+import math
+import os
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zlib
+
+import numpy as np
+
+SERVICE_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(SERVICE_ROOT, 'src'))
+
+# Relative tolerance between tiled and in-memory scores on the check image
+SCORE_TOLERANCE = 0.01
+
+FORMATS = ('ppm', 'tiff', 'png', 'jpeg')
+
+# Rows per TIFF strip, as scanners and libtiff write them
+TIFF_ROWS_PER_STRIP = 64
+
+
+def synthetic_band(y0, rows, width, seed=0):
+    """Paper-white band with grid lines, filled boxes, text-like strokes and scan noise"""
+    rng = np.random.default_rng(seed + y0)
+    band = np.full((rows, width, 3), 245, dtype=np.uint8)
+    ys = np.arange(y0, y0 + rows)
+    band[ys % 400 < 3] = (40, 40, 40)
+    band[:, np.arange(width) % 500 < 3] = (40, 40, 40)
+    # Colored blocks every 1200 px
+    block = ((ys // 1200) % 3)[:, None]
+    in_block = ((np.arange(width) // 1200) % 4 == 1)[None, :] & ((ys % 1200) < 300)[:, None]
+    colors = np.array([(200, 80, 60), (60, 160, 90), (70, 90, 210)], dtype=np.uint8)
+    band[in_block] = np.broadcast_to(colors[block], (rows, width, 3))[in_block]
+    # Short dark strokes standing in for text
+    strokes = rng.random((rows, -(-width // 8))) < 0.01
+    band[np.repeat(strokes, 8, axis=1)[:, :width]] = (20, 20, 20)
+    noise = rng.integers(-6, 7, size=(rows, width, 1), dtype=np.int16)
+    return np.clip(band.astype(np.int16) + noise, 0, 255).astype(np.uint8)
+
+
+def write_synthetic_ppm(path, width, height, band_rows=256):
+    """Stream a binary PPM to disk without materializing the full image"""
+    with open(path, 'wb') as f:
+        f.write(f"P6\n{width} {height}\n255\n".encode('ascii'))
+        for y0 in range(0, height, band_rows):
+            rows = min(band_rows, height - y0)
+            # PPM stores RGB; the band is generated in BGR order
+            f.write(synthetic_band(y0, rows, width)[:, :, ::-1].tobytes())
+
+
+def write_synthetic_tiff(path, width, height, band_rows=256):
+    """Stream a deflate-compressed RGB TIFF in strips, with the IFD at the end"""
+    offsets, byte_counts = [], []
+    with open(path, 'wb') as f:
+        f.write(b'II*\x00\x00\x00\x00\x00')
+        for y0 in range(0, height, band_rows):
+            band = synthetic_band(y0, min(band_rows, height - y0), width)[:, :, ::-1]
+            for s0 in range(0, band.shape[0], TIFF_ROWS_PER_STRIP):
+                data = zlib.compress(band[s0:s0 + TIFF_ROWS_PER_STRIP].tobytes(), 6)
+                offsets.append(f.tell())
+                byte_counts.append(len(data))
+                f.write(data)
+
+        arrays_at = f.tell()
+        f.write(struct.pack('<3H', 8, 8, 8))
+        f.write(struct.pack(f'<{len(offsets)}I', *offsets))
+        f.write(struct.pack(f'<{len(byte_counts)}I', *byte_counts))
+        strips_at = arrays_at + 6
+        # (tag, type, count, value): SHORT = 3, LONG = 4
+        entries = [
+            (256, 4, 1, width), (257, 4, 1, height), (258, 3, 3, arrays_at), (259, 3, 1, 8),
+            (262, 3, 1, 2), (273, 4, len(offsets), strips_at), (277, 3, 1, 3),
+            (278, 4, 1, TIFF_ROWS_PER_STRIP), (279, 4, len(offsets), strips_at + 4 * len(offsets)),
+        ]
+        if len(offsets) == 1:
+            entries[5] = (273, 4, 1, offsets[0])
+            entries[8] = (279, 4, 1, byte_counts[0])
+        ifd_at = f.tell()
+        f.write(struct.pack('<H', len(entries)))
+        for tag, tag_type, count, value in entries:
+            f.write(struct.pack('<HHII', tag, tag_type, count, value))
+        f.write(struct.pack('<I', 0))
+        f.seek(4)
+        f.write(struct.pack('<I', ifd_at))
+
+
+def write_synthetic_png(path, width, height, band_rows=256):
+    """Stream an RGB PNG: unfiltered rows, one IDAT chunk per band"""
+    def chunk(f, kind, data):
+        f.write(struct.pack('>I', len(data)) + kind + data)
+        f.write(struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff))
+
+    compressor = zlib.compressobj(6)
+    with open(path, 'wb') as f:
+        f.write(b'\x89PNG\r\n\x1a\n')
+        chunk(f, b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0))
+        for y0 in range(0, height, band_rows):
+            band = synthetic_band(y0, min(band_rows, height - y0), width)[:, :, ::-1]
+            rows = np.concatenate([np.zeros((band.shape[0], 1), np.uint8), band.reshape(band.shape[0], -1)], axis=1)
+            chunk(f, b'IDAT', compressor.compress(rows.tobytes()))
+        chunk(f, b'IDAT', compressor.flush())
+        chunk(f, b'IEND', b'')
+
+
+def write_jpeg_from(ppm_path, path):
+    """Re-encode the PPM as JPEG; holds the full image in this process"""
+    import cv2
+
+    if not cv2.imwrite(path, cv2.imread(ppm_path), [cv2.IMWRITE_JPEG_QUALITY, 90]):
+        raise ValueError(f"Could not write {path}")
+
+
+def current_rss_mb():
+    """Resident set size from /proc (Linux)"""
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+
+
+class RssSampler(threading.Thread):
+    """Polls RSS while the analysis runs. ru_maxrss is not used because the
+    import of cv2/numpy already sets a high-water mark above the baseline."""
+
+    def __init__(self, interval=0.005):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.peak = current_rss_mb()
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            self.peak = max(self.peak, current_rss_mb())
+            time.sleep(self.interval)
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+        self.peak = max(self.peak, current_rss_mb())
+
+
+def child(args):
+    """Runs in a fresh interpreter so only this analysis is measured"""
+    from PIL import Image
+    from utils.tiled_quality import analyze_image_quality_tiled
+
+    # The service raises PIL's pixel limit the same way (see utils/pipeline.py)
+    Image.MAX_IMAGE_PIXELS = None
+    baseline = current_rss_mb()
+    sampler = RssSampler()
+    sampler.start()
+    start = time.time()
+    try:
+        result = analyze_image_quality_tiled(args.image, mode=args.mode, max_memory_mb=args.max_memory_mb)
+    except ValueError as e:
+        result = {'refused': str(e)}
+    sampler.stop()
+    report = {
+        'seconds': round(time.time() - start, 2),
+        'baseline_rss_mb': round(baseline, 1),
+        'peak_rss_mb': round(sampler.peak, 1),
+    }
+    for key in ('quality_scores', 'tiling', 'refused'):
+        if key in result:
+            report[key] = result[key]
+    print(json.dumps(report))
+
+
+def run_child(image, mode, max_memory_mb):
+    output = subprocess.check_output([
+        sys.executable, os.path.abspath(__file__), '--child',
+        '--image', image, '--mode', mode, '--max-memory-mb', str(max_memory_mb)
+    ])
+    return json.loads(output.decode().strip().splitlines()[-1])
+
+
+def check_agreement(tmp_dir, mode):
+    """Compare tiled against in-memory scores on small images that fit either way"""
+    import cv2
+    from utils.image_processing import analyze_image_quality
+    from utils.tiled_quality import analyze_image_quality_tiled
+
+    png_path = os.path.join(tmp_dir, 'check.png')
+    cv2.imwrite(png_path, synthetic_band(0, 1800, 2400))
+    tiff_path = os.path.join(tmp_dir, 'check.tif')
+    write_synthetic_tiff(tiff_path, 2400, 1800)
+    mismatches = {}
+    for path in (png_path, tiff_path):
+        reference = analyze_image_quality(path, mode=mode)['quality_scores']
+        # A small ceiling forces many strips
+        tiled = analyze_image_quality_tiled(path, mode=mode, max_memory_mb=32)['quality_scores']
+        for name, value in reference.items():
+            if not math.isclose(value, tiled[name], rel_tol=SCORE_TOLERANCE, abs_tol=0.01):
+                mismatches[f"{os.path.basename(path)} {name}"] = (value, tiled[name])
+    return mismatches
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--megapixels', type=float, default=200)
+    parser.add_argument('--aspect', type=float, default=4 / 3, help="width / height")
+    parser.add_argument('--max-memory-mb', type=float, default=512)
+    parser.add_argument('--mode', choices=('full', 'fast'), default='fast')
+    parser.add_argument('--formats', default=','.join(FORMATS), help="Comma-separated subset of " + ', '.join(FORMATS))
+    parser.add_argument('--keep', help="Write the synthetic images into this directory and keep them")
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--image', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args)
+        return
+
+    formats = [name for name in args.formats.split(',') if name]
+    unknown = set(formats) - set(FORMATS)
+    if unknown:
+        parser.error(f"Unknown formats: {', '.join(sorted(unknown))}")
+    height = int(math.sqrt(args.megapixels * 1e6 / args.aspect))
+    width = int(args.megapixels * 1e6 / height)
+    # The one-off decode gets half the ceiling, at 3 bytes per pixel
+    fits_decoded = width * height * 3 <= args.max_memory_mb * 1024 * 1024 / 2
+
+    failures = []
+    reports = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        mismatches = check_agreement(tmp_dir, args.mode)
+        if mismatches:
+            failures.append(f"Tiled metrics disagree with in-memory analysis: {mismatches}")
+        else:
+            print("Tiled metrics agree with in-memory analysis")
+
+        directory = args.keep or tmp_dir
+        os.makedirs(directory, exist_ok=True)
+        ppm_path = os.path.join(directory, 'synthetic.ppm')
+        writers = {
+            'ppm': (ppm_path, write_synthetic_ppm),
+            'tiff': (os.path.join(directory, 'synthetic.tif'), write_synthetic_tiff),
+            'png': (os.path.join(directory, 'synthetic.png'), write_synthetic_png),
+            'jpeg': (os.path.join(directory, 'synthetic.jpg'), lambda path, w, h: write_jpeg_from(ppm_path, path)),
+        }
+        if 'jpeg' in formats and 'ppm' not in formats:
+            write_synthetic_ppm(ppm_path, width, height)
+        for name in sorted(formats, key=FORMATS.index):
+            path, write = writers[name]
+            start = time.time()
+            write(path, width, height)
+            print(f"Wrote {name} {width}x{height} ({width * height / 1e6:.0f} MP, "
+                  f"{os.path.getsize(path) / 1e6:.0f} MB) in {time.time() - start:.1f}s")
+            reports[name] = run_child(path, args.mode, args.max_memory_mb)
+
+    for name, report in reports.items():
+        growth = report['peak_rss_mb'] - report['baseline_rss_mb']
+        print(f"{name}: {json.dumps(report, indent=2)}")
+        print(f"{name}: peak RSS growth {growth:.0f} MB against a ceiling of {args.max_memory_mb:.0f} MB")
+        if growth > args.max_memory_mb:
+            failures.append(f"{name}: memory ceiling exceeded ({growth:.0f} MB)")
+        if 'refused' in report and not (name == 'png' and not fits_decoded):
+            failures.append(f"{name}: refused unexpectedly: {report['refused']}")
+        if name == 'png' and not fits_decoded and 'refused' not in report:
+            failures.append(f"{name}: decoded above the ceiling instead of being refused")
+        scale = report.get('quality_scores', {}).get('analysis_scale')
+        if scale is not None and not (name == 'jpeg' and not fits_decoded):
+            failures.append(f"{name}: analyzed at reduced scale {scale} unexpectedly")
+
+    for failure in failures:
+        print(failure)
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
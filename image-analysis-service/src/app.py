@@ -1,25 +1,53 @@
 # image-analysis-service/src/app.py
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, json
 import cv2
 import numpy as np
 # import pytesseract
 import os
 import logging
-from utils.image_processing import analyze_image_quality
-from utils.text_extract import extract_text, extract_math_symbols
-from utils.diagram_features import extract_diagram_features,DiagramType
+from utils.pipeline import run_analysis, InvalidImageError, DEFAULT_STAGES
+from utils.metrics import metrics
+from utils.job_queue import JobQueue, QueueFullError
+from utils.admission import AdmissionController, read_image_header
+from utils.fidelity import FidelityPolicy
+from utils.deadline import Deadline, budget_seconds
+from utils.documents import analyze_document_page, is_multipage_document, page_header, probe_document
+from utils.ocr_engines import available_engines
+from utils.cloud_ocr import get_textract
+from utils.near_duplicate import fingerprint_file, get_near_duplicate_index
+from utils.similarity_index import get_similarity_index
+from utils.visual_embedding import embedding_vector
+from utils.text_similarity import document_signature, get_text_similarity_index
+from utils.palette_index import document_palette, get_palette_index
+from utils.term_index import SUGGEST_MAX, get_term_index
+import config
+import subprocess
 import traceback
-from PIL import Image
+import time
 import io
+import queue
+import shutil
 import uuid
+from collections import deque
 
 
 import pytesseract
-import boto3
 
 app = Flask(__name__)
 
 UPLOAD_FOLDER = "uploads"
+
+# Optional per-request time budget in milliseconds
+DEADLINE_HEADER = 'X-Deadline-Ms'
+# Optional form field or query argument naming the OCR engine (utils/ocr_engines.py)
+OCR_ENGINE_PARAM = 'ocr_engine'
+# Optional form field or query argument; '0' analyzes even if a near-duplicate was analyzed before
+NEAR_DUPLICATE_PARAM = 'near_duplicates'
+# Results per /similar query: default and most allowed
+SIMILAR_DEFAULT_RESULTS = 10
+SIMILAR_MAX_RESULTS = 100
+# The /similar* upsert endpoints store this many lines at a time
+SIMILAR_UPSERT_BATCH = 10000
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
 # Configure logging with more details
@@ -29,146 +57,38 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-def safe_analyze_image_quality(image_path):
-    """Wrapper for analyze_image_quality with error handling"""
-    # Special handling for SVG files
-    if image_path.lower().endswith('.svg'):
-        logger.info(f"SVG file detected: {image_path}. Using default quality values.")
-        # Return default quality values for SVG files since they're vector graphics
-        return {
-            'basic_metrics': {
-                'resolution': "Vector",
-                'aspect_ratio': "1.0",
-                'file_size_mb': os.path.getsize(image_path) / (1024 * 1024),
-                'dimensions': {
-                    'width': 800,  # Default display width
-                    'height': 600,  # Default display height
-                    'megapixels': 0  # SVGs don't have pixels
-                }
-            },
-            'quality_scores': {
-                'overall_quality': 90,  # Vector graphics are typically high quality
-                'blur_score': 100,
-                'contrast_score': 85,
-                'brightness_score': 85,
-                'noise_level': 0,
-                'sharpness': 100,
-                'edge_density': 0.7,
-                'detail_score': 90
-            },
-            'color_analysis': {
-                'color_distribution': {
-                    'mean_rgb': [128, 128, 128],
-                    'mean_hsv': [0, 0, 128],
-                    'mean_lab': [50, 0, 0],
-                    'std_rgb': [50, 50, 50]
-                },
-                'color_stats': {
-                    'dominant_colors': [[0, 0, 0], [255, 255, 255], [128, 128, 128]]
-                }
-            }
-        }
-    
-    # Original implementation for raster images
-    try:
-        return analyze_image_quality(image_path)
-    except Exception as e:
-        logger.error(f"Error in analyze_image_quality: {str(e)}")
-        logger.error(traceback.format_exc())
-        # Return default values
-        return {
-            'basic_metrics': {
-                'resolution': "800x600",
-                'aspect_ratio': "1.33",
-                'file_size_mb': os.path.getsize(image_path) / (1024 * 1024),
-                'dimensions': {
-                    'width': 800,
-                    'height': 600,
-                    'megapixels': 0.48
-                }
-            },
-            'quality_scores': {
-                'overall_quality': 50,
-                'blur_score': 50,
-                'contrast_score': 50,
-                'brightness_score': 50,
-                'noise_level': 5,
-                'sharpness': 50,
-                'edge_density': 0.5,
-                'detail_score': 50
-            },
-            'color_analysis': {
-                'color_distribution': {
-                    'mean_rgb': [128, 128, 128],
-                    'mean_hsv': [0, 0, 128],
-                    'mean_lab': [50, 0, 0],
-                    'std_rgb': [50, 50, 50]
-                },
-                'color_stats': {
-                    'dominant_colors': [[128, 128, 128], [0, 0, 0], [255, 255, 255]]
-                }
-            }
-        }
-
-
-
-def safe_extract_math_symbols(image_path):
-    """Safely extract math symbols with error handling"""
-    try:
-        symbols_result = extract_math_symbols(image_path)
-        if isinstance(symbols_result, dict) and 'error' in symbols_result:
-            # logger.warning(f"Symbol extraction warning: {symbols_result['error']}")
-            return []
-        if not isinstance(symbols_result, list):
-            return []
-        return symbols_result
-    except Exception as e:
-        logger.error(f"Error in math symbol extraction: {str(e)}")
-        logger.error(traceback.format_exc())
-        return []
-
-def assign_quality_label(score):
-    """Assigns a Low, Medium, or High rating based on quality score."""
-    if score >= 80:
-        return "High"
-    elif score >= 50:
-        return "Medium"
-    else:
-        return "Low"
-
-def is_image_valid(file_path):
-    """Check if the image is valid and can be opened"""
-    # Special handling for SVG files
-    if file_path.lower().endswith('.svg'):
-        try:
-            # For SVG files, we just check if the file exists and is not empty
-            file_size = os.path.getsize(file_path)
-            if file_size > 0:
-                return True
-            else:
-                logger.error(f"SVG file exists but is empty: {file_path}")
-                return False
-        except Exception as e:
-            logger.error(f"Error checking SVG file: {str(e)}")
-            return False
-    else:
-        # For other image formats, use PIL
-        try:
-            with Image.open(file_path) as img:
-                img.verify()
-            return True
-        except Exception as e:
-            logger.error(f"Invalid image file: {str(e)}")
-            return False
-
+# Separate worker pools so small uploads never queue behind large scans
+job_queues = {
+    'fast': JobQueue(
+        max_workers=config.JOB_FAST_WORKERS,
+        max_queue_depth=config.JOB_MAX_QUEUE_DEPTH,
+        result_ttl=config.JOB_RESULT_TTL_SECONDS,
+        max_wait=config.JOB_MAX_WAIT_SECONDS
+    ),
+    'heavy': JobQueue(
+        max_workers=config.JOB_HEAVY_WORKERS,
+        max_queue_depth=config.JOB_HEAVY_MAX_QUEUE_DEPTH,
+        result_ttl=config.JOB_RESULT_TTL_SECONDS,
+        max_wait=config.JOB_MAX_WAIT_SECONDS
+    ),
+}
+admission = AdmissionController(
+    budget=config.ADMISSION_COST_BUDGET,
+    fast_lane_max_cost=config.FAST_LANE_MAX_COST,
+    fast_lane_reserve=config.FAST_LANE_RESERVED_COST
+)
+fidelity_policy = FidelityPolicy(
+    degrade_queue=config.FIDELITY_DEGRADE_QUEUE_FILL,
+    recover_queue=config.FIDELITY_RECOVER_QUEUE_FILL,
+    degrade_latency=config.FIDELITY_DEGRADE_LATENCY_SECONDS,
+    recover_latency=config.FIDELITY_RECOVER_LATENCY_SECONDS,
+    min_dwell=config.FIDELITY_MIN_DWELL_SECONDS,
+    enabled=config.FIDELITY_ADAPTIVE
+)
 
 def extract_text_with_textract(image_path):
-     """Use AWS Textract instead of Tesseract for OCR."""
-     with open(image_path, "rb") as f:
-         img_bytes = f.read()
-     resp = textract.detect_document_text(Document={"Bytes": img_bytes})
-     lines = [b["Text"] for b in resp["Blocks"] if b["BlockType"] == "LINE"]
-     return "\n".join(lines).strip()
+    """Use AWS Textract instead of Tesseract for OCR (pooled and cached, see utils/cloud_ocr.py)."""
+    return get_textract().detect_file(image_path).text
 
 
 
@@ -179,7 +99,28 @@ def root():
         'service': 'image-analysis',
         'endpoints': [
             {'path': '/health', 'method': 'GET'},
-            {'path': '/analyze', 'method': 'POST'}
+            {'path': '/metrics', 'method': 'GET'},
+            {'path': '/analyze', 'method': 'POST'},
+            {'path': '/documents', 'method': 'POST'},
+            {'path': '/ocr', 'method': 'POST'},
+            {'path': '/jobs', 'method': 'POST'},
+            {'path': '/jobs/<job_id>', 'method': 'GET'},
+            {'path': '/near-duplicates/export', 'method': 'GET'},
+            {'path': '/near-duplicates/import', 'method': 'POST'},
+            {'path': '/similar', 'method': 'POST'},
+            {'path': '/similar/upsert', 'method': 'POST'},
+            {'path': '/similar-text', 'method': 'POST'},
+            {'path': '/similar-text/upsert', 'method': 'POST'},
+            {'path': '/similar-text/rebuild', 'method': 'POST'},
+            {'path': '/similar-text/<id>', 'method': 'DELETE'},
+            {'path': '/similar-palette', 'method': 'POST'},
+            {'path': '/similar-palette/upsert', 'method': 'POST'},
+            {'path': '/similar-palette/rebuild', 'method': 'POST'},
+            {'path': '/similar-palette/<id>', 'method': 'DELETE'},
+            {'path': '/autocomplete', 'method': 'GET'},
+            {'path': '/autocomplete/upsert', 'method': 'POST'},
+            {'path': '/autocomplete/rebuild', 'method': 'POST'},
+            {'path': '/autocomplete/<id>', 'method': 'DELETE'}
         ]
     })
 # image-analysis-service/src/app.py - Update the analyze endpoint
@@ -233,118 +174,70 @@ def analyze():
     # Log file information
     logger.info(f"Processing file: {image.filename}, Content type: {image.content_type}, Size: {image.content_length} bytes")
     
+    try:
+        deadline = Deadline.from_milliseconds(
+            request.headers.get(DEADLINE_HEADER), config.ANALYSIS_DEADLINE_SECONDS
+        )
+    except ValueError:
+        return jsonify({'error': f"{DEADLINE_HEADER} must be a number of milliseconds"}), 400
+    try:
+        ocr_engine = _requested_ocr_engine()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
     # Create unique path to avoid collisions
     filename = f"{uuid.uuid4()}-{image.filename}"
     image_path = os.path.join(UPLOAD_FOLDER, filename)
+
+    request_start = time.perf_counter()
+    metrics.request_started()
     
     try:
         # Save the image
         image.save(image_path)
         logger.info(f"Image saved at {image_path}")
-        
-        # Check if the file is saved correctly
-        if not os.path.exists(image_path):
-            raise Exception("File was not saved correctly")
-            
-        # Check file size
-        file_size = os.path.getsize(image_path)
-        logger.debug(f"Saved file size: {file_size} bytes")
-        if file_size == 0:
-            raise Exception("File is empty (0 bytes)")
-        
-        # Check if the image is valid - this now handles SVG files specially
-        is_svg = image_path.lower().endswith('.svg')
-        if not is_image_valid(image_path):
-            if is_svg:
-                logger.warning(f"SVG file could not be validated, but will try to process anyway: {image_path}")
-            else:
-                return jsonify({
-                    'error': 'Invalid image file. Could not be processed as an image.',
-                    'basic_metrics': {
-                        'dimensions': {'width': 0, 'height': 0, 'megapixels': 0}
-                    },
-                    'quality_scores': {
-                        'overall_quality': 0
-                    },
-                    'text_result': "",
-                    'symbols_result': []
-                }), 400
-                
-                
-        # try:
-          
-
-
-
-
-        #         diagram_data = extract_diagram_features(image_path)
-        #         # Convert to serializable dict
-        #         diagram_features = diagram_data.to_dict()
-        #         dt = diagram_data.diagram_type
-        #         if isinstance(dt, DiagramType):
-        #             diagram_features["diagram_type"] = dt.value
-
-        #         logger.info("diagram_features: %r", diagram_features)          
-
-        # except Exception as diag_err:
-        #         logger.error("Diagram extraction failed: %s", diag_err, exc_info=True)
-        #         # You might want to set diagram_features to an empty or error dict here
-        #         diagram_features = {}
 
+        if is_multipage_document(image_path):
+            # The page stream takes over the upload; the cleanup below finds nothing
+            result = _document_response(image_path, image.filename, deadline, ocr_engine)
+            return result
 
+        fingerprint = _near_duplicate_fingerprint(image_path, ocr_engine)
+        if fingerprint is not None and request.values.get(NEAR_DUPLICATE_PARAM) != '0':
+            reused = _reuse_near_duplicate(fingerprint, image.filename)
+            if reused is not None:
+                result = reused
+                return jsonify(result)
 
-
-
-        # try:
-        #     text_result = extract_text_with_textract(image_path)
-        #     logger.info(f"Textract OCR completed: {len(text_result)} characters")
-        # except Exception as text_error:
-        #     logger.error(f"Text extraction failed completely: {str(text_error)}")
-        #     logger.error(traceback.format_exc())
-        #     text_result = ""
-        
-        # Extract symbols - for SVG, this will likely return empty
         try:
-            symbols_result = safe_extract_math_symbols(image_path)
-            logger.info(f"Symbol extraction completed: {len(symbols_result)} symbols")
-        except Exception as symbol_error:
-            logger.error(f"Symbol extraction failed completely: {str(symbol_error)}")
-            logger.error(traceback.format_exc())
-            symbols_result = []
-        
-        # Get Image Quality Metrics - already handles SVG files specially
-        try:
-            quality_metrics = safe_analyze_image_quality(image_path)
-            quality_score = quality_metrics["quality_scores"]["overall_quality"]
-            quality_label = assign_quality_label(quality_score)
-            logger.info(f"Quality analysis completed: {quality_label} ({quality_score})")
-        except Exception as quality_error:
-            logger.error(f"Quality analysis failed: {str(quality_error)}")
-            logger.error(traceback.format_exc())
-            # Default metrics
-            quality_metrics = {
+            job, lane_queue = _queue_analysis(image_path, image.filename, deadline, ocr_engine)
+        except QueueFullError as e:
+            logger.warning(f"Rejecting {image.filename}: {str(e)}")
+            return _overloaded_response(e)
+
+        # Wait for the worker process; the lane decides which pool runs it
+        finished = _wait_for_job(job, deadline)
+        lane_queue.discard(job.job_id)
+        if not finished:
+            logger.error(f"Job {job.job_id} for {image.filename} did not finish in time, giving up")
+            return jsonify({'error': 'Analysis did not finish in time', 'partial_result': True, 'stages': {}}), 504
+        if isinstance(job.exception, InvalidImageError):
+            return jsonify({
+                'error': str(job.exception),
                 'basic_metrics': {
-                    'dimensions': {'width': 800, 'height': 600, 'megapixels': 0.48}
+                    'dimensions': {'width': 0, 'height': 0, 'megapixels': 0}
                 },
                 'quality_scores': {
-                    'overall_quality': 50
-                }
-            }
-            quality_label = "Medium"
-        
-        # Combine All Results
-        result = {
-            "file_info": {
-                "filename": image.filename,
-                "size_mb": os.path.getsize(image_path) / (1024 * 1024),
-                "is_vector": is_svg
-            },
-            "quality_rating": quality_label,
-            **quality_metrics,
-            # 'text_result': text_result,
-            'symbols_result': symbols_result,
-            #  'diagram_features': diagram_features if 'diagram_features' in locals() else {}
-        }
+                    'overall_quality': 0
+                },
+                'text_result': "",
+                'symbols_result': []
+            }), 400
+        if job.exception is not None:
+            raise job.exception
+        result = job.result
+        if fingerprint is not None:
+            _remember_result(fingerprint, result)
         
         # Log successful analysis
         logger.info(f"Successfully analyzed image: {image.filename}")
@@ -355,47 +248,852 @@ def analyze():
         # logger.error(f"Unhandled exception in analyze endpoint: {str(e)}")
         logger.error(traceback.format_exc())
         
-        # Return a partial result even on error
-        is_svg = image_path.lower().endswith('.svg') if 'image_path' in locals() else False
-        
+        # Stage failures are reported inside the result; this path is for
+        # errors before any stage ran (unreadable upload, worker crash)
         return jsonify({
             'error': str(e),
             'partial_result': True,
             'file_info': {
-                'filename': image.filename if 'image' in locals() else 'unknown',
-                'is_vector': is_svg
-            },
-            'basic_metrics': {
-                'dimensions': {'width': 800, 'height': 600, 'megapixels': 0 if is_svg else 0.48}
-            },
-            'quality_scores': {
-                'overall_quality': 90 if is_svg else 50,
-                'blur_score': 100 if is_svg else 50,
-                'brightness_score': 85 if is_svg else 50,
-                'contrast_score': 85 if is_svg else 50,
-                'detail_score': 90 if is_svg else 50,
-                'edge_density': 0.7 if is_svg else 0.5,
-                'noise_level': 0 if is_svg else 5,
-                'sharpness': 100 if is_svg else 50
+                'filename': image.filename,
+                'is_vector': image_path.lower().endswith('.svg')
             },
-            'quality_rating': "High" if is_svg else "Medium",
+            'stages': {},
             'text_result': "",
             'symbols_result': [],
-            # 'diagram_features': diagram_data if 'diagram_features' in locals() else {}
         }), 500
 
     finally:
+        request_ok = 'result' in locals()
+        metrics.record('request', time.perf_counter() - request_start, ok=request_ok)
+        metrics.request_finished()
 
         logger.info('Cleaning up temporary files', )
         # Clean up the uploaded file
-        if 'image_path' in locals() and os.path.exists(image_path):
-            try:
-                os.remove(image_path)
-                logger.info(f"Temporary file {image_path} removed")
-            except Exception as e:
-                logger.error(f"Error removing temporary file: {str(e)}")
+        _remove_upload(image_path)
                 
                 
+def _remove_upload(image_path):
+    try:
+        os.remove(image_path)
+        logger.info(f"Temporary file {image_path} removed")
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        logger.error(f"Error removing temporary file: {str(e)}")
+
+
+def _requested_ocr_engine():
+    """
+    OCR engine named by the client, or None for the configured one.
+
+    :raises ValueError: if the engine is unknown or not installed here
+    """
+    name = request.values.get(OCR_ENGINE_PARAM) or None
+    engines = available_engines()
+    if name is not None and not engines.get(name):
+        installed = sorted(engine for engine, ok in engines.items() if ok)
+        raise ValueError(f"{OCR_ENGINE_PARAM} must be one of {installed}, got '{name}'")
+    return name
+
+
+def _near_duplicate_fingerprint(image_path, ocr_engine):
+    """
+    Fingerprint of an upload whose result can be reused or stored, or
+    None (disabled, engine chosen by the client, vector or oversized image).
+    """
+    if not config.NEAR_DUPLICATE_ENABLED or ocr_engine is not None:
+        return None
+    try:
+        return fingerprint_file(image_path, config.NEAR_DUPLICATE_MAX_MEGAPIXELS)
+    except Exception as e:
+        logger.warning(f"Could not fingerprint {image_path} for near-duplicate lookup: {str(e)}")
+        return None
+
+
+def _reuse_near_duplicate(fingerprint, original_filename):
+    """Stored result of a near-duplicate of the upload, flagged as such, or None"""
+    start = time.perf_counter()
+    try:
+        match = get_near_duplicate_index().lookup(fingerprint)
+    except Exception as e:
+        logger.error(f"Near-duplicate lookup failed: {str(e)}")
+        return None
+    finally:
+        metrics.record('near_duplicate_lookup', time.perf_counter() - start)
+    if match is None:
+        return None
+
+    result = dict(match.result)
+    file_info = result.get('file_info', {})
+    logger.info(f"{original_filename} is a near-duplicate of {file_info.get('filename')} "
+                f"(distance {match.distance}), reusing its result")
+    result['file_info'] = dict(file_info, filename=original_filename)
+    result['near_duplicate'] = {
+        'of': file_info.get('filename'),
+        'distance': match.distance,
+        'entry': match.entry,
+        'stored': match.fingerprint.to_dict(),
+        'uploaded': fingerprint.to_dict(),
+    }
+    return result
+
+
+def _remember_result(fingerprint, result):
+    """Keep a complete, full-fidelity result for near-duplicates of this upload"""
+    if result.get('partial_result') or result.get('fidelity', {}).get('degraded'):
+        return
+    try:
+        get_near_duplicate_index().add(fingerprint, result)
+    except Exception as e:
+        logger.error(f"Could not store result for near-duplicate lookup: {str(e)}")
+
+
+def _wait_for_job(job, deadline):
+    """
+    Block until a queued job finishes, or until its deadline plus a grace
+    period has passed (SYNC_MAX_WAIT_SECONDS without a deadline).
+
+    :return: True if the job finished
+    """
+    remaining = deadline.remaining()
+    timeout = config.SYNC_MAX_WAIT_SECONDS if remaining is None else remaining + config.SYNC_WAIT_GRACE_SECONDS
+    return job.done.wait(timeout)
+
+
+def _overloaded_response(error):
+    response = jsonify({'error': str(error), 'retry_after': error.retry_after})
+    response.headers['Retry-After'] = str(error.retry_after)
+    return response, 503
+
+
+def _on_job_done(image_path, ticket, notify=None):
+    """
+    Build the completion callback for a queued analysis job.
+
+    :param image_path: Upload to remove once the job is done, or None
+    :param notify: Optional extra callback invoked with the Job
+    """
+    def callback(job):
+        admission.release(ticket)
+        fidelity_policy.observe_latency(job.finished_at - job.submitted_at)
+        fidelity_policy.observe_queue(max(q.fill() for q in job_queues.values()))
+        if job.status == 'completed':
+            metrics.record_timings(job.result.get('stage_timings_ms'))
+        metrics.record(f"job_{ticket.lane}", job.finished_at - job.submitted_at, ok=job.status == 'completed')
+        if image_path is not None:
+            _remove_upload(image_path)
+        if notify is not None:
+            notify(job)
+    return callback
+
+
+def _queue_analysis(image_path, original_filename, deadline, ocr_engine=None, stages=DEFAULT_STAGES):
+    """
+    Admit a saved upload against the cost budget and queue it on its lane.
+
+    Only the image header is read here; pixels are decoded by the worker.
+
+    :param deadline: Deadline, or seconds counted from when a worker starts the job
+    :param ocr_engine: OCR engine requested by the client, or None
+    :param stages: Pipeline stages to run and charge for
+
+    :return: Tuple of (Job, JobQueue it was queued on)
+    :raises QueueFullError: when the budget or the lane queue is exhausted
+    """
+    header = read_image_header(image_path)
+    ticket = admission.admit(header, stages)
+    lane_queue = job_queues[ticket.lane]
+    fidelity_policy.observe_queue(max(q.fill() for q in job_queues.values()))
+    fidelity = fidelity_policy.level
+    try:
+        job = lane_queue.submit(
+            run_analysis, image_path, original_filename, fidelity, deadline, stages, ocr_engine,
+            on_done=_on_job_done(image_path, ticket),
+            meta={'lane': ticket.lane, 'estimated_cost': ticket.cost, 'fidelity': fidelity}
+        )
+    except QueueFullError:
+        admission.release(ticket, finished=False)
+        raise
+    logger.info(f"Queued {original_filename} on {ticket.lane} lane (cost {ticket.cost})")
+    return job, lane_queue
+
+
+def _queue_page(document_path, original_filename, info, index, work_dir, deadline, notify, ocr_engine=None):
+    """
+    Admit and queue one page of a multi-page document.
+
+    Cost is estimated from the size the page will be rendered at; the
+    worker renders it. Same lanes, budget and fidelity as single images.
+
+    :return: The queued Job
+    :raises QueueFullError: when the budget or the lane queue is exhausted
+    """
+    header = page_header(info, index, config.DOCUMENT_RENDER_DPI, config.DOCUMENT_PAGE_MAX_SIDE)
+    ticket = admission.admit(header, DEFAULT_STAGES)
+    lane_queue = job_queues[ticket.lane]
+    fidelity_policy.observe_queue(max(q.fill() for q in job_queues.values()))
+    fidelity = fidelity_policy.level
+    try:
+        return lane_queue.submit(
+            analyze_document_page, document_path, original_filename, info, index, work_dir,
+            fidelity, deadline, config.DOCUMENT_RENDER_DPI, config.DOCUMENT_PAGE_MAX_SIDE,
+            config.DOCUMENT_TEXT_MIN_CHARS, ocr_engine,
+            on_done=_on_job_done(None, ticket, notify),
+            meta={'lane': ticket.lane, 'estimated_cost': ticket.cost, 'fidelity': fidelity, 'page': index + 1}
+        )
+    except QueueFullError:
+        admission.release(ticket, finished=False)
+        raise
+
+
+def _stream_document(work_dir, document_path, original_filename, info, deadline, ocr_engine=None):
+    """
+    Queue the pages of a document and yield NDJSON lines as they finish.
+
+    Pages are submitted as long as admission lets them in; when the budget
+    or the lanes are full, the stream waits for a page to finish before
+    submitting more. Pages not submitted by the deadline are reported as
+    skipped. The first line describes the document, the last one sums up.
+    """
+    finished = queue.Queue()
+    pending = deque(range(info.page_count))
+    in_flight = 0
+    counts = {'completed': 0, 'failed': 0, 'skipped': 0}
+    start = time.perf_counter()
+    try:
+        yield json.dumps({
+            'type': 'document', 'filename': original_filename,
+            'kind': info.kind, 'pages': info.page_count
+        }) + '\n'
+        while pending or in_flight:
+            while pending and not deadline.expired():
+                try:
+                    _queue_page(
+                        document_path, original_filename, info, pending[0], work_dir, deadline, finished.put,
+                        ocr_engine
+                    )
+                except QueueFullError as e:
+                    if not in_flight:
+                        # Nothing of ours to wait for; other requests hold the capacity
+                        time.sleep(min(e.retry_after, deadline.remaining() or e.retry_after))
+                    break
+                pending.popleft()
+                in_flight += 1
+
+            if pending and deadline.expired():
+                for index in pending:
+                    counts['skipped'] += 1
+                    yield json.dumps({'type': 'page', 'page': index + 1, 'status': 'skipped', 'reason': 'deadline'}) + '\n'
+                pending.clear()
+
+            if in_flight:
+                job = finished.get()
+                in_flight -= 1
+                job_queues[job.meta['lane']].discard(job.job_id)
+                counts['completed' if job.status == 'completed' else 'failed'] += 1
+                yield json.dumps({'type': 'page', **job.to_dict()}) + '\n'
+
+        yield json.dumps({
+            'type': 'summary', 'pages': info.page_count, **counts,
+            'elapsed_ms': round((time.perf_counter() - start) * 1000, 2)
+        }) + '\n'
+    finally:
+        metrics.record('document', time.perf_counter() - start, ok=counts['failed'] == 0)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def _document_response(upload_path, original_filename, deadline, ocr_engine=None):
+    """
+    Streaming response for a multi-page upload; takes ownership of the file.
+
+    :return: Response streaming NDJSON, or a 400 response if the pages cannot be read
+    """
+    work_dir = os.path.join(UPLOAD_FOLDER, uuid.uuid4().hex)
+    os.makedirs(work_dir)
+    document_path = os.path.join(work_dir, os.path.basename(upload_path))
+    os.replace(upload_path, document_path)
+    try:
+        info = probe_document(document_path, config.DOCUMENT_MAX_PAGES)
+    except (ValueError, subprocess.TimeoutExpired) as e:
+        info = None
+        logger.error(f"Could not read pages of {original_filename}: {str(e)}")
+    if info is None or info.page_count == 0:
+        shutil.rmtree(work_dir, ignore_errors=True)
+        return jsonify({'error': f"Could not read the pages of {original_filename}"}), 400
+
+    logger.info(f"Streaming {info.page_count} {info.kind} pages of {original_filename}")
+    return Response(
+        _stream_document(work_dir, document_path, original_filename, info, deadline, ocr_engine),
+        mimetype='application/x-ndjson'
+    )
+
+
+@app.route('/documents', methods=['POST'])
+def analyze_document():
+    """
+    Analyze a multi-page PDF or TIFF page by page.
+
+    Pages run in parallel on the job queue lanes; the response streams one
+    JSON line per page, in the order pages finish.
+    """
+    if 'image' not in request.files or request.files['image'].filename == '':
+        logger.warning('No document provided in request')
+        return jsonify({
+            'error': 'No file found in request. Make sure to include a file with key "image".'
+        }), 400
+
+    try:
+        deadline = Deadline.from_milliseconds(
+            request.headers.get(DEADLINE_HEADER), config.ANALYSIS_DEADLINE_SECONDS
+        )
+    except ValueError:
+        return jsonify({'error': f"{DEADLINE_HEADER} must be a number of milliseconds"}), 400
+    try:
+        ocr_engine = _requested_ocr_engine()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    document = request.files['image']
+    upload_path = os.path.join(UPLOAD_FOLDER, f"{uuid.uuid4()}-{os.path.basename(document.filename)}")
+    document.save(upload_path)
+    if not is_multipage_document(upload_path):
+        _remove_upload(upload_path)
+        return jsonify({'error': 'Expected a PDF or a multi-page TIFF; use /analyze for single images'}), 400
+    return _document_response(upload_path, document.filename, deadline, ocr_engine)
+
+
+@app.route('/ocr', methods=['POST'])
+def cloud_ocr():
+    """
+    Text of an image from AWS Textract.
+
+    Runs in the request thread: the call is network-bound, and the shared
+    client caps concurrent calls and caches results by image content.
+    """
+    if 'image' not in request.files or request.files['image'].filename == '':
+        logger.warning('No image provided in OCR request')
+        return jsonify({
+            'error': 'No image file found in request. Make sure to include a file with key "image".'
+        }), 400
+
+    image = request.files['image']
+    start = time.perf_counter()
+    try:
+        result = get_textract().detect_text(image.read())
+    except ValueError as e:
+        return jsonify({'error': f"Could not read {image.filename} as an image: {str(e)}"}), 400
+    except Exception as e:
+        logger.error(f"Cloud OCR failed for {image.filename}: {str(e)}")
+        metrics.record('cloud_ocr', time.perf_counter() - start, ok=False)
+        return jsonify({'error': f"Cloud OCR failed: {str(e)}"}), 502
+    metrics.record('cloud_ocr', time.perf_counter() - start, ok=True)
+    return jsonify({'engine': 'textract', **result.to_dict()})
+
+
+@app.route('/jobs', methods=['POST'])
+def submit_job():
+    """Queue an image for analysis and return a job id immediately"""
+    if 'image' not in request.files or request.files['image'].filename == '':
+        logger.warning('No image provided in job request')
+        return jsonify({
+            'error': 'No image file found in request. Make sure to include a file with key "image".'
+        }), 400
+
+    try:
+        # Seconds rather than a Deadline: the clock starts when a worker picks the job up
+        deadline_seconds = budget_seconds(request.headers.get(DEADLINE_HEADER), config.ANALYSIS_DEADLINE_SECONDS)
+    except ValueError:
+        return jsonify({'error': f"{DEADLINE_HEADER} must be a number of milliseconds"}), 400
+    try:
+        ocr_engine = _requested_ocr_engine()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    image = request.files['image']
+    image_path = os.path.join(UPLOAD_FOLDER, f"{uuid.uuid4()}-{image.filename}")
+    image.save(image_path)
+
+    try:
+        job, _ = _queue_analysis(image_path, image.filename, deadline_seconds, ocr_engine)
+    except QueueFullError as e:
+        _remove_upload(image_path)
+        logger.warning(f"Rejecting job for {image.filename}: {str(e)}")
+        return _overloaded_response(e)
+
+    response = jsonify({
+        'job_id': job.job_id,
+        'status': job.status,
+        'lane': job.meta['lane'],
+        'status_url': f"/jobs/{job.job_id}"
+    })
+    response.headers['Location'] = f"/jobs/{job.job_id}"
+    return response, 202
+
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """Return job status or result; `?wait=<seconds>` long-polls until the job finishes"""
+    try:
+        wait = float(request.args.get('wait', 0))
+    except ValueError:
+        return jsonify({'error': 'wait must be a number of seconds'}), 400
+
+    job = None
+    for lane_queue in job_queues.values():
+        job = lane_queue.get(job_id, wait=wait)
+        if job is not None:
+            break
+    if job is None:
+        return jsonify({'error': f"Unknown or expired job: {job_id}"}), 404
+    return jsonify(job.to_dict())
+
+
+@app.route('/near-duplicates/export', methods=['GET'])
+def export_near_duplicates():
+    """Every stored result with its image fingerprint, as NDJSON"""
+    return Response(get_near_duplicate_index().export_lines(), mimetype='application/x-ndjson')
+
+
+@app.route('/near-duplicates/import', methods=['POST'])
+def import_near_duplicates():
+    """Bulk load NDJSON lines as written by /near-duplicates/export"""
+    lines = (line.decode('utf-8') for line in request.stream)
+    try:
+        added = get_near_duplicate_index().import_lines(lines)
+    except ValueError as e:
+        return jsonify({'error': f"Invalid near-duplicate export: {str(e)}"}), 400
+    return jsonify({'added': added, **get_near_duplicate_index().stats()})
+
+
+@app.route('/similar', methods=['POST'])
+def similar():
+    """
+    Stored diagrams most similar to a query: an uploaded `image`, or a JSON
+    body with the `id` of a stored diagram or an `embedding` (the
+    `visual_embedding` of an /analyze result, or its vector). Optional `k`
+    and `min_score`, as form fields, query arguments or JSON keys.
+
+    Uploaded images are embedded by a worker, admitted and queued like
+    /analyze (503 when overloaded, X-Deadline-Ms honored).
+    """
+    body = request.get_json(silent=True) if request.is_json else None
+    options = body if isinstance(body, dict) else request.values
+    try:
+        k = int(options.get('k', SIMILAR_DEFAULT_RESULTS))
+        min_score = options.get('min_score')
+        min_score = None if min_score is None else float(min_score)
+    except (TypeError, ValueError):
+        return jsonify({'error': "k must be an integer and min_score a number"}), 400
+    if not 1 <= k <= SIMILAR_MAX_RESULTS:
+        return jsonify({'error': f"k must be between 1 and {SIMILAR_MAX_RESULTS}"}), 400
+
+    index = get_similarity_index()
+    exclude_id = None
+    if 'image' in request.files:
+        try:
+            deadline = Deadline.from_milliseconds(
+                request.headers.get(DEADLINE_HEADER), config.ANALYSIS_DEADLINE_SECONDS
+            )
+        except ValueError:
+            return jsonify({'error': f"{DEADLINE_HEADER} must be a number of milliseconds"}), 400
+        try:
+            embedding = _embed_upload(request.files['image'], deadline)
+        except QueueFullError as e:
+            logger.warning(f"Rejecting similar-diagram query: {str(e)}")
+            return _overloaded_response(e)
+        except TimeoutError as e:
+            logger.error(f"Similar-diagram query: {str(e)}")
+            return jsonify({'error': str(e)}), 504
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        vector = embedding_vector(embedding)
+        query = {'image': True}
+    elif isinstance(body, dict) and body.get('id') is not None:
+        vector = index.vector(body['id'])
+        if vector is None:
+            return jsonify({'error': f"Unknown id: {body['id']}"}), 404
+        exclude_id = body['id']
+        query = {'id': str(body['id'])}
+    elif isinstance(body, dict) and body.get('embedding') is not None:
+        try:
+            vector = embedding_vector(body['embedding'])
+        except ValueError as e:
+            return jsonify({'error': f"Invalid embedding: {str(e)}"}), 400
+        query = {'embedding': True}
+    else:
+        return jsonify({'error': "Send an image file, or JSON with an id or an embedding"}), 400
+
+    start = time.perf_counter()
+    matches = index.search(vector, k=k, exclude_id=exclude_id, min_score=min_score)
+    metrics.record('similar_search', time.perf_counter() - start)
+    return jsonify({
+        'query': query,
+        'results': [match.to_dict() for match in matches],
+        'search': index.stats()['search'],
+    })
+
+
+def _embed_upload(upload, deadline):
+    """
+    Visual embedding of an uploaded image, computed by a worker: the upload
+    is admitted and queued like an analysis that only runs the embedding
+    stage, and the request waits for it.
+
+    :raises QueueFullError: when the budget or the lane queue is exhausted
+    :raises ValueError: if the upload cannot be decoded or the deadline passes first
+    :raises TimeoutError: if the job has not finished well after the deadline
+    """
+    filename = os.path.basename(upload.filename or 'query')
+    path = os.path.join(UPLOAD_FOLDER, f"{uuid.uuid4()}-{filename}")
+    upload.save(path)
+    try:
+        job, lane_queue = _queue_analysis(path, filename, deadline, stages=('embedding',))
+    except QueueFullError:
+        _remove_upload(path)
+        raise
+    # The job's completion callback removes the upload
+    finished = _wait_for_job(job, deadline)
+    lane_queue.discard(job.job_id)
+    if not finished:
+        raise TimeoutError("Embedding did not finish in time")
+    if isinstance(job.exception, InvalidImageError):
+        raise ValueError(str(job.exception))
+    if job.exception is not None:
+        raise job.exception
+    if 'visual_embedding' not in job.result:
+        status = job.result['stages'].get('embedding', {})
+        raise ValueError(f"Could not embed the image: {status.get('error') or status.get('reason', 'no pixels')}")
+    return job.result['visual_embedding']
+
+
+@app.route('/similar/upsert', methods=['POST'])
+def upsert_similar():
+    """
+    Store embeddings under client ids: NDJSON lines of
+    {"id": ..., "embedding": ..., "meta": {...}}, where `embedding` is the
+    `visual_embedding` of an /analyze result (or its vector) and `meta` is
+    returned with matches. An existing id is overwritten.
+    """
+    index = get_similarity_index()
+    upserted = 0
+    batch = []
+    try:
+        for number, line in enumerate(request.stream, 1):
+            if not line.strip():
+                continue
+            try:
+                item = json.loads(line)
+                batch.append((str(item['id']), embedding_vector(item['embedding']), item.get('meta')))
+            except (ValueError, KeyError, TypeError) as e:
+                raise ValueError(f"Line {number}: {str(e)}")
+            if len(batch) == SIMILAR_UPSERT_BATCH:
+                upserted += index.upsert_many(batch)
+                batch = []
+        upserted += index.upsert_many(batch)
+    except ValueError as e:
+        # Batches before the bad line are stored; `upserted` counts them
+        return jsonify({'error': f"Invalid upsert: {str(e)}", 'upserted': upserted}), 400
+    return jsonify({'upserted': upserted, **index.stats()})
+
+
+@app.route('/similar-text', methods=['POST'])
+def similar_text():
+    """
+    Stored diagrams whose text and symbols are most similar to a query: a
+    JSON body with the `id` of a stored diagram, an /analyze `result`, or
+    `text` and/or `symbols`. Optional `k` and `min_similarity` (estimated
+    Jaccard similarity of the text shingles).
+    """
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict):
+        return jsonify({'error': "Send JSON with an id, a result, or text and symbols"}), 400
+    try:
+        k = int(body.get('k', SIMILAR_DEFAULT_RESULTS))
+        min_similarity = body.get('min_similarity')
+        min_similarity = None if min_similarity is None else float(min_similarity)
+    except (TypeError, ValueError):
+        return jsonify({'error': "k must be an integer and min_similarity a number"}), 400
+    if not 1 <= k <= SIMILAR_MAX_RESULTS:
+        return jsonify({'error': f"k must be between 1 and {SIMILAR_MAX_RESULTS}"}), 400
+
+    index = get_text_similarity_index()
+    exclude_id = None
+    if body.get('id') is not None:
+        signature = index.signature(body['id'])
+        if signature is None:
+            return jsonify({'error': f"Unknown id: {body['id']}"}), 404
+        exclude_id = body['id']
+    else:
+        document = body.get('result') if isinstance(body.get('result'), dict) else body
+        try:
+            signature = document_signature(document)
+        except ValueError as e:
+            return jsonify({'error': f"Invalid query: {str(e)}"}), 400
+        if signature is None:
+            return jsonify({'error': "The query has no text or symbols"}), 400
+
+    start = time.perf_counter()
+    matches = index.search(signature, k=k, exclude_id=exclude_id, min_similarity=min_similarity)
+    metrics.record('similar_text_search', time.perf_counter() - start)
+    return jsonify({'results': [match.to_dict() for match in matches]})
+
+
+def _result_items(stream):
+    """
+    (id, document, meta) of NDJSON lines {"id": ..., "result": {...}, "meta": {...}},
+    where `result` is an /analyze result. The fields an index reads may be
+    given on the line itself instead: `text_result`/`symbols_result` or
+    `text`/`symbols` for /similar-text and /autocomplete, `colors` for
+    /similar-palette.
+
+    :raises ValueError: on a malformed line
+    """
+    for number, line in enumerate(stream, 1):
+        if not line.strip():
+            continue
+        try:
+            item = json.loads(line)
+            document = item['result'] if isinstance(item.get('result'), dict) else item
+            yield str(item['id']), document, item.get('meta')
+        except (ValueError, KeyError, TypeError) as e:
+            raise ValueError(f"Line {number}: {str(e)}")
+
+
+@app.route('/similar-text/upsert', methods=['POST'])
+def upsert_similar_text():
+    """
+    Store diagrams' text under client ids, as NDJSON (see _result_items()).
+    An existing id is replaced; a line without text or symbols removes it.
+    """
+    index = get_text_similarity_index()
+    stored = without_text = 0
+    batch = []
+    try:
+        for item in _result_items(request.stream):
+            batch.append(item)
+            if len(batch) == SIMILAR_UPSERT_BATCH:
+                counts = index.insert_many(batch)
+                stored, without_text, batch = stored + counts[0], without_text + counts[1], []
+        counts = index.insert_many(batch)
+        stored, without_text = stored + counts[0], without_text + counts[1]
+    except ValueError as e:
+        # Batches before the bad line are stored; `upserted` counts them
+        return jsonify({'error': f"Invalid upsert: {str(e)}", 'upserted': stored}), 400
+    return jsonify({'upserted': stored, 'without_text': without_text, **index.stats()})
+
+
+@app.route('/similar-text/rebuild', methods=['POST'])
+def rebuild_similar_text():
+    """
+    Replace the similar-text index with an exported result set (NDJSON, see
+    _result_items()), computing signatures on every core. Queries are answered
+    from the previous index while the signatures are computed.
+    """
+    try:
+        items = list(_result_items(line.decode('utf-8') for line in request.stream))
+    except ValueError as e:
+        return jsonify({'error': f"Invalid export: {str(e)}"}), 400
+    index = get_text_similarity_index()
+    start = time.perf_counter()
+    try:
+        stored, without_text = index.rebuild(items, workers=config.TEXT_SIMILARITY_REBUILD_WORKERS)
+    except ValueError as e:
+        return jsonify({'error': f"Invalid export: {str(e)}"}), 400
+    return jsonify({
+        'stored': stored,
+        'without_text': without_text,
+        'seconds': round(time.perf_counter() - start, 3),
+        **index.stats(),
+    })
+
+
+@app.route('/similar-text/<item_id>', methods=['DELETE'])
+def delete_similar_text(item_id):
+    if not get_text_similarity_index().delete(item_id):
+        return jsonify({'error': f"Unknown id: {item_id}"}), 404
+    return jsonify({'deleted': item_id})
+
+
+@app.route('/similar-palette', methods=['POST'])
+def similar_palette():
+    """
+    Stored diagrams whose palettes are closest to a query: a JSON body with
+    `colors` ('#rrggbb' or [r, g, b]), the `id` of a stored diagram or an
+    /analyze `result`. Optional `k` and `max_distance` (average CIEDE2000
+    difference between nearest colors).
+    """
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict):
+        return jsonify({'error': "Send JSON with colors, an id or a result"}), 400
+    try:
+        k = int(body.get('k', SIMILAR_DEFAULT_RESULTS))
+        max_distance = body.get('max_distance')
+        max_distance = None if max_distance is None else float(max_distance)
+    except (TypeError, ValueError):
+        return jsonify({'error': "k must be an integer and max_distance a number"}), 400
+    if not 1 <= k <= SIMILAR_MAX_RESULTS:
+        return jsonify({'error': f"k must be between 1 and {SIMILAR_MAX_RESULTS}"}), 400
+
+    index = get_palette_index()
+    exclude_id = None
+    if body.get('id') is not None:
+        palette = index.palette(body['id'])
+        if palette is None:
+            return jsonify({'error': f"Unknown id: {body['id']}"}), 404
+        exclude_id = body['id']
+    else:
+        document = body.get('result') if isinstance(body.get('result'), dict) else body
+        try:
+            palette = document_palette(document)
+        except ValueError as e:
+            return jsonify({'error': f"Invalid query: {str(e)}"}), 400
+        if palette is None:
+            return jsonify({'error': "The query has no colors"}), 400
+
+    start = time.perf_counter()
+    matches = index.search(palette, k=k, exclude_id=exclude_id, max_distance=max_distance)
+    metrics.record('similar_palette_search', time.perf_counter() - start)
+    return jsonify({'results': [match.to_dict() for match in matches]})
+
+
+@app.route('/similar-palette/upsert', methods=['POST'])
+def upsert_similar_palette():
+    """
+    Store diagrams' palettes under client ids, as NDJSON (see _result_items()).
+    An existing id is replaced; a line without colors removes it.
+    """
+    index = get_palette_index()
+    stored = without_colors = 0
+    batch = []
+    try:
+        for item in _result_items(request.stream):
+            batch.append(item)
+            if len(batch) == SIMILAR_UPSERT_BATCH:
+                counts = index.upsert_many(batch)
+                stored, without_colors, batch = stored + counts[0], without_colors + counts[1], []
+        counts = index.upsert_many(batch)
+        stored, without_colors = stored + counts[0], without_colors + counts[1]
+    except ValueError as e:
+        # Batches before the bad line are stored; `upserted` counts them
+        return jsonify({'error': f"Invalid upsert: {str(e)}", 'upserted': stored}), 400
+    return jsonify({'upserted': stored, 'without_colors': without_colors, **index.stats()})
+
+
+@app.route('/similar-palette/rebuild', methods=['POST'])
+def rebuild_similar_palette():
+    """Replace the palette index with stored analysis results (NDJSON, see _result_items())"""
+    try:
+        items = list(_result_items(line.decode('utf-8') for line in request.stream))
+        index = get_palette_index()
+        start = time.perf_counter()
+        stored, without_colors = index.rebuild(items)
+    except ValueError as e:
+        return jsonify({'error': f"Invalid export: {str(e)}"}), 400
+    return jsonify({
+        'stored': stored,
+        'without_colors': without_colors,
+        'seconds': round(time.perf_counter() - start, 3),
+        **index.stats(),
+    })
+
+
+@app.route('/similar-palette/<item_id>', methods=['DELETE'])
+def delete_similar_palette(item_id):
+    if not get_palette_index().delete(item_id):
+        return jsonify({'error': f"Unknown id: {item_id}"}), 404
+    return jsonify({'deleted': item_id})
+
+
+@app.route('/autocomplete', methods=['GET'])
+def autocomplete():
+    """
+    Terms from stored diagrams completing `prefix`, most diagrams first, then
+    near spellings if there are fewer than `limit` (unless fuzzy=false).
+    """
+    prefix = request.args.get('prefix', '')
+    try:
+        limit = int(request.args.get('limit', 10))
+    except ValueError:
+        return jsonify({'error': "limit must be an integer"}), 400
+    if not 1 <= limit <= SUGGEST_MAX:
+        return jsonify({'error': f"limit must be between 1 and {SUGGEST_MAX}"}), 400
+    fuzzy = request.args.get('fuzzy', 'true').lower() not in ('false', '0', 'no')
+
+    start = time.perf_counter()
+    suggestions = get_term_index().suggest(prefix, limit=limit, fuzzy=fuzzy)
+    metrics.record('autocomplete', time.perf_counter() - start)
+    return jsonify({'suggestions': [suggestion.to_dict() for suggestion in suggestions]})
+
+
+@app.route('/autocomplete/upsert', methods=['POST'])
+def upsert_autocomplete():
+    """
+    Store diagrams' terms under client ids, as NDJSON (see _result_items()).
+    An existing id is replaced; a line without text or symbols removes it.
+    """
+    index = get_term_index()
+    stored = without_terms = 0
+    batch = []
+    try:
+        for item_id, document, _ in _result_items(request.stream):
+            batch.append((item_id, document))
+            if len(batch) == SIMILAR_UPSERT_BATCH:
+                counts = index.upsert_many(batch)
+                stored, without_terms, batch = stored + counts[0], without_terms + counts[1], []
+        counts = index.upsert_many(batch)
+        stored, without_terms = stored + counts[0], without_terms + counts[1]
+    except ValueError as e:
+        # Batches before the bad line are stored; `upserted` counts them
+        return jsonify({'error': f"Invalid upsert: {str(e)}", 'upserted': stored}), 400
+    return jsonify({'upserted': stored, 'without_terms': without_terms, **index.stats()})
+
+
+@app.route('/autocomplete/rebuild', methods=['POST'])
+def rebuild_autocomplete():
+    """
+    Replace the autocomplete index with stored analysis results (NDJSON, see
+    _result_items()), extracting terms and writing the snapshot in
+    TERM_INDEX_WORKERS processes. Suggestions come from the previous index
+    until the new one is swapped in.
+    """
+    try:
+        items = [(item_id, document) for item_id, document, _ in
+                 _result_items(line.decode('utf-8') for line in request.stream)]
+        index = get_term_index()
+        start = time.perf_counter()
+        stored, without_terms = index.rebuild(items, workers=config.TERM_INDEX_WORKERS)
+    except ValueError as e:
+        return jsonify({'error': f"Invalid export: {str(e)}"}), 400
+    return jsonify({
+        'stored': stored,
+        'without_terms': without_terms,
+        'seconds': round(time.perf_counter() - start, 3),
+        **index.stats(),
+    })
+
+
+@app.route('/autocomplete/<item_id>', methods=['DELETE'])
+def delete_autocomplete(item_id):
+    if not get_term_index().delete(item_id):
+        return jsonify({'error': f"Unknown id: {item_id}"}), 404
+    return jsonify({'deleted': item_id})
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Expose per-stage timing statistics for load testing and monitoring"""
+    snapshot = metrics.snapshot()
+    snapshot['job_queues'] = {lane: q.stats() for lane, q in job_queues.items()}
+    snapshot['admission'] = admission.stats()
+    snapshot['fidelity'] = fidelity_policy.stats()
+    snapshot['cloud_ocr'] = get_textract().stats()
+    snapshot['near_duplicates'] = get_near_duplicate_index().stats()
+    snapshot['similar'] = get_similarity_index().stats()
+    snapshot['similar_text'] = get_text_similarity_index().stats()
+    snapshot['similar_palette'] = get_palette_index().stats()
+    snapshot['autocomplete'] = get_term_index().stats()
+    return jsonify(snapshot)
+
 @app.route('/health', methods=['GET'])
 def health_check():
     logger.info('Health check endpoint called')
@@ -424,8 +1122,10 @@ def health_check():
         'components': {
             'tesseract': 'ok' if tesseract_ok else 'error',
             'opencv': 'ok' if opencv_ok else 'error'
-        }
+        },
+        # Engines whose packages are installed (models load in the workers)
+        'ocr_engines': available_engines()
     }), 200 if status == "healthy" else 207
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5001)
\ No newline at end of file
+    app.run(host='0.0.0.0', port=int(os.environ.get('PORT', 5001)), threaded=True)
\ No newline at end of file
@@ -0,0 +1,169 @@
+# image-analysis-service/src/config.py
+"""Service settings, read once from the environment at import time."""
+import os
+import tempfile
+
+
+def _env_int(name, default):
+    return int(os.environ.get(name, default))
+
+
+def _env_float(name, default):
+    return float(os.environ.get(name, default))
+
+
+# Persistent indexes (near duplicates, similar diagrams, text, palettes,
+# autocomplete) live in subdirectories of DATA_DIR. In containers it is
+# /app/data, a volume next to /app/uploads; a directory under the system
+# temp dir would be lost on restart or wiped by tmp cleaners.
+DATA_DIR = os.environ.get(
+    'DATA_DIR', os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data')
+)
+
+
+# Async job queue. Workers are split between a fast lane for small images
+# and a heavy lane for large ones; each lane has its own queue depth.
+JOB_WORKERS = _env_int('JOB_WORKERS', os.cpu_count() or 1)
+JOB_HEAVY_WORKERS = _env_int('JOB_HEAVY_WORKERS', max(1, JOB_WORKERS // 2))
+JOB_FAST_WORKERS = _env_int('JOB_FAST_WORKERS', max(1, JOB_WORKERS - JOB_HEAVY_WORKERS))
+JOB_MAX_QUEUE_DEPTH = _env_int('JOB_MAX_QUEUE_DEPTH', 32)
+JOB_HEAVY_MAX_QUEUE_DEPTH = _env_int('JOB_HEAVY_MAX_QUEUE_DEPTH', JOB_MAX_QUEUE_DEPTH // 2)
+JOB_RESULT_TTL_SECONDS = _env_int('JOB_RESULT_TTL_SECONDS', 900)
+JOB_MAX_WAIT_SECONDS = _env_float('JOB_MAX_WAIT_SECONDS', 60)
+
+# Default time budget per analysis when the client sends no X-Deadline-Ms
+# header (0 = unlimited). Synchronous requests count queue wait against it;
+# jobs start the clock when a worker picks them up.
+ANALYSIS_DEADLINE_SECONDS = _env_float('ANALYSIS_DEADLINE_SECONDS', 240)
+
+# Synchronous requests give up on their job (504) this long after the
+# deadline, in case a worker hangs or its pool breaks without reporting;
+# without a deadline they wait at most SYNC_MAX_WAIT_SECONDS
+SYNC_WAIT_GRACE_SECONDS = _env_float('SYNC_WAIT_GRACE_SECONDS', 30)
+SYNC_MAX_WAIT_SECONDS = _env_float('SYNC_MAX_WAIT_SECONDS', 900)
+
+# Quality analysis of images at or above this size runs strip by strip with
+# a working set bounded by QUALITY_MAX_MEMORY_MB (0 = never tile)
+QUALITY_TILED_MIN_MEGAPIXELS = _env_float('QUALITY_TILED_MIN_MEGAPIXELS', 40)
+QUALITY_MAX_MEMORY_MB = _env_float('QUALITY_MAX_MEMORY_MB', 512)
+# Largest image PIL will open (its own default stops at ~179 MP)
+MAX_IMAGE_MEGAPIXELS = _env_float('MAX_IMAGE_MEGAPIXELS', 1000)
+
+# Admission control, in cost units (~1 unit = quality stage on a 1 MP image)
+ADMISSION_COST_BUDGET = _env_float('ADMISSION_COST_BUDGET', 32 * JOB_WORKERS)
+FAST_LANE_MAX_COST = _env_float('FAST_LANE_MAX_COST', 3.0)
+FAST_LANE_RESERVED_COST = _env_float('FAST_LANE_RESERVED_COST', ADMISSION_COST_BUDGET / 4)
+
+
+def _env_floats(name, default):
+    return [float(v) for v in os.environ.get(name, default).split(',')]
+
+
+# Adaptive fidelity. Lists hold the threshold for leaving/returning to
+# level 0 and level 1; recover thresholds sit below degrade ones (hysteresis).
+FIDELITY_ADAPTIVE = os.environ.get('FIDELITY_ADAPTIVE', '1') == '1'
+FIDELITY_DEGRADE_QUEUE_FILL = _env_floats('FIDELITY_DEGRADE_QUEUE_FILL', '0.5,0.8')
+FIDELITY_RECOVER_QUEUE_FILL = _env_floats('FIDELITY_RECOVER_QUEUE_FILL', '0.2,0.5')
+FIDELITY_DEGRADE_LATENCY_SECONDS = _env_floats('FIDELITY_DEGRADE_LATENCY_SECONDS', '30,90')
+FIDELITY_RECOVER_LATENCY_SECONDS = _env_floats('FIDELITY_RECOVER_LATENCY_SECONDS', '10,45')
+FIDELITY_MIN_DWELL_SECONDS = _env_float('FIDELITY_MIN_DWELL_SECONDS', 15)
+
+# SVG uploads are analyzed from their XML. Those whose text is drawn as
+# outlines are rendered for OCR at this long side; renders are cached here.
+SVG_RASTER_MAX_SIDE = _env_int('SVG_RASTER_MAX_SIDE', 2048)
+SVG_RASTER_CACHE_DIR = os.environ.get(
+    'SVG_RASTER_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'svg-raster-cache')
+)
+
+# Multi-page PDF/TIFF uploads are split into pages analyzed in parallel.
+# Pages render at DOCUMENT_RENDER_DPI unless that exceeds DOCUMENT_PAGE_MAX_SIDE
+# pixels; PDF pages with at least DOCUMENT_TEXT_MIN_CHARS of embedded text
+# skip OCR and use that text.
+DOCUMENT_RENDER_DPI = _env_int('DOCUMENT_RENDER_DPI', 150)
+DOCUMENT_PAGE_MAX_SIDE = _env_int('DOCUMENT_PAGE_MAX_SIDE', 3000)
+DOCUMENT_TEXT_MIN_CHARS = _env_int('DOCUMENT_TEXT_MIN_CHARS', 20)
+DOCUMENT_MAX_PAGES = _env_int('DOCUMENT_MAX_PAGES', 500)
+
+
+def _env_mapping(name, default=''):
+    """'key=value,key=value' -> dict"""
+    pairs = [item.split('=', 1) for item in os.environ.get(name, default).split(',') if '=' in item]
+    return {key.strip(): value.strip() for key, value in pairs}
+
+
+# OCR engine (tesseract, paddleocr or easyocr; see utils/ocr_engines.py).
+# Requests may name one with `ocr_engine`; otherwise OCR_FIDELITY_ENGINES
+# picks one per fidelity level, e.g. 'full=paddleocr,minimal=tesseract',
+# and OCR_ENGINE covers the rest. Worker processes load OCR_WARM_ENGINES
+# when they start, so no job waits for model loading.
+OCR_ENGINE = os.environ.get('OCR_ENGINE', 'tesseract')
+OCR_FIDELITY_ENGINES = _env_mapping('OCR_FIDELITY_ENGINES')
+OCR_WARM_ENGINES = [name for name in os.environ.get('OCR_WARM_ENGINES', OCR_ENGINE).split(',') if name]
+
+# Cloud OCR (AWS Textract, see utils/cloud_ocr.py), served by /ocr. One
+# pooled client per process makes at most TEXTRACT_MAX_CONCURRENCY calls at
+# once; results are cached by image content in memory and under
+# TEXTRACT_CACHE_DIR ('' = memory only), so each unique image is sent once.
+# TEXTRACT_ENDPOINT_URL points the client at a local stub for testing.
+TEXTRACT_REGION = os.environ.get('TEXTRACT_REGION', os.environ.get('AWS_REGION', 'us-east-1'))
+TEXTRACT_ENDPOINT_URL = os.environ.get('TEXTRACT_ENDPOINT_URL') or None
+TEXTRACT_MAX_CONCURRENCY = _env_int('TEXTRACT_MAX_CONCURRENCY', 4)
+TEXTRACT_MAX_ATTEMPTS = _env_int('TEXTRACT_MAX_ATTEMPTS', 5)
+TEXTRACT_TIMEOUT_SECONDS = _env_float('TEXTRACT_TIMEOUT_SECONDS', 30)
+TEXTRACT_CACHE_SIZE = _env_int('TEXTRACT_CACHE_SIZE', 256)
+TEXTRACT_CACHE_DIR = os.environ.get(
+    'TEXTRACT_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'textract-cache')
+)
+
+# Near-duplicate reuse (utils/near_duplicate.py). /analyze results are kept
+# with an image fingerprint under NEAR_DUPLICATE_DIR ('' = memory only); an
+# upload whose perceptual hash is within NEAR_DUPLICATE_MAX_DISTANCE bits of
+# a stored image, with the same content aspect ratio and at most
+# NEAR_DUPLICATE_MAX_UNMATCHED unmatched ink pixels per block of the detail
+# mask, gets the stored result, flagged `near_duplicate`. Images over
+# NEAR_DUPLICATE_MAX_MEGAPIXELS are not fingerprinted (that runs in the
+# request thread).
+NEAR_DUPLICATE_ENABLED = os.environ.get('NEAR_DUPLICATE_ENABLED', '1') == '1'
+NEAR_DUPLICATE_DIR = os.environ.get('NEAR_DUPLICATE_DIR', os.path.join(DATA_DIR, 'near-duplicate-index'))
+NEAR_DUPLICATE_MAX_DISTANCE = _env_int('NEAR_DUPLICATE_MAX_DISTANCE', 6)
+NEAR_DUPLICATE_ASPECT_TOLERANCE = _env_float('NEAR_DUPLICATE_ASPECT_TOLERANCE', 0.02)
+NEAR_DUPLICATE_MAX_UNMATCHED = _env_int('NEAR_DUPLICATE_MAX_UNMATCHED', 3)
+NEAR_DUPLICATE_MAX_MEGAPIXELS = _env_float('NEAR_DUPLICATE_MAX_MEGAPIXELS', 50)
+
+# Similar-diagram search (utils/visual_embedding.py, utils/similarity_index.py).
+# /analyze results carry a `visual_embedding`; clients upsert it under their
+# own diagram id and query /similar. Vectors are kept under
+# SIMILARITY_INDEX_DIR ('' = memory only) and searched exhaustively until
+# there are SIMILARITY_IVF_MIN_VECTORS of them, then through an IVF-PQ index
+# scoring SIMILARITY_IVF_PROBES lists per query.
+SIMILARITY_INDEX_DIR = os.environ.get('SIMILARITY_INDEX_DIR', os.path.join(DATA_DIR, 'similarity-index'))
+SIMILARITY_IVF_MIN_VECTORS = _env_int('SIMILARITY_IVF_MIN_VECTORS', 50000)
+SIMILARITY_IVF_PROBES = _env_int('SIMILARITY_IVF_PROBES', 16)
+
+# Similar-text search (utils/text_similarity.py). Clients insert /analyze
+# results (their `text_result` and `symbols_result`) under their own
+# diagram id and query /similar-text; MinHash signatures and LSH band tables
+# are kept under TEXT_SIMILARITY_DIR ('' = memory only). Matches below
+# TEXT_SIMILARITY_MIN_SIMILARITY (estimated Jaccard similarity of the text
+# shingles) are dropped unless the query asks otherwise.
+# /similar-text/rebuild uses TEXT_SIMILARITY_REBUILD_WORKERS processes.
+TEXT_SIMILARITY_DIR = os.environ.get('TEXT_SIMILARITY_DIR', os.path.join(DATA_DIR, 'text-similarity-index'))
+TEXT_SIMILARITY_MIN_SIMILARITY = _env_float('TEXT_SIMILARITY_MIN_SIMILARITY', 0.5)
+TEXT_SIMILARITY_REBUILD_WORKERS = _env_int('TEXT_SIMILARITY_REBUILD_WORKERS', os.cpu_count() or 1)
+
+# Palette search (utils/palette_index.py). Clients upsert /analyze results
+# (their dominant colors) under their own diagram id and query
+# /similar-palette with colors or a stored id. Palettes are kept under
+# PALETTE_INDEX_DIR ('' = memory only); matches farther than
+# PALETTE_MAX_DISTANCE (average CIEDE2000 difference between nearest
+# colors) are dropped unless the query asks otherwise.
+PALETTE_INDEX_DIR = os.environ.get('PALETTE_INDEX_DIR', os.path.join(DATA_DIR, 'palette-index'))
+PALETTE_MAX_DISTANCE = _env_float('PALETTE_MAX_DISTANCE', 15.0)
+
+# Autocomplete (utils/term_index.py). Clients upsert /analyze results (their
+# `text_result` or OCR `text`, and `symbols_result`) under their own diagram
+# id and query /autocomplete; the term snapshot and document log are kept
+# under TERM_INDEX_DIR ('' = memory only). Snapshots are written with
+# TERM_INDEX_WORKERS processes.
+TERM_INDEX_DIR = os.environ.get('TERM_INDEX_DIR', os.path.join(DATA_DIR, 'term-index'))
+TERM_INDEX_WORKERS = _env_int('TERM_INDEX_WORKERS', os.cpu_count() or 1)
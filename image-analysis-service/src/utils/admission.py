@@ -0,0 +1,193 @@
+# image-analysis-service/src/utils/admission.py
+import logging
+import math
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Optional
+
+from PIL import Image
+
+from utils.job_queue import QueueFullError
+
+logger = logging.getLogger(__name__)
+
+# Relative cost of each pipeline stage per megapixel. One unit is roughly the
+# CPU time of the quality stage on a 1 MP image.
+STAGE_COST_PER_MEGAPIXEL = {
+    'symbols': 1.5,     # several full-image OCR passes
+    'quality': 1.0,     # blur/noise/FFT metrics plus k-means
+    'diagram_features': 0.3,  # Hough and blob detectors at 1-2k px: 1-5 s for a 12 MP upload
+    'embedding': 0.3,   # decode plus 512 px features: 0.4 s for a 12 MP PNG
+}
+
+# Fixed per-stage overhead (process hand-off, engine start-up) in cost units
+STAGE_BASE_COST = 0.05
+
+# Used when the header cannot be read (SVG or unknown formats)
+UNKNOWN_SIZE_MEGAPIXELS = 0.5
+
+# Retry-After estimates use the durations of this many recent requests per
+# lane, and assume this many seconds per request before any have finished
+RETRY_DURATION_SAMPLES = 50
+RETRY_DEFAULT_SECONDS = 5.0
+
+
+@dataclass
+class ImageHeader:
+    width: int
+    height: int
+    format: Optional[str]
+    frames: int = 1
+
+    @property
+    def megapixels(self) -> float:
+        return (self.width * self.height) / 1000000
+
+
+@dataclass
+class AdmissionTicket:
+    cost: float
+    lane: str
+    header: Optional[ImageHeader]
+    charge: float
+    admitted_at: float = 0.0
+
+
+class BudgetExceededError(QueueFullError):
+    """Raised when admitting a request would exceed the global cost budget"""
+
+    def __init__(self, retry_after, cost):
+        super().__init__(retry_after)
+        self.args = (f"Cost budget exhausted ({cost} units requested), retry after {retry_after}s",)
+        self.cost = cost
+
+
+def read_image_header(image_path):
+    """
+    Read dimensions, format and frame count without decoding pixel data.
+
+    :param image_path: Path to the image file
+    :return: ImageHeader, or None if the file is not a readable raster image
+    """
+    if image_path.lower().endswith('.svg'):
+        return None
+    try:
+        # PIL only parses the header until pixel data is accessed
+        with Image.open(image_path) as img:
+            width, height = img.size
+            return ImageHeader(
+                width=width,
+                height=height,
+                format=img.format,
+                frames=getattr(img, 'n_frames', 1)
+            )
+    except Exception as e:
+        logger.debug(f"Could not read image header for {image_path}: {str(e)}")
+        return None
+
+
+def estimate_cost(header, stages):
+    """
+    Estimate the CPU cost of analyzing an image with the given stages.
+    Every frame of a multi-frame file counts.
+
+    :param header: ImageHeader or None
+    :param stages: Iterable of enabled stage names
+    :return: Cost in budget units
+    """
+    megapixels = header.megapixels * max(1, header.frames) if header is not None else UNKNOWN_SIZE_MEGAPIXELS
+    cost = 0.0
+    for stage in stages:
+        cost += STAGE_BASE_COST + megapixels * STAGE_COST_PER_MEGAPIXEL.get(stage, 1.0)
+    return round(cost, 3)
+
+
+class AdmissionController:
+    """
+    Admits requests against a global cost budget and assigns them a lane.
+
+    Requests up to `fast_lane_max_cost` go to the fast lane, anything larger
+    to the heavy lane. The heavy lane may only use the budget minus
+    `fast_lane_reserve`, so small interactive uploads never wait behind a
+    backlog of large scans. A heavy request larger than its share is charged
+    the whole share, so it runs only when no other heavy work is in flight,
+    and like every request only while the global budget has room for it.
+    """
+
+    def __init__(self, budget, fast_lane_max_cost, fast_lane_reserve):
+        self.budget = budget
+        self.fast_lane_max_cost = fast_lane_max_cost
+        self.heavy_limit = max(0.0, budget - fast_lane_reserve)
+        self._lock = threading.Lock()
+        self._in_use = {'fast': 0.0, 'heavy': 0.0}
+        self._admitted = {'fast': 0, 'heavy': 0}
+        self._durations = {lane: deque(maxlen=RETRY_DURATION_SAMPLES) for lane in ('fast', 'heavy')}
+
+    def lane_for(self, cost):
+        return 'fast' if cost <= self.fast_lane_max_cost else 'heavy'
+
+    def admit(self, header, stages):
+        """
+        Reserve budget for a request.
+
+        :return: AdmissionTicket to pass to release() when the work is done
+        :raises BudgetExceededError: when the budget is exhausted
+        """
+        cost = estimate_cost(header, stages)
+        lane = self.lane_for(cost)
+        with self._lock:
+            total_in_use = self._in_use['fast'] + self._in_use['heavy']
+            if lane == 'heavy':
+                charge = min(cost, self.heavy_limit)
+                fits = self._in_use['heavy'] + charge <= self.heavy_limit
+                fits = fits and total_in_use + charge <= self.budget
+            else:
+                charge = cost
+                fits = total_in_use + charge <= self.budget
+            if not fits:
+                raise BudgetExceededError(self._retry_after(lane, total_in_use, charge), cost)
+            self._in_use[lane] += charge
+            self._admitted[lane] += 1
+        return AdmissionTicket(cost=cost, lane=lane, header=header, charge=charge, admitted_at=time.time())
+
+    def _retry_after(self, lane, total_in_use, charge):
+        """
+        Rough seconds until `charge` fits (caller holds the lock): the share
+        of the work in flight that has to finish first, times how long
+        recent requests on the lane took.
+        """
+        durations = self._durations[lane]
+        average = sum(durations) / len(durations) if durations else RETRY_DEFAULT_SECONDS
+        if lane == 'heavy':
+            excess = max(self._in_use['heavy'] + charge - self.heavy_limit, total_in_use + charge - self.budget)
+            in_flight = self._in_use['heavy']
+        else:
+            excess = total_in_use + charge - self.budget
+            in_flight = total_in_use
+        share = min(1.0, excess / in_flight) if in_flight > 0 else 1.0
+        return max(1, math.ceil(average * share))
+
+    def release(self, ticket, finished=True):
+        """
+        Return a ticket's budget.
+
+        :param finished: False when the request never ran (its queue was
+                         full); its duration then says nothing about retries
+        """
+        with self._lock:
+            self._in_use[ticket.lane] = max(0.0, self._in_use[ticket.lane] - ticket.charge)
+            self._admitted[ticket.lane] -= 1
+            if finished:
+                self._durations[ticket.lane].append(time.time() - ticket.admitted_at)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'budget': self.budget,
+                'heavy_limit': self.heavy_limit,
+                'fast_lane_max_cost': self.fast_lane_max_cost,
+                'in_use': {lane: round(value, 3) for lane, value in self._in_use.items()},
+                'admitted': dict(self._admitted),
+            }
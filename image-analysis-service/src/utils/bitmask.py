@@ -0,0 +1,106 @@
+# image-analysis-service/src/utils/bitmask.py
+"""Binary images stored eight pixels per byte."""
+import cv2
+import numpy as np
+
+# Set bits per byte value, for counting without unpacking
+_POPCOUNT = np.array([bin(value).count('1') for value in range(256)], dtype=np.uint8)
+
+
+class PackedMask:
+    """
+    A two-level image packed with np.packbits along rows.
+
+    Masks from cv2.threshold are 0/255; bitonal images keep their own dark
+    and light levels so unpacking restores them exactly.
+
+    :param bits: Packed rows as returned by np.packbits(..., axis=1)
+    :param shape: (height, width) of the unpacked image
+    :param low: Value of unset pixels
+    :param high: Value of set pixels
+    """
+
+    def __init__(self, bits, shape, low=0, high=255):
+        self.bits = bits
+        self.shape = shape
+        self.low = int(low)
+        self.high = int(high)
+
+    @classmethod
+    def from_array(cls, mask, low=0, high=255):
+        """Pack a 2D array; pixels equal to `high` (or any nonzero pixel for 0/255 masks) are set"""
+        if high == 255 and low == 0:
+            set_pixels = mask > 0
+        else:
+            set_pixels = mask == high
+        return cls(np.packbits(set_pixels, axis=1), mask.shape, low, high)
+
+    @property
+    def nbytes(self):
+        return self.bits.nbytes
+
+    def unpack(self):
+        """The uint8 image, allocated on demand"""
+        image = np.unpackbits(self.bits, axis=1, count=self.shape[1])
+        if self.high - self.low != 1:
+            image *= np.uint8(self.high - self.low)
+        if self.low:
+            image += np.uint8(self.low)
+        return image
+
+    def _region_bits(self, x, y, width, height):
+        """0/1 array of one region, unpacking only the rows and bytes it covers"""
+        first = x // 8
+        bits = np.unpackbits(self.bits[y:y + height, first:-(-(x + width) // 8)], axis=1)
+        return bits[:, x - 8 * first:x - 8 * first + width]
+
+    def unpack_region(self, x, y, width, height):
+        """The uint8 image of one region, see unpack()"""
+        image = self._region_bits(x, y, width, height)
+        if self.high - self.low != 1:
+            image *= np.uint8(self.high - self.low)
+        if self.low:
+            image += np.uint8(self.low)
+        return image
+
+    def region(self, x, y, width, height):
+        """One region, still packed; byte-aligned regions are sliced without unpacking"""
+        if x % 8:
+            bits = np.packbits(self._region_bits(x, y, width, height), axis=1)
+        else:
+            bits = _clear_padding(np.array(self.bits[y:y + height, x // 8:-(-(x + width) // 8)]), width)
+        return PackedMask(bits, (bits.shape[0], width), self.low, self.high)
+
+    def inverted(self):
+        """0/255 mask set where this one is unset"""
+        return PackedMask(_clear_padding(np.invert(self.bits), self.shape[1]), self.shape)
+
+    def count_nonzero(self):
+        """Number of set pixels (padding bits are always zero)"""
+        return int(cv2.sumElems(cv2.LUT(self.bits, _POPCOUNT))[0])
+
+
+def _clear_padding(bits, width):
+    """Zero the bits past `width` in the last byte of each row (modified in place)"""
+    padding = 8 * bits.shape[1] - width
+    if padding:
+        bits[:, -1] &= np.uint8((0xFF << padding) & 0xFF)
+    return bits
+
+
+def as_array(image):
+    """Unpack a PackedMask; arrays are returned unchanged"""
+    return image.unpack() if isinstance(image, PackedMask) else image
+
+
+def two_levels(gray):
+    """
+    (low, high) if the image has at most two distinct values, else None.
+
+    :param gray: Single-channel uint8 image
+    """
+    histogram = cv2.calcHist([gray], [0], None, [256], [0, 256]).ravel()
+    levels = np.flatnonzero(histogram)
+    if len(levels) > 2:
+        return None
+    return int(levels[0]), int(levels[-1])
@@ -0,0 +1,291 @@
+# image-analysis-service/src/utils/cloud_ocr.py
+"""
+Cloud OCR through AWS Textract (DetectDocumentText), paid at most once per
+unique image.
+
+- One boto3 client per process, created on first use; its connection pool
+  is sized to the concurrency limit, and a semaphore caps calls in flight.
+- Results are cached by SHA-256 of the image bytes: in memory (LRU) and as
+  JSON under a cache directory shared by the worker processes. Concurrent
+  requests for the same image wait for the first call instead of repeating it.
+- Images beyond the API limits (TEXTRACT_MAX_BYTES, TEXTRACT_MAX_SIDE) or in
+  formats it does not take are downscaled / re-encoded before upload.
+- Throttling and server errors are retried with exponential backoff and
+  full jitter; botocore's own retries are turned off so only this loop
+  retries.
+
+The endpoint can be overridden (config.TEXTRACT_ENDPOINT_URL) to run
+against a local stub, see benchmarks/textract_stub.py.
+"""
+import hashlib
+import json
+import logging
+import os
+import random
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import asdict, dataclass, field
+from typing import List
+
+import cv2
+import numpy as np
+
+import config
+
+logger = logging.getLogger(__name__)
+
+# DetectDocumentText limits for synchronous calls
+TEXTRACT_MAX_BYTES = 10 * 1024 * 1024
+TEXTRACT_MAX_SIDE = 10000
+
+# Error codes worth retrying: throttling and transient server errors
+TEXTRACT_RETRY_ERRORS = (
+    'ThrottlingException', 'ProvisionedThroughputExceededException',
+    'LimitExceededException', 'InternalServerError', 'ServiceUnavailable',
+)
+# Backoff before retry n is uniform in [0, min(MAX, BASE * 2**n)] seconds
+TEXTRACT_BACKOFF_BASE = 0.2
+TEXTRACT_BACKOFF_MAX = 5.0
+
+# Formats sent as they are (by magic bytes); anything else is re-encoded as PNG
+_UPLOAD_FORMATS = (b'\x89PNG', b'\xff\xd8\xff', b'II*\x00', b'MM\x00*')
+# JPEG quality used when a PNG would exceed TEXTRACT_MAX_BYTES
+_UPLOAD_JPEG_QUALITY = 90
+
+
+@dataclass
+class CloudOcrResult:
+    """
+    Lines of text read by the cloud engine.
+
+    :param confidence: Mean line confidence, 0-100
+    :param cached: True if no API call was made for this result
+    """
+    lines: List[str] = field(default_factory=list)
+    confidence: float = 0.0
+    cached: bool = False
+
+    @property
+    def text(self):
+        return "\n".join(self.lines).strip()
+
+    def to_dict(self):
+        return {**asdict(self), 'text': self.text}
+
+
+def _fit_to_limits(data, max_bytes=TEXTRACT_MAX_BYTES, max_side=TEXTRACT_MAX_SIDE):
+    """
+    Image bytes the API accepts: `data` itself if it is within the limits,
+    else downscaled to `max_side` and re-encoded (PNG, then JPEG, then
+    smaller) until it fits `max_bytes`.
+
+    :raises ValueError: if the bytes are not a decodable image
+    """
+    # Only on cache misses, next to a network call: decoding is cheap here
+    image = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_UNCHANGED)
+    if image is None:
+        raise ValueError("Not a decodable image")
+    if data.startswith(_UPLOAD_FORMATS) and len(data) <= max_bytes and max(image.shape[:2]) <= max_side:
+        return data
+
+    if image.dtype != np.uint8:
+        image = cv2.convertScaleAbs(image, alpha=255.0 / max(1, int(image.max())))
+    scale = min(1.0, max_side / float(max(image.shape[:2])))
+    while True:
+        if scale < 1.0:
+            resized = cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        else:
+            resized = image
+        encoded = cv2.imencode('.png', resized)[1]
+        if encoded.size > max_bytes:
+            encoded = cv2.imencode('.jpg', resized, [cv2.IMWRITE_JPEG_QUALITY, _UPLOAD_JPEG_QUALITY])[1]
+        if encoded.size <= max_bytes:
+            logger.debug(f"Upload re-encoded at scale {scale:.2f}: {len(data)} -> {encoded.size} bytes")
+            return encoded.tobytes()
+        # Bytes shrink roughly with area
+        scale *= 0.9 * np.sqrt(max_bytes / float(encoded.size))
+
+
+class TextractClient:
+    """
+    Pooled, cached and concurrency-limited Textract client; see the module
+    docstring. Thread-safe; create one per process (get_textract()).
+
+    :param cache_dir: Directory for the shared result cache, or None for memory only
+    """
+
+    def __init__(self, region=None, endpoint_url=None, max_concurrency=4, max_attempts=5,
+                 timeout=30, cache_size=256, cache_dir=None,
+                 backoff_base=TEXTRACT_BACKOFF_BASE, backoff_max=TEXTRACT_BACKOFF_MAX):
+        self.region = region
+        self.endpoint_url = endpoint_url
+        self.max_concurrency = max(1, max_concurrency)
+        self.max_attempts = max(1, max_attempts)
+        self.timeout = timeout
+        self.cache_size = cache_size
+        self.cache_dir = cache_dir
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
+        self._client = None
+        self._client_lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(self.max_concurrency)
+        self._cache = OrderedDict()
+        self._in_flight = {}
+        self._lock = threading.Lock()
+        self._stats = {'requests': 0, 'api_calls': 0, 'cache_hits': 0, 'retries': 0, 'failures': 0}
+
+    def _boto_client(self):
+        if self._client is None:
+            with self._client_lock:
+                if self._client is None:
+                    import boto3
+                    from botocore.config import Config
+                    # Credentials: the README's AWS_ACCESS_KEY / AWS_SECRET_KEY, else boto3's default chain
+                    self._client = boto3.client(
+                        'textract',
+                        region_name=self.region,
+                        endpoint_url=self.endpoint_url,
+                        aws_access_key_id=os.environ.get('AWS_ACCESS_KEY') or None,
+                        aws_secret_access_key=os.environ.get('AWS_SECRET_KEY') or None,
+                        config=Config(
+                            max_pool_connections=self.max_concurrency,
+                            connect_timeout=self.timeout,
+                            read_timeout=self.timeout,
+                            retries={'total_max_attempts': 1},
+                        )
+                    )
+        return self._client
+
+    def _count(self, key):
+        with self._lock:
+            self._stats[key] += 1
+
+    def _cache_path(self, digest):
+        return os.path.join(self.cache_dir, f"{digest}.json") if self.cache_dir else None
+
+    def _cached(self, digest):
+        with self._lock:
+            if digest in self._cache:
+                self._cache.move_to_end(digest)
+                return self._cache[digest]
+        path = self._cache_path(digest)
+        if path and os.path.exists(path):
+            try:
+                with open(path) as f:
+                    result = CloudOcrResult(**json.load(f))
+            except (OSError, ValueError, TypeError) as e:
+                logger.warning(f"Ignoring unreadable OCR cache entry {path}: {str(e)}")
+                return None
+            self._remember(digest, result, persist=False)
+            return result
+        return None
+
+    def _remember(self, digest, result, persist=True):
+        with self._lock:
+            self._cache[digest] = result
+            self._cache.move_to_end(digest)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        path = self._cache_path(digest)
+        if persist and path:
+            try:
+                os.makedirs(self.cache_dir, exist_ok=True)
+                # Write then rename, so other processes never read a partial file
+                temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}"
+                with open(temp_path, 'w') as f:
+                    json.dump({'lines': result.lines, 'confidence': result.confidence}, f)
+                os.replace(temp_path, path)
+            except OSError as e:
+                logger.warning(f"Could not cache OCR result at {path}: {str(e)}")
+
+    def _call(self, data):
+        """DetectDocumentText with retries on throttling; returns the response"""
+        from botocore.exceptions import ClientError
+
+        for attempt in range(self.max_attempts):
+            try:
+                with self._slots:
+                    self._count('api_calls')
+                    return self._boto_client().detect_document_text(Document={'Bytes': data})
+            except ClientError as e:
+                code = e.response.get('Error', {}).get('Code', '')
+                if code not in TEXTRACT_RETRY_ERRORS or attempt == self.max_attempts - 1:
+                    raise
+                delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+                logger.warning(f"Textract {code}, retry {attempt + 1} in {delay:.2f}s")
+                self._count('retries')
+                time.sleep(delay)
+
+    def detect_text(self, data):
+        """
+        Text lines in an image.
+
+        :param data: Encoded image bytes (PNG, JPEG, TIFF, or anything OpenCV decodes)
+        :return: CloudOcrResult
+        :raises ValueError: if `data` is not an image
+        :raises botocore.exceptions.BotoCoreError, ClientError: if the call fails after retries
+        """
+        self._count('requests')
+        digest = hashlib.sha256(data).hexdigest()
+        while True:
+            cached = self._cached(digest)
+            if cached is not None:
+                self._count('cache_hits')
+                return CloudOcrResult(cached.lines, cached.confidence, cached=True)
+            with self._lock:
+                pending = self._in_flight.get(digest)
+                if pending is None:
+                    self._in_flight[digest] = threading.Event()
+                    break
+            # Same image being read by another thread; use its result
+            pending.wait()
+
+        try:
+            response = self._call(_fit_to_limits(data))
+            lines = [block for block in response.get('Blocks', []) if block.get('BlockType') == 'LINE']
+            confidences = [block.get('Confidence', 0.0) for block in lines]
+            result = CloudOcrResult(
+                [block.get('Text', '') for block in lines],
+                float(np.mean(confidences)) if confidences else 0.0
+            )
+            self._remember(digest, result)
+            return result
+        except Exception:
+            self._count('failures')
+            raise
+        finally:
+            with self._lock:
+                self._in_flight.pop(digest).set()
+
+    def detect_file(self, path):
+        """detect_text() on the contents of a file"""
+        with open(path, 'rb') as f:
+            return self.detect_text(f.read())
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, cached_results=len(self._cache), max_concurrency=self.max_concurrency)
+
+
+_textract = None
+_textract_lock = threading.Lock()
+
+
+def get_textract():
+    """This process's TextractClient, built from config on first use"""
+    global _textract
+    if _textract is None:
+        with _textract_lock:
+            if _textract is None:
+                _textract = TextractClient(
+                    region=config.TEXTRACT_REGION,
+                    endpoint_url=config.TEXTRACT_ENDPOINT_URL,
+                    max_concurrency=config.TEXTRACT_MAX_CONCURRENCY,
+                    max_attempts=config.TEXTRACT_MAX_ATTEMPTS,
+                    timeout=config.TEXTRACT_TIMEOUT_SECONDS,
+                    cache_size=config.TEXTRACT_CACHE_SIZE,
+                    cache_dir=config.TEXTRACT_CACHE_DIR or None
+                )
+    return _textract
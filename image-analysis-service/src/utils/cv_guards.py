@@ -0,0 +1,101 @@
+# image-analysis-service/src/utils/cv_guards.py
+"""Input guards that keep Hough transforms bounded on noisy images."""
+import cv2
+import numpy as np
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Above this many edge pixels the edge map is thinned before voting
+MAX_HOUGH_EDGE_PIXELS = 250000
+# Never hand more lines than this to Python-level loops
+MAX_HOUGH_LINES = 2000
+# HoughCircles estimates a radius for every candidate center from the edge
+# pixels within maxRadius of it, so its cost grows much faster than the edge
+# count: with radii up to 200, 15 s at 170k edge pixels (a 3 MP diagram) and
+# 0.6 s at 50k; 150 s at 1.1M with radii up to 100 (a 3 MP photo of texture).
+# Above this count the image is halved until it fits.
+MAX_CIRCLE_EDGE_PIXELS = 50000
+MAX_HOUGH_CIRCLES = 500
+
+
+def thin_edges(edges, max_pixels=MAX_HOUGH_EDGE_PIXELS):
+    """
+    Keep at most `max_pixels` edge pixels by taking every k-th one.
+
+    :return: Tuple of (edge map, stride k). k == 1 means the map is unchanged.
+    """
+    count = cv2.countNonZero(edges)
+    if count <= max_pixels:
+        return edges, 1
+    stride = int(np.ceil(count / max_pixels))
+    ys, xs = np.nonzero(edges)
+    thinned = np.zeros_like(edges)
+    thinned[ys[::stride], xs[::stride]] = 255
+    logger.debug(f"Thinned edge map from {count} to {len(ys[::stride])} pixels (stride {stride})")
+    return thinned, stride
+
+
+def hough_lines_p(edges, rho, theta, threshold, minLineLength=0, maxLineGap=0, max_lines=MAX_HOUGH_LINES):
+    """
+    cv2.HoughLinesP with a capped edge-pixel count and a capped result size.
+
+    Vote thresholds and gap tolerance are scaled with the thinning stride so
+    lines survive thinning. When too many lines are found, the longest are kept.
+    """
+    edges, stride = thin_edges(edges)
+    lines = cv2.HoughLinesP(
+        edges, rho, theta,
+        threshold=max(1, int(threshold // stride)),
+        minLineLength=minLineLength,
+        maxLineGap=maxLineGap + stride - 1
+    )
+    if lines is None or len(lines) <= max_lines:
+        return lines
+    segments = lines[:, 0, :].astype(np.float32)
+    lengths = np.hypot(segments[:, 2] - segments[:, 0], segments[:, 3] - segments[:, 1])
+    keep = np.argsort(lengths)[::-1][:max_lines]
+    return lines[np.sort(keep)]
+
+
+def hough_lines(edges, rho, theta, threshold, max_lines=MAX_HOUGH_LINES):
+    """cv2.HoughLines with a capped edge-pixel count; keeps the strongest lines"""
+    edges, stride = thin_edges(edges)
+    lines = cv2.HoughLines(edges, rho, theta, threshold=max(1, int(threshold // stride)))
+    if lines is None:
+        return None
+    # HoughLines returns lines ordered by accumulator votes
+    return lines[:max_lines]
+
+
+def hough_circles(gray, dp, minDist, param1=100, param2=100, minRadius=0, maxRadius=0,
+                  max_edge_pixels=MAX_CIRCLE_EDGE_PIXELS, max_circles=MAX_HOUGH_CIRCLES):
+    """
+    cv2.HoughCircles (HOUGH_GRADIENT) with a capped edge-pixel count and a
+    capped result size.
+
+    The edge count is that of the Canny pass HoughCircles runs internally.
+    While it is above `max_edge_pixels` the image is halved with pyrDown;
+    distances and radii are scaled with it and the circles found are mapped
+    back to the original coordinates. The vote threshold is kept: lowered
+    with the scale, it lets hundreds of spurious circles through on a halved
+    diagram, each of which costs a radius search.
+    """
+    scale = 1
+    while (cv2.countNonZero(cv2.Canny(gray, max(1, param1 // 2), param1)) > max_edge_pixels
+           and min(gray.shape[:2]) >= 64):
+        gray = cv2.pyrDown(gray)
+        scale *= 2
+    if scale > 1:
+        logger.debug(f"Reduced image {scale}x for HoughCircles")
+    circles = cv2.HoughCircles(
+        gray, cv2.HOUGH_GRADIENT, dp=dp, minDist=max(1, minDist / scale),
+        param1=param1, param2=param2,
+        minRadius=minRadius // scale, maxRadius=max(1, maxRadius // scale) if maxRadius > 0 else 0
+    )
+    if circles is None:
+        return None
+    # Circles are ordered by accumulator votes
+    circles = circles[:, :max_circles]
+    circles *= scale
+    return circles
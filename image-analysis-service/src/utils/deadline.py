@@ -0,0 +1,92 @@
+# image-analysis-service/src/utils/deadline.py
+import time
+
+
+class DeadlineExceeded(Exception):
+    """Raised by Deadline.check() once the time budget is used up"""
+    pass
+
+
+def budget_seconds(value, default_seconds=None):
+    """
+    Seconds of a header value in milliseconds, without starting the clock
+    (for jobs, whose deadline starts when a worker picks them up).
+
+    :param value: Header value or None; "0" disables the deadline
+    :param default_seconds: Used when no header is given (None or 0 = unlimited)
+    :return: Seconds, or None for no deadline
+    :raises ValueError: if the value is not a number
+    """
+    if value is not None:
+        milliseconds = float(value)
+        return milliseconds / 1000.0 if milliseconds > 0 else None
+    return default_seconds if default_seconds else None
+
+
+class Deadline:
+    """
+    Wall-clock time budget for one request.
+
+    Uses absolute wall time so it stays valid when handed to a worker
+    process. A Deadline created with `seconds=None` never expires.
+    """
+
+    def __init__(self, seconds=None, expires_at=None):
+        if expires_at is None and seconds is not None:
+            expires_at = time.time() + seconds
+        self.expires_at = expires_at
+
+    @classmethod
+    def from_milliseconds(cls, value, default_seconds=None):
+        """
+        Build a deadline from a header value in milliseconds, starting now.
+
+        :param value: Header value or None; "0" disables the deadline
+        :param default_seconds: Used when no header is given (None or 0 = unlimited)
+        :raises ValueError: if the value is not a number
+        """
+        return cls(budget_seconds(value, default_seconds))
+
+    @property
+    def limited(self):
+        return self.expires_at is not None
+
+    def remaining(self):
+        """Seconds left, or None if unlimited"""
+        if self.expires_at is None:
+            return None
+        return max(0.0, self.expires_at - time.time())
+
+    def expired(self):
+        return self.expires_at is not None and time.time() >= self.expires_at
+
+    def check(self, what=None):
+        """Raise DeadlineExceeded if the budget is used up"""
+        if self.expired():
+            raise DeadlineExceeded(f"Deadline exceeded{' during ' + what if what else ''}")
+
+    def for_stage(self, shares, stage, pending_stages):
+        """
+        Budget for one stage: its share of the time remaining, relative to the
+        shares of all stages that have not run yet.
+
+        :param shares: Dict of stage name -> relative weight
+        :param stage: Stage about to run
+        :param pending_stages: Stages not yet run, including `stage`
+        :return: A new Deadline that never outlives this one
+        """
+        if self.expires_at is None:
+            return Deadline()
+        total = sum(shares.get(name, 1.0) for name in pending_stages) or 1.0
+        budget = self.remaining() * shares.get(stage, 1.0) / total
+        return Deadline(expires_at=min(self.expires_at, time.time() + budget))
+
+    def to_dict(self):
+        remaining = self.remaining()
+        return {'remaining_ms': round(remaining * 1000) if remaining is not None else None}
+
+
+def check_deadline(deadline, what=None):
+    """Cooperative check for functions whose deadline argument is optional"""
+    if deadline is not None:
+        deadline.check(what)
@@ -0,0 +1,255 @@
+# image-analysis-service/src/utils/decode.py
+"""
+Decode images at the cheapest representation the consumers need.
+
+Each consumer declares a DecodeRequirement (channels and the smallest long
+side it can work with). Requirements are merged, the image is decoded once,
+and every consumer takes a view of it. JPEGs are downscaled in the DCT
+domain by libjpeg (IMREAD_REDUCED_*), which makes the decode itself cheaper;
+other formats are decoded in full and then reduced.
+"""
+import logging
+from dataclasses import dataclass
+from typing import Optional
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from utils.bitmask import PackedMask, two_levels
+from utils.preprocessor import Preprocessor
+
+logger = logging.getLogger(__name__)
+
+# Power-of-two factors libjpeg can apply while decoding
+REDUCTION_FACTORS = (8, 4, 2)
+
+REDUCED_FLAGS = {
+    (1, 1): cv2.IMREAD_GRAYSCALE,
+    (1, 2): cv2.IMREAD_REDUCED_GRAYSCALE_2,
+    (1, 4): cv2.IMREAD_REDUCED_GRAYSCALE_4,
+    (1, 8): cv2.IMREAD_REDUCED_GRAYSCALE_8,
+    (3, 1): cv2.IMREAD_COLOR,
+    (3, 2): cv2.IMREAD_REDUCED_COLOR_2,
+    (3, 4): cv2.IMREAD_REDUCED_COLOR_4,
+    (3, 8): cv2.IMREAD_REDUCED_COLOR_8,
+}
+
+
+@dataclass(frozen=True)
+class DecodeRequirement:
+    """
+    What a consumer needs from the decoded pixels.
+
+    :param channels: 1 if grayscale is enough, 3 for BGR
+    :param min_long_side: Smallest acceptable long side in pixels, None for full resolution
+    """
+    channels: int = 3
+    min_long_side: Optional[int] = None
+
+    def merge(self, other):
+        """The cheapest requirement that satisfies both"""
+        if self.min_long_side is None or other.min_long_side is None:
+            min_long_side = None
+        else:
+            min_long_side = max(self.min_long_side, other.min_long_side)
+        return DecodeRequirement(max(self.channels, other.channels), min_long_side)
+
+
+FULL_COLOR = DecodeRequirement(channels=3)
+FULL_GRAY = DecodeRequirement(channels=1)
+
+
+def merge_requirements(requirements):
+    """Merge an iterable of requirements; None if it is empty"""
+    merged = None
+    for requirement in requirements:
+        merged = requirement if merged is None else merged.merge(requirement)
+    return merged
+
+
+def reduction_factor(width, height, requirement):
+    """Largest power-of-two downscale that keeps the long side above the requirement"""
+    if requirement.min_long_side is None:
+        return 1
+    long_side = max(width, height)
+    for factor in REDUCTION_FACTORS:
+        if long_side / factor >= requirement.min_long_side:
+            return factor
+    return 1
+
+
+# Content tonality, detected once at decode time
+COLOR = 'color'
+GRAYSCALE = 'grayscale'
+BITONAL = 'bitonal'
+
+# Largest per-pixel channel spread still treated as gray (JPEG chroma noise)
+GRAYSCALE_TOLERANCE = 4
+
+# Pixels checked before scanning the whole image for color
+TONALITY_SAMPLE_PIXELS = 65536
+
+# PIL modes that are single-channel on disk
+GRAY_MODES = ('1', 'L', 'LA', 'I;16', 'I;16B', 'I')
+
+
+def to_gray(image):
+    """Grayscale version of an image; single-channel input is returned as is"""
+    return image if image.ndim == 2 else cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+
+
+def is_grayscale(image, tolerance=GRAYSCALE_TOLERANCE):
+    """True if no pixel of a BGR image has channels further apart than `tolerance`"""
+    if image.ndim == 2:
+        return True
+    # A strided sample rejects most color images without a full pass
+    step = max(1, int(np.sqrt(image.shape[0] * image.shape[1] / TONALITY_SAMPLE_PIXELS)))
+    for candidate in (image[::step, ::step], image):
+        b, g, r = cv2.split(np.ascontiguousarray(candidate))
+        spread = cv2.absdiff(cv2.max(cv2.max(b, g), r), cv2.min(cv2.min(b, g), r))
+        if cv2.minMaxLoc(spread)[1] > tolerance:
+            return False
+    return True
+
+
+class DecodedImage:
+    """
+    Decoded pixels plus the factor they were reduced by.
+
+    Grayscale content is kept single-channel whatever the file stores;
+    bitonal content (two gray levels) is kept bit-packed, in its views too,
+    and unpacked only when a consumer reads `image`. Consumers that work on
+    two levels read `packed` (or `pixels`) instead.
+
+    :param image: uint8 array, HxW (grayscale) or HxWx3 (BGR); None if packed
+    :param scale: Downscale factor relative to the file (1 = full resolution)
+    :param tonality: COLOR, GRAYSCALE or BITONAL
+    :param packed: PackedMask holding a bitonal image
+    """
+
+    def __init__(self, image=None, scale=1, tonality=COLOR, packed=None):
+        self._image = image
+        self.scale = scale
+        self.tonality = tonality
+        self.packed = packed
+        self._preprocessors = {}
+
+    @classmethod
+    def from_pixels(cls, image, scale=1):
+        """Detect tonality and store the cheapest lossless representation"""
+        if image.ndim == 3 and not is_grayscale(image):
+            return cls(image=image, scale=scale, tonality=COLOR)
+        gray = to_gray(image)
+        levels = two_levels(gray)
+        if levels is None:
+            return cls(image=gray, scale=scale, tonality=GRAYSCALE)
+        low, high = levels
+        return cls(scale=scale, tonality=BITONAL, packed=PackedMask.from_array(gray, low, high))
+
+    @property
+    def image(self):
+        return self._image if self._image is not None else self.packed.unpack()
+
+    @property
+    def pixels(self):
+        """The PackedMask of bitonal content, else the array; for consumers that accept both"""
+        return self.packed if self.packed is not None else self._image
+
+    @property
+    def shape(self):
+        return self._image.shape if self._image is not None else self.packed.shape
+
+    @property
+    def nbytes(self):
+        return self._image.nbytes if self._image is not None else self.packed.nbytes
+
+    @property
+    def channels(self):
+        return 1 if len(self.shape) == 2 else self.shape[2]
+
+    def view(self, requirement):
+        """
+        A representation for one consumer, derived without decoding again.
+
+        Grayscale and bitonal content stays single-channel even when the
+        consumer accepts BGR; consumers handle both. Bitonal content at full
+        size stays packed.
+        """
+        if self.packed is not None and reduction_factor(self.shape[1], self.shape[0], requirement) == 1:
+            return DecodedImage(scale=self.scale, tonality=BITONAL, packed=self.packed)
+        image = self.image
+        if requirement.channels == 1 and image.ndim == 3:
+            image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+
+        height, width = image.shape[:2]
+        factor = reduction_factor(width, height, requirement)
+        if factor > 1:
+            image = cv2.resize(
+                image, (max(1, width // factor), max(1, height // factor)),
+                interpolation=cv2.INTER_AREA
+            )
+        # Area averaging introduces intermediate levels
+        tonality = GRAYSCALE if self.tonality == BITONAL and factor > 1 else self.tonality
+        if image.ndim == 2 and tonality == COLOR:
+            tonality = GRAYSCALE
+        return DecodedImage(image=image, scale=self.scale * factor, tonality=tonality)
+
+    def preprocessor(self, requirement, crop=None):
+        """
+        Preprocessor over one view (optionally cropped), shared by every
+        stage that asks for the same view, so preprocessing chains run once
+        per analysis.
+
+        :param crop: ContentCrop applied to the view, or None
+        """
+        key = (requirement, None if crop is None else (crop.x, crop.y, crop.width, crop.height))
+        if key not in self._preprocessors:
+            view = self.view(requirement)
+            packed = view.packed
+            if packed is None:
+                image = view.image if crop is None else crop.apply(view.image)
+            else:
+                # Bitonal: only the crop is unpacked, and the packed copy is kept for binary variants
+                if crop is not None:
+                    packed = packed.region(crop.x, crop.y, crop.width, crop.height)
+                image = packed.unpack()
+            self._preprocessors[key] = Preprocessor(image, packed=packed)
+        return self._preprocessors[key]
+
+
+def decode_image(image_path, requirement=FULL_COLOR):
+    """
+    Decode an image at the cheapest representation that meets `requirement`.
+
+    Files stored as grayscale are decoded single-channel; color files whose
+    content turns out to be gray are reduced to one channel after decoding.
+
+    :param image_path: Path to the image file
+    :param requirement: DecodeRequirement
+    :return: DecodedImage
+    :raises ValueError: if the file cannot be decoded
+    """
+    try:
+        with Image.open(image_path) as img:
+            width, height = img.size
+            image_format = img.format
+            gray_file = img.mode in GRAY_MODES
+    except Exception as e:
+        raise ValueError(f"Unable to read image at {image_path}: {str(e)}")
+
+    channels = 1 if gray_file else requirement.channels
+    factor = reduction_factor(width, height, requirement)
+    if image_format == 'JPEG':
+        # libjpeg scales while decoding (and skips chroma for grayscale)
+        image = cv2.imread(image_path, REDUCED_FLAGS[(channels, factor)])
+        if image is None:
+            raise ValueError(f"Unable to read image at {image_path}")
+        return DecodedImage.from_pixels(image, scale=factor)
+
+    image = cv2.imread(image_path, REDUCED_FLAGS[(channels, 1)])
+    if image is None:
+        raise ValueError(f"Unable to read image at {image_path}")
+    if factor > 1:
+        image = DecodedImage(image=image).view(requirement).image
+    return DecodedImage.from_pixels(image, scale=factor)
@@ -2,14 +2,26 @@
 import cv2
 import numpy as np
 import logging
-import traceback
 from enum import Enum
 from dataclasses import dataclass
 from typing import Dict, List, Any, Tuple, Optional
+from utils.cv_guards import hough_circles, hough_lines_p
+from utils.deadline import check_deadline
+from utils.decode import DecodeRequirement, decode_image, to_gray
+from utils.bitmask import PackedMask
+from utils.trim import find_content_crop
+from utils.text_regions import close_text_mask
 
 # Configure logging
 logger = logging.getLogger(__name__)
 
+# Classification and the shape detectors work on a modest size; larger
+# images are decoded at a power-of-two reduction (color for the histogram).
+# Their areas and radii are in pixels, sized for exports of 1-2k px, and
+# their cost grows faster than the pixel count: 12 MP uploads are measured
+# at half size, 2-6x faster (benchmarks/diagram_features.py).
+DIAGRAM_FEATURES_REQUIREMENT = DecodeRequirement(channels=3, min_long_side=1024)
+
 class DiagramType(Enum):
     BAR_CHART = "bar_chart"
     LINE_GRAPH = "line_graph"
@@ -37,60 +49,111 @@ class DiagramFeatures:
             "specific_features": self.specific_features
         }
 
-def extract_diagram_features(image_path: str) -> DiagramFeatures:
+def extract_diagram_features(image_path: str, deadline=None, decoded=None, crop=None) -> DiagramFeatures:
     """
     Extract features from a diagram image
     
     :param image_path: Path to the diagram image
+    :param deadline: Optional Deadline checked between steps; raises DeadlineExceeded
+    :param decoded: Optional DecodedImage to take a view of instead of decoding again
+    :param crop: ContentCrop of `decoded` found by the caller (None if not worth
+                 trimming); only used with `decoded`, otherwise found here
     :return: DiagramFeatures object containing extracted features
     """
-    try:
-        logger.info(f"Extracting features from diagram: {image_path}")
-        
-        # Read the image
-        image = cv2.imread(image_path)
-        if image is None:
-            logger.error(f"Failed to read image at {image_path}")
-            raise ValueError(f"Unable to read image at {image_path}")
-            
-        # Extract general features (common to all diagram types)
-        general_features = extract_general_features(image)
-        
-        # Classify diagram type
-        diagram_type, confidence = classify_diagram_type(image)
-        logger.info(f"Classified diagram as {diagram_type.value} with confidence {confidence:.2f}")
-        
-        # Extract type-specific features
-        specific_features = extract_specific_features(image, diagram_type)
-        
-        return DiagramFeatures(
-            diagram_type=diagram_type,
-            type_confidence=confidence,
-            general_features=general_features,
-            specific_features=specific_features
-        )
-        
-    except Exception as e:
-        logger.error(f"Error extracting diagram features: {str(e)}")
-        logger.error(traceback.format_exc())
-        return DiagramFeatures(
-            diagram_type=DiagramType.UNKNOWN,
-            type_confidence=0.0,
-            general_features={"error": str(e)},
-            specific_features={}
-        )
-
-def extract_general_features(image: np.ndarray) -> Dict[str, Any]:
+    logger.info(f"Extracting features from diagram: {image_path}")
+    
+    # Read the image
+    if decoded is not None:
+        view = decoded.view(DIAGRAM_FEATURES_REQUIREMENT)
+        if crop is not None:
+            crop = crop.reduced(view.scale // decoded.scale)
+    else:
+        view = decode_image(image_path, DIAGRAM_FEATURES_REQUIREMENT)
+        crop = find_content_crop(view.packed if view.packed is not None else to_gray(view.image))
+    full_height, full_width = view.shape[:2]
+
+    # Detectors only need the content; blank canvas around it is cropped.
+    # Bitonal images stay packed until then, and only the crop is unpacked.
+    packed = view.packed
+    if packed is not None:
+        if crop is not None:
+            packed = packed.region(crop.x, crop.y, crop.width, crop.height)
+        image = packed.unpack()
+    else:
+        image = view.image if crop is None else crop.apply(view.image)
+        
+    # Dark-on-light foreground mask shared by several detectors, kept bit-packed
+    foreground = otsu_foreground_mask(to_gray(image), packed)
+
+    # Extract general features (common to all diagram types)
+    general_features = extract_general_features(image, foreground)
+    dimensions = general_features["dimensions"]
+    if crop is not None:
+        # Densities are reported for the whole frame; the margin has no content
+        general_features["edge_density"] = crop.to_full_density(general_features["edge_density"])
+        general_features["estimated_text_area"] = crop.to_full_density(general_features["estimated_text_area"])
+        x, y, width, height = crop.to_original_box(0, 0, crop.width, crop.height)
+        general_features["content_bbox"] = {
+            "x": x * view.scale, "y": y * view.scale,
+            "width": width * view.scale, "height": height * view.scale
+        }
+    # Report the size of the file, not of the crop or the reduced decode
+    dimensions["width"] = full_width * view.scale
+    dimensions["height"] = full_height * view.scale
+    dimensions["aspect_ratio"] = full_width / full_height
+    if view.scale > 1:
+        general_features["analysis_scale"] = 1 / view.scale
+    check_deadline(deadline, "diagram classification")
+    
+    # Classify diagram type
+    diagram_type, confidence = classify_diagram_type(image, foreground, deadline)
+    logger.info(f"Classified diagram as {diagram_type.value} with confidence {confidence:.2f}")
+    check_deadline(deadline, "diagram specific features")
+    
+    # Extract type-specific features
+    specific_features = extract_specific_features(image, diagram_type, foreground)
+    
+    return DiagramFeatures(
+        diagram_type=diagram_type,
+        type_confidence=confidence,
+        general_features=general_features,
+        specific_features=specific_features
+    )
+
+def otsu_foreground_mask(gray: np.ndarray, packed: Optional[PackedMask] = None) -> PackedMask:
+    """
+    Inverted Otsu threshold (dark strokes set), packed 8 pixels per byte
+    
+    :param gray: Single-channel image
+    :param packed: The image's own PackedMask if it is bitonal. Otsu splits
+                   two levels between them, so the mask is its complement,
+                   taken without thresholding the unpacked image.
+    """
+    if packed is not None and packed.low < packed.high:
+        return packed.inverted()
+    _, mask = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
+    return PackedMask.from_array(mask)
+
+def _foreground(gray: np.ndarray, foreground: Optional[PackedMask]) -> np.ndarray:
+    """Unpacked foreground mask, computed here if none was shared"""
+    if foreground is not None:
+        return foreground.unpack()
+    _, mask = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
+    return mask
+
+def extract_general_features(image: np.ndarray, foreground: Optional[PackedMask] = None) -> Dict[str, Any]:
     """
     Extract general features common to all diagram types
     
-    :param image: Image as numpy array
+    :param image: Image as numpy array (BGR or single-channel)
+    :param foreground: Optional shared otsu_foreground_mask() of the image
     :return: Dictionary of general features
     """
     features = {}
     
     # Image dimensions
-    height, width, channels = image.shape
+    height, width = image.shape[:2]
+    channels = 1 if image.ndim == 2 else image.shape[2]
     features["dimensions"] = {
         "width": width,
         "height": height,
@@ -113,7 +176,7 @@ def extract_general_features(image: np.ndarray) -> Dict[str, Any]:
         color_count = np.sum(hist > 0.01)  # Count colors above 1% threshold
         
         features["color_count"] = int(color_count)
-        features["is_colorful"] = color_count > 10  # Arbitrary threshold
+        features["is_colorful"] = bool(color_count > 10)  # Arbitrary threshold
     else:
         features["color_count"] = 0
         features["is_colorful"] = False
@@ -123,38 +186,71 @@ def extract_general_features(image: np.ndarray) -> Dict[str, Any]:
     features["has_light_background"] = is_light_bg
     
     # Edge complexity
-    edges = cv2.Canny(cv2.cvtColor(image, cv2.COLOR_BGR2GRAY), 100, 200)
+    gray = to_gray(image)
+    edges = cv2.Canny(gray, 100, 200)
     edge_pixels = np.count_nonzero(edges)
     features["edge_density"] = edge_pixels / (width * height)
     
     # Text region estimation (rough approximation)
-    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-    _, text_mask = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
-    text_pixels = np.count_nonzero(text_mask)
+    if foreground is None:
+        foreground = otsu_foreground_mask(gray)
+    text_pixels = foreground.count_nonzero()
     features["estimated_text_area"] = text_pixels / (width * height)
     
     return features
 
-def classify_diagram_type(image: np.ndarray) -> Tuple[DiagramType, float]:
+def classify_diagram_type(image: np.ndarray, foreground: Optional[PackedMask] = None,
+                           deadline=None) -> Tuple[DiagramType, float]:
     """
     Classify the type of diagram based on visual features
     
-    :param image: Image as numpy array
+    :param image: Image as numpy array (BGR or single-channel)
+    :param foreground: Optional shared otsu_foreground_mask() of the image
+    :param deadline: Optional Deadline checked between detectors; raises DeadlineExceeded
     :return: Tuple of (DiagramType, confidence_score)
     """
     # Convert to grayscale for analysis
-    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    gray = to_gray(image)
     
     # Detect various visual elements
     has_vertical_bars = detect_vertical_bars(gray)
     has_horizontal_bars = detect_horizontal_bars(gray)
     has_lines = detect_lines(gray)
+    check_deadline(deadline, "diagram classification")
+    # Blob detection is the slowest detector on photos; counted once and shared
     has_points = detect_points(gray)
+    check_deadline(deadline, "diagram classification")
     has_circles = detect_circles(gray)
     has_arrows = detect_arrows(gray)
-    has_boxes = detect_rectangular_shapes(gray)
-    has_network = detect_network_pattern(gray)
+    has_boxes = detect_rectangular_shapes(gray, foreground)
+    has_network = detect_network_pattern(gray, has_points, has_lines)
+    check_deadline(deadline, "diagram classification")
+    
+    return score_diagram_types(
+        vertical_bars=has_vertical_bars,
+        horizontal_bars=has_horizontal_bars,
+        lines=has_lines,
+        points=has_points,
+        circles=has_circles,
+        arrows=has_arrows,
+        boxes=has_boxes,
+        network=has_network,
+        # The remaining checks are expensive and only matter under these conditions
+        pie_segments=has_circles > 0 and detect_pie_segments(gray),
+        overlapping_circles=2 <= has_circles <= 5 and detect_overlapping_circles(gray),
+        chemical_bonds=detect_chemical_bonds(gray, has_points)
+    )
+
+def score_diagram_types(vertical_bars: int, horizontal_bars: int, lines: int, points: int,
+                        circles: int, arrows: int, boxes: int, network: bool,
+                        pie_segments: bool, overlapping_circles: bool,
+                        chemical_bonds: bool) -> Tuple[DiagramType, float]:
+    """
+    Rule-based classification from element counts, whether they were
+    detected in pixels or read from vector geometry (utils/svg_vector.py)
     
+    :return: Tuple of (DiagramType, confidence_score)
+    """
     # Simple rule-based classification
     type_scores = {
         DiagramType.BAR_CHART: 0.0,
@@ -169,35 +265,35 @@ def classify_diagram_type(image: np.ndarray) -> Tuple[DiagramType, float]:
     }
     
     # Bar chart detection
-    if has_vertical_bars > 3 or has_horizontal_bars > 3:
-        type_scores[DiagramType.BAR_CHART] = 0.6 + min(has_vertical_bars, has_horizontal_bars) * 0.02
+    if vertical_bars > 3 or horizontal_bars > 3:
+        type_scores[DiagramType.BAR_CHART] = 0.6 + min(vertical_bars, horizontal_bars) * 0.02
         
     # Line graph detection
-    if has_lines > 2 and has_points:
-        type_scores[DiagramType.LINE_GRAPH] = 0.5 + min(has_lines * 0.1, 0.4)
+    if lines > 2 and points:
+        type_scores[DiagramType.LINE_GRAPH] = 0.5 + min(lines * 0.1, 0.4)
         
     # Scatter plot detection
-    if has_points > 15 and not has_lines:
-        type_scores[DiagramType.SCATTER_PLOT] = 0.5 + min(has_points * 0.005, 0.4)
+    if points > 15 and not lines:
+        type_scores[DiagramType.SCATTER_PLOT] = 0.5 + min(points * 0.005, 0.4)
         
     # Pie chart detection
-    if has_circles > 0 and detect_pie_segments(gray):
-        type_scores[DiagramType.PIE_CHART] = 0.7 + min(has_circles * 0.1, 0.2)
+    if circles > 0 and pie_segments:
+        type_scores[DiagramType.PIE_CHART] = 0.7 + min(circles * 0.1, 0.2)
         
     # Flow chart detection
-    if has_boxes > 3 and has_arrows > 2:
-        type_scores[DiagramType.FLOW_CHART] = 0.6 + min((has_boxes + has_arrows) * 0.02, 0.3)
+    if boxes > 3 and arrows > 2:
+        type_scores[DiagramType.FLOW_CHART] = 0.6 + min((boxes + arrows) * 0.02, 0.3)
         
     # Network diagram detection
-    if has_network and has_points > 5:
+    if network and points > 5:
         type_scores[DiagramType.NETWORK_DIAGRAM] = 0.7
         
     # Venn diagram detection
-    if has_circles >= 2 and has_circles <= 5 and detect_overlapping_circles(gray):
+    if circles >= 2 and circles <= 5 and overlapping_circles:
         type_scores[DiagramType.VENN_DIAGRAM] = 0.8
         
     # Chemical structure detection
-    if detect_chemical_bonds(gray) and has_points > 3:
+    if chemical_bonds and points > 3:
         type_scores[DiagramType.CHEMICAL_STRUCTURE] = 0.75
     
     # Find diagram type with highest score
@@ -205,15 +301,17 @@ def classify_diagram_type(image: np.ndarray) -> Tuple[DiagramType, float]:
     
     return best_type[0], best_type[1]
 
-def extract_specific_features(image: np.ndarray, diagram_type: DiagramType) -> Dict[str, Any]:
+def extract_specific_features(image: np.ndarray, diagram_type: DiagramType,
+                              foreground: Optional[PackedMask] = None) -> Dict[str, Any]:
     """
     Extract features specific to the diagram type
     
-    :param image: Image as numpy array
+    :param image: Image as numpy array (BGR or single-channel)
     :param diagram_type: Type of diagram
+    :param foreground: Optional shared otsu_foreground_mask() of the image
     :return: Dictionary of type-specific features
     """
-    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    gray = to_gray(image)
     features = {}
     
     if diagram_type == DiagramType.BAR_CHART:
@@ -288,11 +386,11 @@ def extract_specific_features(image: np.ndarray, diagram_type: DiagramType) -> D
         segment_count = detect_pie_segment_count(gray)
         
         features["segment_count"] = segment_count
-        features["has_labels"] = detect_text_regions(gray) > 2
+        features["has_labels"] = detect_text_regions(gray, foreground) > 2
         
     elif diagram_type == DiagramType.FLOW_CHART:
         # Extract flow chart specific features
-        box_count, box_sizes = detect_box_details(gray)
+        box_count, box_sizes = detect_box_details(gray, foreground)
         arrow_count, arrow_directions = detect_arrow_details(gray)
         
         features["box_count"] = box_count
@@ -341,7 +439,7 @@ def extract_specific_features(image: np.ndarray, diagram_type: DiagramType) -> D
 # Detection helper functions (implementations would need to be expanded)
 def has_light_background(image: np.ndarray) -> bool:
     """Detect if image has a light/white background"""
-    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    gray = to_gray(image)
     h, w = gray.shape
     
     # Check corners and center for light values
@@ -353,13 +451,13 @@ def has_light_background(image: np.ndarray) -> bool:
         gray[h//2, w//2]
     ]
     
-    return sum(p > 200 for p in corners) >= 3  # If majority of checked points are light
+    return bool(sum(p > 200 for p in corners) >= 3)  # If majority of checked points are light
 
 def detect_vertical_bars(gray: np.ndarray) -> int:
     """Detect number of vertical bars"""
     # Simple placeholder - would need more sophisticated implementation
     edges = cv2.Canny(gray, 50, 150)
-    lines = cv2.HoughLinesP(edges, 1, np.pi/180, threshold=100, minLineLength=gray.shape[0]//3, maxLineGap=20)
+    lines = hough_lines_p(edges, 1, np.pi/180, threshold=100, minLineLength=gray.shape[0]//3, maxLineGap=20)
     
     if lines is None:
         return 0
@@ -377,7 +475,7 @@ def detect_horizontal_bars(gray: np.ndarray) -> int:
     """Detect number of horizontal bars"""
     # Simple placeholder - would need more sophisticated implementation
     edges = cv2.Canny(gray, 50, 150)
-    lines = cv2.HoughLinesP(edges, 1, np.pi/180, threshold=100, minLineLength=gray.shape[1]//3, maxLineGap=20)
+    lines = hough_lines_p(edges, 1, np.pi/180, threshold=100, minLineLength=gray.shape[1]//3, maxLineGap=20)
     
     if lines is None:
         return 0
@@ -394,7 +492,7 @@ def detect_horizontal_bars(gray: np.ndarray) -> int:
 def detect_lines(gray: np.ndarray) -> int:
     """Detect number of significant lines"""
     edges = cv2.Canny(gray, 50, 150)
-    lines = cv2.HoughLinesP(edges, 1, np.pi/180, threshold=80, minLineLength=max(gray.shape[0], gray.shape[1])//5, maxLineGap=20)
+    lines = hough_lines_p(edges, 1, np.pi/180, threshold=80, minLineLength=max(gray.shape[0], gray.shape[1])//5, maxLineGap=20)
     
     if lines is None:
         return 0
@@ -431,8 +529,8 @@ def detect_points(gray: np.ndarray, threshold: int = 30) -> int:
 def detect_circles(gray: np.ndarray) -> int:
     """Detect number of circles"""
     # Use Hough Circle Transform
-    circles = cv2.HoughCircles(
-        gray, cv2.HOUGH_GRADIENT, dp=1, minDist=20,
+    circles = hough_circles(
+        gray, dp=1, minDist=20,
         param1=50, param2=30, minRadius=10, maxRadius=100
     )
     
@@ -454,10 +552,10 @@ def detect_arrows(gray: np.ndarray) -> int:
     
     return y_count
 
-def detect_rectangular_shapes(gray: np.ndarray) -> int:
+def detect_rectangular_shapes(gray: np.ndarray, foreground: Optional[PackedMask] = None) -> int:
     """Detect number of rectangular shapes"""
     # Find contours
-    _, thresh = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
+    thresh = _foreground(gray, foreground)
     contours, _ = cv2.findContours(thresh, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
     
     rectangles = 0
@@ -472,19 +570,22 @@ def detect_rectangular_shapes(gray: np.ndarray) -> int:
     
     return rectangles
 
-def detect_network_pattern(gray: np.ndarray) -> bool:
-    """Detect if image contains a network pattern"""
+def detect_network_pattern(gray: np.ndarray, point_count: Optional[int] = None,
+                           line_count: Optional[int] = None) -> bool:
+    """Detect if image contains a network pattern, reusing point and line counts if known"""
     # Look for point clusters connected by lines
-    point_count = detect_points(gray)
-    line_count = detect_lines(gray)
+    if point_count is None:
+        point_count = detect_points(gray)
+    if line_count is None:
+        line_count = detect_lines(gray)
     
     # Heuristic: networks typically have more lines than points (edges > nodes)
     return point_count > 3 and line_count > point_count
 
 def detect_pie_segments(gray: np.ndarray) -> bool:
     """Detect if image contains pie segment patterns"""
-    circles = cv2.HoughCircles(
-        gray, cv2.HOUGH_GRADIENT, dp=1, minDist=50,
+    circles = hough_circles(
+        gray, dp=1, minDist=50,
         param1=50, param2=30, minRadius=30, maxRadius=200
     )
     
@@ -497,7 +598,7 @@ def detect_pie_segments(gray: np.ndarray) -> bool:
     
     # Look for lines that might be segment boundaries
     edges = cv2.Canny(gray, 50, 150)
-    lines = cv2.HoughLinesP(edges, 1, np.pi/180, threshold=50, minLineLength=radius*0.5, maxLineGap=10)
+    lines = hough_lines_p(edges, 1, np.pi/180, threshold=50, minLineLength=radius*0.5, maxLineGap=10)
     
     if lines is None:
         return False
@@ -515,8 +616,8 @@ def detect_pie_segments(gray: np.ndarray) -> bool:
 
 def detect_overlapping_circles(gray: np.ndarray) -> bool:
     """Detect if image contains overlapping circles (for Venn diagrams)"""
-    circles = cv2.HoughCircles(
-        gray, cv2.HOUGH_GRADIENT, dp=1, minDist=20,
+    circles = hough_circles(
+        gray, dp=1, minDist=20,
         param1=50, param2=30, minRadius=20, maxRadius=150
     )
     
@@ -538,18 +639,19 @@ def detect_overlapping_circles(gray: np.ndarray) -> bool:
     
     return False
 
-def detect_chemical_bonds(gray: np.ndarray) -> bool:
-    """Detect if image contains chemical bond patterns"""
+def detect_chemical_bonds(gray: np.ndarray, point_count: Optional[int] = None) -> bool:
+    """Detect if image contains chemical bond patterns, reusing the point count if known"""
     # Look for specific patterns of points and connecting lines
     
     # First check if we have points that might be atoms
-    point_count = detect_points(gray)
+    if point_count is None:
+        point_count = detect_points(gray)
     if point_count < 3:
         return False
     
     # Then look for short connecting lines that might be bonds
     edges = cv2.Canny(gray, 50, 150)
-    lines = cv2.HoughLinesP(edges, 1, np.pi/180, threshold=50, minLineLength=10, maxLineGap=5)
+    lines = hough_lines_p(edges, 1, np.pi/180, threshold=50, minLineLength=10, maxLineGap=5)
     
     if lines is None:
         return False
@@ -616,10 +718,13 @@ def estimate_clusters(points: List[Tuple[int, int]], distance_threshold: int = 3
     if not points:
         return 0
     
-    # Convert to numpy array
-    points_array = np.array(points)
-    
-    # Simple clustering by distance (a more sophisticated approach would use K-means or DBSCAN)
+    # Simple clustering by distance (a more sophisticated approach would use K-means or DBSCAN).
+    # Points are bucketed in a grid of threshold-sized cells, so neighbors are
+    # only looked for in the 3x3 cells around a point instead of among all
+    # points; photos of texture give tens of thousands of blobs.
+    cells = {}
+    for index, (x, y) in enumerate(points):
+        cells.setdefault((x // distance_threshold, y // distance_threshold), []).append(index)
     visited = [False] * len(points)
     cluster_count = 0
     
@@ -635,18 +740,18 @@ def estimate_clusters(points: List[Tuple[int, int]], distance_threshold: int = 3
         stack = [i]
         while stack:
             current = stack.pop()
-            current_point = points_array[current]
+            x, y = points[current]
+            column, row = x // distance_threshold, y // distance_threshold
             
             # Find neighbors
-            for j in range(len(points)):
-                if not visited[j]:
-                    # Calculate distance
-                    other_point = points_array[j]
-                    distance = np.sqrt(np.sum((current_point - other_point)**2))
-                    
-                    if distance < distance_threshold:
-                        visited[j] = True
-                        stack.append(j)
+            for dx in (-1, 0, 1):
+                for dy in (-1, 0, 1):
+                    for j in cells.get((column + dx, row + dy), ()):
+                        if not visited[j]:
+                            other_x, other_y = points[j]
+                            if (other_x - x) ** 2 + (other_y - y) ** 2 < distance_threshold ** 2:
+                                visited[j] = True
+                                stack.append(j)
     
     return cluster_count
 
@@ -655,7 +760,7 @@ def detect_grid_lines(gray: np.ndarray) -> bool:
     edges = cv2.Canny(gray, 30, 100)
     
     # Look for regularly spaced horizontal and vertical lines
-    lines = cv2.HoughLinesP(edges, 1, np.pi/180, threshold=50, minLineLength=gray.shape[1]//4, maxLineGap=10)
+    lines = hough_lines_p(edges, 1, np.pi/180, threshold=50, minLineLength=gray.shape[1]//4, maxLineGap=10)
     
     if lines is None:
         return False
@@ -684,7 +789,7 @@ def detect_pie_segment_count(gray: np.ndarray) -> int:
     # This would require a more sophisticated implementation to count actual segments
     # For now, we'll use a heuristic based on edge detection
     edges = cv2.Canny(gray, 50, 150)
-    lines = cv2.HoughLinesP(edges, 1, np.pi/180, threshold=50, minLineLength=20, maxLineGap=10)
+    lines = hough_lines_p(edges, 1, np.pi/180, threshold=50, minLineLength=20, maxLineGap=10)
     
     if lines is None:
         return 0
@@ -706,14 +811,13 @@ def detect_pie_segment_count(gray: np.ndarray) -> int:
     # Each segment typically has one radial line
     return max(3, center_lines)  # Minimum 3 segments if it's a pie chart
 
-def detect_text_regions(gray: np.ndarray) -> int:
+def detect_text_regions(gray: np.ndarray, foreground: Optional[PackedMask] = None) -> int:
     """Detect number of potential text regions"""
     # This is a simplified approach - real text detection is complex
-    _, binary = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
+    binary = _foreground(gray, foreground)
     
     # Use morphology to identify potential text regions
-    kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (5, 5))
-    morphed = cv2.morphologyEx(binary, cv2.MORPH_CLOSE, kernel)
+    morphed = close_text_mask(binary)
     
     # Find contours that might be text
     contours, _ = cv2.findContours(morphed, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
@@ -729,10 +833,10 @@ def detect_text_regions(gray: np.ndarray) -> int:
     
     return text_regions
 
-def detect_box_details(gray: np.ndarray) -> Tuple[int, List[float]]:
+def detect_box_details(gray: np.ndarray, foreground: Optional[PackedMask] = None) -> Tuple[int, List[float]]:
     """Detect details about boxes in a flow chart"""
     # Find contours
-    _, thresh = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
+    thresh = _foreground(gray, foreground)
     contours, _ = cv2.findContours(thresh, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
     
     box_count = 0
@@ -1,16 +1,23 @@
 # image-analysis-service/src/utils/diagram_ocr.py
 import cv2
-import pytesseract
 import numpy as np
 import logging
 import traceback
 from PIL import Image
 import re
+from utils.ocr_engines import engine_or_default
+from utils.preprocessor import DENOISE_NONE, apply_denoising, decide_denoising
+from utils.symbol_detect import detect_math_symbols
+from utils.text_regions import find_text_regions, measure_glyph_height, ocr_regions, ocr_scale, region_config, scale_for_ocr
 
 logger = logging.getLogger(__name__)
 
-def enhance_for_ocr(image):
-    """Create diagram-optimized image variants for better OCR results"""
+def enhance_for_ocr(image, deadline=None):
+    """
+    Create diagram-optimized image variants for better OCR results
+
+    The NL-means variant is skipped once `deadline` (optional) has expired.
+    """
     results = []
     
     # Basic grayscale conversion
@@ -35,26 +42,39 @@ def enhance_for_ocr(image):
     enhanced = clahe.apply(gray)
     results.append(("clahe", enhanced))
     
-    # 4. Noise reduction with edge preservation
-    denoised = cv2.fastNlMeansDenoising(gray, None, 10, 7, 21)
-    _, denoised_binary = cv2.threshold(denoised, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
-    results.append(("denoised", denoised_binary))
-    
-    # 5. Special handling for diagrams with small text
-    # Scale up, then apply thresholding
-    h, w = gray.shape
-    scaled = cv2.resize(gray, (w*2, h*2), interpolation=cv2.INTER_CUBIC)
-    _, scaled_binary = cv2.threshold(scaled, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
-    results.append(("scaled", scaled_binary))
+    # 4. Noise reduction with edge preservation, only for noisy images
+    decision = decide_denoising(gray)
+    if decision.branch == DENOISE_NONE:
+        logger.debug(f"Skipping denoised OCR variant (noise sigma {decision.noise_sigma:.2f})")
+    elif deadline is None or not deadline.expired():
+        denoised = apply_denoising(gray, decision)
+        _, denoised_binary = cv2.threshold(denoised, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+        results.append(("denoised", denoised_binary))
+    else:
+        logger.warning("Deadline reached, skipping denoised OCR variant")
     
     return results
 
-def extract_diagram_text(image_path):
+def _plan_ocr(gray):
+    """
+    Text regions to OCR (None to OCR whole images) and the resize factor
+    for whole-image OCR, from the median glyph height
+    """
+    try:
+        regions = find_text_regions(gray)
+        return regions, 1.0 if regions else ocr_scale(measure_glyph_height(gray))
+    except Exception as e:
+        logger.warning(f"Text region detection failed, using whole-image OCR: {str(e)}")
+        return None, 1.0
+
+def extract_diagram_text(image_path, deadline=None, engine=None):
     """
     Extracts text from diagrams using specialized processing techniques
     
     Args:
         image_path: Path to the image file
+        deadline: Optional Deadline; the best result so far is returned once it expires
+        engine: OCR engine name (see utils.ocr_engines), None for Tesseract
         
     Returns:
         Extracted text as string
@@ -73,7 +93,7 @@ def extract_diagram_text(image_path):
                 return ""
         
         # Create enhanced versions for OCR
-        enhanced_versions = enhance_for_ocr(image)
+        enhanced_versions = enhance_for_ocr(image, deadline)
         
         # OCR configurations optimized for diagrams
         configs = [
@@ -82,27 +102,38 @@ def extract_diagram_text(image_path):
             '--psm 11 --oem 3',  # Sparse text. No OSD.
         ]
         
+        # With text regions, only their crops are read, as lines (see text_regions.py)
+        # Engines other than Tesseract ignore the segmentation modes
+        ocr = engine_or_default(engine)
+        configs = list(dict.fromkeys(ocr.normalize_config(config) for config in configs))
+        
+        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if len(image.shape) > 2 else image
+        regions, scale = _plan_ocr(gray)
+        if regions:
+            configs = list(dict.fromkeys(region_config(config) for config in configs))
+        
         # Try all combinations and score results
         results = []
         
         for version_name, img in enhanced_versions:
+            if deadline is not None and deadline.expired():
+                logger.warning(f"Deadline reached, skipping remaining OCR variants from {version_name}")
+                break
+            img = scale_for_ocr(img, scale)
             for config in configs:
                 try:
-                    # Extract text with confidence data
-                    ocr_data = pytesseract.image_to_data(img, config=config, output_type=pytesseract.Output.DICT)
-                    
-                    # Get the text
-                    text = pytesseract.image_to_string(img, config=config)
-                    text = text.strip()
+                    if regions:
+                        region_result = ocr_regions(img, regions, config, ocr.name)
+                        text, avg_confidence = region_result.text, region_result.confidence
+                    else:
+                        # Extract text with confidence data
+                        ocr_result = ocr.read(img, config)
+                        text, avg_confidence = ocr_result.text.strip(), ocr_result.confidence
                     
                     # Skip empty results
                     if not text:
                         continue
                     
-                    # Calculate confidence
-                    confidences = [conf for conf in ocr_data['conf'] if conf != -1]
-                    avg_confidence = np.mean(confidences) if confidences else 0
-                    
                     # Count actual content
                     text_length = len(text.replace(" ", "").replace("\n", ""))
                     word_count = len([w for w in text.split() if w.strip()])
@@ -144,12 +175,18 @@ def extract_diagram_text(image_path):
         logger.error(traceback.format_exc())
         return ""
 
-def extract_math_symbols(image_path):
+def extract_math_symbols(image_path, deadline=None, engine=None):
     """
     Extract mathematical symbols and expressions from diagrams
+
+    Glyphs are classified by the connected-component detector
+    (utils.symbol_detect), which OCRs only the ones it cannot tell apart;
+    images it cannot handle are OCR'd in every enhanced variant instead.
     
     Args:
         image_path: Path to the image file
+        deadline: Optional Deadline; symbols found so far are returned once it expires
+        engine: OCR engine name (see utils.ocr_engines), None for Tesseract
         
     Returns:
         List of detected mathematical symbols
@@ -160,12 +197,22 @@ def extract_math_symbols(image_path):
         if image is None:
             return []
         
-        # Create enhanced versions
-        enhanced_versions = enhance_for_ocr(image)
+        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if len(image.shape) > 2 else image
+        ocr = engine_or_default(engine)
         
         # Define patterns for mathematical symbols
         math_pattern = r'[+\-*/=≠<>≤≥≈±∓×÷∞∂∫∬∭∮∇∆√∛∜∑∏π]'
         
+        decision = decide_denoising(gray)
+        denoised = gray if decision.branch == DENOISE_NONE else apply_denoising(gray, decision)
+        detected = detect_math_symbols(denoised, math_pattern, ocr.name, deadline)
+        if detected is not None:
+            return [symbol for symbol in detected if re.fullmatch(math_pattern, symbol)]
+        
+        # Create enhanced versions
+        enhanced_versions = enhance_for_ocr(image, deadline)
+        regions, scale = _plan_ocr(gray)
+        
         all_symbols = set()
         
         # Try math-specific configurations
@@ -173,12 +220,20 @@ def extract_math_symbols(image_path):
             '--psm 6 --oem 3 -c tessedit_char_whitelist=0123456789+-*/()=<>≤≥∞∫∑√π{}[]^',
             '--psm 11 --oem 3', # Sparse text mode better for isolated symbols
         ]
+        math_configs = list(dict.fromkeys(ocr.normalize_config(config) for config in math_configs))
         
         # Process each enhanced version
         for _, img in enhanced_versions:
-            for config in math_configs:
+            if deadline is not None and deadline.expired():
+                logger.warning("Deadline reached, skipping remaining symbol variants")
+                break
+            img = scale_for_ocr(img, scale)
+            for config in (list(dict.fromkeys(region_config(c) for c in math_configs)) if regions else math_configs):
                 try:
-                    text = pytesseract.image_to_string(img, config=config)
+                    if regions:
+                        text = ocr_regions(img, regions, config, ocr.name).text
+                    else:
+                        text = ocr.read(img, config).text
                     
                     # Find math symbols
                     symbols = re.findall(math_pattern, text)
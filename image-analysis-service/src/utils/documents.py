@@ -0,0 +1,194 @@
+# image-analysis-service/src/utils/documents.py
+"""
+Multi-page PDF and TIFF uploads, analyzed page by page.
+
+The request thread only reads the page list (pdfinfo, or the TIFF frame
+count). Each page is then a separate job: the worker renders its page with
+pdftoppm (or extracts the TIFF frame) at a bounded resolution, reads the PDF
+text layer with pdftotext, and runs the normal pipeline on the render.
+Pages whose text layer has enough text skip OCR and report that text.
+"""
+import logging
+import os
+import re
+import subprocess
+from dataclasses import dataclass, field
+from typing import List, Tuple
+
+from PIL import Image
+
+from utils.admission import ImageHeader, read_image_header
+from utils.decode import GRAY_MODES
+from utils.pipeline import run_analysis, DEFAULT_STAGES
+from utils.text_extract import find_math_symbols
+
+logger = logging.getLogger(__name__)
+
+PDF = 'pdf'
+TIFF = 'tiff'
+
+# PDF page sizes are in points
+POINTS_PER_INCH = 72
+
+# Seconds allowed for one poppler call
+POPPLER_TIMEOUT_SECONDS = 120
+
+_PAGE_SIZE_RE = re.compile(r'^Page\s+(\d+)\s+size:\s+([\d.]+)\s+x\s+([\d.]+)', re.MULTILINE)
+_PAGES_RE = re.compile(r'^Pages:\s+(\d+)', re.MULTILINE)
+
+
+@dataclass
+class DocumentInfo:
+    """
+    Page list of a multi-page upload.
+
+    :param kind: PDF or TIFF
+    :param page_sizes: (width, height) per page, in points for PDF and pixels for TIFF
+    """
+    kind: str
+    page_sizes: List[Tuple[float, float]] = field(default_factory=list)
+
+    @property
+    def page_count(self):
+        return len(self.page_sizes)
+
+
+def _poppler(args):
+    """Run a poppler-utils command and return its stdout as text"""
+    completed = subprocess.run(
+        args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=POPPLER_TIMEOUT_SECONDS
+    )
+    if completed.returncode != 0:
+        raise ValueError(f"{args[0]} failed: {completed.stderr.decode(errors='replace').strip()}")
+    return completed.stdout.decode('utf-8', errors='replace')
+
+
+def is_multipage_document(path):
+    """True for PDFs and TIFFs with more than one frame"""
+    if path.lower().endswith('.pdf'):
+        return True
+    header = read_image_header(path)
+    return header is not None and header.format == 'TIFF' and header.frames > 1
+
+
+def probe_document(path, max_pages=None):
+    """
+    Page list of a PDF or multi-frame TIFF, without rendering anything.
+
+    :param max_pages: Pages beyond this are left out
+    :return: DocumentInfo, or None if the file is not a multi-page document
+    :raises ValueError: if a PDF cannot be read
+    """
+    if path.lower().endswith('.pdf'):
+        try:
+            # -l past the last page makes pdfinfo list every page size
+            output = _poppler(['pdfinfo', '-f', '1', '-l', str(max_pages or 100000), path])
+        except FileNotFoundError:
+            raise ValueError("PDF support needs poppler-utils (pdfinfo) on the PATH")
+        sizes = [(float(w), float(h)) for _, w, h in _PAGE_SIZE_RE.findall(output)]
+        if not sizes:
+            # Older pdfinfo versions print one size for the whole document
+            pages = _PAGES_RE.search(output)
+            if pages is None:
+                raise ValueError(f"Could not read page list of {path}")
+            sizes = [(612.0, 792.0)] * int(pages.group(1))
+        return DocumentInfo(PDF, sizes[:max_pages] if max_pages else sizes)
+
+    header = read_image_header(path)
+    if header is None or header.format != 'TIFF' or header.frames < 2:
+        return None
+    sizes = []
+    with Image.open(path) as img:
+        for index in range(min(header.frames, max_pages or header.frames)):
+            img.seek(index)
+            sizes.append(img.size)
+    return DocumentInfo(TIFF, sizes)
+
+
+def render_dpi(width_pt, height_pt, dpi, max_side):
+    """Render resolution for a PDF page: `dpi`, lowered so the long side fits `max_side`"""
+    long_side_inches = max(width_pt, height_pt) / POINTS_PER_INCH
+    return max(1, min(dpi, int(max_side / long_side_inches)))
+
+
+def page_header(info, index, dpi, max_side):
+    """ImageHeader the rendered page will have, for cost estimation before rendering"""
+    width, height = info.page_sizes[index]
+    if info.kind == PDF:
+        scale = render_dpi(width, height, dpi, max_side) / POINTS_PER_INCH
+    else:
+        scale = min(1.0, max_side / max(width, height))
+    return ImageHeader(width=max(1, int(width * scale)), height=max(1, int(height * scale)), format='PNG')
+
+
+def render_page(path, info, index, out_dir, dpi, max_side):
+    """
+    Render one page to a PNG in `out_dir`.
+
+    :param index: Zero-based page index
+    :return: Path of the PNG
+    """
+    out_prefix = os.path.join(out_dir, f"page-{index + 1}")
+    if info.kind == PDF:
+        width, height = info.page_sizes[index]
+        page = str(index + 1)
+        try:
+            _poppler([
+                'pdftoppm', '-f', page, '-l', page, '-singlefile', '-png',
+                '-r', str(render_dpi(width, height, dpi, max_side)), path, out_prefix
+            ])
+        except FileNotFoundError:
+            raise ValueError("PDF support needs poppler-utils (pdftoppm) on the PATH")
+        return f"{out_prefix}.png"
+
+    with Image.open(path) as img:
+        img.seek(index)
+        frame = img.convert('L' if img.mode in GRAY_MODES else 'RGB')
+    frame.thumbnail((max_side, max_side), Image.LANCZOS)
+    frame.save(f"{out_prefix}.png")
+    return f"{out_prefix}.png"
+
+
+def read_text_layer(path, index):
+    """Embedded text of one PDF page ('' if it has none or pdftotext is missing)"""
+    page = str(index + 1)
+    try:
+        return _poppler(['pdftotext', '-f', page, '-l', page, '-enc', 'UTF-8', '-layout', path, '-']).strip()
+    except FileNotFoundError:
+        logger.warning("pdftotext not found, PDF pages will be OCRed")
+    except (ValueError, subprocess.TimeoutExpired) as e:
+        logger.warning(f"Could not read text layer of page {page}: {str(e)}")
+    return ''
+
+
+def analyze_document_page(path, original_filename, info, index, out_dir, fidelity, deadline,
+                          dpi, max_side, text_min_chars, ocr_engine=None):
+    """
+    Render and analyze one page; runs in a worker process.
+
+    :param ocr_engine: OCR engine requested by the client, see run_analysis()
+    :return: Result dictionary as returned by /analyze, plus the page number
+             and where its text came from
+    """
+    text = read_text_layer(path, index) if info.kind == PDF else ''
+    use_text_layer = len(text) >= text_min_chars
+    stages = tuple(stage for stage in DEFAULT_STAGES if stage != 'symbols') if use_text_layer else DEFAULT_STAGES
+
+    page_path = render_page(path, info, index, out_dir, dpi, max_side)
+    try:
+        result = run_analysis(
+            page_path, f"{original_filename} (page {index + 1})", fidelity, deadline, stages, ocr_engine
+        )
+    finally:
+        try:
+            os.remove(page_path)
+        except OSError:
+            pass
+
+    result['page'] = index + 1
+    if use_text_layer:
+        # The PDF's own text is exact; OCR would only approximate it
+        result['text_result'] = text
+        result['symbols_result'] = sorted(find_math_symbols(text))
+        result['text_source'] = 'pdf_text'
+    return result
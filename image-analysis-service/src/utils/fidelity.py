@@ -0,0 +1,133 @@
+# image-analysis-service/src/utils/fidelity.py
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+FULL = 0
+REDUCED = 1
+MINIMAL = 2
+
+# What each fidelity level turns off. Level 0 is the normal pipeline.
+FIDELITY_SETTINGS = {
+    FULL: {
+        'name': 'full',
+        'ocr_variants': None,       # all preprocessing variants
+        'quality_mode': 'full',
+        'refine_colors': True,      # k-means for dominant colors
+    },
+    REDUCED: {
+        'name': 'reduced',
+        'ocr_variants': 3,
+        'quality_mode': 'fast',
+        'refine_colors': True,
+    },
+    MINIMAL: {
+        'name': 'minimal',
+        'ocr_variants': 1,
+        'quality_mode': 'fast',
+        'refine_colors': False,     # histogram peaks only
+    },
+}
+
+
+def fidelity_settings(level):
+    """Return the settings dict for a fidelity level"""
+    return FIDELITY_SETTINGS[max(FULL, min(MINIMAL, level))]
+
+
+def describe_fidelity(level):
+    """Summary stored in the analysis result so degraded results can be re-run"""
+    return {
+        'level': level,
+        'name': fidelity_settings(level)['name'],
+        'degraded': level > FULL,
+    }
+
+
+class FidelityPolicy:
+    """
+    Load-aware fidelity selector with hysteresis.
+
+    Watches queue fill (0..1) and an EWMA of job latency. The level steps up
+    (less thorough) when either signal crosses the degrade threshold for the
+    current level, and steps back down only when both signals are below the
+    lower recover threshold. Levels change one step at a time and stay put
+    for at least `min_dwell` seconds.
+
+    :param degrade_queue: Queue fill needed to leave level 0 and level 1
+    :param recover_queue: Queue fill needed to return to level 0 and level 1
+    :param degrade_latency: Latency (s) needed to leave level 0 and level 1
+    :param recover_latency: Latency (s) needed to return to level 0 and level 1
+    """
+
+    def __init__(self, degrade_queue, recover_queue, degrade_latency, recover_latency,
+                 min_dwell=10.0, ewma_alpha=0.2, enabled=True):
+        self.degrade_queue = degrade_queue
+        self.recover_queue = recover_queue
+        self.degrade_latency = degrade_latency
+        self.recover_latency = recover_latency
+        self.min_dwell = min_dwell
+        self.ewma_alpha = ewma_alpha
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._level = FULL
+        self._changed_at = 0.0
+        self._latency = None
+        self._queue_fill = 0.0
+
+    def observe_latency(self, seconds):
+        with self._lock:
+            if self._latency is None:
+                self._latency = seconds
+            else:
+                self._latency += self.ewma_alpha * (seconds - self._latency)
+            self._update()
+
+    def observe_queue(self, fill):
+        with self._lock:
+            self._queue_fill = fill
+            self._update()
+
+    def _update(self):
+        """Re-evaluate the level (caller holds the lock)"""
+        if not self.enabled:
+            return
+        now = time.time()
+        if now - self._changed_at < self.min_dwell:
+            return
+        latency = self._latency or 0.0
+        level = self._level
+
+        if level < MINIMAL and (
+            self._queue_fill >= self.degrade_queue[level] or latency >= self.degrade_latency[level]
+        ):
+            level += 1
+        elif level > FULL and (
+            self._queue_fill < self.recover_queue[level - 1] and latency < self.recover_latency[level - 1]
+        ):
+            level -= 1
+
+        if level != self._level:
+            logger.warning(
+                f"Fidelity level {self._level} -> {level} "
+                f"(queue fill {self._queue_fill:.2f}, latency {latency:.1f}s)"
+            )
+            self._level = level
+            self._changed_at = now
+
+    @property
+    def level(self):
+        with self._lock:
+            return self._level
+
+    def stats(self):
+        with self._lock:
+            return {
+                'enabled': self.enabled,
+                'level': self._level,
+                'name': fidelity_settings(self._level)['name'],
+                'queue_fill': round(self._queue_fill, 3),
+                'latency_ewma_s': round(self._latency, 3) if self._latency is not None else None,
+            }
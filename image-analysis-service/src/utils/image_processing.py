@@ -1,27 +1,70 @@
-from PIL import Image
 import numpy as np
 import cv2
-import io
 import os
+from utils.deadline import check_deadline
+from utils.decode import FULL_COLOR, decode_image, to_gray
 
-def analyze_image_quality(image_path):
-    """Analyzes comprehensive image quality metrics"""
-    image = cv2.imread(image_path)
+# Fast mode bounds (used under load, see utils/fidelity.py)
+FAST_FFT_MAX_SIDE = 1024
+FAST_KMEANS_SAMPLES = 20000
+
+# Rows / columns per batch in the blocked 2D FFT
+FFT_BLOCK = 64
+
+# Relative agreement of the float32 kernels with float64 reference results
+# (checked by benchmarks/quality_memory.py)
+QUALITY_SCORE_TOLERANCE = 1e-4
+
+# Blur, noise and sharpness depend on scale, so quality needs full-resolution BGR
+QUALITY_REQUIREMENT = FULL_COLOR
+
+def analyze_image_quality(image_path, mode='full', refine_colors=True, deadline=None, image=None):
+    """
+    Analyzes comprehensive image quality metrics
+
+    :param image_path: Path to the image file
+    :param mode: 'full', or 'fast' to run the FFT on a center crop, skip the
+                 2x detail scale and run k-means on a pixel sample
+    :param refine_colors: If False, dominant colors come from histogram peaks
+                          instead of k-means
+    :param deadline: Optional Deadline checked between metrics; raises
+                     DeadlineExceeded once it expires
+    :param image: Already decoded BGR or single-channel image (decoded from
+                  image_path if None). Grayscale content is analyzed on
+                  one channel; the color metrics are derived from it.
+
+    Kernels run in float32 with single-pass statistics. Against the former
+    float64 implementation the scores agree within QUALITY_SCORE_TOLERANCE
+    (relative); the blur score moves most, through the float32 FFT.
+    """
+    if image is None:
+        image = decode_image(image_path, QUALITY_REQUIREMENT).image
     height, width = image.shape[:2]
+    fast = mode == 'fast'
+    # Converted once; the gray metrics take it as is
+    gray = to_gray(image)
     
     # Basic metrics
-    blur_score = calculate_blur(image)
-    contrast_score = calculate_contrast(image)
-    brightness_score = calculate_brightness(image)
-    noise_level = calculate_noise(image)
-    sharpness = calculate_sharpness(image)
+    blur_score = calculate_blur(gray, fft_max_side=FAST_FFT_MAX_SIDE if fast else None)
+    contrast_score = calculate_contrast(gray)
+    check_deadline(deadline, "quality metrics")
+    noise_level = calculate_noise(gray)
+    sharpness = calculate_sharpness(gray)
+    check_deadline(deadline, "quality metrics")
     
     # Color analysis
-    color_metrics = analyze_color_distribution(image)
+    color_metrics = analyze_color_distribution(
+        image,
+        refine_colors=refine_colors,
+        max_samples=FAST_KMEANS_SAMPLES if fast else None
+    )
+    # Mean HSV value, as calculate_brightness() would compute it
+    brightness_score = color_metrics['color_distribution']['mean_hsv'][2]
+    check_deadline(deadline, "quality metrics")
     
     # Edge and detail analysis
-    edge_density = calculate_edge_density(image)
-    detail_score = calculate_detail_score(image)
+    edge_density = calculate_edge_density(gray)
+    detail_score = calculate_detail_score(gray, scales=(0.5, 1.0) if fast else (0.5, 1.0, 2.0))
     
     quality_score = calculate_quality_score(
         blur_score, contrast_score, brightness_score, 
@@ -49,7 +92,8 @@ def analyze_image_quality(image_path):
             'edge_density': round(edge_density, 2),
             'detail_score': round(detail_score, 2)
         },
-        'color_analysis': color_metrics
+        'color_analysis': color_metrics,
+        'quality_mode': mode
     }
 
 def calculate_quality_score(blur, contrast, brightness, noise, sharpness, edge_density):
@@ -81,121 +125,258 @@ def calculate_quality_score(blur, contrast, brightness, noise, sharpness, edge_d
     
     return round(final_score)
 
-def calculate_blur(image):
+def calculate_blur(image, fft_max_side=None):
     """Enhanced blur detection using multiple methods"""
-    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    gray = to_gray(image)
     
-    # Laplacian variance method
-    laplacian_var = cv2.Laplacian(gray, cv2.CV_64F).var()
+    # Laplacian variance method (integer responses, exact in float32)
+    _, laplacian_std = cv2.meanStdDev(cv2.Laplacian(gray, cv2.CV_32F))
+    laplacian_var = laplacian_std[0, 0] ** 2
     
     # FFT method for blur detection
     rows, cols = gray.shape
     crow, ccol = rows//2, cols//2
-    f = np.fft.fft2(gray)
-    fshift = np.fft.fftshift(f)
-    fft_blur = 20 * np.log(np.abs(fshift))
+    fft_input = gray
+    if fft_max_side and max(rows, cols) > fft_max_side:
+        # Center crop keeps the spectrum statistics of the content at a fraction of the cost
+        half = fft_max_side // 2
+        fft_input = gray[max(0, crow - half):crow + half, max(0, ccol - half):ccol + half]
     
-    return (laplacian_var + np.mean(fft_blur)) / 2
+    return (laplacian_var + mean_log_spectrum(fft_input)) / 2
 
-def calculate_contrast(image):
-    """Calculate image contrast using multiple methods"""
-    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+def mean_log_spectrum(gray, block=FFT_BLOCK):
+    """
+    Mean of 20*log|F| over the full 2D spectrum, from a float32 real FFT.
+
+    Transformed at the image's own size: padding to a faster DFT size would
+    add frequencies and shift the score. Only half the spectrum is computed:
+    for real input the other half holds the same magnitudes, so interior
+    columns are counted twice. Rows and then columns are transformed
+    `block` at a time, so the only full-size buffer is the complex64 half
+    spectrum.
+    """
+    dft_rows, dft_cols = gray.shape
+    half_cols = dft_cols // 2 + 1
+    spectrum = np.empty((dft_rows, half_cols), dtype=np.complex64)
+    for y in range(0, dft_rows, block):
+        spectrum[y:y + block] = np.fft.rfft(gray[y:y + block].astype(np.float32), axis=1)
     
-    # Standard deviation method
-    std_contrast = gray.std()
+    column_sums = np.empty(half_cols)
+    for x in range(0, half_cols, block):
+        magnitude = np.abs(np.fft.fft(spectrum[:, x:x + block], axis=0))
+        np.log(magnitude, out=magnitude)
+        column_sums[x:x + block] = magnitude.sum(axis=0, dtype=np.float64)
     
-    # RMS contrast
-    rms_contrast = np.sqrt(np.mean(np.square(gray - np.mean(gray))))
+    weights = np.full(half_cols, 2.0)
+    weights[0] = 1.0
+    if dft_cols % 2 == 0:
+        # Nyquist column has no mirror
+        weights[-1] = 1.0
+    return 20 * float(column_sums @ weights) / (dft_rows * dft_cols)
+
+def calculate_contrast(image):
+    """Calculate image contrast using multiple methods"""
+    gray = to_gray(image)
     
-    return (std_contrast + rms_contrast) / 2
+    # Standard deviation and RMS contrast are the same quantity; one pass
+    _, std = cv2.meanStdDev(gray)
+    return std[0, 0]
 
 def calculate_brightness(image):
     """Calculate image brightness using multiple channels"""
-    # Convert to HSV for better brightness calculation
-    hsv = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
-    return np.mean(hsv[:, :, 2])
+    if image.ndim == 2:
+        # HSV value of a gray pixel is its gray level
+        return cv2.mean(image)[0]
+    # HSV value is the largest of the three channels
+    b, g, r = cv2.split(image)
+    return cv2.mean(cv2.max(cv2.max(b, g), r))[0]
 
 def calculate_noise(image):
     """Estimate image noise level"""
-    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    gray = to_gray(image)
     
     # Calculate noise using mean of Gaussian derivatives
-    noise_sigma = np.mean([
-        np.std(cv2.GaussianBlur(gray, (3,3), s) - gray)
-        for s in [1.0, 2.0, 3.0]
-    ])
+    sigmas = []
+    for s in [1.0, 2.0, 3.0]:
+        difference = cv2.GaussianBlur(gray, (3,3), s)
+        # In place, with uint8 wrap-around like the original `blurred - gray`
+        np.subtract(difference, gray, out=difference)
+        sigmas.append(cv2.meanStdDev(difference)[1][0, 0])
     
-    return noise_sigma
+    return float(np.mean(sigmas))
 
 def calculate_sharpness(image):
     """Calculate image sharpness"""
-    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    gray = to_gray(image)
     
-    # Sobel derivatives
-    dx = cv2.Sobel(gray, cv2.CV_64F, 1, 0)
-    dy = cv2.Sobel(gray, cv2.CV_64F, 0, 1)
+    # Sobel derivatives (integer responses, exact in float32)
+    dx = cv2.Sobel(gray, cv2.CV_32F, 1, 0)
+    dy = cv2.Sobel(gray, cv2.CV_32F, 0, 1)
+    cv2.magnitude(dx, dy, dx)
     
-    return np.mean(np.sqrt(dx*dx + dy*dy))
+    return cv2.mean(dx)[0]
 
 def calculate_edge_density(image):
     """Calculate edge density in the image"""
-    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    gray = to_gray(image)
     edges = cv2.Canny(gray, 100, 200)
-    return np.mean(edges > 0)
+    return cv2.countNonZero(edges) / edges.size
 
-def calculate_detail_score(image):
+def calculate_detail_score(image, scales=(0.5, 1.0, 2.0)):
     """Calculate detail preservation score"""
-    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    gray = to_gray(image)
     
     # Multi-scale detail analysis
     detail_scores = []
-    for scale in [0.5, 1.0, 2.0]:
-        scaled = cv2.resize(gray, None, fx=scale, fy=scale)
-        detail_scores.append(np.std(scaled))
+    for scale in scales:
+        scaled = gray if scale == 1.0 else cv2.resize(gray, None, fx=scale, fy=scale)
+        detail_scores.append(cv2.meanStdDev(scaled)[1][0, 0])
     
-    return np.mean(detail_scores)
+    return float(np.mean(detail_scores))
 
-def analyze_color_distribution(image):
+def analyze_color_distribution(image, refine_colors=True, max_samples=None):
     """Analyze color distribution and characteristics"""
-    # Convert to different color spaces
+    if image.ndim == 2:
+        return analyze_gray_distribution(image, refine_colors, max_samples)
+
+    # Single-pass per-channel statistics; color space copies are uint8
+    mean_bgr, std_bgr = cv2.meanStdDev(image)
     hsv = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
-    lab = cv2.cvtColor(image, cv2.COLOR_BGR2LAB)
+    mean_hsv, std_hsv = cv2.meanStdDev(hsv)
+    del hsv
+    mean_lab = cv2.mean(cv2.cvtColor(image, cv2.COLOR_BGR2LAB))[:3]
     
     # Calculate color metrics
     color_metrics = {
         'color_distribution': {
-            'mean_rgb': image.mean(axis=(0,1)).tolist(),
-            'std_rgb': image.std(axis=(0,1)).tolist(),
-            'mean_hsv': hsv.mean(axis=(0,1)).tolist(),
-            'mean_lab': lab.mean(axis=(0,1)).tolist()
+            'mean_rgb': mean_bgr.ravel().tolist(),
+            'std_rgb': std_bgr.ravel().tolist(),
+            'mean_hsv': mean_hsv.ravel().tolist(),
+            'mean_lab': list(mean_lab)
         },
         'color_stats': {
-            'saturation': np.mean(hsv[:,:,1]),
-            'value_variance': np.var(hsv[:,:,2]),
-            'dominant_colors': get_dominant_colors(image),
+            'saturation': mean_hsv[1, 0],
+            'value_variance': std_hsv[2, 0] ** 2,
+            'dominant_colors': (
+                get_dominant_colors(image, max_samples=max_samples) if refine_colors
+                else get_histogram_colors(image)
+            ),
             'color_contrast': calculate_color_contrast(image)
         }
     }
     
     return color_metrics
 
-def get_dominant_colors(image, n_colors=3):
+def analyze_gray_distribution(image, refine_colors=True, max_samples=None):
+    """
+    analyze_color_distribution() for single-channel content, from one histogram.
+
+    Gray pixels have equal B, G and R, zero hue and saturation, and neutral a/b.
+    """
+    histogram = cv2.calcHist([image], [0], None, [256], [0, 256]).ravel().astype(np.float64)
+    total = histogram.sum()
+    levels = np.arange(256, dtype=np.float64)
+    mean = (histogram * levels).sum() / total
+    variance = (histogram * (levels - mean) ** 2).sum() / total
+    # LAB of each gray level, weighted by how often it occurs
+    lab_lut = cv2.cvtColor(
+        cv2.cvtColor(np.arange(256, dtype=np.uint8).reshape(1, 256), cv2.COLOR_GRAY2BGR),
+        cv2.COLOR_BGR2LAB
+    )[0].astype(np.float64)
+    mean_lab = (histogram[:, None] * lab_lut).sum(axis=0) / total
+    std = float(np.sqrt(variance))
+
+    return {
+        'color_distribution': {
+            'mean_rgb': [mean] * 3,
+            'std_rgb': [std] * 3,
+            'mean_hsv': [0.0, 0.0, mean],
+            'mean_lab': mean_lab.tolist()
+        },
+        'color_stats': {
+            'saturation': 0.0,
+            'value_variance': variance,
+            'dominant_colors': (
+                get_dominant_gray_levels(histogram) if refine_colors
+                else get_histogram_colors(image)
+            ),
+            'color_contrast': calculate_color_contrast(image)
+        }
+    }
+
+def get_dominant_gray_levels(histogram, n_colors=3, max_iter=200, eps=0.1):
+    """
+    k-means over the 256 gray levels weighted by their counts.
+
+    Same objective as k-means over the pixels, but in O(levels) per iteration.
+    Pixel k-means also stalls on line art, where there are fewer distinct
+    levels than clusters.
+    """
+    levels = np.flatnonzero(histogram).astype(np.float64)
+    if len(levels) <= n_colors:
+        centers = levels
+    else:
+        weights = histogram[levels.astype(np.int64)]
+        # Start from evenly spaced weighted quantiles (deterministic)
+        cumulative = np.cumsum(weights) / weights.sum()
+        centers = np.interp((np.arange(n_colors) + 0.5) / n_colors, cumulative, levels)
+        for _ in range(max_iter):
+            assignment = np.argmin(np.abs(levels[:, None] - centers[None, :]), axis=1)
+            updated = centers.copy()
+            for k in range(n_colors):
+                members = assignment == k
+                if members.any():
+                    updated[k] = np.average(levels[members], weights=weights[members])
+            converged = np.max(np.abs(updated - centers)) < eps
+            centers = updated
+            if converged:
+                break
+    return [[int(level)] * 3 for level in np.uint8(centers)]
+
+def get_dominant_colors(image, n_colors=3, max_samples=None):
     """Extract dominant colors using k-means clustering"""
     pixels = image.reshape(-1, 3)
+    attempts = 10
+    if max_samples and len(pixels) > max_samples:
+        # Evenly strided sample keeps the result deterministic
+        pixels = pixels[::len(pixels) // max_samples]
+        attempts = 3
     pixels = np.float32(pixels)
     
     criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 200, 0.1)
-    _, labels, centers = cv2.kmeans(pixels, n_colors, None, criteria, 10, cv2.KMEANS_RANDOM_CENTERS)
+    _, labels, centers = cv2.kmeans(pixels, n_colors, None, criteria, attempts, cv2.KMEANS_RANDOM_CENTERS)
     
     centers = np.uint8(centers)
     return centers.tolist()
 
+def get_histogram_colors(image, n_colors=3, bits=4):
+    """Dominant colors as the most populated bins of a quantized color histogram (no k-means)"""
+    shift = 8 - bits
+    levels = 1 << bits
+    # cv2.calcHist counts in place; no per-pixel code array
+    if image.ndim == 2:
+        # Same code as a BGR pixel with three equal channels
+        gray_counts = cv2.calcHist([image], [0], None, [levels], [0, 256]).ravel()
+        counts = np.zeros(1 << (3 * bits), dtype=np.int64)
+        counts[np.arange(levels) * ((1 << (2 * bits)) | (1 << bits) | 1)] = gray_counts
+    else:
+        # Bins indexed [b, g, r], so the flattened order is the (b, g, r) code
+        counts = cv2.calcHist([image], [0, 1, 2], None, [levels] * 3, [0, 256] * 3).ravel().astype(np.int64)
+    top = np.argsort(counts)[::-1][:n_colors]
+    top = top[counts[top] > 0]
+    mask = (1 << bits) - 1
+    half_bin = 1 << (shift - 1) if shift else 0
+    colors = np.stack([(top >> (2 * bits)) & mask, (top >> bits) & mask, top & mask], axis=1)
+    return ((colors << shift) + half_bin).astype(np.uint8).tolist()
+
 def calculate_color_contrast(image):
     """Calculate contrast between different color channels"""
-    b, g, r = cv2.split(image)
+    if image.ndim == 2:
+        return {'rg_contrast': 0.0, 'rb_contrast': 0.0, 'gb_contrast': 0.0}
+    b, g, r, _ = cv2.mean(image)
     return {
-        'rg_contrast': np.abs(np.mean(r) - np.mean(g)),
-        'rb_contrast': np.abs(np.mean(r) - np.mean(b)),
-        'gb_contrast': np.abs(np.mean(g) - np.mean(b))
+        'rg_contrast': abs(r - g),
+        'rb_contrast': abs(r - b),
+        'gb_contrast': abs(g - b)
     }
 
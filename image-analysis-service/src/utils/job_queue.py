@@ -0,0 +1,221 @@
+# image-analysis-service/src/utils/job_queue.py
+import math
+import multiprocessing
+import threading
+import time
+import uuid
+import logging
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+logger = logging.getLogger(__name__)
+
+
+class QueueFullError(Exception):
+    """Raised when the job queue has no free slot; carries a Retry-After hint in seconds"""
+
+    def __init__(self, retry_after):
+        super().__init__(f"Job queue is full, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+class Job:
+    """State of one submitted job"""
+
+    def __init__(self, job_id, meta=None):
+        self.job_id = job_id
+        self.meta = meta or {}
+        self.status = 'queued'
+        self.submitted_at = time.time()
+        self.finished_at = None
+        self.result = None
+        self.error = None
+        self.exception = None
+        self.future = None
+        self.done = threading.Event()
+
+    def to_dict(self):
+        status = self.status
+        if status == 'queued' and self.future is not None and self.future.running():
+            status = 'running'
+        data = {
+            'job_id': self.job_id,
+            'status': status,
+            'submitted_at': self.submitted_at,
+            'finished_at': self.finished_at,
+            **self.meta,
+        }
+        if self.status == 'completed':
+            data['result'] = self.result
+        elif self.status == 'failed':
+            data['error'] = self.error
+        return data
+
+
+def _init_worker():
+    """
+    Keep each worker process single-threaded so the pool size is the CPU
+    budget, and load OCR models once per process before the first job.
+    """
+    import cv2
+    cv2.setNumThreads(1)
+    import config
+    from utils.ocr_engines import warm_engines
+    warm_engines(config.OCR_WARM_ENGINES)
+
+
+class JobQueue:
+    """
+    Bounded in-process work queue drained by a pool of worker processes.
+
+    At most `max_workers` jobs run at once and at most `max_queue_depth` more
+    wait behind them; further submissions raise QueueFullError. Finished jobs
+    are kept for `result_ttl` seconds so clients can collect them.
+    """
+
+    def __init__(self, max_workers, max_queue_depth, result_ttl, max_wait=60):
+        self.max_workers = max_workers
+        self.max_queue_depth = max_queue_depth
+        self.result_ttl = result_ttl
+        self.max_wait = max_wait
+        self._executor = None
+        self._lock = threading.Lock()
+        self._jobs = {}
+        self._active = 0
+        self._durations = deque(maxlen=50)
+
+    def _get_executor(self):
+        """The worker pool, created on first use and again after it broke"""
+        with self._lock:
+            if self._executor is None:
+                # spawn rather than fork: the Flask process is multi-threaded
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.max_workers,
+                    mp_context=multiprocessing.get_context('spawn'),
+                    initializer=_init_worker
+                )
+            return self._executor
+
+    def _drop_executor(self, executor):
+        """
+        Forget a broken pool so the next submit starts a new one. A pool that
+        has already been replaced is left alone.
+        """
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+
+    @property
+    def capacity(self):
+        return self.max_workers + self.max_queue_depth
+
+    def depth(self):
+        """Number of jobs waiting for a worker"""
+        with self._lock:
+            return max(0, self._active - self.max_workers)
+
+    def fill(self):
+        """Fraction of queue capacity (running + waiting) in use"""
+        with self._lock:
+            return self._active / self.capacity if self.capacity else 1.0
+
+    def retry_after(self):
+        """Rough number of seconds until a slot frees up"""
+        average = sum(self._durations) / len(self._durations) if self._durations else 5.0
+        waiting = max(1, self._active - self.max_workers + 1)
+        return max(1, math.ceil(average * waiting / self.max_workers))
+
+    def submit(self, fn, *args, on_done=None, meta=None):
+        """
+        Queue `fn(*args)` for execution in a worker process.
+
+        :param on_done: Optional callback invoked with the Job once it finishes
+        :param meta: Extra fields reported with the job status
+        :return: The queued Job
+        """
+        with self._lock:
+            self._reap()
+            if self._active >= self.capacity:
+                raise QueueFullError(self.retry_after())
+            self._active += 1
+            job = Job(uuid.uuid4().hex, meta)
+            self._jobs[job.job_id] = job
+
+        try:
+            executor = self._get_executor()
+            try:
+                job.future = executor.submit(fn, *args)
+            except BrokenProcessPool:
+                logger.warning("Worker pool was broken, starting a new one")
+                self._drop_executor(executor)
+                executor = self._get_executor()
+                job.future = executor.submit(fn, *args)
+        except Exception:
+            with self._lock:
+                self._active -= 1
+                self._jobs.pop(job.job_id, None)
+            raise
+
+        job.future.add_done_callback(lambda future: self._finish(job, future, on_done, executor))
+        return job
+
+    def _finish(self, job, future, on_done, executor):
+        try:
+            job.result = future.result()
+            job.status = 'completed'
+        except Exception as e:
+            job.exception = e
+            job.error = str(e) or e.__class__.__name__
+            job.status = 'failed'
+            if isinstance(e, BrokenProcessPool):
+                self._drop_executor(executor)
+        job.finished_at = time.time()
+        with self._lock:
+            self._active -= 1
+            self._durations.append(job.finished_at - job.submitted_at)
+        job.done.set()
+        if on_done is not None:
+            try:
+                on_done(job)
+            except Exception as e:
+                logger.error(f"Job completion callback failed: {str(e)}")
+
+    def get(self, job_id, wait=0):
+        """
+        Look up a job, optionally long-polling until it finishes.
+
+        :param wait: Seconds to wait for completion (capped at max_wait)
+        :return: The Job, or None if unknown or expired
+        """
+        with self._lock:
+            self._reap()
+            job = self._jobs.get(job_id)
+        if job is not None and wait > 0:
+            job.done.wait(min(wait, self.max_wait))
+        return job
+
+    def discard(self, job_id):
+        """Forget a finished job whose result was already delivered"""
+        with self._lock:
+            self._jobs.pop(job_id, None)
+
+    def _reap(self):
+        """Drop finished jobs older than the result TTL (caller holds the lock)"""
+        cutoff = time.time() - self.result_ttl
+        expired = [
+            job_id for job_id, job in self._jobs.items()
+            if job.finished_at is not None and job.finished_at < cutoff
+        ]
+        for job_id in expired:
+            del self._jobs[job_id]
+
+    def stats(self):
+        with self._lock:
+            return {
+                'workers': self.max_workers,
+                'active': self._active,
+                'queued': max(0, self._active - self.max_workers),
+                'max_queue_depth': self.max_queue_depth,
+                'retained_jobs': len(self._jobs),
+            }
@@ -0,0 +1,111 @@
+# image-analysis-service/src/utils/metrics.py
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+
+class StageMetrics:
+    """
+    Thread-safe recorder for per-stage timings.
+
+    Keeps lifetime counters plus a rolling window of recent samples so the
+    `/metrics` endpoint can report current latency percentiles.
+    """
+
+    def __init__(self, window_seconds=60, max_samples=10000):
+        self.window_seconds = window_seconds
+        self.max_samples = max_samples
+        self.started_at = time.time()
+        self._lock = threading.Lock()
+        self._samples = {}
+        self._totals = {}
+        self._in_flight = 0
+
+    def record(self, stage, seconds, ok=True):
+        """Record one execution of a stage"""
+        now = time.time()
+        with self._lock:
+            samples = self._samples.setdefault(stage, deque(maxlen=self.max_samples))
+            samples.append((now, seconds, ok))
+            totals = self._totals.setdefault(stage, {'count': 0, 'errors': 0, 'seconds': 0.0})
+            totals['count'] += 1
+            totals['seconds'] += seconds
+            if not ok:
+                totals['errors'] += 1
+
+    def record_timings(self, timings_ms):
+        """Record a `stage_timings_ms` dict as returned in an analysis result"""
+        for stage, ms in (timings_ms or {}).items():
+            self.record(stage, ms / 1000.0)
+
+    def request_started(self):
+        with self._lock:
+            self._in_flight += 1
+
+    def request_finished(self):
+        with self._lock:
+            self._in_flight -= 1
+
+    def snapshot(self):
+        """Return lifetime totals and windowed percentiles for every stage"""
+        now = time.time()
+        cutoff = now - self.window_seconds
+        stages = {}
+        with self._lock:
+            for stage, samples in self._samples.items():
+                while samples and samples[0][0] < cutoff:
+                    samples.popleft()
+                durations = np.array([s[1] for s in samples], dtype=np.float64) * 1000.0
+                errors = sum(1 for s in samples if not s[2])
+                totals = self._totals[stage]
+                stage_stats = {
+                    'total_count': totals['count'],
+                    'total_errors': totals['errors'],
+                    'window_count': int(durations.size),
+                    'window_errors': errors,
+                    'window_rate_per_s': durations.size / self.window_seconds,
+                }
+                if durations.size:
+                    p50, p95, p99 = np.percentile(durations, [50, 95, 99])
+                    stage_stats.update({
+                        'mean_ms': round(float(durations.mean()), 2),
+                        'p50_ms': round(float(p50), 2),
+                        'p95_ms': round(float(p95), 2),
+                        'p99_ms': round(float(p99), 2),
+                    })
+                stages[stage] = stage_stats
+            in_flight = self._in_flight
+
+        return {
+            'timestamp': now,
+            'uptime_s': round(now - self.started_at, 1),
+            'window_s': self.window_seconds,
+            'in_flight': in_flight,
+            'stages': stages,
+        }
+
+
+class StageTimer:
+    """Context manager that times a block and stores it in a timings dict"""
+
+    def __init__(self, timings, stage, metrics=None):
+        self.timings = timings
+        self.stage = stage
+        self.metrics = metrics
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        elapsed = time.perf_counter() - self._start
+        self.timings[self.stage] = round(elapsed * 1000.0, 2)
+        if self.metrics is not None:
+            self.metrics.record(self.stage, elapsed, ok=exc_type is None)
+        return False
+
+
+# Process-wide recorder used by the Flask app
+metrics = StageMetrics()
@@ -0,0 +1,453 @@
+# image-analysis-service/src/utils/near_duplicate.py
+"""
+Near-duplicate lookup of analyzed images by perceptual hash.
+
+The same diagram arrives re-saved, recompressed or resized. Each analyzed
+image is fingerprinted from a gray copy decoded at reduced size and cropped
+to its content (so margins and scale do not matter):
+
+- a 64-bit perceptual hash (pHash: signs of the low-frequency DCT
+  coefficients of a 32x32 thumbnail), used to find candidates
+- the content aspect ratio, a cheap metadata check
+- a 192x192 two-level ink mask ("detail": strong and faint ink, relative
+  to the background), to tell a copy from the same diagram with another
+  label: the hash alone cannot see a changed label
+
+An upload whose hash is within NEAR_DUPLICATE_MAX_DISTANCE bits of a stored
+one, with the same content aspect ratio and no strong ink in one mask away
+from any ink in the other (beyond DETAIL_MAX_UNMATCHED pixels in any 8x8
+block), gets the stored result back instead of a new analysis. Comparing
+strong ink against faint ink keeps strokes that resampling or compression
+lightened from counting as differences. Images whose content is under
+DETAIL_MIN_SIDE pixels are not fingerprinted: too little detail survives to
+verify them.
+
+Hashes are searched by multi-index hashing: the hash is split into four
+16-bit chunks, and two hashes within distance d agree within d // 4 bits
+on at least one chunk. Each chunk has a table from its 65536 values to
+entry ids (counts + ids sorted by chunk value), so a query probes a few
+dozen buckets per chunk and checks only the entries found there; entries
+added since the last table build are scanned directly. Lookups stay well
+under a millisecond at millions of entries.
+
+Storage is append-only files under the index directory: entries.bin
+(fixed-size records: hash, sizes, where the result is), details.bin (one
+mask per entry) and results.jsonl (one result per line). Results and masks
+are written before their entry, so a crash never leaves an entry without
+them. Export and import use JSON lines of the fingerprint and result.
+"""
+import base64
+import io
+import json
+import logging
+import os
+import threading
+from dataclasses import dataclass
+
+import cv2
+import numpy as np
+
+import config
+from utils.admission import read_image_header
+from utils.decode import DecodeRequirement, decode_image
+from utils.trim import find_content_crop
+
+logger = logging.getLogger(__name__)
+
+# Decoded at reduced size (JPEGs in the DCT domain), enough for the detail mask
+HASH_REQUIREMENT = DecodeRequirement(channels=1, min_long_side=1024)
+HASH_THUMBNAIL_SIZE = 32
+HASH_BITS = 64
+# Content box threshold (gray levels from the background): high enough that
+# JPEG ringing around strokes does not widen the box
+HASH_CROP_THRESHOLD = 96
+# Detail mask side, and the most unmatched ink pixels allowed in any 8x8 block.
+# The mask holds two bit planes: strong and faint ink.
+DETAIL_SIZE = 192
+DETAIL_BYTES = 2 * DETAIL_SIZE * DETAIL_SIZE // 8
+DETAIL_BLOCK = 8
+DETAIL_MAX_UNMATCHED = 3
+# Smallest content long side fingerprinted (smaller content is scaled up to the mask)
+DETAIL_MIN_SIDE = 128
+# Ink levels on the thumbnail stretched to darkest = 0, median (background) = 255
+DETAIL_STRONG_INK = 112
+DETAIL_FAINT_INK = 192
+
+# Multi-index hashing: HASH_BITS split into INDEX_CHUNKS chunks of CHUNK_BITS
+INDEX_CHUNKS = 4
+CHUNK_BITS = HASH_BITS // INDEX_CHUNKS
+# Rebuild the chunk tables once this many entries were added after the last build
+INDEX_MERGE_EVERY = 65536
+
+ENTRY_DTYPE = np.dtype([
+    ('hash', '<u8'), ('offset', '<u8'), ('length', '<u4'), ('width', '<u4'), ('height', '<u4'),
+    ('aspect', '<f4'),
+])
+
+_POPCOUNT = np.array([bin(value).count('1') for value in range(256)], np.uint8)
+
+
+def _chunk_masks(radius):
+    """All CHUNK_BITS-bit values with at most `radius` bits set"""
+    values = np.arange(1 << CHUNK_BITS, dtype=np.uint32)
+    counts = _POPCOUNT[values & 0xFF] + _POPCOUNT[values >> 8]
+    return values[counts <= radius]
+
+
+def hamming_distances(hashes, value):
+    """Bit differences between each uint64 of `hashes` and `value`"""
+    diff = np.bitwise_xor(hashes, np.uint64(value))
+    return _POPCOUNT[diff.view(np.uint8)].reshape(-1, 8).sum(axis=1)
+
+
+def perceptual_hash(gray):
+    """
+    64-bit pHash of a grayscale image: the 8x8 lowest DCT frequencies of a
+    32x32 thumbnail, each bit set where the coefficient is above their
+    median (the DC term excluded).
+    """
+    thumbnail = cv2.resize(gray, (HASH_THUMBNAIL_SIZE, HASH_THUMBNAIL_SIZE), interpolation=cv2.INTER_AREA)
+    low = cv2.dct(thumbnail.astype(np.float32))[:8, :8].ravel()
+    bits = low > np.median(low[1:])
+    return int(np.packbits(bits).view('>u8')[0])
+
+
+def detail_mask(content):
+    """Packed strong and faint ink planes of a content crop"""
+    thumbnail = cv2.resize(content, (DETAIL_SIZE, DETAIL_SIZE), interpolation=cv2.INTER_AREA).astype(np.float32)
+    darkest, background = np.percentile(thumbnail, [1, 50])
+    stretched = (thumbnail - darkest) * (255.0 / max(1.0, background - darkest))
+    planes = np.stack([stretched < DETAIL_STRONG_INK, stretched < DETAIL_FAINT_INK])
+    return np.packbits(planes).tobytes()
+
+
+def _detail_planes(detail):
+    return np.unpackbits(np.frombuffer(detail, np.uint8)).reshape(2, DETAIL_SIZE, DETAIL_SIZE)
+
+
+def detail_mismatch(first, second):
+    """
+    Largest number of strong ink pixels, in any DETAIL_BLOCK square, of one
+    detail mask with no ink (strong or faint) of the other within one pixel.
+    """
+    strong_a, faint_a = _detail_planes(first)
+    strong_b, faint_b = _detail_planes(second)
+    kernel = np.ones((3, 3), np.uint8)
+    unmatched = (strong_a & (1 - cv2.dilate(faint_b, kernel))) | (strong_b & (1 - cv2.dilate(faint_a, kernel)))
+    counts = cv2.boxFilter(unmatched.astype(np.float32), -1, (DETAIL_BLOCK, DETAIL_BLOCK), normalize=False)
+    return int(round(float(counts.max())))
+
+
+@dataclass
+class ImageFingerprint:
+    """
+    :param width, height: Image size in pixels
+    :param aspect: Width / height of the content box
+    :param detail: Packed ink planes of the content (see detail_mask)
+    """
+    hash: int
+    width: int
+    height: int
+    aspect: float
+    detail: bytes
+
+    def to_dict(self):
+        return {'hash': f"{self.hash:016x}", 'width': self.width, 'height': self.height,
+                'aspect': round(self.aspect, 4)}
+
+
+def fingerprint_image(gray, width, height):
+    """
+    Fingerprint of a decoded image.
+
+    :param gray: Grayscale pixels, possibly reduced
+    :param width, height: Size of the image file
+    :return: ImageFingerprint, or None if the content is under DETAIL_MIN_SIDE
+    """
+    crop = find_content_crop(gray, threshold=HASH_CROP_THRESHOLD, padding=0, min_gain=0)
+    content = gray if crop is None else crop.apply(gray)
+    if max(content.shape) < DETAIL_MIN_SIDE:
+        return None
+    return ImageFingerprint(
+        perceptual_hash(content), width, height, content.shape[1] / float(content.shape[0]), detail_mask(content)
+    )
+
+
+def fingerprint_file(image_path, max_megapixels=None):
+    """
+    Fingerprint of an image file.
+
+    :param max_megapixels: Skip images larger than this (None for no limit)
+    :return: ImageFingerprint, or None for vector, multi-frame, unreadable,
+             oversized or too small images
+    """
+    header = read_image_header(image_path)
+    if header is None or header.frames > 1:
+        return None
+    if max_megapixels is not None and header.megapixels > max_megapixels:
+        return None
+    try:
+        gray = decode_image(image_path, HASH_REQUIREMENT).view(HASH_REQUIREMENT).image
+    except ValueError as e:
+        logger.debug(f"No fingerprint for {image_path}: {str(e)}")
+        return None
+    return fingerprint_image(gray, header.width, header.height)
+
+
+@dataclass
+class NearDuplicate:
+    """A stored result close to a queried image"""
+    entry: int
+    distance: int
+    fingerprint: ImageFingerprint
+    result: dict
+
+
+class NearDuplicateIndex:
+    """
+    Perceptual-hash index of analysis results; see the module docstring.
+    Thread-safe.
+
+    :param directory: Where entries and results are stored, None for memory only
+    :param max_distance: Largest Hamming distance counted as a near-duplicate
+    :param aspect_tolerance: Largest relative aspect-ratio difference of a near-duplicate
+    :param max_unmatched: Largest detail_mismatch() of a near-duplicate
+    """
+
+    def __init__(self, directory=None, max_distance=6, aspect_tolerance=0.02, max_unmatched=DETAIL_MAX_UNMATCHED,
+                 merge_every=INDEX_MERGE_EVERY):
+        self.directory = directory
+        self.max_distance = max_distance
+        self.aspect_tolerance = aspect_tolerance
+        self.max_unmatched = max_unmatched
+        self.merge_every = merge_every
+        self._probes = _chunk_masks(max_distance // INDEX_CHUNKS)
+        self._lock = threading.RLock()
+        self._entries = np.zeros(0, ENTRY_DTYPE)
+        self._count = 0
+        self._indexed = 0
+        self._tables = []
+        self._stats = {'lookups': 0, 'hits': 0, 'rejected_by_detail': 0, 'added': 0}
+
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            entries_path = os.path.join(directory, 'entries.bin')
+            entries = np.zeros(0, ENTRY_DTYPE)
+            if os.path.exists(entries_path):
+                size = os.path.getsize(entries_path)
+                if size % ENTRY_DTYPE.itemsize:
+                    # A torn last record from a crash; its result line is ignored
+                    logger.warning(f"Truncating partial record at the end of {entries_path}")
+                    with open(entries_path, 'r+b') as f:
+                        f.truncate(size - size % ENTRY_DTYPE.itemsize)
+                entries = np.fromfile(entries_path, ENTRY_DTYPE)
+            self._entries_file = open(entries_path, 'ab')
+            self._results_file = open(os.path.join(directory, 'results.jsonl'), 'a+b')
+            self._details_file = open(os.path.join(directory, 'details.bin'), 'a+b')
+            # Masks written for entries a crash kept from being recorded
+            self._details_file.truncate(len(entries) * DETAIL_BYTES)
+            self._append(entries)
+            self._build()
+            logger.info(f"Loaded {self._count} near-duplicate entries from {directory}")
+        else:
+            self._entries_file = None
+            self._results_file = io.BytesIO()
+            self._details_file = io.BytesIO()
+
+    def __len__(self):
+        return self._count
+
+    def _append(self, entries):
+        """Add entry records to memory (grown by doubling)"""
+        needed = self._count + len(entries)
+        if needed > len(self._entries):
+            grown = np.zeros(max(needed, 2 * len(self._entries), 1024), ENTRY_DTYPE)
+            grown[:self._count] = self._entries[:self._count]
+            self._entries = grown
+        self._entries[self._count:needed] = entries
+        self._count = needed
+
+    def _build(self):
+        """Rebuild the chunk tables over every entry"""
+        hashes = self._entries['hash'][:self._count]
+        self._tables = []
+        for chunk in range(INDEX_CHUNKS):
+            keys = ((hashes >> np.uint64(chunk * CHUNK_BITS)) & np.uint64(0xFFFF)).astype(np.uint16)
+            ids = np.argsort(keys, kind='stable').astype(np.uint32)
+            offsets = np.zeros((1 << CHUNK_BITS) + 1, np.int64)
+            np.cumsum(np.bincount(keys, minlength=1 << CHUNK_BITS), out=offsets[1:])
+            self._tables.append((offsets, ids))
+        self._indexed = self._count
+
+    def _candidates(self, value):
+        """Entry ids sharing a chunk within the probe radius, plus unindexed ones"""
+        found = [np.arange(self._indexed, self._count, dtype=np.uint32)]
+        for chunk, (offsets, ids) in enumerate(self._tables):
+            probes = ((value >> (chunk * CHUNK_BITS)) & 0xFFFF) ^ self._probes
+            starts = offsets[probes]
+            lengths = offsets[probes + 1] - starts
+            total = int(lengths.sum())
+            if total:
+                # Concatenated id ranges [start, end) of every probed bucket
+                positions = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(total)
+                found.append(ids[positions])
+        return np.unique(np.concatenate(found))
+
+    def nearest(self, value):
+        """
+        Entries within max_distance of a hash.
+
+        :return: (entry ids, distances), closest first
+        """
+        with self._lock:
+            candidates = self._candidates(value)
+            distances = hamming_distances(self._entries['hash'][candidates], value)
+            close = distances <= self.max_distance
+            candidates, distances = candidates[close], distances[close]
+            order = np.argsort(distances, kind='stable')
+            return candidates[order], distances[order]
+
+    def _read_result(self, entry):
+        record = self._entries[entry]
+        self._results_file.seek(int(record['offset']))
+        return json.loads(self._results_file.read(int(record['length'])))
+
+    def _read_detail(self, entry):
+        self._details_file.seek(int(entry) * DETAIL_BYTES)
+        return self._details_file.read(DETAIL_BYTES)
+
+    def _fingerprint(self, entry):
+        record = self._entries[entry]
+        return ImageFingerprint(
+            int(record['hash']), int(record['width']), int(record['height']), float(record['aspect']),
+            self._read_detail(entry)
+        )
+
+    def lookup(self, fingerprint):
+        """
+        The closest stored result of a near-duplicate image.
+
+        :param fingerprint: ImageFingerprint of the query image
+        :return: NearDuplicate, or None
+        """
+        with self._lock:
+            self._stats['lookups'] += 1
+            ids, distances = self.nearest(fingerprint.hash)
+            for entry, distance in zip(ids, distances):
+                # Cheap metadata check first: resized copies keep their aspect ratio
+                aspect = float(self._entries[entry]['aspect'])
+                if abs(aspect - fingerprint.aspect) > self.aspect_tolerance * fingerprint.aspect:
+                    continue
+                if detail_mismatch(self._read_detail(entry), fingerprint.detail) > self.max_unmatched:
+                    self._stats['rejected_by_detail'] += 1
+                    continue
+                self._stats['hits'] += 1
+                return NearDuplicate(int(entry), int(distance), self._fingerprint(entry), self._read_result(entry))
+        return None
+
+    def add_many(self, items):
+        """
+        Store results (bulk load): one write per file and one table build.
+
+        :param items: Iterable of (ImageFingerprint, result dict)
+        :return: Number of entries added
+        """
+        with self._lock:
+            self._results_file.seek(0, os.SEEK_END)
+            offset = self._results_file.tell()
+            records, lines, details = [], [], []
+            for fingerprint, result in items:
+                if len(fingerprint.detail) != DETAIL_BYTES:
+                    raise ValueError(f"Detail mask of {len(fingerprint.detail)} bytes, expected {DETAIL_BYTES}")
+                line = json.dumps(result).encode()
+                records.append((
+                    fingerprint.hash, offset, len(line), fingerprint.width, fingerprint.height, fingerprint.aspect
+                ))
+                lines.append(line)
+                details.append(fingerprint.detail)
+                offset += len(line) + 1
+            if not records:
+                return 0
+            entries = np.array(records, ENTRY_DTYPE)
+            # Results and masks first: an entry never points past the end of their files
+            self._results_file.write(b"\n".join(lines) + b"\n")
+            self._results_file.flush()
+            self._details_file.seek(self._count * DETAIL_BYTES)
+            self._details_file.write(b"".join(details))
+            self._details_file.flush()
+            if self._entries_file is not None:
+                self._entries_file.write(entries.tobytes())
+                self._entries_file.flush()
+            self._append(entries)
+            self._stats['added'] += len(entries)
+            if self._count - self._indexed >= min(self.merge_every, max(1024, self._indexed)):
+                self._build()
+            return len(entries)
+
+    def add(self, fingerprint, result):
+        """Store one analysis result; returns its entry id"""
+        with self._lock:
+            self.add_many([(fingerprint, result)])
+            return self._count - 1
+
+    def export_lines(self):
+        """Yield every entry as a JSON line (see import_lines())"""
+        with self._lock:
+            count = self._count
+        for entry in range(count):
+            with self._lock:
+                fingerprint = self._fingerprint(entry)
+                line = {
+                    **fingerprint.to_dict(),
+                    'detail': base64.b64encode(fingerprint.detail).decode('ascii'),
+                    'result': self._read_result(entry),
+                }
+            yield json.dumps(line) + '\n'
+
+    def import_lines(self, lines):
+        """
+        Bulk load JSON lines as written by export_lines().
+
+        :return: Number of entries added
+        :raises ValueError: on a malformed line (nothing from the batch is added)
+        """
+        items = []
+        for number, line in enumerate(lines, 1):
+            if not line.strip():
+                continue
+            try:
+                data = json.loads(line)
+                fingerprint = ImageFingerprint(
+                    int(data['hash'], 16), int(data['width']), int(data['height']), float(data['aspect']),
+                    base64.b64decode(data['detail'])
+                )
+                if len(fingerprint.detail) != DETAIL_BYTES:
+                    raise ValueError(f"detail must be {DETAIL_BYTES} bytes")
+                items.append((fingerprint, data['result']))
+            except (ValueError, KeyError, TypeError) as e:
+                raise ValueError(f"Line {number}: {str(e)}")
+        return self.add_many(items)
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, entries=self._count, unindexed=self._count - self._indexed,
+                        max_distance=self.max_distance)
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_near_duplicate_index():
+    """This process's NearDuplicateIndex, loaded from config on first use"""
+    global _index
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                _index = NearDuplicateIndex(
+                    directory=config.NEAR_DUPLICATE_DIR or None,
+                    max_distance=config.NEAR_DUPLICATE_MAX_DISTANCE,
+                    aspect_tolerance=config.NEAR_DUPLICATE_ASPECT_TOLERANCE,
+                    max_unmatched=config.NEAR_DUPLICATE_MAX_UNMATCHED
+                )
+    return _index
@@ -0,0 +1,390 @@
+# image-analysis-service/src/utils/ocr_engines.py
+"""
+OCR engines behind one interface: Tesseract, PaddleOCR and EasyOCR, on CPU.
+
+Each engine imports its package on first use and loads its models once per
+process; worker processes can load them at start (see OCR_WARM_ENGINES in
+config.py), and every job the process runs reuses them.
+
+Two entry points:
+
+- read(image, config): find and read all text in an image
+- read_lines(crops, config): read one line of text per crop, batched.
+  Tesseract gets the crops packed onto sheets (one process start per
+  sheet), PaddleOCR runs its recognizer on the whole list, EasyOCR
+  recognizes the boxes of one stacked canvas in a batch.
+
+`config` is a Tesseract config string; the other engines only take the
+character whitelist (tessedit_char_whitelist) from it.
+"""
+import importlib.util
+import logging
+import re
+import threading
+from dataclasses import dataclass, field
+from typing import List, Tuple
+
+import cv2
+import numpy as np
+
+from utils.bitmask import as_array
+
+logger = logging.getLogger(__name__)
+
+TESSERACT = 'tesseract'
+PADDLEOCR = 'paddleocr'
+EASYOCR = 'easyocr'
+
+# Recognition language of the learned engines
+OCR_LANGUAGE = 'en'
+# Crops per recognizer batch
+OCR_BATCH_SIZE = 32
+
+# Minimum gap between crops on a Tesseract sheet or EasyOCR canvas, in pixels
+SHEET_GAP = 16
+# Sheets are split before Tesseract's size limit
+SHEET_MAX_HEIGHT = 16000
+
+_WHITELIST_RE = re.compile(r'tessedit_char_whitelist=(\S+)')
+
+
+class OcrEngineError(RuntimeError):
+    """An engine is unknown or its package is not installed"""
+
+
+@dataclass
+class OcrWord:
+    """
+    One recognized word (or line, for engines that read whole lines).
+
+    :param confidence: 0-100, -1 if the engine gives none
+    :param line: Key of the text line the word belongs to, in reading order
+    """
+    text: str
+    confidence: float
+    left: int = 0
+    top: int = 0
+    width: int = 0
+    height: int = 0
+    line: Tuple = ()
+
+
+@dataclass
+class OcrResult:
+    """Words read from one image or crop"""
+    words: List[OcrWord] = field(default_factory=list)
+
+    @property
+    def text(self):
+        """Words joined with spaces, lines with newlines"""
+        lines = {}
+        for word in self.words:
+            lines.setdefault(word.line, []).append(word.text)
+        return "\n".join(" ".join(words) for words in lines.values())
+
+    @property
+    def confidence(self):
+        """Mean word confidence (0 if there are none)"""
+        confidences = [word.confidence for word in self.words if word.confidence >= 0]
+        return float(np.mean(confidences)) if confidences else 0.0
+
+
+def config_whitelist(config):
+    """Characters allowed by a Tesseract config, or None"""
+    match = _WHITELIST_RE.search(config or '')
+    return match.group(1) if match else None
+
+
+def _gray(image):
+    image = as_array(image)
+    return cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim == 3 else image
+
+
+def _bgr(image):
+    image = as_array(image)
+    return cv2.cvtColor(image, cv2.COLOR_GRAY2BGR) if image.ndim == 2 else image
+
+
+def _background(crop):
+    """Border level of a crop, used to pad it on a sheet"""
+    return int(np.median(np.concatenate([crop[0], crop[-1], crop[:, 0], crop[:, -1]])))
+
+
+def pack_sheets(crops):
+    """
+    Pack grayscale crops onto sheets, shelf by shelf (tallest first), with
+    gaps wide enough that the engine keeps neighboring crops apart.
+
+    :return: List of (sheet, [(crop index, x0, y0, x1, y1), ...]) giving
+             where each crop sits on its sheet
+    """
+    # Roughly square sheets, never narrower than the widest crop
+    total_area = sum((c.shape[0] + SHEET_GAP) * (c.shape[1] + 2 * c.shape[0]) for c in crops)
+    sheet_width = max(max(c.shape[1] for c in crops) + 2 * SHEET_GAP, int(np.sqrt(total_area)))
+
+    # Place crops: (sheet number, index, x, y)
+    placements, sheet, x, y, shelf_height = [], 0, SHEET_GAP, SHEET_GAP, 0
+    for index in sorted(range(len(crops)), key=lambda i: -crops[i].shape[0]):
+        height, width = crops[index].shape[:2]
+        # Horizontal gap at least a line height, wider than a word space
+        gap = max(SHEET_GAP, height)
+        if x > SHEET_GAP and x + width + SHEET_GAP > sheet_width:
+            x, y, shelf_height = SHEET_GAP, y + shelf_height + SHEET_GAP, 0
+        if y > SHEET_GAP and y + height + SHEET_GAP > SHEET_MAX_HEIGHT:
+            sheet, x, y, shelf_height = sheet + 1, SHEET_GAP, SHEET_GAP, 0
+        placements.append((sheet, index, x, y))
+        x += width + gap
+        shelf_height = max(shelf_height, height)
+
+    result = []
+    for number in range(sheet + 1):
+        placed = [p for p in placements if p[0] == number]
+        height = max(y + crops[i].shape[0] for _, i, _, y in placed) + SHEET_GAP
+        # Background of the sheet follows the crops (dark-on-light or inverted)
+        canvas = np.full((height, sheet_width), int(np.median([_background(crops[i]) for _, i, _, _ in placed])), np.uint8)
+        rects = []
+        for _, i, x, y in placed:
+            crop = crops[i]
+            canvas[y:y + crop.shape[0], x:x + crop.shape[1]] = crop
+            rects.append((i, x, y, x + crop.shape[1], y + crop.shape[0]))
+        result.append((canvas, rects))
+    return result
+
+
+class OcrEngine:
+    """
+    Base class. Subclasses set `name` and `package`, load their models in
+    load() and implement read(); read_lines() defaults to one read() per crop.
+    """
+    name = None
+    package = None
+
+    def load(self):
+        """Import the package and load models; called once per process"""
+
+    def normalize_config(self, config):
+        """
+        The part of a Tesseract config this engine uses: configs that normalize
+        to the same string give the same result, so callers trying several
+        can skip duplicates. Other engines only keep the whitelist.
+        """
+        whitelist = config_whitelist(config)
+        return f"-c tessedit_char_whitelist={whitelist}" if whitelist else ''
+
+    def read(self, image, config=''):
+        """
+        Find and read all text in `image` (array or PackedMask).
+
+        :return: OcrResult
+        """
+        raise NotImplementedError
+
+    def read_lines(self, crops, config=''):
+        """
+        Read one line of text from each crop.
+
+        :return: One OcrResult per crop, in order
+        """
+        return [self.read(crop, config) for crop in crops]
+
+
+class TesseractEngine(OcrEngine):
+    name = TESSERACT
+    package = 'pytesseract'
+
+    def normalize_config(self, config):
+        return config
+
+    def load(self):
+        import pytesseract
+        # If using Windows, specify the path to Tesseract (adjust this path if needed)
+        # pytesseract.pytesseract.tesseract_cmd = r'C:\Program Files\Tesseract-OCR\tesseract.exe'
+        self._tesseract = pytesseract
+
+    def _data(self, image, config):
+        return self._tesseract.image_to_data(image, config=config, output_type=self._tesseract.Output.DICT)
+
+    def read(self, image, config=''):
+        data = self._data(as_array(image), config)
+        words = [
+            OcrWord(text.strip(), float(conf), left, top, width, height, (block, par, line))
+            for text, conf, left, top, width, height, block, par, line in zip(
+                data['text'], data['conf'], data['left'], data['top'], data['width'], data['height'],
+                data['block_num'], data['par_num'], data['line_num'])
+            if text.strip()
+        ]
+        return OcrResult(words)
+
+    def read_lines(self, crops, config=''):
+        """One Tesseract call per sheet of packed crops; words are mapped back by position"""
+        results = [OcrResult() for _ in crops]
+        if not crops:
+            return results
+        for sheet, rects in pack_sheets([_gray(crop) for crop in crops]):
+            for word in self.read(sheet, config).words:
+                center_x, center_y = word.left + word.width / 2, word.top + word.height / 2
+                for index, x0, y0, x1, y1 in rects:
+                    if x0 <= center_x < x1 and y0 <= center_y < y1:
+                        results[index].words.append(word)
+                        break
+        return results
+
+
+class PaddleOcrEngine(OcrEngine):
+    name = PADDLEOCR
+    package = 'paddleocr'
+
+    def load(self):
+        from paddleocr import PaddleOCR
+        self._ocr = PaddleOCR(
+            use_angle_cls=False, lang=OCR_LANGUAGE, use_gpu=False, show_log=False,
+            cpu_threads=1, rec_batch_num=OCR_BATCH_SIZE
+        )
+
+    def read(self, image, config=''):
+        # One entry per page; None when nothing was found
+        page = self._ocr.ocr(_bgr(image), cls=False)[0] or []
+        words = []
+        for index, (box, (text, confidence)) in enumerate(page):
+            xs, ys = [point[0] for point in box], [point[1] for point in box]
+            words.append(OcrWord(
+                text, confidence * 100, int(min(xs)), int(min(ys)),
+                int(max(xs) - min(xs)), int(max(ys) - min(ys)), (index,)
+            ))
+        return OcrResult(_allowed(words, config_whitelist(config)))
+
+    def read_lines(self, crops, config=''):
+        """Recognizer only (no detection), batched over all crops"""
+        if not crops:
+            return []
+        recognized = self._ocr.ocr([_bgr(crop) for crop in crops], det=False, cls=False)[0]
+        whitelist = config_whitelist(config)
+        return [
+            OcrResult(_allowed([OcrWord(text, confidence * 100)] if text else [], whitelist))
+            for text, confidence in recognized
+        ]
+
+
+class EasyOcrEngine(OcrEngine):
+    name = EASYOCR
+    package = 'easyocr'
+
+    def load(self):
+        import easyocr
+        import torch
+        # Same CPU budget as the rest of the worker (one thread)
+        torch.set_num_threads(1)
+        self._reader = easyocr.Reader([OCR_LANGUAGE], gpu=False, verbose=False)
+
+    @staticmethod
+    def _words(results):
+        words = []
+        for index, (box, text, confidence) in enumerate(results):
+            xs, ys = [point[0] for point in box], [point[1] for point in box]
+            words.append(OcrWord(
+                text, confidence * 100, int(min(xs)), int(min(ys)),
+                int(max(xs) - min(xs)), int(max(ys) - min(ys)), (index,)
+            ))
+        return words
+
+    def read(self, image, config=''):
+        results = self._reader.readtext(
+            _gray(image), detail=1, paragraph=False,
+            allowlist=config_whitelist(config), batch_size=OCR_BATCH_SIZE
+        )
+        return OcrResult(self._words(results))
+
+    def read_lines(self, crops, config=''):
+        """Crops stacked on one canvas, all boxes recognized in one batch"""
+        if not crops:
+            return []
+        crops = [_gray(crop) for crop in crops]
+        width = max(crop.shape[1] for crop in crops)
+        height = sum(crop.shape[0] + SHEET_GAP for crop in crops) + SHEET_GAP
+        canvas = np.full((height, width + 2 * SHEET_GAP), 255, np.uint8)
+        boxes, tops, top = [], {}, SHEET_GAP
+        for index, crop in enumerate(crops):
+            canvas[top:top + crop.shape[0], SHEET_GAP:SHEET_GAP + crop.shape[1]] = crop
+            boxes.append([SHEET_GAP, SHEET_GAP + crop.shape[1], top, top + crop.shape[0]])
+            tops[top] = index
+            top += crop.shape[0] + SHEET_GAP
+
+        results = [OcrResult() for _ in crops]
+        recognized = self._reader.recognize(
+            canvas, horizontal_list=boxes, free_list=[], detail=1,
+            allowlist=config_whitelist(config), batch_size=OCR_BATCH_SIZE
+        )
+        for word in self._words(recognized):
+            # Results come back sorted by position; map them by their top edge
+            index = tops.get(word.top)
+            if index is not None and word.text:
+                results[index].words.append(word)
+        return results
+
+
+def _allowed(words, whitelist):
+    """Words with characters outside `whitelist` removed (engines without a native whitelist)"""
+    if not whitelist:
+        return words
+    for word in words:
+        word.text = ''.join(c for c in word.text if c in whitelist)
+    return [word for word in words if word.text]
+
+
+ENGINE_CLASSES = {engine.name: engine for engine in (TesseractEngine, PaddleOcrEngine, EasyOcrEngine)}
+
+_engines = {}
+_engines_lock = threading.Lock()
+
+
+def get_engine(name=None):
+    """
+    The loaded engine called `name` (TESSERACT if None), loading it on first use.
+
+    :raises OcrEngineError: if the engine is unknown or its package is missing
+    """
+    name = name or TESSERACT
+    engine = _engines.get(name)
+    if engine is not None:
+        return engine
+    if name not in ENGINE_CLASSES:
+        raise OcrEngineError(f"Unknown OCR engine '{name}', expected one of {sorted(ENGINE_CLASSES)}")
+    with _engines_lock:
+        if name not in _engines:
+            engine = ENGINE_CLASSES[name]()
+            try:
+                engine.load()
+            except ImportError as e:
+                raise OcrEngineError(f"OCR engine '{name}' needs the {engine.package} package: {str(e)}")
+            logger.info(f"Loaded OCR engine {name}")
+            _engines[name] = engine
+    return _engines[name]
+
+
+def engine_or_default(name=None):
+    """
+    get_engine(name), falling back to Tesseract (with a warning) when that
+    engine cannot be loaded, e.g. a profile naming an engine not installed
+    on this worker.
+    """
+    try:
+        return get_engine(name)
+    except OcrEngineError as e:
+        if not name or name == TESSERACT:
+            raise
+        logger.warning(f"{str(e)}; using {TESSERACT}")
+        return get_engine(TESSERACT)
+
+
+def available_engines():
+    """Engine name -> whether its package is installed (nothing is imported)"""
+    return {name: importlib.util.find_spec(engine.package) is not None for name, engine in ENGINE_CLASSES.items()}
+
+
+def warm_engines(names):
+    """Load engines ahead of the first job; failures are logged, not raised"""
+    for name in names:
+        try:
+            get_engine(name)
+        except Exception as e:
+            logger.warning(f"Could not load OCR engine {name}: {str(e)}")
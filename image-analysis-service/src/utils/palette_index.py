@@ -0,0 +1,663 @@
+# image-analysis-service/src/utils/palette_index.py
+"""
+Search of diagrams by color palette: an inverted index over quantized
+CIELAB colors, re-ranked by perceptual color distance.
+
+Each result's palette is its `dominant_colors` (analyze_color_distribution(),
+or the SVG's own colors; BGR as the service writes them), at most
+PALETTE_MAX_COLORS of them, converted to CIELAB (L 0..100, a and b about
+-128..127). A query is a palette too: a few colors, or a stored diagram's.
+
+Palette distance is perceptual: each color's CIEDE2000 difference to the
+nearest color of the other palette, averaged over the query's colors and
+over the stored colors, and the two averages averaged. 0 is the same
+palette; differences under ~2 are barely visible, and a distance of 10
+already tells palettes apart at a glance.
+
+Search runs in three steps:
+
+- inverted index: LAB space is cut into bins (PALETTE_L_STEP units of
+  lightness, PALETTE_AB_STEP of a and b), and each bin lists, per color
+  slot, the rows with a color in it. A query color looks up its bin and
+  the 26 around it, which holds every stored color within PALETTE_L_STEP
+  of it. Each row then has a count of unmatched colors: query colors with
+  no stored color near, plus stored colors near no query color. Every
+  unmatched color adds about PALETTE_L_STEP or more to the distance, so
+  the rows with the fewest are kept, at least RERANK_CANDIDATES of them
+- coarse scoring: those palettes are scored by CIE76 (Euclidean LAB)
+  distance, all pairs from one matrix product, and the best
+  RERANK_CANDIDATES kept
+- exact re-ranking of those by CIEDE2000
+
+Common colors (the white background of nearly every diagram) would make
+posting lists of nearly every row, so bins holding more than
+DENSE_BIN_SHARE of the rows are kept as one byte a row instead (bit s: slot
+s is in the bin), OR-ed in whole. Either way no distance is computed for
+rows that have more unmatched colors than the best ones.
+
+Storage under the index directory, named by index.json (replaced last, so
+a crash mid-rebuild keeps the previous files in use): palettes-<n>.bin
+(fixed-size records: LAB colors and their count) and keys-<n>.jsonl (one
+line per upsert, with id, row and metadata, or per delete), replayed on
+load. The bins are rebuilt from the palettes on load and every
+INDEX_MERGE_EVERY upserts; newer rows are matched directly.
+"""
+import io
+import json
+import logging
+import os
+import re
+import threading
+from dataclasses import dataclass
+
+import cv2
+import numpy as np
+
+import config
+
+logger = logging.getLogger(__name__)
+
+PALETTE_MAX_COLORS = 5
+PALETTE_L_STEP = 10
+PALETTE_AB_STEP = 16
+L_BINS = 100 // PALETTE_L_STEP
+AB_BINS = 256 // PALETTE_AB_STEP
+PALETTE_BINS = L_BINS * AB_BINS * AB_BINS
+
+PALETTE_DTYPE = np.dtype([('lab', '<f4', (PALETTE_MAX_COLORS, 3)), ('count', 'u1')])
+# Unused color slots: far from every real color, so never the nearest one
+_UNUSED_LAB = np.float32(1e4)
+
+# Candidates scored by CIEDE2000 after the CIE76 pass
+RERANK_CANDIDATES = 512
+# Palette rows scored per matrix product
+SCAN_BLOCK_ROWS = 65536
+INDEX_MERGE_EVERY = 16384
+# Bins with more of the rows than this are slot bitmasks, not posting lists
+DENSE_BIN_SHARE = 1 / 16.
+_SLOT_BITS = (1 << np.arange(PALETTE_MAX_COLORS)).astype(np.uint8)
+_BIT_COUNTS = np.array([bin(value).count('1') for value in range(256)], np.uint8)
+
+_HEX_COLOR = re.compile(r'^#?([0-9a-fA-F]{6})$')
+# (L, a) offsets of the runs of three consecutive b bins around a bin
+_PLANE_NEIGHBOURS = [(dl, da) for dl in (-1, 0, 1) for da in (-1, 0, 1)]
+
+
+@dataclass
+class PaletteMatch:
+    """A stored diagram with a palette close to a query"""
+    id: str
+    distance: float
+    meta: dict
+    colors: list
+
+    def to_dict(self):
+        return {'id': self.id, 'distance': round(self.distance, 2), 'meta': self.meta, 'colors': self.colors}
+
+
+def bgr_to_lab(colors):
+    """CIELAB (L 0..100) of 8-bit BGR colors, n x 3 float32"""
+    colors = np.asarray(colors, np.float32).reshape(1, -1, 3) / 255.0
+    return cv2.cvtColor(colors, cv2.COLOR_BGR2LAB)[0]
+
+
+def lab_to_hex(lab):
+    """'#rrggbb' of each CIELAB color"""
+    bgr = cv2.cvtColor(np.asarray(lab, np.float32).reshape(1, -1, 3), cv2.COLOR_LAB2BGR)[0]
+    bgr = np.clip(np.round(bgr * 255), 0, 255).astype(int)
+    return [f"#{r:02x}{g:02x}{b:02x}" for b, g, r in bgr]
+
+
+def parse_colors(colors):
+    """
+    BGR colors from a client: '#rrggbb' strings or [r, g, b] lists.
+
+    :raises ValueError: on anything else
+    """
+    if not isinstance(colors, (list, tuple)) or not colors:
+        raise ValueError("colors must be a non-empty list")
+    bgr = []
+    for color in colors:
+        if isinstance(color, str) and _HEX_COLOR.match(color):
+            value = int(_HEX_COLOR.match(color).group(1), 16)
+            bgr.append([value & 0xFF, (value >> 8) & 0xFF, value >> 16])
+        elif isinstance(color, (list, tuple)) and len(color) == 3 and all(0 <= c <= 255 for c in color):
+            bgr.append([color[2], color[1], color[0]])
+        else:
+            raise ValueError(f"color must be '#rrggbb' or [r, g, b], got {color!r}")
+    return bgr
+
+
+def document_palette(document):
+    """
+    CIELAB palette of an analysis result (its dominant colors), or of a
+    dict with client `colors`; None if it has neither.
+
+    :raises ValueError: on malformed colors
+    """
+    if document.get('colors') is not None:
+        bgr = parse_colors(document['colors'])
+    else:
+        stats = (document.get('color_analysis') or {}).get('color_stats') or {}
+        bgr = stats.get('dominant_colors')
+        if not bgr:
+            return None
+        bgr = np.asarray(bgr, np.float32)
+        if bgr.ndim != 2 or bgr.shape[1] != 3:
+            raise ValueError("dominant_colors must be a list of [b, g, r] colors")
+    return bgr_to_lab(np.asarray(bgr, np.float32)[:PALETTE_MAX_COLORS])
+
+
+def _palette_record(lab):
+    record = np.zeros(1, PALETTE_DTYPE)
+    record['lab'][0] = _UNUSED_LAB
+    record['lab'][0, :len(lab)] = lab
+    record['count'] = len(lab)
+    return record
+
+
+def _records_or_empty(records):
+    return np.concatenate(records) if records else np.zeros(0, PALETTE_DTYPE)
+
+
+def lab_bins(lab):
+    """(L, a, b) bin coordinates of CIELAB colors, ... x 3"""
+    lab = np.asarray(lab, np.float32)
+    return np.stack([
+        np.clip((lab[..., 0] // PALETTE_L_STEP).astype(np.int32), 0, L_BINS - 1),
+        np.clip(((lab[..., 1] + 128) // PALETTE_AB_STEP).astype(np.int32), 0, AB_BINS - 1),
+        np.clip(((lab[..., 2] + 128) // PALETTE_AB_STEP).astype(np.int32), 0, AB_BINS - 1),
+    ], axis=-1)
+
+
+def _bin_ids(coordinates):
+    return (coordinates[..., 0] * AB_BINS + coordinates[..., 1]) * AB_BINS + coordinates[..., 2]
+
+
+def delta_e_2000(lab1, lab2):
+    """CIEDE2000 color difference, broadcasting over leading dimensions"""
+    lab1 = np.asarray(lab1, np.float64)
+    lab2 = np.asarray(lab2, np.float64)
+    l1, a1, b1 = lab1[..., 0], lab1[..., 1], lab1[..., 2]
+    l2, a2, b2 = lab2[..., 0], lab2[..., 1], lab2[..., 2]
+    c_mean = (np.hypot(a1, b1) + np.hypot(a2, b2)) / 2
+    g = 0.5 * (1 - np.sqrt(c_mean ** 7 / (c_mean ** 7 + 25.0 ** 7)))
+    a1, a2 = a1 * (1 + g), a2 * (1 + g)
+    c1, c2 = np.hypot(a1, b1), np.hypot(a2, b2)
+    h1 = np.degrees(np.arctan2(b1, a1)) % 360
+    h2 = np.degrees(np.arctan2(b2, a2)) % 360
+    chroma_zero = (c1 * c2) == 0
+
+    dl = l2 - l1
+    dc = c2 - c1
+    dh = h2 - h1
+    dh = np.where(dh > 180, dh - 360, np.where(dh < -180, dh + 360, dh))
+    dh = np.where(chroma_zero, 0, dh)
+    dh_term = 2 * np.sqrt(c1 * c2) * np.sin(np.radians(dh / 2))
+
+    l_mean = (l1 + l2) / 2
+    c_mean = (c1 + c2) / 2
+    h_sum = h1 + h2
+    h_mean = np.where(np.abs(h1 - h2) > 180, np.where(h_sum < 360, h_sum + 360, h_sum - 360), h_sum) / 2
+    h_mean = np.where(chroma_zero, h_sum, h_mean)
+    t = (1 - 0.17 * np.cos(np.radians(h_mean - 30)) + 0.24 * np.cos(np.radians(2 * h_mean))
+         + 0.32 * np.cos(np.radians(3 * h_mean + 6)) - 0.20 * np.cos(np.radians(4 * h_mean - 63)))
+    s_l = 1 + 0.015 * (l_mean - 50) ** 2 / np.sqrt(20 + (l_mean - 50) ** 2)
+    s_c = 1 + 0.045 * c_mean
+    s_h = 1 + 0.015 * c_mean * t
+    r_t = (-2 * np.sqrt(c_mean ** 7 / (c_mean ** 7 + 25.0 ** 7))
+           * np.sin(np.radians(60 * np.exp(-(((h_mean - 275) / 25) ** 2)))))
+    return np.sqrt(
+        (dl / s_l) ** 2 + (dc / s_c) ** 2 + (dh_term / s_h) ** 2 + r_t * (dc / s_c) * (dh_term / s_h)
+    )
+
+
+def _chamfer(pairs, counts):
+    """
+    Symmetric average nearest-color distance.
+
+    :param pairs: query colors x PALETTE_MAX_COLORS x rows (unused slots huge)
+    :param counts: colors used by each row
+    """
+    # Reduced slot by slot: numpy's reductions over a short inner axis are slow
+    nearest = pairs[:, 0]
+    for slot in range(1, PALETTE_MAX_COLORS):
+        nearest = np.minimum(nearest, pairs[:, slot])
+    query_side = nearest.mean(axis=0)
+    used = np.arange(PALETTE_MAX_COLORS)[:, None] < counts[None, :]
+    stored_side = np.where(used, pairs.min(axis=0), 0).sum(axis=0) / np.maximum(counts, 1)
+    return (query_side + stored_side) / 2
+
+
+def palette_distances(lab, counts, query, exact=True):
+    """
+    Palette distance of stored palettes to a query palette.
+
+    :param lab: CIELAB colors, PALETTE_MAX_COLORS x rows x 3 (slot-major)
+    :param counts: colors used by each row
+    :param query: CIELAB palette, n x 3
+    :param exact: CIEDE2000 if True, else CIE76 (one matrix product)
+    """
+    if exact:
+        pairs = delta_e_2000(lab[None], query[:, None, None, :])
+    else:
+        points = lab.reshape(-1, 3)
+        squared = (np.einsum('ij,ij->i', points, points)[None, :] + (query * query).sum(axis=1)[:, None]
+                   - 2 * query @ points.T)
+        pairs = np.sqrt(np.maximum(squared, 0)).reshape(len(query), PALETTE_MAX_COLORS, -1)
+    return _chamfer(pairs, counts)
+
+
+class PaletteIndex:
+    """
+    Palette search over stored diagrams; see the module docstring.
+    Thread-safe.
+
+    :param directory: Where palettes and ids are stored, None for memory only
+    :param max_distance: Default largest palette distance returned
+    :param merge_every: Unindexed upserts that trigger a bin rebuild
+    """
+
+    def __init__(self, directory=None, max_distance=15.0, merge_every=INDEX_MERGE_EVERY):
+        self.directory = directory
+        self.max_distance = max_distance
+        self.merge_every = merge_every
+        self._lock = threading.RLock()
+        self._generation = 0
+        self._stats = {'searches': 0, 'upserted': 0, 'deleted': 0, 'rebuilds': 0}
+        self._reset()
+
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            self._generation = self._read_state().get('generation', 0)
+            palettes_path = self._palettes_path()
+            records = np.zeros(0, PALETTE_DTYPE)
+            if os.path.exists(palettes_path):
+                records = np.fromfile(palettes_path, PALETTE_DTYPE, os.path.getsize(palettes_path)
+                                      // PALETTE_DTYPE.itemsize)
+            self._keys_file = open(self._keys_path(), 'a+b')
+            self._replay_keys(records)
+            self._palettes_file = open(palettes_path, 'ab')
+            # Records written for upserts whose key line a crash kept from being recorded
+            self._palettes_file.truncate(self._count * PALETTE_DTYPE.itemsize)
+            self._build()
+            logger.info(f"Loaded {len(self._rows)} palettes from {directory}")
+        else:
+            self._keys_file = io.BytesIO()
+            self._palettes_file = None
+
+    def _reset(self):
+        self._ids = []
+        self._meta = []
+        self._rows = {}
+        # Slot-major colors (PALETTE_MAX_COLORS x capacity x 3) and color counts
+        self._lab = np.zeros((PALETTE_MAX_COLORS, 0, 3), np.float32)
+        self._counts = np.zeros(0, np.uint8)
+        self._alive = np.zeros(0, bool)
+        self._count = 0
+        # Bins cover rows below _indexed: the rows with slot s in bin i are
+        # _postings[_offsets[s, i]:_offsets[s, i + 1]], or for dense bins
+        # those with bit s of _dense_masks[_dense_bins[i]]
+        self._offsets = np.zeros((PALETTE_MAX_COLORS, PALETTE_BINS + 1), np.int64)
+        self._postings = np.zeros(0, np.uint32)
+        self._dense_bins = {}
+        self._dense_masks = np.zeros((0, 0), np.uint8)
+        self._indexed = 0
+
+    def __len__(self):
+        return len(self._rows)
+
+    # Storage
+
+    def _state_path(self):
+        return os.path.join(self.directory, 'index.json')
+
+    def _palettes_path(self, generation=None):
+        return os.path.join(self.directory, f"palettes-{self._generation if generation is None else generation}.bin")
+
+    def _keys_path(self, generation=None):
+        return os.path.join(self.directory, f"keys-{self._generation if generation is None else generation}.jsonl")
+
+    def _read_state(self):
+        try:
+            with open(self._state_path()) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except ValueError as e:
+            logger.error(f"Unreadable {self._state_path()}, starting from generation 0: {str(e)}")
+            return {}
+
+    def _replay_keys(self, records):
+        """Rebuild ids, metadata, palettes and deletions from the key log"""
+        self._keys_file.seek(0)
+        upserts = []
+        for number, line in enumerate(self._keys_file):
+            try:
+                record = json.loads(line)
+                item_id = record['id']
+                if not record.get('deleted') and record['row'] != self._count + len(upserts):
+                    raise ValueError("row out of sequence")
+            except (ValueError, KeyError):
+                # A torn last line from a crash: that upsert or delete never completed
+                logger.warning(f"Ignoring unreadable line {number + 1} of the palette keys")
+                self._keys_file.truncate(self._keys_file.tell() - len(line))
+                break
+            if record.get('deleted'):
+                self._flush_replayed(upserts, records)
+                self._forget(item_id)
+            else:
+                upserts.append((item_id, record.get('meta') or {}))
+        self._flush_replayed(upserts, records)
+
+    def _flush_replayed(self, upserts, records):
+        if upserts:
+            start = self._count
+            self._append_rows([item_id for item_id, _ in upserts], [meta for _, meta in upserts],
+                              records[start:start + len(upserts)])
+            upserts.clear()
+
+    def _append_rows(self, ids, metas, records):
+        """Record new rows for ids, replacing the rows of ids already stored"""
+        needed = self._count + len(ids)
+        if needed > len(self._counts):
+            size = max(needed, 2 * len(self._counts), 1024)
+            lab = np.full((PALETTE_MAX_COLORS, size, 3), _UNUSED_LAB, np.float32)
+            lab[:, :self._count] = self._lab[:, :self._count]
+            counts, alive = np.zeros(size, np.uint8), np.zeros(size, bool)
+            counts[:self._count], alive[:self._count] = self._counts[:self._count], self._alive[:self._count]
+            self._lab, self._counts, self._alive = lab, counts, alive
+        self._lab[:, self._count:needed] = records['lab'].transpose(1, 0, 2)
+        self._counts[self._count:needed] = records['count']
+        self._alive[self._count:needed] = True
+        self._ids.extend(ids)
+        self._meta.extend(metas)
+        start = self._count
+        self._count = needed
+        for offset, item_id in enumerate(ids):
+            # Later duplicates of an id in the same batch win
+            self._forget(item_id)
+            self._rows[item_id] = start + offset
+
+    def _forget(self, item_id):
+        row = self._rows.pop(item_id, None)
+        if row is not None:
+            self._alive[row] = False
+            self._meta[row] = None
+        return row is not None
+
+    def _write_keys(self, records):
+        if records:
+            self._keys_file.seek(0, os.SEEK_END)
+            self._keys_file.write(b"".join(json.dumps(record).encode() + b"\n" for record in records))
+            self._keys_file.flush()
+
+    # Bins
+
+    def _slot_bins(self, start, end):
+        """Bin coordinates (slots x rows x 3) and used-slot flags of rows [start, end)"""
+        used = np.arange(PALETTE_MAX_COLORS)[:, None] < self._counts[None, start:end]
+        return lab_bins(self._lab[:, start:end]), used
+
+    def _build(self):
+        """Rebuild the bin postings and dense bin masks over every live row"""
+        count = self._count
+        coordinates, used = self._slot_bins(0, count)
+        bins = np.where(used & self._alive[None, :count], _bin_ids(coordinates), PALETTE_BINS)
+        sizes = np.bincount(bins.ravel(), minlength=PALETTE_BINS + 1)[:PALETTE_BINS]
+        dense = np.flatnonzero(sizes > max(RERANK_CANDIDATES, DENSE_BIN_SHARE * count))
+        self._dense_bins = {int(bin_id): i for i, bin_id in enumerate(dense)}
+        self._dense_masks = np.zeros((len(dense), count), np.uint8)
+        sparse = np.ones(PALETTE_BINS + 1, bool)
+        sparse[dense] = False
+        sparse[PALETTE_BINS] = False
+
+        postings = []
+        self._offsets = np.zeros((PALETTE_MAX_COLORS, PALETTE_BINS + 1), np.int64)
+        for slot in range(PALETTE_MAX_COLORS):
+            for i, bin_id in enumerate(dense):
+                self._dense_masks[i] |= (bins[slot] == bin_id) * _SLOT_BITS[slot]
+            rows = np.flatnonzero(sparse[bins[slot]])
+            slot_bins = bins[slot, rows]
+            postings.append(rows[np.argsort(slot_bins, kind='stable')].astype(np.uint32))
+            self._offsets[slot] = sum(len(part) for part in postings[:-1])
+            np.cumsum(np.bincount(slot_bins, minlength=PALETTE_BINS), out=self._offsets[slot, 1:])
+            self._offsets[slot, 1:] += self._offsets[slot, 0]
+        self._postings = np.concatenate(postings)
+        self._indexed = count
+
+    def _maintain(self):
+        unindexed = self._count - self._indexed
+        if unindexed and unindexed >= min(self.merge_every, max(1024, self._indexed)):
+            self._build()
+
+    def _near_slots(self, coordinates, tail_bins, tail_used):
+        """Per row, bit s set if slot s is in or next to the bin at `coordinates`"""
+        near = np.zeros(self._count, np.uint8)
+        l, a, b = (int(c) for c in coordinates)
+        low, high = max(b - 1, 0), min(b + 1, AB_BINS - 1)
+        for dl, da in _PLANE_NEIGHBOURS:
+            if not (0 <= l + dl < L_BINS and 0 <= a + da < AB_BINS):
+                continue
+            # Three consecutive bins, in which each row has a slot at most once
+            first = ((l + dl) * AB_BINS + a + da) * AB_BINS
+            for slot in range(PALETTE_MAX_COLORS):
+                rows = self._postings[self._offsets[slot, first + low]:self._offsets[slot, first + high + 1]]
+                near[rows] |= _SLOT_BITS[slot]
+            for bin_id in range(first + low, first + high + 1):
+                if bin_id in self._dense_bins:
+                    near[:self._indexed] |= self._dense_masks[self._dense_bins[bin_id]]
+        if len(tail_used[0]):
+            close = np.all(np.abs(tail_bins - coordinates) <= 1, axis=2) & tail_used
+            near[self._indexed:] = (close * _SLOT_BITS[:, None]).sum(axis=0)
+        return near
+
+    def _unmatched_colors(self, query):
+        """
+        Per row: query colors with no stored color in or next to their bin,
+        plus stored colors in or next to the bin of no query color (255 for
+        deleted rows).
+        """
+        count = self._count
+        missing = np.zeros(count, np.uint8)
+        matched = np.zeros(count, np.uint8)
+        tail_bins, tail_used = self._slot_bins(self._indexed, count)
+        for coordinates in lab_bins(query):
+            near = self._near_slots(coordinates, tail_bins, tail_used)
+            matched |= near
+            missing += near == 0
+        unmatched = missing + self._counts[:count] - _BIT_COUNTS[matched]
+        unmatched[~self._alive[:count]] = 255
+        return unmatched
+
+    def _candidates(self, query, k):
+        """Rows with the fewest unmatched colors, at least max(k, RERANK_CANDIDATES) if there are"""
+        unmatched = self._unmatched_colors(query)
+        tiers = np.cumsum(np.bincount(unmatched, minlength=256)[:255])
+        wanted = max(k, RERANK_CANDIDATES)
+        level = int(np.searchsorted(tiers, wanted)) if len(tiers) else 0
+        return np.flatnonzero(unmatched <= min(level, 254))
+
+    def _coarse(self, query, rows):
+        """Best RERANK_CANDIDATES of `rows` by CIE76 palette distance"""
+        best_rows, best_scores = [], []
+        for start in range(0, len(rows), SCAN_BLOCK_ROWS):
+            block = rows[start:start + SCAN_BLOCK_ROWS]
+            scores = palette_distances(self._lab[:, block], self._counts[block], query, exact=False)
+            if len(scores) > RERANK_CANDIDATES:
+                top = np.argpartition(scores, RERANK_CANDIDATES)[:RERANK_CANDIDATES]
+                block, scores = block[top], scores[top]
+            best_rows.append(block)
+            best_scores.append(scores)
+        if not best_rows:
+            return rows
+        rows, scores = np.concatenate(best_rows), np.concatenate(best_scores)
+        if len(rows) > RERANK_CANDIDATES:
+            rows = rows[np.argpartition(scores, RERANK_CANDIDATES)[:RERANK_CANDIDATES]]
+        return rows
+
+    # Public API
+
+    def upsert_many(self, items):
+        """
+        Store palettes (bulk load): one write per file, then at most one bin
+        rebuild. An existing id is replaced; a document without a palette
+        removes it.
+
+        :param items: Iterable of (id, document, metadata dict or None), where
+                      document is an analysis result or {colors}
+        :return: (number stored, number without a palette)
+        :raises ValueError: on malformed colors (nothing is stored)
+        """
+        ids, metas, records, empty = [], [], [], []
+        for item_id, document, meta in items:
+            palette = document_palette(document)
+            if palette is None:
+                empty.append(str(item_id))
+                continue
+            ids.append(str(item_id))
+            metas.append(meta or {})
+            records.append(_palette_record(palette))
+        records = _records_or_empty(records)
+        with self._lock:
+            lines = [{'id': item_id, 'deleted': True} for item_id in empty if item_id in self._rows]
+            lines += [{'id': item_id, 'row': self._count + i, 'meta': meta}
+                      for i, (item_id, meta) in enumerate(zip(ids, metas))]
+            # Palettes first: a key line never points past the end of the palette file
+            if self._palettes_file is not None:
+                self._palettes_file.write(records.tobytes())
+                self._palettes_file.flush()
+            self._write_keys(lines)
+            for item_id in empty:
+                self._forget(item_id)
+            self._append_rows(ids, metas, records)
+            self._stats['upserted'] += len(ids)
+            self._maintain()
+            return len(ids), len(empty)
+
+    def upsert(self, item_id, document, meta=None):
+        """Store one palette; returns False if the document has none"""
+        return self.upsert_many([(item_id, document, meta)])[0] == 1
+
+    def delete(self, item_id):
+        """Remove a palette; returns False if the id is unknown"""
+        with self._lock:
+            item_id = str(item_id)
+            if item_id not in self._rows:
+                return False
+            self._write_keys([{'id': item_id, 'deleted': True}])
+            self._forget(item_id)
+            self._stats['deleted'] += 1
+            return True
+
+    def palette(self, item_id):
+        """Stored CIELAB palette of an id, or None"""
+        with self._lock:
+            row = self._rows.get(str(item_id))
+            return None if row is None else np.array(self._lab[:self._counts[row], row])
+
+    def search(self, palette, k=10, exclude_id=None, max_distance=None):
+        """
+        Stored diagrams with the palettes closest to a query palette.
+
+        :param palette: CIELAB colors, n x 3 (see document_palette())
+        :param exclude_id: Id left out of the results (the query's own)
+        :param max_distance: Largest palette distance returned, None for the index default
+        :return: List of PaletteMatch, closest first
+        """
+        query = np.asarray(palette, np.float32).reshape(-1, 3)[:PALETTE_MAX_COLORS]
+        if not len(query):
+            raise ValueError("The query palette has no colors")
+        max_distance = self.max_distance if max_distance is None else max_distance
+        with self._lock:
+            self._stats['searches'] += 1
+            excluded = self._rows.get(str(exclude_id)) if exclude_id is not None else None
+            rows = self._candidates(query, k + (excluded is not None))
+            rows = self._coarse(query, rows[rows != excluded] if excluded is not None else rows)
+            distances = palette_distances(self._lab[:, rows], self._counts[rows], query)
+            order = np.argsort(distances, kind='stable')
+            matches = []
+            for i in order[:k]:
+                if distances[i] > max_distance:
+                    break
+                row = rows[i]
+                matches.append(PaletteMatch(
+                    self._ids[row], float(distances[i]), self._meta[row],
+                    lab_to_hex(self._lab[:self._counts[row], row])
+                ))
+            return matches
+
+    def rebuild(self, items):
+        """
+        Replace the whole index with palettes from stored analysis results,
+        then swap the new files in.
+
+        :param items: Iterable of (id, document, metadata dict or None); a later
+                      item with the same id replaces an earlier one
+        :return: (number stored, number without a palette)
+        :raises ValueError: on malformed colors (the index is left as it was)
+        """
+        latest = {}
+        for item_id, document, meta in items:
+            latest[str(item_id)] = (document, meta or {})
+        ids, metas, records = [], [], []
+        for item_id, (document, meta) in latest.items():
+            palette = document_palette(document)
+            if palette is not None:
+                ids.append(item_id)
+                metas.append(meta)
+                records.append(_palette_record(palette))
+        records = _records_or_empty(records)
+
+        with self._lock:
+            previous = self._generation
+            self._generation += 1
+            self._reset()
+            if self.directory:
+                self._keys_file.close()
+                self._palettes_file.close()
+                with open(self._palettes_path(), 'wb') as f:
+                    f.write(records.tobytes())
+                with open(self._keys_path(), 'wb') as f:
+                    f.write(b"".join(
+                        json.dumps({'id': item_id, 'row': row, 'meta': meta}).encode() + b"\n"
+                        for row, (item_id, meta) in enumerate(zip(ids, metas))
+                    ))
+                temporary = self._state_path() + '.tmp'
+                with open(temporary, 'w') as f:
+                    json.dump({'generation': self._generation}, f)
+                os.replace(temporary, self._state_path())
+                for path in (self._palettes_path(previous), self._keys_path(previous)):
+                    try:
+                        os.remove(path)
+                    except OSError as e:
+                        logger.warning(f"Could not remove old palette index file {path}: {str(e)}")
+                self._keys_file = open(self._keys_path(), 'a+b')
+                self._palettes_file = open(self._palettes_path(), 'ab')
+            self._append_rows(ids, metas, records)
+            self._build()
+            self._stats['rebuilds'] += 1
+            logger.info(f"Rebuilt the palette index: {len(ids)} palettes, {len(latest) - len(ids)} without one")
+            return len(ids), len(latest) - len(ids)
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, palettes=len(self._rows), rows=self._count,
+                        unindexed=self._count - self._indexed, dense_bins=len(self._dense_bins))
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_palette_index():
+    """This process's PaletteIndex, loaded from config on first use"""
+    global _index
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                _index = PaletteIndex(
+                    directory=config.PALETTE_INDEX_DIR or None,
+                    max_distance=config.PALETTE_MAX_DISTANCE
+                )
+    return _index
@@ -0,0 +1,399 @@
+# image-analysis-service/src/utils/pipeline.py
+import os
+import logging
+import traceback
+from PIL import Image
+
+import config
+from utils.image_processing import analyze_image_quality, QUALITY_REQUIREMENT
+from utils.tiled_quality import analyze_image_quality_tiled, DEFAULT_MAX_MEMORY_MB
+from utils.text_extract import extract_math_symbols, find_math_symbols, OCR_REQUIREMENT
+from utils.metrics import StageTimer
+from utils.fidelity import FULL, fidelity_settings, describe_fidelity
+from utils.deadline import Deadline, DeadlineExceeded, check_deadline
+from utils.admission import read_image_header
+from utils.decode import FULL_GRAY, decode_image, merge_requirements
+from utils.visual_embedding import EMBEDDING_REQUIREMENT, compute_embedding
+from utils.diagram_features import DIAGRAM_FEATURES_REQUIREMENT, extract_diagram_features
+from utils.trim import find_content_crop
+from utils.ocr_engines import engine_or_default
+from utils.svg_vector import (
+    is_svg_valid, parse_svg, rasterize_svg, svg_diagram_features, svg_quality_metrics
+)
+
+logger = logging.getLogger(__name__)
+
+# PIL refuses to open images above ~179 MP by default; large scans are
+# expected here and bounded by admission control and tiled analysis instead
+Image.MAX_IMAGE_PIXELS = int(config.MAX_IMAGE_MEGAPIXELS * 1000000)
+
+# Stages run by run_analysis, in order; also used for cost estimation.
+# Quality runs first because it also produces the basic metrics.
+DEFAULT_STAGES = ('quality', 'diagram_features', 'symbols', 'embedding')
+
+# Relative share of the request deadline given to each stage
+STAGE_BUDGET_SHARES = {'quality': 0.35, 'diagram_features': 0.15, 'symbols': 0.45, 'embedding': 0.05}
+
+# Pixels each stage needs; run_analysis decodes once for all of them
+STAGE_REQUIREMENTS = {
+    'quality': QUALITY_REQUIREMENT,
+    'diagram_features': DIAGRAM_FEATURES_REQUIREMENT,
+    'symbols': OCR_REQUIREMENT,
+    'embedding': EMBEDDING_REQUIREMENT,
+}
+
+# Stages that read the file themselves when quality analysis is tiled: a
+# shared full-resolution color decode is what tiling avoids
+TILED_SEPARATE_STAGES = ('quality', 'diagram_features', 'embedding')
+
+# Stages that only look at content and run on the image cropped to it.
+# Quality metrics are defined over the whole frame and keep the margin.
+TRIMMED_STAGES = ('diagram_features', 'symbols')
+
+
+class InvalidImageError(Exception):
+    """Raised when an uploaded file cannot be processed as an image"""
+    pass
+
+
+def safe_analyze_image_quality(image_path, mode='full', refine_colors=True, deadline=None,
+                               tiled_min_megapixels=None, max_memory_mb=None, image=None, svg=None):
+    """
+    Wrapper for analyze_image_quality with SVG handling; errors propagate to the pipeline.
+
+    Images of at least `tiled_min_megapixels` are analyzed strip by strip
+    within `max_memory_mb` (see utils/tiled_quality.py); `image` is ignored then.
+    SVGs are measured from their XML (see utils/svg_vector.py), using `svg`
+    if the file was already parsed.
+    """
+    # Vector graphics: sizes and colors come from the XML
+    if image_path.lower().endswith('.svg'):
+        return svg_quality_metrics(svg or parse_svg(image_path, deadline), image_path)
+
+    header = read_image_header(image_path)
+    if uses_tiled_quality(header, tiled_min_megapixels):
+        logger.info(f"Large image ({header.megapixels:.0f} MP), using tiled quality analysis")
+        return analyze_image_quality_tiled(
+            image_path, mode=mode, refine_colors=refine_colors,
+            max_memory_mb=max_memory_mb or DEFAULT_MAX_MEMORY_MB, deadline=deadline
+        )
+
+    # Original implementation for raster images
+    return analyze_image_quality(
+        image_path, mode=mode, refine_colors=refine_colors, deadline=deadline, image=image
+    )
+
+
+def uses_tiled_quality(header, tiled_min_megapixels):
+    """True if the quality stage reads the file strip by strip itself"""
+    return bool(tiled_min_megapixels) and header is not None and header.megapixels >= tiled_min_megapixels
+
+
+def safe_extract_math_symbols(image_path, max_variants=None, deadline=None, image=None, preprocessor=None,
+                              engine=None):
+    """Safely extract math symbols with error handling"""
+    try:
+        symbols_result = extract_math_symbols(image_path, max_variants, deadline, image, preprocessor, engine)
+        if isinstance(symbols_result, dict) and 'error' in symbols_result:
+            # logger.warning(f"Symbol extraction warning: {symbols_result['error']}")
+            return []
+        if not isinstance(symbols_result, list):
+            return []
+        return symbols_result
+    except Exception as e:
+        logger.error(f"Error in math symbol extraction: {str(e)}")
+        logger.error(traceback.format_exc())
+        return []
+
+def assign_quality_label(score):
+    """Assigns a Low, Medium, or High rating based on quality score."""
+    if score >= 80:
+        return "High"
+    elif score >= 50:
+        return "Medium"
+    else:
+        return "Low"
+
+def is_image_valid(file_path):
+    """Check if the image is valid and can be opened"""
+    # Special handling for SVG files
+    if file_path.lower().endswith('.svg'):
+        try:
+            # For SVG files, check for an <svg> root without parsing the rest
+            if os.path.getsize(file_path) > 0:
+                return is_svg_valid(file_path)
+            else:
+                logger.error(f"SVG file exists but is empty: {file_path}")
+                return False
+        except Exception as e:
+            logger.error(f"Error checking SVG file: {str(e)}")
+            return False
+    else:
+        # For other image formats, use PIL
+        try:
+            with Image.open(file_path) as img:
+                img.verify()
+            return True
+        except Exception as e:
+            logger.error(f"Invalid image file: {str(e)}")
+            return False
+
+
+def probe_basic_metrics(image_path, svg=None):
+    """Basic metrics from the image header, reported even if the quality stage does not run"""
+    header = read_image_header(image_path)
+    basic_metrics = {
+        'file_size_mb': round(os.path.getsize(image_path) / (1024 * 1024), 2),
+    }
+    if svg is not None:
+        basic_metrics.update({
+            'resolution': "Vector",
+            'aspect_ratio': f"{svg.width / svg.height:.2f}",
+            'dimensions': {'width': svg.width, 'height': svg.height, 'megapixels': 0}
+        })
+    if header is not None:
+        basic_metrics.update({
+            'resolution': f"{header.width}x{header.height}",
+            'aspect_ratio': f"{header.width / header.height:.2f}",
+            'dimensions': {
+                'width': header.width,
+                'height': header.height,
+                'megapixels': header.megapixels
+            }
+        })
+    return basic_metrics
+
+
+def _stage_preprocessor(decoded, stage, crop=None):
+    """Shared Preprocessor over this stage's view of the decode, or None to let it read the file"""
+    if decoded is None:
+        return None
+    return decoded.preprocessor(STAGE_REQUIREMENTS[stage], crop if stage in TRIMMED_STAGES else None)
+
+
+def _stage_image(decoded, stage, crop=None):
+    """This stage's view of the shared decode, or None to let it read the file"""
+    preprocessor = _stage_preprocessor(decoded, stage, crop)
+    return None if preprocessor is None else preprocessor.image
+
+
+def _run_quality_stage(image_path, settings, deadline, decoded, crop, svg):
+    quality_metrics = safe_analyze_image_quality(
+        image_path,
+        mode=settings['quality_mode'],
+        refine_colors=settings['refine_colors'],
+        deadline=deadline,
+        tiled_min_megapixels=config.QUALITY_TILED_MIN_MEGAPIXELS,
+        max_memory_mb=config.QUALITY_MAX_MEMORY_MB,
+        image=_stage_image(decoded, 'quality'),
+        svg=svg
+    )
+    quality_score = quality_metrics["quality_scores"]["overall_quality"]
+    quality_label = assign_quality_label(quality_score)
+    logger.info(f"Quality analysis completed: {quality_label} ({quality_score})")
+    return {"quality_rating": quality_label, **quality_metrics}
+
+
+def _run_diagram_features_stage(image_path, settings, deadline, decoded, crop, svg):
+    if svg is not None:
+        # Classification from geometry, no pixels needed
+        features = svg_diagram_features(svg)
+    else:
+        if uses_tiled_quality(read_image_header(image_path), config.QUALITY_TILED_MIN_MEGAPIXELS):
+            # Decoded reduced from the file, like the embedding
+            decoded = crop = None
+        features = extract_diagram_features(image_path, deadline, decoded, crop)
+    logger.info(f"Diagram features extracted: {features.diagram_type.value} ({features.type_confidence:.2f})")
+    return {'diagram_features': features.to_dict()}
+
+
+def ocr_engine_for(fidelity_name, requested=None):
+    """OCR engine name: the request's, else the one configured for the fidelity level, else OCR_ENGINE"""
+    return requested or config.OCR_FIDELITY_ENGINES.get(fidelity_name) or config.OCR_ENGINE
+
+
+def _run_symbols_stage(image_path, settings, deadline, decoded, crop, svg):
+    if svg is not None:
+        return _svg_symbols(image_path, settings, deadline, svg)
+    preprocessor = _stage_preprocessor(decoded, 'symbols', crop)
+    engine = engine_or_default(settings['ocr_engine']).name
+    symbols_result = safe_extract_math_symbols(
+        image_path, settings['ocr_variants'], deadline, preprocessor=preprocessor, engine=engine
+    )
+    logger.info(f"Symbol extraction completed with {engine}: {len(symbols_result)} symbols")
+    result = {'symbols_result': symbols_result, 'ocr_engine': engine}
+    if preprocessor is not None:
+        result['preprocessing'] = {'denoise': preprocessor.source.denoise_decision().to_dict()}
+    return result
+
+
+def _svg_symbols(image_path, settings, deadline, svg):
+    """Symbols from the SVG's own text; OCR on a render only if its text is drawn as outlines"""
+    if svg.texts:
+        symbols_result = sorted(find_math_symbols(svg.text))
+        logger.info(f"Symbol extraction completed from SVG text: {len(symbols_result)} symbols")
+        return {'symbols_result': symbols_result, 'text_result': svg.text, 'text_source': 'vector'}
+
+    raster = rasterize_svg(image_path, svg, config.SVG_RASTER_MAX_SIDE, config.SVG_RASTER_CACHE_DIR)
+    if raster is None:
+        return {'symbols_result': [], 'text_source': 'none'}
+    engine = engine_or_default(settings['ocr_engine']).name
+    symbols_result = safe_extract_math_symbols(image_path, settings['ocr_variants'], deadline, raster, engine=engine)
+    logger.info(f"Symbol extraction completed on SVG render with {engine}: {len(symbols_result)} symbols")
+    return {'symbols_result': symbols_result, 'text_source': 'ocr', 'ocr_engine': engine}
+
+
+def _run_embedding_stage(image_path, settings, deadline, decoded, crop, svg):
+    check_deadline(deadline, "visual embedding")
+    if svg is not None:
+        image = rasterize_svg(image_path, svg, config.SVG_RASTER_MAX_SIDE, config.SVG_RASTER_CACHE_DIR)
+        if image is None:
+            return {}
+    else:
+        if decoded is None or uses_tiled_quality(read_image_header(image_path), config.QUALITY_TILED_MIN_MEGAPIXELS):
+            # Reduced while decoding (JPEGs in the DCT domain)
+            decoded = decode_image(image_path, EMBEDDING_REQUIREMENT)
+        image = decoded.view(EMBEDDING_REQUIREMENT).image
+    embedding = compute_embedding(image, deadline)
+    logger.info(f"Visual embedding computed ({len(embedding['vector'])} values)")
+    return {'visual_embedding': embedding}
+
+
+STAGE_RUNNERS = {
+    'quality': _run_quality_stage,
+    'diagram_features': _run_diagram_features_stage,
+    'symbols': _run_symbols_stage,
+    'embedding': _run_embedding_stage,
+}
+
+
+def decode_for_stages(image_path, header, stages):
+    """
+    Decode once at the cheapest representation all stages accept.
+
+    Stages that read the file themselves (SVG, TILED_SEPARATE_STAGES of
+    tiled images) add no requirement. Returns None if nothing needs
+    decoding or decoding fails, in which case each stage falls back to
+    reading the file.
+    """
+    if header is None:
+        return None
+    requirements = [
+        STAGE_REQUIREMENTS[stage] for stage in stages
+        if not (stage in TILED_SEPARATE_STAGES and uses_tiled_quality(header, config.QUALITY_TILED_MIN_MEGAPIXELS))
+    ]
+    requirement = merge_requirements(requirements)
+    if requirement is None:
+        return None
+    try:
+        return decode_image(image_path, requirement)
+    except ValueError as e:
+        logger.warning(f"Shared decode failed, stages will read the file: {str(e)}")
+        return None
+
+
+def run_analysis(image_path, original_filename, fidelity=FULL, deadline=None, stages=DEFAULT_STAGES,
+                 ocr_engine=None):
+    """
+    Run the full analysis pipeline on a saved upload.
+
+    Kept free of Flask state so it can run in the request thread or in a
+    worker process of the job queue. Each stage gets a share of the deadline
+    and checks it cooperatively. The result always carries a `stages` map
+    with the status of each stage: completed, partial (stopped early by its
+    budget), skipped (deadline reached before it ran) or failed. Output keys
+    of stages that did not run are left out rather than filled with defaults.
+
+    :param image_path: Path of the saved upload
+    :param original_filename: Filename as sent by the client
+    :param fidelity: Fidelity level chosen by the load policy (0 = full)
+    :param deadline: Deadline, seconds counted from now, or None for no limit
+    :param stages: Subset of DEFAULT_STAGES to run, in order
+    :param ocr_engine: OCR engine requested by the client, see ocr_engine_for()
+    :return: Result dictionary as returned by /analyze
+    """
+    stage_timings = {}
+    settings = fidelity_settings(fidelity)
+    settings = dict(settings, ocr_engine=ocr_engine_for(settings['name'], ocr_engine))
+    if not isinstance(deadline, Deadline):
+        deadline = Deadline(deadline)
+
+    # Check if the file is saved correctly
+    if not os.path.exists(image_path):
+        raise Exception("File was not saved correctly")
+
+    # Check file size
+    file_size = os.path.getsize(image_path)
+    logger.debug(f"Saved file size: {file_size} bytes")
+    if file_size == 0:
+        raise Exception("File is empty (0 bytes)")
+
+    # Check if the image is valid - this now handles SVG files specially
+    is_svg = image_path.lower().endswith('.svg')
+    if not is_image_valid(image_path):
+        if is_svg:
+            logger.warning(f"SVG file could not be validated, but will try to process anyway: {image_path}")
+        else:
+            raise InvalidImageError('Invalid image file. Could not be processed as an image.')
+
+    svg = None
+    if is_svg:
+        # One streaming pass gives geometry, text and colors for every stage
+        try:
+            with StageTimer(stage_timings, 'parse'):
+                svg = parse_svg(image_path, deadline)
+        except (ValueError, DeadlineExceeded) as e:
+            logger.warning(f"SVG parsing failed, stages will report errors: {str(e)}")
+
+    result = {
+        "file_info": {
+            "filename": original_filename,
+            "size_mb": os.path.getsize(image_path) / (1024 * 1024),
+            "is_vector": is_svg
+        },
+        "basic_metrics": probe_basic_metrics(image_path, svg),
+    }
+
+    if svg is not None:
+        result['vector'] = svg.to_dict()
+
+    with StageTimer(stage_timings, 'decode'):
+        decoded = decode_for_stages(image_path, read_image_header(image_path), stages)
+    crop = None
+    if decoded is not None:
+        # Grayscale and bitonal content runs through single-channel stages
+        result['file_info']['tonality'] = decoded.tonality
+        crop = find_content_crop(decoded.view(FULL_GRAY).pixels)
+        if crop is not None:
+            result['file_info']['content_crop'] = crop.to_dict()
+
+    stage_status = {}
+    pending = list(stages)
+    for stage in stages:
+        if deadline.expired():
+            logger.warning(f"Deadline reached, skipping stage {stage}")
+            stage_status[stage] = {'status': 'skipped', 'reason': 'deadline'}
+            pending.remove(stage)
+            continue
+
+        stage_deadline = deadline.for_stage(STAGE_BUDGET_SHARES, stage, pending)
+        pending.remove(stage)
+        try:
+            with StageTimer(stage_timings, stage):
+                result.update(STAGE_RUNNERS[stage](image_path, settings, stage_deadline, decoded, crop, svg))
+            stage_status[stage] = {'status': 'partial' if stage_deadline.expired() else 'completed'}
+        except DeadlineExceeded as e:
+            logger.warning(f"Stage {stage} ran out of time: {str(e)}")
+            stage_status[stage] = {'status': 'skipped', 'reason': 'deadline'}
+        except Exception as stage_error:
+            logger.error(f"Stage {stage} failed: {str(stage_error)}")
+            logger.error(traceback.format_exc())
+            stage_status[stage] = {'status': 'failed', 'error': str(stage_error)}
+
+    result.update({
+        'stages': stage_status,
+        'partial_result': any(info['status'] != 'completed' for info in stage_status.values()),
+        'stage_timings_ms': stage_timings,
+        'fidelity': describe_fidelity(fidelity),
+    })
+    return result
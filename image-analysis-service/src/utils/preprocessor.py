@@ -4,94 +4,335 @@ import numpy as np
 import logging
 import os
 import traceback
+from collections import OrderedDict
+from dataclasses import dataclass, asdict
 
 logger = logging.getLogger(__name__)
 
-def preprocess_image(image_path, methods=None):
+# Methods applied when preprocess_image() is called without a list
+DEFAULT_METHODS = ('denoise', 'enhance_contrast', 'auto_straighten')
+
+# Chain results a Preprocessor keeps (least recently used are dropped)
+PREPROCESS_CACHE_SIZE = 8
+
+# LAB value of white, for borders of images rotated in LAB
+LAB_WHITE = (255, 128, 128)
+
+# Skew is estimated on a copy whose long side is at most DESKEW_MAX_SIDE,
+# from at most DESKEW_MAX_POINTS ink pixels
+DESKEW_MAX_SIDE = 1024
+DESKEW_MAX_POINTS = 40_000
+DESKEW_MIN_POINTS = 50
+# Angles searched (degrees): a coarse sweep, then a fine one around its best
+DESKEW_MAX_ANGLE = 20.0
+DESKEW_COARSE_STEP = 1.0
+DESKEW_FINE_STEP = 0.1
+# Smaller skews are left alone
+DESKEW_MIN_ANGLE = 0.5
+
+# Denoising branches, picked from the estimated noise level
+DENOISE_NONE = 'none'
+DENOISE_BILATERAL = 'bilateral'
+DENOISE_NL_MEANS = 'nl_means'
+
+# Noise sigma (gray levels) up to which denoising is skipped; clean digital
+# exports and JPEG ringing sit well below it
+DENOISE_NONE_MAX_SIGMA = 1.5
+# Up to this sigma an edge-preserving bilateral filter is enough (a 3x3
+# median erodes thin strokes); above it, NL-means
+DENOISE_BILATERAL_MAX_SIGMA = 4.0
+# NL-means strength follows the noise level, within these bounds
+NL_MEANS_MIN_STRENGTH = 3.0
+NL_MEANS_MAX_STRENGTH = 20.0
+# Search window: 11 instead of OpenCV's usual 21 costs little quality once the
+# strength matches the noise, and is about 3x faster
+NL_MEANS_SEARCH_WINDOW = 11
+
+# Noise is estimated on up to NOISE_SAMPLE_TILES tiles of NOISE_TILE_SIZE
+# pixels, spread over the image; the NOISE_TILE_PERCENTILE of the per-tile
+# estimates keeps edges and texture from counting as noise
+NOISE_TILE_SIZE = 64
+NOISE_SAMPLE_TILES = 64
+NOISE_TILE_PERCENTILE = 25
+
+# Immerkaer's noise operator: the difference of two Laplacians, which
+# cancels image structure that is locally linear
+_NOISE_KERNEL = np.array([[1, -2, 1], [-2, 4, -2], [1, -2, 1]], dtype=np.float32)
+
+
+def estimate_noise_sigma(gray):
+    """
+    Standard deviation of additive noise, after Immerkaer (1996).
+
+    One 3x3 filter over a sample of tiles, instead of blurring the whole
+    image (see calculate_noise() in image_processing.py for the quality score).
+
+    :param gray: Single-channel uint8 image
+    :return: Estimated sigma in gray levels
+    """
+    height, width = gray.shape[:2]
+    tile = min(NOISE_TILE_SIZE, height, width)
+    if tile < 3:
+        return 0.0
+    per_axis = max(1, int(np.sqrt(NOISE_SAMPLE_TILES)))
+    ys = np.linspace(0, height - tile, min(per_axis, height // tile), dtype=int)
+    xs = np.linspace(0, width - tile, min(per_axis, width // tile), dtype=int)
+
+    sigmas = []
+    for y in ys:
+        for x in xs:
+            response = cv2.filter2D(gray[y:y + tile, x:x + tile], cv2.CV_32F, _NOISE_KERNEL)
+            # Border pixels see reflected neighbors; only the interior counts
+            interior = np.abs(response[1:-1, 1:-1])
+            sigmas.append(np.sqrt(np.pi / 2) * float(interior.mean()) / 6)
+    return float(np.percentile(sigmas, NOISE_TILE_PERCENTILE))
+
+
+@dataclass
+class DenoiseDecision:
+    """
+    Denoising chosen for one image.
+
+    :param branch: DENOISE_NONE, DENOISE_BILATERAL or DENOISE_NL_MEANS
+    :param noise_sigma: Estimated noise sigma it was chosen from
+    """
+    branch: str
+    noise_sigma: float
+
+    def to_dict(self):
+        return {**asdict(self), 'noise_sigma': round(self.noise_sigma, 3)}
+
+
+def decide_denoising(gray):
+    """Pick a DenoiseDecision for a grayscale image (or the gray plane of a color one)"""
+    sigma = estimate_noise_sigma(gray)
+    if sigma <= DENOISE_NONE_MAX_SIGMA:
+        return DenoiseDecision(DENOISE_NONE, sigma)
+    if sigma <= DENOISE_BILATERAL_MAX_SIGMA:
+        return DenoiseDecision(DENOISE_BILATERAL, sigma)
+    return DenoiseDecision(DENOISE_NL_MEANS, sigma)
+
+
+class PreprocessState:
+    """
+    One image in every color space computed for it so far.
+
+    Conversions happen on first use and are kept, so methods that need the
+    same plane (grayscale for line and threshold detection, LAB for
+    contrast) share one conversion, and a chain that ends in LAB converts
+    back to BGR once, when the result is read.
+    """
+
+    def __init__(self, bgr=None, gray=None, lab=None):
+        self._bgr = bgr
+        self._gray = gray
+        self._lab = lab
+        self._denoise_decision = None
+
+    @classmethod
+    def from_image(cls, image):
+        return cls(gray=image) if image.ndim == 2 else cls(bgr=image)
+
+    @property
+    def is_gray(self):
+        return self._bgr is None and self._lab is None
+
+    def image(self):
+        """BGR image, or the grayscale image for single-channel content"""
+        if self.is_gray:
+            return self._gray
+        if self._bgr is None:
+            self._bgr = cv2.cvtColor(self._lab, cv2.COLOR_LAB2BGR)
+        return self._bgr
+
+    def gray(self):
+        if self._gray is None:
+            self._gray = cv2.cvtColor(self.image(), cv2.COLOR_BGR2GRAY)
+        return self._gray
+
+    def lab(self):
+        """LAB planes (color content only)"""
+        if self._lab is None:
+            self._lab = cv2.cvtColor(self.image(), cv2.COLOR_BGR2LAB)
+        return self._lab
+
+    def denoise_decision(self):
+        """DenoiseDecision for this image, estimated once"""
+        if self._denoise_decision is None:
+            self._denoise_decision = decide_denoising(self.gray())
+        return self._denoise_decision
+
+
+def _denoise_step(state):
+    decision = state.denoise_decision()
+    if decision.branch == DENOISE_NONE:
+        return state
+    return PreprocessState.from_image(apply_denoising(state.image(), decision))
+
+
+def _contrast_step(state):
+    if state.is_gray:
+        return PreprocessState(gray=apply_contrast_enhancement(state.gray()))
+    # Stays in LAB; converted back only when a later step or the caller needs BGR
+    return PreprocessState(lab=enhance_lab_contrast(state.lab()))
+
+
+def _sharpen_step(state):
+    return PreprocessState.from_image(apply_sharpening(state.image()))
+
+
+def _straighten_step(state):
+    angle = detect_skew_angle(state.gray())
+    if angle is None:
+        # Unchanged image: keep the planes already converted
+        return state
+    if state._lab is not None and state._bgr is None:
+        return PreprocessState(lab=rotate_image(state.lab(), angle, LAB_WHITE))
+    return PreprocessState.from_image(rotate_image(state.image(), angle))
+
+
+def _background_step(state):
+    return PreprocessState.from_image(apply_background_cleaning(state.image(), state.gray()))
+
+
+PREPROCESSING_STEPS = {
+    'denoise': _denoise_step,
+    'enhance_contrast': _contrast_step,
+    'sharpen': _sharpen_step,
+    'auto_straighten': _straighten_step,
+    'clean_background': _background_step,
+}
+
+
+class Preprocessor:
+    """
+    Runs preprocessing chains on one image and caches their results.
+
+    Chains are cached by their method list, and a chain starts from its
+    longest cached prefix: after ['denoise'], ['denoise', 'enhance_contrast']
+    only runs the contrast step. Stages holding the same Preprocessor (see
+    DecodedImage.preprocessor()) share results this way.
+
+    :param image: BGR or grayscale image; not modified
+    :param packed: PackedMask of `image` if it is bitonal, for consumers that
+                   work on two levels (see DecodedImage.packed)
+    """
+
+    def __init__(self, image, cache_size=PREPROCESS_CACHE_SIZE, packed=None):
+        self.source = PreprocessState.from_image(image)
+        self.packed = packed
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+
+    @property
+    def image(self):
+        return self.source.image()
+
+    def state(self, methods):
+        """PreprocessState after applying `methods` in order"""
+        methods = tuple(methods)
+        state, start = self.source, 0
+        for end in range(len(methods), 0, -1):
+            if methods[:end] in self._cache:
+                state, start = self._cache[methods[:end]], end
+                self._cache.move_to_end(methods[:end])
+                break
+
+        for end in range(start + 1, len(methods) + 1):
+            step = PREPROCESSING_STEPS.get(methods[end - 1])
+            if step is None:
+                logger.warning(f"Unknown preprocessing method: {methods[end - 1]}")
+            else:
+                state = step(state)
+            self._cache[methods[:end]] = state
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return state
+
+    def run(self, methods):
+        """Preprocessed image (BGR, or grayscale for single-channel content)"""
+        return self.state(methods).image()
+
+
+def debug_output_path(image_path):
+    """Where a preprocessed copy of `image_path` is written for debugging"""
+    root, extension = os.path.splitext(image_path)
+    return f"{root}_preprocessed{extension or '.png'}"
+
+
+def preprocess_image(image, methods=None, debug_path=None):
     """
     Preprocess an image before sending it to the analysis pipeline.
-    Returns the path to the preprocessed image.
-    
-    :param image_path: Path to the input image
-    :param methods: List of preprocessing methods to apply (or None for default)
-    :return: Path to preprocessed image
+
+    :param image: BGR or grayscale array, or a Preprocessor to reuse its cached chains
+    :param methods: List of preprocessing methods to apply (or None for DEFAULT_METHODS)
+    :param debug_path: Also write the result to this path (debugging only, see debug_output_path())
+    :return: Preprocessed array (the input image if preprocessing fails)
     """
+    preprocessor = image if isinstance(image, Preprocessor) else Preprocessor(image)
     try:
-        # Read the image
-        image = cv2.imread(image_path)
-        if image is None:
-            logger.error(f"Failed to read image at {image_path}")
-            return image_path  # Return original if we can't process
-        
-        # Default preprocessing methods if none specified
-        if methods is None:
-            methods = ['denoise', 'enhance_contrast', 'auto_straighten']
-        
-        # Apply preprocessing methods
-        enhanced_image = image.copy()
-        
-        # Apply selected methods
-        for method in methods:
-            if method == 'denoise':
-                enhanced_image = apply_denoising(enhanced_image)
-            elif method == 'enhance_contrast':
-                enhanced_image = apply_contrast_enhancement(enhanced_image)
-            elif method == 'sharpen':
-                enhanced_image = apply_sharpening(enhanced_image)
-            elif method == 'auto_straighten':
-                enhanced_image = apply_auto_straightening(enhanced_image)
-            elif method == 'clean_background':
-                enhanced_image = apply_background_cleaning(enhanced_image)
-            # Add other methods as needed
-        
-        # Save the preprocessed image with a different filename
-        output_path = image_path.replace('.', '_preprocessed.')
-        cv2.imwrite(output_path, enhanced_image)
-        
-        return output_path
-    
+        enhanced_image = preprocessor.run(DEFAULT_METHODS if methods is None else methods)
     except Exception as e:
         logger.error(f"Error in image preprocessing: {str(e)}")
         logger.error(traceback.format_exc())
-        return image_path  # Return original if preprocessing fails
+        return preprocessor.image  # Return original if preprocessing fails
 
-def apply_denoising(image):
-    """Apply denoising to reduce noise while preserving edges"""
+    if debug_path:
+        cv2.imwrite(debug_path, enhanced_image)
+        logger.debug(f"Wrote preprocessed image to {debug_path}")
+    return enhanced_image
+
+def apply_denoising(image, decision=None):
+    """
+    Apply denoising to reduce noise while preserving edges.
+
+    :param decision: DenoiseDecision (estimated from the image if None)
+    """
     try:
-        # Check if image is grayscale or color
-        if len(image.shape) == 2 or image.shape[2] == 1:
-            # For grayscale images
-            denoised = cv2.fastNlMeansDenoising(image, None, 7, 7, 21)
+        if decision is None:
+            decision = decide_denoising(image if image.ndim == 2 else cv2.cvtColor(image, cv2.COLOR_BGR2GRAY))
+        if decision.branch == DENOISE_NONE:
+            return image
+        if decision.branch == DENOISE_BILATERAL:
+            denoised = cv2.bilateralFilter(image, 5, 3 * decision.noise_sigma, 2)
         else:
-            # For color images - use Non-local Means Denoising
-            denoised = cv2.fastNlMeansDenoisingColored(image, None, 7, 7, 7, 21)
+            denoised = _nl_means(image, decision)
         
-        logger.info("Applied denoising")
+        logger.info(f"Applied {decision.branch} denoising (noise sigma {decision.noise_sigma:.2f})")
         return denoised
     
     except Exception as e:
         logger.warning(f"Error applying denoising: {str(e)}")
         return image  # Return original if denoising fails
 
+def _nl_means(image, decision):
+    """Non-local means with a strength matched to the noise"""
+    strength = float(np.clip(decision.noise_sigma, NL_MEANS_MIN_STRENGTH, NL_MEANS_MAX_STRENGTH))
+    # Check if image is grayscale or color
+    if image.ndim == 2:
+        # For grayscale images
+        return cv2.fastNlMeansDenoising(image, None, strength, 7, NL_MEANS_SEARCH_WINDOW)
+    # For color images - use Non-local Means Denoising
+    return cv2.fastNlMeansDenoisingColored(image, None, strength, strength, 7, NL_MEANS_SEARCH_WINDOW)
+
+def _clahe():
+    return cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8))
+
+def enhance_lab_contrast(lab):
+    """CLAHE on the L plane of a LAB image; returns a new LAB image"""
+    l, a, b = cv2.split(lab)
+    return cv2.merge((_clahe().apply(l), a, b))
+
 def apply_contrast_enhancement(image):
     """Apply contrast enhancement to improve visibility"""
     try:
         # Convert to LAB color space for better contrast enhancement
         if len(image.shape) > 2:
-            lab = cv2.cvtColor(image, cv2.COLOR_BGR2LAB)
-            l, a, b = cv2.split(lab)
-            
-            # Apply CLAHE to L channel
-            clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8))
-            cl = clahe.apply(l)
-            
-            # Merge channels back and convert to BGR
-            enhanced_lab = cv2.merge((cl, a, b))
+            enhanced_lab = enhance_lab_contrast(cv2.cvtColor(image, cv2.COLOR_BGR2LAB))
             enhanced_img = cv2.cvtColor(enhanced_lab, cv2.COLOR_LAB2BGR)
         else:
             # For grayscale images
-            clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8))
-            enhanced_img = clahe.apply(image)
+            enhanced_img = _clahe().apply(image)
         
         logger.info("Applied contrast enhancement")
         return enhanced_img
@@ -118,62 +359,89 @@ def apply_sharpening(image):
         logger.warning(f"Error applying sharpening: {str(e)}")
         return image  # Return original if sharpening fails
 
+def _skew_profile_scores(ys, xs, angles):
+    """
+    Sharpness of the horizontal projection profile of ink points after
+    rotating them by each angle (degrees, as rotate_image() would).
+
+    Text lines and box edges line up into tall, narrow peaks when straight;
+    the sum of squared bin counts rewards exactly that.
+    """
+    radians = np.radians(angles)[:, None]
+    # Row of each point after getRotationMatrix2D(angle) about the center
+    rows = np.rint(ys * np.cos(radians) - xs * np.sin(radians)).astype(np.int32)
+    offset = -int(rows.min())
+    bins = int(rows.max()) + offset + 1
+    flat = (rows + offset + np.arange(len(angles), dtype=np.int32)[:, None] * bins).ravel()
+    profiles = np.bincount(flat, minlength=len(angles) * bins).reshape(len(angles), bins)
+    return (profiles.astype(np.float64) ** 2).sum(axis=1)
+
+def detect_skew_angle(gray):
+    """
+    Rotation that straightens text lines and box edges, in degrees.
+
+    Works on a copy downscaled to DESKEW_MAX_SIDE and binarized, and on at
+    most DESKEW_MAX_POINTS ink pixels, so the cost does not grow with the
+    image beyond the one resize. The angle is signed and found coarse to
+    fine: a DESKEW_COARSE_STEP sweep over +-DESKEW_MAX_ANGLE, then a
+    DESKEW_FINE_STEP sweep around the best coarse angle.
+
+    :param gray: Single-channel image
+    :return: Angle for rotate_image(), or None if the skew is below
+             DESKEW_MIN_ANGLE or there is too little ink to tell
+    """
+    height, width = gray.shape[:2]
+    factor = min(1.0, DESKEW_MAX_SIDE / max(height, width))
+    small = gray
+    if factor < 1.0:
+        small = cv2.resize(gray, (max(1, int(width * factor)), max(1, int(height * factor))), interpolation=cv2.INTER_AREA)
+    
+    # Dark ink on a light background becomes the foreground
+    _, ink = cv2.threshold(small, 0, 1, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
+    if cv2.countNonZero(ink) > ink.size / 2:
+        # Light content on a dark background
+        ink = 1 - ink
+    ys, xs = np.nonzero(ink)
+    if len(ys) < DESKEW_MIN_POINTS:
+        logger.info("Too little content for auto-straightening")
+        return None
+    if len(ys) > DESKEW_MAX_POINTS:
+        stride = -(-len(ys) // DESKEW_MAX_POINTS)
+        ys, xs = ys[::stride], xs[::stride]
+    ys = ys.astype(np.float32) - small.shape[0] / 2
+    xs = xs.astype(np.float32) - small.shape[1] / 2
+    
+    coarse = np.arange(-DESKEW_MAX_ANGLE, DESKEW_MAX_ANGLE + DESKEW_COARSE_STEP / 2, DESKEW_COARSE_STEP)
+    best = coarse[int(np.argmax(_skew_profile_scores(ys, xs, coarse)))]
+    fine = np.arange(best - DESKEW_COARSE_STEP, best + DESKEW_COARSE_STEP + DESKEW_FINE_STEP / 2, DESKEW_FINE_STEP)
+    angle = round(float(fine[int(np.argmax(_skew_profile_scores(ys, xs, fine)))]), 2)
+    
+    # Only straighten if deviation is significant
+    if abs(angle) < DESKEW_MIN_ANGLE:
+        logger.info(f"Image is already straight (deviation: {angle:.2f}°)")
+        return None
+    return angle
+
+def rotate_image(image, angle, border_value=(255, 255, 255)):
+    """Rotate about the center, keeping the size and filling corners with `border_value`"""
+    height, width = image.shape[:2]
+    center = (width/2, height/2)
+    rotation_matrix = cv2.getRotationMatrix2D(center, angle, 1.0)
+    return cv2.warpAffine(image, rotation_matrix, (width, height), 
+                          flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_CONSTANT, 
+                          borderValue=border_value)
+
 def apply_auto_straightening(image):
     """Detect and correct skewed diagrams"""
     try:
         # Convert to grayscale if necessary
-        if len(image.shape) > 2:
-            gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-        else:
-            gray = image.copy()
-        
-        # Detect edges
-        edges = cv2.Canny(gray, 50, 150, apertureSize=3)
-        
-        # Find lines using Hough Transform
-        lines = cv2.HoughLines(edges, 1, np.pi/180, threshold=100)
+        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if len(image.shape) > 2 else image
         
-        if lines is None or len(lines) == 0:
-            logger.info("No lines detected for auto-straightening")
+        rotation_angle = detect_skew_angle(gray)
+        if rotation_angle is None:
             return image
         
-        # Calculate the average angle of horizontal lines
-        angles = []
-        for line in lines:
-            rho, theta = line[0]
-            # Convert to degrees
-            angle_deg = np.degrees(theta)
-            
-            # Check if it's close to horizontal (0 or 180 degrees)
-            if angle_deg < 45 or angle_deg > 135:
-                deviation = min(angle_deg, 180 - angle_deg)
-                angles.append(deviation)
-        
-        if not angles:
-            logger.info("No horizontal lines found for straightening")
-            return image
-        
-        # Calculate average deviation
-        avg_deviation = np.mean(angles)
-        
-        # Only straighten if deviation is significant
-        if avg_deviation < 2.0:
-            logger.info(f"Image is already straight (deviation: {avg_deviation:.2f}°)")
-            return image
-        
-        # Determine rotation angle
-        rotation_angle = avg_deviation if avg_deviation < 45 else -avg_deviation
-        
-        # Get image center and rotation matrix
-        height, width = image.shape[:2]
-        center = (width/2, height/2)
-        rotation_matrix = cv2.getRotationMatrix2D(center, rotation_angle, 1.0)
-        
-        # Perform rotation
-        rotated_image = cv2.warpAffine(image, rotation_matrix, (width, height), 
-                                       flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_CONSTANT, 
-                                       borderValue=(255, 255, 255))
-        
+        rotated_image = rotate_image(image, rotation_angle)
         logger.info(f"Applied auto-straightening (angle: {rotation_angle:.2f}°)")
         return rotated_image
     
@@ -181,14 +449,12 @@ def apply_auto_straightening(image):
         logger.warning(f"Error applying auto-straightening: {str(e)}")
         return image  # Return original if straightening fails
 
-def apply_background_cleaning(image):
+def apply_background_cleaning(image, gray=None):
     """Clean up the background to improve clarity of diagram elements"""
     try:
-        # Convert to grayscale if necessary
-        if len(image.shape) > 2:
-            gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-        else:
-            gray = image.copy()
+        # Convert to grayscale if necessary (or use the caller's)
+        if gray is None:
+            gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if len(image.shape) > 2 else image
         
         # Apply adaptive thresholding
         thresh = cv2.adaptiveThreshold(gray, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, 
@@ -0,0 +1,564 @@
+# image-analysis-service/src/utils/similarity_index.py
+"""
+Nearest-neighbour search over visual embeddings (utils/visual_embedding.py).
+
+Vectors are unit length, so similarity is the dot product. Each vector is
+stored under a client id (the backend's diagram id) with a small metadata
+dict; upserting an existing id overwrites its vector in place.
+
+Small collections are searched exhaustively: the float16 matrix is scored
+in blocks with one matrix product each (BLAS, vectorized). Once there are
+ivf_min_vectors vectors, an IVF-PQ index takes over:
+
+- a coarse k-means quantizer splits the vectors into ~sqrt(N) lists
+- each vector's residual from its list centroid is product-quantized: the
+  dimensions are split into PQ_SUBSPACES groups and each group is stored
+  as the id of the nearest of 256 codewords (one byte)
+- a query scores only the vectors of its `probes` nearest lists, from
+  per-list lookup tables of subspace distances (asymmetric distance), then
+  re-ranks the best RERANK_CANDIDATES by exact dot product
+
+Vectors added or overwritten since the last encoding are scored exactly on
+every query and encoded ENCODE_EVERY at a time. The quantizers are trained
+again whenever the collection has doubled since they were trained.
+
+Storage under the index directory: vectors.f16 (row-major float16 matrix,
+memory-mapped for search), keys.jsonl (one line per upsert: id, row,
+metadata; replayed on load) and the IVF files of the current generation
+(ivf-<n>.npz with the quantizers, codes-<n>.bin with each row's list and
+codes), named by ivf.json, which is replaced last so a crash mid-training
+leaves the previous generation in use.
+"""
+import io
+import json
+import logging
+import os
+import threading
+from dataclasses import dataclass
+
+import numpy as np
+
+import config
+from utils.visual_embedding import EMBEDDING_DIM
+
+logger = logging.getLogger(__name__)
+
+VECTOR_DTYPE = np.dtype('<f2')
+# Rows scored per matrix product in exhaustive search
+SEARCH_BLOCK_ROWS = 65536
+
+# IVF-PQ
+PQ_SUBSPACES = 16
+PQ_CODEWORDS = 256
+IVF_MIN_LISTS = 64
+IVF_MAX_LISTS = 4096
+IVF_TRAIN_SAMPLES = 65536
+# Codebooks have few dimensions per subspace; 64 rows per codeword is plenty
+PQ_TRAIN_SAMPLES = 16384
+KMEANS_ITERATIONS = 12
+RERANK_CANDIDATES = 256
+# Vectors scored exactly before they are encoded into the lists
+ENCODE_EVERY = 4096
+
+
+def _code_dtype(subspaces):
+    return np.dtype([('list', '<u2'), ('code', 'u1', (subspaces,))])
+
+
+@dataclass
+class SimilarMatch:
+    id: str
+    score: float
+    meta: dict
+
+    def to_dict(self):
+        return {'id': self.id, 'score': round(self.score, 4), 'meta': self.meta}
+
+
+def normalize_rows(vectors):
+    """float32 copy of `vectors` scaled to unit length (zero rows stay zero)"""
+    vectors = np.asarray(vectors, np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.where(norms > 0, norms, 1)
+
+
+def nearest_centroids(data, centroids, block=SEARCH_BLOCK_ROWS):
+    """Index of the nearest centroid (squared L2) of each row of `data`"""
+    norms = (centroids * centroids).sum(axis=1)
+    labels = np.empty(len(data), np.int64)
+    for start in range(0, len(data), block):
+        chunk = np.asarray(data[start:start + block], np.float32)
+        labels[start:start + len(chunk)] = np.argmin(norms - 2 * chunk @ centroids.T, axis=1)
+    return labels
+
+
+def kmeans(data, k, iterations=KMEANS_ITERATIONS, rng=None):
+    """
+    Lloyd's k-means with random initial centroids; empty clusters are
+    reseeded from random rows.
+
+    :param data: float32 array, N x D with N >= k
+    :return: float32 centroids, k x D
+    """
+    rng = rng or np.random.default_rng(0)
+    centroids = data[rng.choice(len(data), k, replace=False)].copy()
+    for _ in range(iterations):
+        labels = nearest_centroids(data, centroids)
+        counts = np.bincount(labels, minlength=k)
+        sums = np.stack([np.bincount(labels, weights=data[:, d], minlength=k) for d in range(data.shape[1])], 1)
+        filled = counts > 0
+        centroids[filled] = (sums[filled] / counts[filled, None]).astype(np.float32)
+        empty = np.flatnonzero(~filled)
+        if len(empty):
+            centroids[empty] = data[rng.choice(len(data), len(empty), replace=False)]
+    return centroids
+
+
+class ProductQuantizer:
+    """
+    Coarse centroids plus per-subspace codebooks of the residuals.
+
+    :param centroids: float32, lists x D
+    :param codebooks: float32 codewords of each subspace, list of PQ_CODEWORDS x d_s
+    """
+
+    def __init__(self, centroids, codebooks):
+        self.centroids = centroids
+        self.codebooks = codebooks
+        self.bounds = np.cumsum([0] + [codebook.shape[1] for codebook in codebooks])
+        self.centroid_norms = (centroids * centroids).sum(axis=1)
+        self.codeword_norms = [(codebook * codebook).sum(axis=1) for codebook in codebooks]
+
+    @property
+    def lists(self):
+        return len(self.centroids)
+
+    @classmethod
+    def train(cls, sample, lists, subspaces=PQ_SUBSPACES, rng=None):
+        rng = rng or np.random.default_rng(0)
+        centroids = kmeans(sample, lists, rng=rng)
+        residuals = sample - centroids[nearest_centroids(sample, centroids)]
+        residuals = residuals[rng.permutation(len(residuals))[:PQ_TRAIN_SAMPLES]]
+        codebooks = [
+            kmeans(np.ascontiguousarray(part), PQ_CODEWORDS, rng=rng)
+            for part in np.array_split(residuals, subspaces, axis=1)
+        ]
+        return cls(centroids, codebooks)
+
+    def encode(self, vectors):
+        """Records of (list, codes) for float32 unit vectors"""
+        records = np.zeros(len(vectors), _code_dtype(len(self.codebooks)))
+        lists = nearest_centroids(vectors, self.centroids)
+        residuals = vectors - self.centroids[lists]
+        records['list'] = lists
+        for s, codebook in enumerate(self.codebooks):
+            part = residuals[:, self.bounds[s]:self.bounds[s + 1]]
+            records['code'][:, s] = np.argmin(self.codeword_norms[s] - 2 * part @ codebook.T, axis=1)
+        return records
+
+    def probe(self, query, probes):
+        """(nearest list ids, distance tables probes x subspaces x codewords)"""
+        coarse = self.centroid_norms - 2 * (self.centroids @ query)
+        probes = min(probes, self.lists)
+        nearest = np.argpartition(coarse, probes - 1)[:probes]
+        residuals = query - self.centroids[nearest]
+        tables = np.empty((len(nearest), len(self.codebooks), PQ_CODEWORDS), np.float32)
+        for s, codebook in enumerate(self.codebooks):
+            part = residuals[:, self.bounds[s]:self.bounds[s + 1]]
+            tables[:, s] = self.codeword_norms[s] - 2 * part @ codebook.T
+        # |q - c - r|^2 = |q - c|^2 + sum over subspaces of |r_s|^2 - 2 (q - c)_s . r_s;
+        # the list term differs between probed lists, so it goes in the first subspace
+        tables[:, 0] += (residuals * residuals).sum(axis=1)[:, None]
+        return nearest, tables
+
+    def save(self, path):
+        arrays = {f"codebook_{s}": codebook for s, codebook in enumerate(self.codebooks)}
+        np.savez(path, centroids=self.centroids, **arrays)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            codebooks = [data[f"codebook_{s}"] for s in range(len(data.files) - 1)]
+            return cls(data['centroids'], codebooks)
+
+
+class SimilarityIndex:
+    """
+    Vector store with exhaustive and IVF-PQ search; see the module docstring.
+    Thread-safe.
+
+    :param directory: Where vectors and ids are stored, None for memory only
+    :param dim: Vector length
+    :param ivf_min_vectors: Collection size from which IVF-PQ is used
+    :param probes: Lists scored per IVF query (more = better recall, slower)
+    """
+
+    def __init__(self, directory=None, dim=EMBEDDING_DIM, ivf_min_vectors=50000, probes=16):
+        self.directory = directory
+        self.dim = dim
+        self.ivf_min_vectors = ivf_min_vectors
+        self.probes = probes
+        self._lock = threading.RLock()
+        self._row_bytes = dim * VECTOR_DTYPE.itemsize
+        self._ids = []
+        self._meta = []
+        self._rows = {}
+        # Key line of the last overwrite of each row, from replaying keys.jsonl
+        self._updated_lines = {}
+        self._count = 0
+        self._mapped = None
+        self._memory = np.zeros((0, dim), VECTOR_DTYPE)
+        # IVF-PQ state: quantizer, per-row records, rows sorted by list
+        self._quantizer = None
+        self._generation = 0
+        self._trained_rows = 0
+        self._codes = np.zeros(0, _code_dtype(PQ_SUBSPACES))
+        self._encoded = 0
+        self._dirty = set()
+        self._list_rows = np.zeros(0, np.int64)
+        self._list_offsets = None
+        self._stats = {'searches': 0, 'exhaustive': 0, 'ivf': 0, 'upserted': 0}
+
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            self._vectors_path = os.path.join(directory, 'vectors.f16')
+            self._keys_file = open(os.path.join(directory, 'keys.jsonl'), 'a+b')
+            self._key_lines = self._replay_keys()
+            with open(self._vectors_path, 'ab') as f:
+                # Rows written for upserts whose key line a crash kept from being recorded
+                f.truncate(self._count * self._row_bytes)
+            self._vectors_file = open(self._vectors_path, 'r+b')
+            self._load_ivf()
+            logger.info(f"Loaded {self._count} vectors from {directory}"
+                        f" ({'IVF-PQ' if self._quantizer else 'exhaustive'} search)")
+        else:
+            self._keys_file = io.BytesIO()
+            self._vectors_file = None
+            self._key_lines = 0
+
+    def __len__(self):
+        return self._count
+
+    # Storage
+
+    def _replay_keys(self):
+        """Rebuild ids and metadata from keys.jsonl; returns its number of lines"""
+        self._keys_file.seek(0)
+        lines = 0
+        for number, line in enumerate(self._keys_file):
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # A torn last line from a crash: that upsert never completed
+                logger.warning(f"Ignoring unreadable line {number + 1} of the similarity keys")
+                self._keys_file.truncate(self._keys_file.tell() - len(line))
+                break
+            row = record['row']
+            if row == self._count:
+                self._ids.append(record['id'])
+                self._meta.append(record.get('meta') or {})
+                self._count += 1
+            else:
+                self._meta[row] = record.get('meta') or {}
+                self._updated_lines[row] = number
+            self._rows[record['id']] = row
+            lines = number + 1
+        return lines
+
+    def _matrix(self):
+        """The stored vectors, count x dim float16 (memory-mapped on disk)"""
+        if self._vectors_file is None:
+            return self._memory[:self._count]
+        if self._mapped is None or len(self._mapped) != self._count:
+            self._mapped = None if self._count == 0 else np.memmap(
+                self._vectors_path, VECTOR_DTYPE, mode='r', shape=(self._count, self.dim)
+            )
+        return self._mapped if self._mapped is not None else np.zeros((0, self.dim), VECTOR_DTYPE)
+
+    def _write_rows(self, rows, vectors):
+        if self._vectors_file is None:
+            needed = max(rows) + 1
+            if needed > len(self._memory):
+                grown = np.zeros((max(needed, 2 * len(self._memory), 1024), self.dim), VECTOR_DTYPE)
+                grown[:len(self._memory)] = self._memory
+                self._memory = grown
+            self._memory[rows] = vectors
+            return
+        vectors = vectors.astype(VECTOR_DTYPE)
+        # Appended rows are contiguous; overwritten ones are written one by one
+        start = 0
+        while start < len(rows):
+            end = start + 1
+            while end < len(rows) and rows[end] == rows[end - 1] + 1:
+                end += 1
+            self._vectors_file.seek(rows[start] * self._row_bytes)
+            self._vectors_file.write(vectors[start:end].tobytes())
+            start = end
+        self._vectors_file.flush()
+
+    # IVF-PQ
+
+    def _ivf_state_path(self):
+        return os.path.join(self.directory, 'ivf.json')
+
+    def _load_ivf(self):
+        path = self._ivf_state_path()
+        if not os.path.exists(path):
+            return
+        try:
+            with open(path) as f:
+                state = json.load(f)
+            generation = state['generation']
+            quantizer = ProductQuantizer.load(os.path.join(self.directory, f"ivf-{generation}.npz"))
+            codes = np.fromfile(os.path.join(self.directory, f"codes-{generation}.bin"), _code_dtype(PQ_SUBSPACES))
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning(f"Ignoring unreadable IVF index, will train again: {str(e)}")
+            return
+        self._quantizer = quantizer
+        self._generation = generation
+        self._trained_rows = state['trained_rows']
+        self._encoded = min(state['encoded_rows'], len(codes), self._count)
+        self._codes = codes[:self._encoded].copy()
+        # Rows overwritten after they were encoded have stale codes
+        self._dirty = {row for row, line in self._updated_lines.items()
+                       if row < self._encoded and line >= state['key_lines']}
+        self._sort_lists()
+
+    def _save_ivf_state(self):
+        if not self.directory:
+            return
+        state = {
+            'generation': self._generation, 'trained_rows': self._trained_rows,
+            'encoded_rows': self._encoded, 'key_lines': self._key_lines,
+        }
+        temp_path = f"{self._ivf_state_path()}.tmp"
+        with open(temp_path, 'w') as f:
+            json.dump(state, f)
+        os.replace(temp_path, self._ivf_state_path())
+
+    def _codes_path(self, generation):
+        return os.path.join(self.directory, f"codes-{generation}.bin")
+
+    def _sort_lists(self):
+        lists = self._codes['list'][:self._encoded]
+        self._list_rows = np.argsort(lists, kind='stable')
+        self._list_offsets = np.zeros(self._quantizer.lists + 1, np.int64)
+        np.cumsum(np.bincount(lists, minlength=self._quantizer.lists), out=self._list_offsets[1:])
+
+    def _vectors_f32(self, rows):
+        return normalize_rows(self._matrix()[rows])
+
+    def _encode_rows(self, rows):
+        """Codes of `rows`, in blocks, as float32 is only needed per block"""
+        records = np.zeros(len(rows), _code_dtype(PQ_SUBSPACES))
+        for start in range(0, len(rows), SEARCH_BLOCK_ROWS):
+            block = rows[start:start + SEARCH_BLOCK_ROWS]
+            records[start:start + len(block)] = self._quantizer.encode(self._vectors_f32(block))
+        return records
+
+    def _train(self):
+        """Train new quantizers on a sample and encode every row (a new generation)"""
+        rng = np.random.default_rng(self._count)
+        sample_rows = np.sort(rng.choice(self._count, min(self._count, IVF_TRAIN_SAMPLES), replace=False))
+        lists = int(np.clip(np.sqrt(self._count), IVF_MIN_LISTS, IVF_MAX_LISTS))
+        lists = min(lists, len(sample_rows) // 4)
+        logger.info(f"Training IVF-PQ over {self._count} vectors ({lists} lists)")
+        self._quantizer = ProductQuantizer.train(self._vectors_f32(sample_rows), lists, rng=rng)
+        self._generation += 1
+        self._trained_rows = self._count
+        self._codes = self._encode_rows(np.arange(self._count))
+        self._encoded = self._count
+        self._dirty = set()
+        self._sort_lists()
+        if self.directory:
+            self._quantizer.save(os.path.join(self.directory, f"ivf-{self._generation}.npz"))
+            self._codes.tofile(self._codes_path(self._generation))
+            self._save_ivf_state()
+            for name in os.listdir(self.directory):
+                if name.startswith(('ivf-', 'codes-')) and not name.startswith(
+                        (f"ivf-{self._generation}.", f"codes-{self._generation}.")):
+                    os.remove(os.path.join(self.directory, name))
+
+    def _encode_pending(self):
+        """Encode rows added or overwritten since the last encoding"""
+        dirty = np.array(sorted(self._dirty), np.int64)
+        new_rows = np.arange(self._encoded, self._count)
+        records = self._encode_rows(np.concatenate([dirty, new_rows]))
+        self._codes = np.concatenate([self._codes[:self._encoded], records[len(dirty):]])
+        self._codes[dirty] = records[:len(dirty)]
+        if self.directory:
+            with open(self._codes_path(self._generation), 'r+b') as f:
+                for row in dirty:
+                    f.seek(int(row) * self._codes.itemsize)
+                    f.write(self._codes[row:row + 1].tobytes())
+                f.seek(self._encoded * self._codes.itemsize)
+                f.write(self._codes[self._encoded:].tobytes())
+        self._encoded = self._count
+        self._dirty = set()
+        self._sort_lists()
+        self._save_ivf_state()
+
+    def _maintain(self):
+        """Train or encode once enough rows are pending"""
+        if self._count < self.ivf_min_vectors:
+            return
+        if self._quantizer is None or self._count >= 2 * self._trained_rows:
+            self._train()
+        elif self._count - self._encoded + len(self._dirty) >= ENCODE_EVERY:
+            self._encode_pending()
+
+    def _ivf_candidates(self, query):
+        """Rows worth an exact score: best of the probed lists plus unencoded rows"""
+        probed, tables = self._quantizer.probe(query, self.probes)
+        starts = self._list_offsets[probed]
+        lengths = self._list_offsets[probed + 1] - starts
+        total = int(lengths.sum())
+        found = [np.arange(self._encoded, self._count), np.array(sorted(self._dirty), np.int64)]
+        if total:
+            positions = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(total)
+            rows = self._list_rows[positions]
+            table_ids = np.repeat(np.arange(len(probed)), lengths)
+            codes = self._codes['code'][rows]
+            distances = tables[table_ids[:, None], np.arange(codes.shape[1]), codes].sum(axis=1)
+            if len(rows) > RERANK_CANDIDATES:
+                rows = rows[np.argpartition(distances, RERANK_CANDIDATES)[:RERANK_CANDIDATES]]
+            found.append(rows)
+        return np.unique(np.concatenate(found))
+
+    # Public API
+
+    def upsert_many(self, items):
+        """
+        Store vectors (bulk load): one write per file, then at most one
+        encoding or training pass.
+
+        :param items: Iterable of (id, vector, metadata dict or None)
+        :return: Number of vectors stored
+        :raises ValueError: on a vector of the wrong length (nothing is stored)
+        """
+        items = list(items)
+        if not items:
+            return 0
+        for item_id, vector, _ in items:
+            if np.shape(vector) != (self.dim,):
+                raise ValueError(f"Vector for {item_id} has shape {np.shape(vector)}, expected ({self.dim},)")
+        vectors = normalize_rows([vector for _, vector, _ in items])
+        with self._lock:
+            rows, lines = [], []
+            next_row = self._count
+            assigned = {}
+            for item_id, _, meta in items:
+                item_id = str(item_id)
+                row = self._rows.get(item_id, assigned.get(item_id))
+                if row is None:
+                    row = assigned[item_id] = next_row
+                    next_row += 1
+                rows.append(row)
+                lines.append(json.dumps({'id': item_id, 'row': row, 'meta': meta or {}}).encode())
+            # Later duplicates of an id in the same batch win
+            order = np.argsort(rows, kind='stable')
+            sorted_rows = np.asarray(rows)[order]
+            self._write_rows(sorted_rows, vectors[order])
+            # Vectors first: a key line never points past the end of vectors.f16
+            self._keys_file.seek(0, os.SEEK_END)
+            self._keys_file.write(b"\n".join(lines) + b"\n")
+            self._keys_file.flush()
+            self._key_lines += len(lines)
+
+            for (item_id, _, meta), row in zip(items, rows):
+                item_id = str(item_id)
+                if row == self._count:
+                    self._ids.append(item_id)
+                    self._meta.append(meta or {})
+                    self._count += 1
+                else:
+                    self._meta[row] = meta or {}
+                    if row < self._encoded:
+                        self._dirty.add(row)
+                self._rows[item_id] = row
+            self._stats['upserted'] += len(items)
+            self._maintain()
+            return len(items)
+
+    def upsert(self, item_id, vector, meta=None):
+        return self.upsert_many([(item_id, vector, meta)])
+
+    def vector(self, item_id):
+        """Stored float32 vector of an id, or None"""
+        with self._lock:
+            row = self._rows.get(str(item_id))
+            return None if row is None else self._vectors_f32(np.array([row]))[0]
+
+    def search(self, vector, k=10, exclude_id=None, min_score=None):
+        """
+        The k stored vectors most similar to `vector`.
+
+        :param exclude_id: Id left out of the results (the query's own)
+        :param min_score: Drop matches scoring below this
+        :return: List of SimilarMatch, best first
+        """
+        query = normalize_rows(np.asarray(vector, np.float32).reshape(1, -1))[0]
+        if query.shape != (self.dim,):
+            raise ValueError(f"Query vector has {query.size} values, expected {self.dim}")
+        with self._lock:
+            self._stats['searches'] += 1
+            excluded = self._rows.get(str(exclude_id)) if exclude_id is not None else None
+            wanted = k + (excluded is not None)
+            if self._quantizer is None:
+                self._stats['exhaustive'] += 1
+                rows, scores = self._exhaustive(query, wanted)
+            else:
+                self._stats['ivf'] += 1
+                rows = self._ivf_candidates(query)
+                scores = self._vectors_f32(rows) @ query
+            order = np.argsort(-scores, kind='stable')
+            matches = []
+            for i in order:
+                row = int(rows[i])
+                if row == excluded:
+                    continue
+                if len(matches) == k or (min_score is not None and scores[i] < min_score):
+                    break
+                matches.append(SimilarMatch(self._ids[row], float(scores[i]), self._meta[row]))
+            return matches
+
+    def _exhaustive(self, query, k):
+        """(rows, scores) of the best k over every stored vector"""
+        matrix = self._matrix()
+        best_rows, best_scores = np.zeros(0, np.int64), np.zeros(0, np.float32)
+        for start in range(0, len(matrix), SEARCH_BLOCK_ROWS):
+            scores = np.asarray(matrix[start:start + SEARCH_BLOCK_ROWS], np.float32) @ query
+            if len(scores) > k:
+                top = np.argpartition(-scores, k)[:k]
+            else:
+                top = np.arange(len(scores))
+            best_rows = np.concatenate([best_rows, top + start])
+            best_scores = np.concatenate([best_scores, scores[top]])
+        return best_rows, best_scores
+
+    def stats(self):
+        with self._lock:
+            return dict(
+                self._stats, vectors=self._count, dim=self.dim,
+                search='ivf_pq' if self._quantizer is not None else 'exhaustive',
+                lists=self._quantizer.lists if self._quantizer is not None else 0,
+                unencoded=self._count - self._encoded + len(self._dirty) if self._quantizer is not None else 0,
+            )
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_similarity_index():
+    """This process's SimilarityIndex, loaded from config on first use"""
+    global _index
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                _index = SimilarityIndex(
+                    directory=config.SIMILARITY_INDEX_DIR or None,
+                    ivf_min_vectors=config.SIMILARITY_IVF_MIN_VECTORS,
+                    probes=config.SIMILARITY_IVF_PROBES
+                )
+    return _index
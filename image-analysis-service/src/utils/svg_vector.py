@@ -0,0 +1,756 @@
+# image-analysis-service/src/utils/svg_vector.py
+"""
+Analyze SVG uploads from their XML instead of their pixels.
+
+The file is read with a streaming parser: element counts, text nodes, fill
+and stroke colors and the geometry of rects, circles, ellipses, lines,
+polylines, polygons and paths are collected as elements close, and closed
+elements are cleared so memory does not grow with the document. Transforms
+are not applied; the geometry is only compared with itself (bar alignment,
+circle overlap, segment lengths relative to the canvas).
+
+Rasterizing is left for the cases that need pixels (text drawn as outlines)
+and goes through rasterize_svg(), bounded in size and cached on disk.
+"""
+import hashlib
+import logging
+import math
+import os
+import re
+import xml.etree.ElementTree as ET
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Tuple
+
+import cv2
+import numpy as np
+
+from utils.deadline import check_deadline
+from utils.diagram_features import DiagramFeatures, DiagramType, score_diagram_types
+from utils.image_processing import calculate_quality_score
+
+logger = logging.getLogger(__name__)
+
+# Canvas size browsers use when an SVG declares neither size nor viewBox
+DEFAULT_SVG_WIDTH = 300
+DEFAULT_SVG_HEIGHT = 150
+
+# Longest side of a raster made from an SVG
+SVG_RASTER_MAX_SIDE = 2048
+
+# Closed polygons of 3-4 vertices below this share of the long side are arrowheads
+ARROWHEAD_MAX_SIZE = 0.05
+
+# Elements between deadline checks while parsing
+PARSE_CHECK_INTERVAL = 5000
+
+# Canny edge pixels per character of 12-16 px label text (measured on
+# rendered Hershey text); SVG text has no geometry of its own here
+TEXT_EDGE_PIXELS_PER_CHAR = 40
+
+# Length units relative to CSS pixels
+UNIT_SCALE = {'': 1.0, 'px': 1.0, 'pt': 4 / 3, 'pc': 16.0, 'mm': 96 / 25.4, 'cm': 96 / 2.54, 'in': 96.0}
+
+NAMED_COLORS = {
+    'black': (0, 0, 0), 'white': (255, 255, 255), 'red': (255, 0, 0), 'lime': (0, 255, 0),
+    'green': (0, 128, 0), 'blue': (0, 0, 255), 'yellow': (255, 255, 0), 'orange': (255, 165, 0),
+    'gray': (128, 128, 128), 'grey': (128, 128, 128), 'silver': (192, 192, 192),
+    'purple': (128, 0, 128), 'navy': (0, 0, 128), 'teal': (0, 128, 128), 'maroon': (128, 0, 0),
+    'cyan': (0, 255, 255), 'magenta': (255, 0, 255), 'lightgray': (211, 211, 211),
+    'lightgrey': (211, 211, 211), 'darkgray': (169, 169, 169), 'darkgrey': (169, 169, 169),
+}
+
+SHAPE_TAGS = ('rect', 'circle', 'ellipse', 'line', 'polyline', 'polygon', 'path')
+# Elements whose descendants make up one text node
+TEXT_TAGS = ('text', 'foreignObject')
+# Containers of shapes that are only drawn where referenced (arrowheads, clips)
+DEFINITION_TAGS = ('defs', 'marker', 'symbol', 'clipPath', 'mask', 'pattern')
+# Style properties read for color statistics
+INHERITED_STYLES = ('fill', 'stroke')
+
+_NUMBER = r'[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?'
+_NUMBER_RE = re.compile(_NUMBER)
+_PATH_TOKEN_RE = re.compile(rf'[MmLlHhVvZzCcSsQqTtAa]|{_NUMBER}')
+_LENGTH_RE = re.compile(rf'^\s*({_NUMBER})\s*([a-z%]*)\s*$')
+_CSS_RULE_RE = re.compile(r'\.([\w-]+)\s*\{([^}]*)\}')
+_RGB_RE = re.compile(r'rgba?\(\s*([\d.]+)(%?)\s*,\s*([\d.]+)(%?)\s*,\s*([\d.]+)(%?)')
+
+# Arguments per path command
+_PATH_ARITY = {'m': 2, 'l': 2, 'h': 1, 'v': 1, 'c': 6, 's': 4, 'q': 4, 't': 2, 'a': 7, 'z': 0}
+
+
+@dataclass
+class SvgSummary:
+    """What the XML says about a drawing; coordinates in user units"""
+    width: float
+    height: float
+    background: Optional[Tuple[int, int, int]] = None
+    element_counts: Dict[str, int] = field(default_factory=dict)
+    texts: List[str] = field(default_factory=list)
+    # RGB color -> filled area (fills) or use count (strokes)
+    fill_areas: Dict[Tuple[int, int, int], float] = field(default_factory=dict)
+    stroke_counts: Dict[Tuple[int, int, int], int] = field(default_factory=dict)
+    rects: List[Tuple[float, float, float, float]] = field(default_factory=list)
+    circles: List[Tuple[float, float, float]] = field(default_factory=list)
+    segments: List[Tuple[float, float, float, float]] = field(default_factory=list)
+    arrowheads: int = 0
+    wedges: int = 0
+    markers: int = 0
+    uses: int = 0
+    curves: int = 0
+
+    @property
+    def long_side(self):
+        return max(self.width, self.height, 1.0)
+
+    @property
+    def text(self):
+        return '\n'.join(self.texts)
+
+    @property
+    def colors(self):
+        """Every color used, fills and strokes"""
+        return set(self.fill_areas) | set(self.stroke_counts)
+
+    def to_dict(self):
+        return {
+            'width': self.width,
+            'height': self.height,
+            'element_counts': self.element_counts,
+            'text_nodes': len(self.texts),
+            'color_count': len(self.colors),
+            'rects': len(self.rects),
+            'circles': len(self.circles),
+            'line_segments': len(self.segments),
+            'curved_paths': self.curves,
+            'arrows': self.arrow_count(),
+        }
+
+    def arrow_count(self):
+        """Marker references plus small closed arrowhead polygons"""
+        return self.markers + self.arrowheads
+
+
+class _ParseState:
+    """Running state of parse_svg(); geometry lands in the summary as elements close"""
+
+    def __init__(self, summary):
+        self.summary = summary
+        self.css_classes = {}
+        # Open switch elements: True once a child has supplied text
+        self.switch_used = []
+        # Fill and stroke of each open element, for inheritance
+        self.styles = []
+        self.text_depth = 0
+        self.definition_depth = 0
+        self.elements = 0
+
+
+def parse_length(value, reference=None):
+    """A length attribute in CSS pixels; percentages need `reference`"""
+    if not value:
+        return None
+    match = _LENGTH_RE.match(value)
+    if match is None:
+        return None
+    number, unit = float(match.group(1)), match.group(2)
+    if unit == '%':
+        return number / 100 * reference if reference else None
+    return number * UNIT_SCALE[unit] if unit in UNIT_SCALE else None
+
+
+def parse_color(value):
+    """(r, g, b) for a CSS color, None for none/transparent/gradients"""
+    if not value:
+        return None
+    value = value.strip().lower()
+    if value.startswith('#'):
+        digits = value[1:]
+        if len(digits) in (3, 4):
+            return tuple(int(c * 2, 16) for c in digits[:3])
+        if len(digits) in (6, 8):
+            return tuple(int(digits[i:i + 2], 16) for i in (0, 2, 4))
+        return None
+    match = _RGB_RE.match(value)
+    if match:
+        channels = []
+        for i in (1, 3, 5):
+            number = float(match.group(i))
+            channels.append(round(number * 2.55) if match.group(i + 1) else round(number))
+        return tuple(min(255, max(0, c)) for c in channels)
+    return NAMED_COLORS.get(value)
+
+
+def _style(elem, css_classes, inherited=None):
+    """
+    Fill and stroke of an element: inherited from its parent, overridden by
+    presentation attributes, class rules and style=, in that order
+    """
+    declarations = dict(inherited or {})
+    declarations.update({name: elem.get(name) for name in INHERITED_STYLES if elem.get(name)})
+    for css_class in (elem.get('class') or '').split():
+        declarations.update(css_classes.get(css_class, {}))
+    declarations.update(_parse_declarations(elem.get('style') or ''))
+    return {name: value for name, value in declarations.items() if name in INHERITED_STYLES}
+
+
+def _parse_declarations(block):
+    declarations = {}
+    for item in block.split(';'):
+        if ':' in item:
+            name, value = item.split(':', 1)
+            declarations[name.strip().lower()] = value.strip()
+    return declarations
+
+
+def _number(elem, name):
+    try:
+        return float(elem.get(name) or 0)
+    except ValueError:
+        return parse_length(elem.get(name)) or 0.0
+
+
+def _points(value):
+    numbers = [float(n) for n in _NUMBER_RE.findall(value or '')]
+    return list(zip(numbers[0::2], numbers[1::2]))
+
+
+def parse_path(d):
+    """
+    Vertices of a path and whether it has curves.
+
+    Only the end point of each command is kept, which is exact for straight
+    paths and enough to place curved ones.
+
+    :return: (subpaths, curved, closed) with subpaths as lists of (x, y)
+    """
+    tokens = _PATH_TOKEN_RE.findall(d or '')
+    subpaths, current = [], []
+    x = y = 0.0
+    start = (0.0, 0.0)
+    command = None
+    curved = closed = False
+    i = 0
+    while i < len(tokens):
+        if tokens[i].isalpha():
+            command = tokens[i]
+            i += 1
+            if command in 'Zz':
+                closed = True
+                x, y = start
+                if current:
+                    subpaths.append(current)
+                current = []
+                continue
+        if command is None:
+            break
+        arity = _PATH_ARITY[command.lower()]
+        if i + arity > len(tokens):
+            break
+        args = [float(t) for t in tokens[i:i + arity]]
+        i += arity
+        relative = command.islower()
+        lower = command.lower()
+        if lower == 'h':
+            x = x + args[0] if relative else args[0]
+        elif lower == 'v':
+            y = y + args[0] if relative else args[0]
+        else:
+            dx, dy = args[-2], args[-1]
+            x, y = (x + dx, y + dy) if relative else (dx, dy)
+            if lower not in 'ml':
+                curved = True
+        if lower == 'm':
+            if current:
+                subpaths.append(current)
+            current = []
+            start = (x, y)
+            # Extra pairs after a moveto are linetos
+            command = 'l' if relative else 'L'
+        if not current:
+            current.append(start)
+        if (x, y) != current[-1]:
+            current.append((x, y))
+    if current:
+        subpaths.append(current)
+    return subpaths, curved, closed
+
+
+def _add_fill(summary, declarations, area):
+    color = parse_color(declarations.get('fill', 'black'))
+    if color is not None and area > 0:
+        summary.fill_areas[color] = summary.fill_areas.get(color, 0.0) + area
+
+
+def _add_stroke(summary, declarations):
+    color = parse_color(declarations.get('stroke'))
+    if color is not None:
+        summary.stroke_counts[color] = summary.stroke_counts.get(color, 0) + 1
+
+
+def _polygon_area(points):
+    if len(points) < 3:
+        return 0.0
+    xs, ys = np.array(points).T
+    return 0.5 * abs(float(np.dot(xs, np.roll(ys, 1)) - np.dot(ys, np.roll(xs, 1))))
+
+
+def _axis_aligned_box(points):
+    """(x, y, w, h) if four vertices form an axis-aligned rectangle"""
+    if len(points) == 5 and points[0] == points[-1]:
+        points = points[:4]
+    if len(points) != 4:
+        return None
+    xs = sorted({round(p[0], 3) for p in points})
+    ys = sorted({round(p[1], 3) for p in points})
+    if len(xs) != 2 or len(ys) != 2:
+        return None
+    return xs[0], ys[0], xs[1] - xs[0], ys[1] - ys[0]
+
+
+def _add_polyline(summary, points, closed, declarations):
+    """Straight segments, boxes and arrowheads from a vertex list"""
+    if closed:
+        _add_fill(summary, declarations, _polygon_area(points))
+        box = _axis_aligned_box(points)
+        if box is not None:
+            summary.rects.append(box)
+            return
+        if len(points) in (3, 4) and _extent(points) < ARROWHEAD_MAX_SIZE * summary.long_side:
+            # Triangle, or the notched quad draw.io uses for arrowheads
+            summary.arrowheads += 1
+            return
+    pairs = zip(points, points[1:] + (points[:1] if closed else []))
+    summary.segments.extend((x1, y1, x2, y2) for (x1, y1), (x2, y2) in pairs)
+
+
+def _extent(points):
+    xs, ys = zip(*points)
+    return max(max(xs) - min(xs), max(ys) - min(ys))
+
+
+def _add_shape(summary, tag, elem, declarations):
+    if tag == 'rect':
+        width, height = _number(elem, 'width'), _number(elem, 'height')
+        if width * height >= 0.9 * summary.width * summary.height:
+            # A full-canvas rect is the background, not a box
+            color = parse_color(declarations.get('fill', 'black'))
+            if color is not None:
+                summary.background = color
+            return
+        summary.rects.append((_number(elem, 'x'), _number(elem, 'y'), width, height))
+        _add_fill(summary, declarations, width * height)
+    elif tag in ('circle', 'ellipse'):
+        rx = _number(elem, 'r') if tag == 'circle' else _number(elem, 'rx')
+        ry = rx if tag == 'circle' else _number(elem, 'ry')
+        summary.circles.append((_number(elem, 'cx'), _number(elem, 'cy'), (rx + ry) / 2))
+        _add_fill(summary, declarations, math.pi * rx * ry)
+    elif tag == 'line':
+        summary.segments.append((_number(elem, 'x1'), _number(elem, 'y1'), _number(elem, 'x2'), _number(elem, 'y2')))
+    elif tag in ('polyline', 'polygon'):
+        _add_polyline(summary, _points(elem.get('points')), tag == 'polygon', declarations)
+    elif tag == 'path':
+        subpaths, curved, closed = parse_path(elem.get('d'))
+        if curved:
+            summary.curves += 1
+            # A closed curve with one straight edge from its start: pie wedge
+            if closed and len(subpaths) == 1:
+                summary.wedges += 1
+            _add_fill(summary, declarations, sum(_polygon_area(p) for p in subpaths))
+        else:
+            for points in subpaths:
+                _add_polyline(summary, points, closed, declarations)
+    if elem.get('marker-end') or elem.get('marker-start') or 'marker' in (elem.get('style') or ''):
+        summary.markers += 1
+    _add_stroke(summary, declarations)
+
+
+def _root_size(elem):
+    """Canvas size from width/height, falling back to the viewBox"""
+    view_box = [float(n) for n in _NUMBER_RE.findall(elem.get('viewBox') or '')]
+    view_width, view_height = (view_box[2], view_box[3]) if len(view_box) == 4 else (None, None)
+    width = parse_length(elem.get('width'), view_width) or view_width or DEFAULT_SVG_WIDTH
+    height = parse_length(elem.get('height'), view_height) or view_height or DEFAULT_SVG_HEIGHT
+    return width, height
+
+
+def _local_name(tag):
+    return tag.rsplit('}', 1)[-1] if isinstance(tag, str) else ''
+
+
+def parse_svg(image_path, deadline=None):
+    """
+    Stream an SVG file into an SvgSummary.
+
+    :param image_path: Path to the SVG file
+    :param deadline: Optional Deadline checked every PARSE_CHECK_INTERVAL elements
+    :return: SvgSummary
+    :raises ValueError: if the file is not well-formed XML with an <svg> root
+    """
+    summary = None
+    state = None
+    stack = []
+    try:
+        for event, elem in ET.iterparse(image_path, events=('start', 'end')):
+            tag = _local_name(elem.tag)
+            if event == 'start':
+                if summary is None:
+                    if tag != 'svg':
+                        raise ValueError(f"Root element is <{tag}>, not <svg>")
+                    summary = SvgSummary(*_root_size(elem))
+                    state = _ParseState(summary)
+                    summary.background = parse_color(_parse_declarations(elem.get('style') or '').get('background-color'))
+                stack.append(tag)
+                state.styles.append(_style(elem, state.css_classes, state.styles[-1] if state.styles else None))
+                if tag in TEXT_TAGS:
+                    state.text_depth += 1
+                elif tag == 'switch':
+                    state.switch_used.append(False)
+                elif tag in DEFINITION_TAGS:
+                    state.definition_depth += 1
+                continue
+
+            stack.pop()
+            declarations = state.styles.pop()
+            state.elements += 1
+            if state.elements % PARSE_CHECK_INTERVAL == 0:
+                check_deadline(deadline, "SVG parsing")
+            summary.element_counts[tag] = summary.element_counts.get(tag, 0) + 1
+
+            if tag == 'style':
+                for name, block in _CSS_RULE_RE.findall(elem.text or ''):
+                    state.css_classes[name] = _parse_declarations(block)
+            elif tag in TEXT_TAGS:
+                state.text_depth -= 1
+                content = ' '.join(''.join(elem.itertext()).split())
+                in_switch = bool(stack) and stack[-1] == 'switch'
+                # A switch renders only its first usable child; draw.io puts
+                # the same label in a foreignObject and a fallback <text>
+                if content and not (in_switch and state.switch_used[-1]) and state.text_depth == 0:
+                    summary.texts.append(content)
+                    if in_switch:
+                        state.switch_used[-1] = True
+            elif tag == 'switch':
+                state.switch_used.pop()
+            elif tag in DEFINITION_TAGS:
+                state.definition_depth -= 1
+            elif tag in SHAPE_TAGS and state.text_depth == 0 and state.definition_depth == 0:
+                _add_shape(summary, tag, elem, declarations)
+            elif tag == 'use' and state.definition_depth == 0:
+                summary.uses += 1
+
+            if state.text_depth == 0:
+                elem.clear()
+    except ET.ParseError as e:
+        raise ValueError(f"Malformed SVG {image_path}: {str(e)}")
+
+    if summary is None:
+        raise ValueError(f"No <svg> element in {image_path}")
+    logger.debug(f"Parsed SVG {image_path}: {summary.to_dict()}")
+    return summary
+
+
+def is_svg_valid(image_path):
+    """True if the file is XML with an <svg> root; reads only up to the root tag"""
+    try:
+        for _, elem in ET.iterparse(image_path, events=('start',)):
+            return _local_name(elem.tag) == 'svg'
+    except ET.ParseError as e:
+        logger.error(f"Malformed SVG file {image_path}: {str(e)}")
+    return False
+
+
+def _palette(summary):
+    """
+    Colors and their share of the canvas: fills by area, the background
+    for what is left. Strokes have no area here and are left out.
+    """
+    canvas = summary.width * summary.height
+    colors = dict(summary.fill_areas)
+    filled = sum(colors.values())
+    background = summary.background or (255, 255, 255)
+    colors[background] = colors.get(background, 0.0) + max(0.0, canvas - filled)
+    rgb = np.array(list(colors.keys()), dtype=np.uint8)
+    weights = np.array(list(colors.values()), dtype=np.float64)
+    return rgb, weights / max(weights.sum(), 1e-9)
+
+
+def _gray_level(rgb):
+    """Gray level of an RGB color, weighted like cv2.COLOR_BGR2GRAY"""
+    r, g, b = rgb
+    return 0.299 * r + 0.587 * g + 0.114 * b
+
+
+def _outline_length(summary):
+    """
+    Length of the drawn outlines in user units: box perimeters, circle
+    circumferences, straight segments, and an estimate for label text.
+    Curved paths keep no geometry and are left out.
+    """
+    length = sum(2 * (abs(w) + abs(h)) for _, _, w, h in summary.rects)
+    length += sum(2 * math.pi * abs(r) for _, _, r in summary.circles)
+    length += sum(math.hypot(x2 - x1, y2 - y1) for x1, y1, x2, y2 in summary.segments)
+    characters = sum(len(text.replace(' ', '')) for text in summary.texts)
+    return length + characters * TEXT_EDGE_PIXELS_PER_CHAR
+
+
+def _edge_step(summary):
+    """
+    Mean gray-level step between ink and background: strokes weighted by
+    use, each text node as one black stroke; fill colors when nothing is
+    stroked.
+    """
+    background = _gray_level(summary.background or (255, 255, 255))
+    inks = dict(summary.stroke_counts)
+    if summary.texts:
+        inks[(0, 0, 0)] = inks.get((0, 0, 0), 0) + len(summary.texts)
+    if not inks:
+        inks = {color: 1 for color in summary.fill_areas} or {(0, 0, 0): 1}
+    steps = [abs(_gray_level(color) - background) for color in inks]
+    return float(np.average(steps, weights=list(inks.values())))
+
+
+def _render_scores(summary, contrast):
+    """
+    Pixel scores of a clean, unaliased render at the declared size, from the
+    geometry (one user unit per pixel). Outlines are drawn as thin strokes:
+    each unit of outline is one edge pixel with a gray-level step of
+    _edge_step(). The Sobel magnitude is 4 x step on either side of it, and
+    the Laplacian is -2 x step on it and +step either side. Flat colors
+    spread the same at every scale, so detail equals contrast. A render has
+    no noise. blur_score keeps only the Laplacian half of the raster score,
+    because the spectrum half needs pixels.
+    """
+    density = min(1.0, _outline_length(summary) / max(summary.width * summary.height, 1.0))
+    step = _edge_step(summary)
+    return {
+        'blur_score': 6 * step * step * density / 2,
+        'noise_level': 0.0,
+        'sharpness': 8 * step * density,
+        'edge_density': density,
+        'detail_score': contrast,
+    }
+
+
+def svg_quality_metrics(summary, image_path):
+    """
+    Quality result shaped like analyze_image_quality(), from the drawing's
+    size, colors and geometry. Scores that describe pixels are those of a
+    clean render at the declared size (see _render_scores()), and the
+    overall score combines them as for rasters.
+
+    Color statistics are area-weighted over the fill colors plus the
+    background and reported in BGR order like the raster path.
+    """
+    width, height = summary.width, summary.height
+    rgb, weights = _palette(summary)
+    bgr = rgb[:, ::-1].reshape(1, -1, 3)
+    hsv = cv2.cvtColor(bgr, cv2.COLOR_BGR2HSV).reshape(-1, 3).astype(np.float64)
+    lab = cv2.cvtColor(bgr, cv2.COLOR_BGR2LAB).reshape(-1, 3).astype(np.float64)
+    gray = cv2.cvtColor(bgr, cv2.COLOR_BGR2GRAY).ravel().astype(np.float64)
+    bgr = bgr.reshape(-1, 3).astype(np.float64)
+
+    mean_bgr = weights @ bgr
+    gray_mean = weights @ gray
+    contrast = math.sqrt(weights @ (gray - gray_mean) ** 2)
+    value_mean = weights @ hsv[:, 2]
+    order = np.argsort(weights)[::-1][:3]
+    scores = _render_scores(summary, contrast)
+    overall = calculate_quality_score(
+        scores['blur_score'], contrast, value_mean, scores['noise_level'], scores['sharpness'], scores['edge_density']
+    )
+
+    return {
+        'basic_metrics': {
+            'resolution': "Vector",
+            'aspect_ratio': f"{width / height:.2f}",
+            'file_size_mb': round(os.path.getsize(image_path) / (1024 * 1024), 2),
+            'dimensions': {
+                'width': width,
+                'height': height,
+                'megapixels': 0  # SVGs don't have pixels
+            }
+        },
+        'quality_scores': {
+            'overall_quality': overall,
+            **{name: round(float(value), 2) for name, value in scores.items()},
+            'contrast_score': round(float(contrast), 2),
+            'brightness_score': round(float(value_mean), 2),
+        },
+        'color_analysis': {
+            'color_distribution': {
+                'mean_rgb': mean_bgr.tolist(),
+                'std_rgb': np.sqrt(weights @ (bgr - mean_bgr) ** 2).tolist(),
+                'mean_hsv': (weights @ hsv).tolist(),
+                'mean_lab': (weights @ lab).tolist()
+            },
+            'color_stats': {
+                'saturation': float(weights @ hsv[:, 1]),
+                'value_variance': float(weights @ (hsv[:, 2] - value_mean) ** 2),
+                'dominant_colors': bgr[order].astype(int).tolist(),
+                'color_count': len(summary.colors)
+            }
+        },
+        'quality_mode': 'vector'
+    }
+
+
+def _aligned_count(boxes, edge):
+    """Size of the largest group of boxes sharing an edge coordinate"""
+    groups = {}
+    for box in boxes:
+        key = round(edge(box))
+        groups[key] = groups.get(key, 0) + 1
+    return max(groups.values(), default=0)
+
+
+def _overlapping_circles(circles):
+    for i, (x1, y1, r1) in enumerate(circles):
+        for x2, y2, r2 in circles[i + 1:]:
+            distance = math.hypot(x2 - x1, y2 - y1)
+            if abs(r1 - r2) < distance < r1 + r2:
+                return True
+    return False
+
+
+def element_signals(summary):
+    """
+    The counts classify_diagram_type() detects in pixels, read from the geometry.
+
+    Sizes are relative to the canvas where the raster detectors use pixel
+    thresholds, so the result does not depend on the SVG's unit scale.
+    """
+    long_side = summary.long_side
+    lengths = [math.hypot(x2 - x1, y2 - y1) for x1, y1, x2, y2 in summary.segments]
+    points = sum(1 for _, _, r in summary.circles if r < 0.02 * long_side) + summary.uses
+    large_circles = [c for c in summary.circles if c[2] >= 0.02 * long_side]
+    # Bars: tall boxes standing on one baseline, or long boxes from one axis
+    vertical = [b for b in summary.rects if b[3] > b[2]]
+    horizontal = [b for b in summary.rects if b[2] >= 3 * b[3]]
+    lines = sum(1 for length in lengths if length > long_side / 10)
+    bonds = sum(1 for length in lengths if 0.01 * long_side < length < 0.05 * long_side)
+    return {
+        'vertical_bars': _aligned_count(vertical, lambda b: b[1] + b[3]),
+        'horizontal_bars': _aligned_count(horizontal, lambda b: b[0]),
+        'lines': lines,
+        'points': points,
+        'circles': len(large_circles),
+        'arrows': summary.arrow_count(),
+        'boxes': len(summary.rects),
+        'network': points > 3 and lines > points,
+        'pie_segments': summary.wedges >= 3,
+        'overlapping_circles': _overlapping_circles(large_circles[:50]),
+        'chemical_bonds': points >= 3 and bonds > points,
+    }
+
+
+def svg_diagram_features(summary):
+    """
+    DiagramFeatures for an SVG, classified with the same rules as rasters.
+
+    :param summary: SvgSummary from parse_svg()
+    :return: DiagramFeatures
+    """
+    signals = element_signals(summary)
+    diagram_type, confidence = score_diagram_types(**signals)
+    rgb, weights = _palette(summary)
+    background = summary.background or (255, 255, 255)
+
+    general_features = {
+        "dimensions": {
+            "width": summary.width,
+            "height": summary.height,
+            "aspect_ratio": summary.width / summary.height
+        },
+        "color_mode": "color" if any(len(set(c)) > 1 for c in summary.colors) else "grayscale",
+        "color_count": len(summary.colors),
+        "is_colorful": len(summary.colors) > 10,
+        "has_light_background": float(np.mean(background)) > 200,
+        "element_counts": summary.element_counts,
+        "text_nodes": len(summary.texts),
+        "is_vector": True
+    }
+
+    specific_features: Dict[str, Any] = {}
+    if diagram_type == DiagramType.BAR_CHART:
+        is_vertical = signals['vertical_bars'] >= signals['horizontal_bars']
+        specific_features["orientation"] = "vertical" if is_vertical else "horizontal"
+        specific_features["bar_count"] = signals['vertical_bars'] if is_vertical else signals['horizontal_bars']
+    elif diagram_type == DiagramType.LINE_GRAPH:
+        specific_features["line_count"] = signals['lines']
+        specific_features["has_markers"] = signals['points'] > 10
+    elif diagram_type == DiagramType.SCATTER_PLOT:
+        specific_features["point_count"] = signals['points']
+    elif diagram_type == DiagramType.PIE_CHART:
+        specific_features["segment_count"] = summary.wedges
+        specific_features["has_labels"] = len(summary.texts) > 2
+    elif diagram_type == DiagramType.FLOW_CHART:
+        box_sizes = [w * h for _, _, w, h in summary.rects]
+        specific_features["box_count"] = len(summary.rects)
+        specific_features["arrow_count"] = signals['arrows']
+        if box_sizes and min(box_sizes) > 0:
+            specific_features["avg_box_size"] = sum(box_sizes) / len(box_sizes)
+            specific_features["varied_box_sizes"] = max(box_sizes) / min(box_sizes) > 2
+    elif diagram_type == DiagramType.NETWORK_DIAGRAM:
+        specific_features["node_count"] = signals['points']
+        specific_features["edge_count"] = signals['lines']
+        specific_features["node_edge_ratio"] = signals['points'] / max(1, signals['lines'])
+    elif diagram_type == DiagramType.CHEMICAL_STRUCTURE:
+        specific_features["atom_count"] = signals['points']
+        specific_features["bond_count"] = len(summary.segments)
+
+    return DiagramFeatures(
+        diagram_type=diagram_type,
+        type_confidence=confidence,
+        general_features=general_features,
+        specific_features=specific_features
+    )
+
+
+def rasterize_svg(image_path, summary, max_side=SVG_RASTER_MAX_SIDE, cache_dir=None):
+    """
+    Render an SVG to a grayscale array no larger than `max_side`, via cairosvg.
+
+    Renders are cached as PNG under `cache_dir`, keyed by file content and
+    size, so repeated uploads of the same drawing render once.
+
+    :param summary: SvgSummary of the file, for its size
+    :return: uint8 array, or None if cairosvg is not installed or rendering fails
+    """
+    # Vectors scale losslessly, so small drawings are rendered up to the bound too
+    scale = max_side / summary.long_side
+    out_width = max(1, int(round(summary.width * scale)))
+    out_height = max(1, int(round(summary.height * scale)))
+
+    cache_path = None
+    if cache_dir:
+        with open(image_path, 'rb') as f:
+            digest = hashlib.sha1(f.read()).hexdigest()
+        cache_path = os.path.join(cache_dir, f"{digest}_{out_width}x{out_height}.png")
+        if os.path.exists(cache_path):
+            cached = cv2.imread(cache_path, cv2.IMREAD_GRAYSCALE)
+            if cached is not None:
+                return cached
+
+    try:
+        import cairosvg
+    except ImportError:
+        logger.warning("cairosvg is not installed, SVG cannot be rasterized")
+        return None
+
+    try:
+        png = cairosvg.svg2png(
+            url=image_path, output_width=out_width, output_height=out_height,
+            background_color='white', unsafe=False
+        )
+        image = cv2.imdecode(np.frombuffer(png, dtype=np.uint8), cv2.IMREAD_GRAYSCALE)
+    except Exception as e:
+        logger.error(f"Error rasterizing SVG {image_path}: {str(e)}")
+        return None
+
+    if cache_path is not None and image is not None:
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            cv2.imwrite(cache_path, image)
+        except OSError as e:
+            logger.warning(f"Could not cache SVG raster at {cache_path}: {str(e)}")
+    return image
@@ -0,0 +1,526 @@
+# image-analysis-service/src/utils/symbol_detect.py
+"""
+Math symbol detection from connected components, without OCR.
+
+Glyph candidates are segmented once: connected components of the ink
+(shared with text_regions.py), filtered to glyph size, with parts stacked
+in one column (the bars of '=', the dots of '÷', the bar under '≤')
+grouped into one glyph. Each glyph becomes a small normalized bitmap plus
+its aspect ratio and its height relative to the text, and all glyphs of
+the image are classified at once against a template set by nearest
+neighbor (one matrix product).
+
+Templates are drawn from stroke descriptions of the symbols of
+MATH_SYMBOLS_PATTERN (text_extract.py) at several stroke widths and
+slants, next to letters, digits and punctuation rendered with OpenCV's
+Hershey fonts as "not a symbol" classes. No font files or model weights
+are needed, and the result is deterministic.
+
+A glyph whose nearest class is a symbol by a clear margin is reported.
+Glyphs where a symbol and another class are too close to call are
+returned as ambiguous regions, which detect_math_symbols() OCRs in one
+batch; everything else is text or drawing. Symbols split side by side
+into separate components ('‖', '≪', '∬') are only found through that OCR.
+"""
+import logging
+import re
+from dataclasses import dataclass, field
+from typing import List
+
+import cv2
+import numpy as np
+
+from utils.text_regions import TextRegion, _glyph_components, _ink, ocr_regions
+
+logger = logging.getLogger(__name__)
+
+# Glyph bitmaps are SYMBOL_FEATURE_SIZE square, glyph scaled to fit inside
+# a one-pixel margin and blurred so stroke width matters less
+SYMBOL_FEATURE_SIZE = 16
+SYMBOL_FEATURE_BLUR = 0.8
+# Weights of log(aspect ratio) and log(height / text height) next to the
+# unit-length bitmap
+SYMBOL_ASPECT_WEIGHT = 0.25
+SYMBOL_SIZE_WEIGHT = 0.3
+
+# Candidates, relative to the median glyph height H: parts stacked less
+# than SYMBOL_GROUP_GAP apart are one glyph if the glyph stays under
+# SYMBOL_GROUP_MAX_HEIGHT; glyphs larger than SYMBOL_MAX_SIZE are shapes,
+# those smaller than SYMBOL_MIN_SIZE specks or punctuation
+SYMBOL_GROUP_GAP = 0.6
+SYMBOL_GROUP_MAX_HEIGHT = 1.5
+SYMBOL_MAX_SIZE = 2.2
+SYMBOL_MIN_SIZE = 0.25
+# Above this many candidates (noise, textures) the image is left to OCR
+SYMBOL_MAX_CANDIDATES = 5000
+
+# Squared feature distances: a symbol is accepted within
+# SYMBOL_MAX_DISTANCE of its nearest template and SYMBOL_MIN_MARGIN closer
+# than any other class; a symbol among the two nearest classes within
+# SYMBOL_AMBIGUOUS_DISTANCE makes the glyph ambiguous
+SYMBOL_MAX_DISTANCE = 0.15
+SYMBOL_MIN_MARGIN = 0.03
+SYMBOL_AMBIGUOUS_DISTANCE = 0.4
+
+# Background kept around ambiguous glyphs for OCR, relative to H
+SYMBOL_OCR_PADDING = 0.3
+
+# Templates: pixels per unit of H, stroke widths in units of H, slants
+_TEMPLATE_SCALE = 48
+_TEMPLATE_STROKES = (0.07, 0.11, 0.16)
+_TEMPLATE_SLANTS = (0.0, 0.18)
+_HERSHEY_FONTS = (
+    cv2.FONT_HERSHEY_SIMPLEX, cv2.FONT_HERSHEY_DUPLEX, cv2.FONT_HERSHEY_COMPLEX,
+    cv2.FONT_HERSHEY_TRIPLEX, cv2.FONT_HERSHEY_PLAIN,
+)
+# Rendered with Hershey fonts: symbols it has, and the classes that are not
+# symbols ('_' is left out: without a baseline it is a '-')
+_HERSHEY_SYMBOLS = '+-*/=<>'
+_HERSHEY_OTHER = (
+    'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789'
+    '()[]{}.,:;!?\'"|&%$#@^~\\'
+)
+# Code points drawn the same way as another: template -> symbol reported
+SYMBOL_ALIASES = {'△': '∆', '▽': '∇'}
+
+
+# Stroke descriptions, in units of H (y down). A shape is a list of
+# ('line', points) polylines, ('dot', (x, y, r)) filled disks and
+# ('text', (text, x, y, height)) Hershey text; only lines and dots can be
+# shifted or mirrored.
+
+def _line(*points):
+    return [('line', [tuple(p) for p in points])]
+
+
+def _closed(*points):
+    return _line(*(points + (points[0],)))
+
+
+def _arc(cx, cy, rx, ry, start=0, end=360):
+    angles = np.radians(np.linspace(start, end, max(3, int(abs(end - start) / 10) + 1)))
+    return _line(*zip(cx + rx * np.cos(angles), cy + ry * np.sin(angles)))
+
+
+def _dot(x, y, r=0.07):
+    return [('dot', (x, y, r))]
+
+
+def _shift(shape, dx=0.0, dy=0.0):
+    return [(kind, [(x + dx, y + dy) for x, y in data]) if kind == 'line' else (kind, (data[0] + dx, data[1] + dy, data[2]))
+            for kind, data in shape]
+
+
+def _mirror_x(shape, width):
+    return [(kind, [(width - x, y) for x, y in data]) if kind == 'line' else (kind, (width - data[0], data[1], data[2]))
+            for kind, data in shape]
+
+
+def _mirror_y(shape, height):
+    return [(kind, [(x, height - y) for x, y in data]) if kind == 'line' else (kind, (data[0], height - data[1], data[2]))
+            for kind, data in shape]
+
+
+def _slash(x0=0.6, y0=-0.15, x1=0.1, y1=0.65):
+    return _line((x0, y0), (x1, y1))
+
+
+def _tilde(y, width=0.7, amplitude=0.08):
+    xs = np.linspace(0, width, 15)
+    return _line(*zip(xs, y - amplitude * np.sin(xs / width * 2 * np.pi)))
+
+
+def _subset():
+    return _arc(0.35, 0.3, 0.35, 0.3, 90, 270) + _line((0.35, 0.0), (0.75, 0.0)) + _line((0.35, 0.6), (0.75, 0.6))
+
+
+def _element():
+    return _arc(0.3, 0.25, 0.3, 0.25, 90, 270) + _line((0.3, 0.0), (0.55, 0.0)) + \
+        _line((0.3, 0.5), (0.55, 0.5)) + _line((0.0, 0.25), (0.5, 0.25))
+
+
+def _integral(dx=0.0):
+    return _shift(_line((0.5, 0.1), (0.42, 0.0), (0.33, 0.03), (0.28, 0.25), (0.24, 1.3),
+                        (0.19, 1.55), (0.09, 1.6), (0.0, 1.5)), dx)
+
+
+def _root(index=None):
+    shape = _line((0.0, 0.6), (0.12, 0.55), (0.32, 1.05), (0.58, 0.0), (1.0, 0.0))
+    if index:
+        shape += [('text', (index, 0.02, 0.42, 0.35))]
+    return shape
+
+
+def _less():
+    return _line((0.6, 0.0), (0.0, 0.3), (0.6, 0.6))
+
+
+def _angle():
+    return _line((0.3, 0.0), (0.0, 0.6), (0.3, 1.2))
+
+
+def _ceiling():
+    return _line((0.3, 0.0), (0.0, 0.0), (0.0, 1.2))
+
+
+def _bracket():
+    return _line((0.35, 0.0), (0.0, 0.0), (0.0, 1.2), (0.35, 1.2)) + _line((0.12, 0.0), (0.12, 1.2))
+
+
+def _flat_paren():
+    return _line((0.3, 0.0), (0.1, 0.15), (0.05, 0.6), (0.1, 1.05), (0.3, 1.2))
+
+
+def _circled():
+    return _arc(0.4, 0.4, 0.4, 0.4)
+
+
+def _product():
+    return _line((0.0, 0.0), (0.8, 0.0)) + _line((0.15, 0.0), (0.15, 1.1)) + _line((0.65, 0.0), (0.65, 1.1))
+
+
+def _exists():
+    return _line((0.0, 0.0), (0.55, 0.0), (0.55, 0.9), (0.0, 0.9)) + _line((0.1, 0.45), (0.55, 0.45))
+
+
+SYMBOL_SHAPES = {
+    '+': _line((0.35, 0.0), (0.35, 0.7)) + _line((0.0, 0.35), (0.7, 0.35)),
+    '-': _line((0.0, 0.0), (0.6, 0.0)),
+    '*': _line((0.3, 0.0), (0.3, 0.6)) + _line((0.04, 0.15), (0.56, 0.45)) + _line((0.04, 0.45), (0.56, 0.15)),
+    '/': _line((0.45, 0.0), (0.0, 1.0)),
+    '=': _line((0.0, 0.0), (0.7, 0.0)) + _line((0.0, 0.32), (0.7, 0.32)),
+    '≠': _line((0.0, 0.0), (0.7, 0.0)) + _line((0.0, 0.32), (0.7, 0.32)) + _slash(0.55, -0.2, 0.15, 0.52),
+    '<': _less(),
+    '>': _mirror_x(_less(), 0.6),
+    '≤': _less() + _line((0.0, 0.8), (0.6, 0.8)),
+    '≥': _mirror_x(_less(), 0.6) + _line((0.0, 0.8), (0.6, 0.8)),
+    '≈': _tilde(0.0) + _tilde(0.3),
+    '±': _line((0.3, 0.0), (0.3, 0.6)) + _line((0.0, 0.3), (0.6, 0.3)) + _line((0.0, 0.8), (0.6, 0.8)),
+    '∓': _line((0.0, 0.0), (0.6, 0.0)) + _line((0.3, 0.2), (0.3, 0.8)) + _line((0.0, 0.5), (0.6, 0.5)),
+    '×': _line((0.0, 0.0), (0.5, 0.5)) + _line((0.5, 0.0), (0.0, 0.5)),
+    '÷': _line((0.0, 0.3), (0.7, 0.3)) + _dot(0.35, 0.05) + _dot(0.35, 0.55),
+    '≅': _tilde(0.0) + _line((0.0, 0.25), (0.7, 0.25)) + _line((0.0, 0.5), (0.7, 0.5)),
+    '≡': _line((0.0, 0.0), (0.7, 0.0)) + _line((0.0, 0.25), (0.7, 0.25)) + _line((0.0, 0.5), (0.7, 0.5)),
+    '≢': _line((0.0, 0.0), (0.7, 0.0)) + _line((0.0, 0.25), (0.7, 0.25)) + _line((0.0, 0.5), (0.7, 0.5)) +
+         _slash(0.55, -0.2, 0.15, 0.7),
+    '≪': _less() + _shift(_less(), 0.35),
+    '≫': _mirror_x(_less() + _shift(_less(), 0.35), 0.95),
+    '⊂': _subset(),
+    '⊃': _mirror_x(_subset(), 0.75),
+    '⊆': _subset() + _line((0.0, 0.85), (0.75, 0.85)),
+    '⊇': _mirror_x(_subset(), 0.75) + _line((0.0, 0.85), (0.75, 0.85)),
+    '⊄': _subset() + _slash(0.6, -0.15, 0.15, 0.75),
+    '⊅': _mirror_x(_subset(), 0.75) + _slash(0.6, -0.15, 0.15, 0.75),
+    '∈': _element(),
+    '∉': _element() + _slash(0.45, -0.15, 0.1, 0.65),
+    '∋': _mirror_x(_element(), 0.55),
+    '∌': _mirror_x(_element(), 0.55) + _slash(0.45, -0.15, 0.1, 0.65),
+    '∀': _line((0.0, 0.0), (0.4, 1.0), (0.8, 0.0)) + _line((0.17, 0.45), (0.63, 0.45)),
+    '∃': _exists(),
+    '∄': _exists() + _slash(0.5, -0.15, 0.05, 1.05),
+    '∧': _line((0.0, 0.7), (0.35, 0.0), (0.7, 0.7)),
+    '∨': _line((0.0, 0.0), (0.35, 0.7), (0.7, 0.0)),
+    '⊕': _circled() + _line((0.4, 0.0), (0.4, 0.8)) + _line((0.0, 0.4), (0.8, 0.4)),
+    '⊗': _circled() + _line((0.12, 0.12), (0.68, 0.68)) + _line((0.68, 0.12), (0.12, 0.68)),
+    '⊙': _circled() + _dot(0.4, 0.4, 0.08),
+    '∪': _line((0.0, 0.0), (0.0, 0.35)) + _arc(0.35, 0.35, 0.35, 0.35, 0, 180) + _line((0.7, 0.0), (0.7, 0.35)),
+    '∩': _mirror_y(_line((0.0, 0.0), (0.0, 0.35)) + _arc(0.35, 0.35, 0.35, 0.35, 0, 180) +
+                   _line((0.7, 0.0), (0.7, 0.35)), 0.7),
+    '∞': _arc(0.25, 0.22, 0.25, 0.2) + _arc(0.75, 0.22, 0.25, 0.2),
+    '∂': _arc(0.3, 0.72, 0.28, 0.28) + _line((0.58, 0.72), (0.58, 0.35), (0.48, 0.1), (0.3, 0.0), (0.12, 0.05)),
+    '∫': _integral(),
+    '∬': _integral() + _integral(0.3),
+    '∭': _integral() + _integral(0.3) + _integral(0.6),
+    '∮': _integral() + _arc(0.26, 0.8, 0.15, 0.15),
+    '▽': _closed((0.0, 0.0), (0.8, 0.0), (0.4, 0.8)),
+    '△': _closed((0.4, 0.0), (0.8, 0.8), (0.0, 0.8)),
+    '√': _root(),
+    '∛': _root('3'),
+    '∜': _root('4'),
+    '∑': _line((0.7, 0.0), (0.0, 0.0), (0.35, 0.55), (0.0, 1.1), (0.7, 1.1)),
+    '∏': _product(),
+    '∐': _mirror_y(_product(), 1.1),
+    '□': _closed((0.0, 0.0), (0.7, 0.0), (0.7, 0.7), (0.0, 0.7)),
+    '◊': _closed((0.3, 0.0), (0.6, 0.45), (0.3, 0.9), (0.0, 0.45)),
+    '⟨': _angle(),
+    '⟩': _mirror_x(_angle(), 0.3),
+    '⟪': _angle() + _shift(_angle(), 0.18),
+    '⟫': _mirror_x(_angle() + _shift(_angle(), 0.18), 0.48),
+    '⌈': _ceiling(),
+    '⌉': _mirror_x(_ceiling(), 0.3),
+    '⌊': _mirror_y(_ceiling(), 1.2),
+    '⌋': _mirror_x(_mirror_y(_ceiling(), 1.2), 0.3),
+    '⟦': _bracket(),
+    '⟧': _mirror_x(_bracket(), 0.35),
+    '⟮': _flat_paren(),
+    '⟯': _mirror_x(_flat_paren(), 0.3),
+    '‖': _line((0.0, 0.0), (0.0, 1.2)) + _line((0.2, 0.0), (0.2, 1.2)),
+    'π': _line((0.0, 0.1), (0.1, 0.0), (0.75, 0.0)) + _line((0.24, 0.0), (0.18, 0.65)) +
+         _line((0.55, 0.0), (0.55, 0.55), (0.65, 0.65)),
+    '∝': _arc(0.25, 0.25, 0.25, 0.2, 40, 320) + _line((0.44, 0.12), (0.8, 0.45)) + _line((0.44, 0.38), (0.8, 0.05)),
+    '°': _arc(0.17, 0.17, 0.17, 0.17),
+    '′': _line((0.12, 0.0), (0.0, 0.35)),
+    '″': _line((0.12, 0.0), (0.0, 0.35)) + _line((0.3, 0.0), (0.18, 0.35)),
+}
+
+
+@dataclass
+class SymbolDetection:
+    """
+    :param symbols: Symbols recognized, each once
+    :param ambiguous: Boxes of glyphs to OCR, padded, with glyph_height set
+    :param candidates: Number of glyph candidates classified
+    :param glyph_height: Median text glyph height (H) in pixels
+    """
+    symbols: List[str] = field(default_factory=list)
+    ambiguous: List[TextRegion] = field(default_factory=list)
+    candidates: int = 0
+    glyph_height: float = 0.0
+
+
+def glyph_features(mask, relative_height):
+    """
+    Feature vector of one glyph.
+
+    :param mask: Glyph pixels (nonzero), cropped to its bounding box
+    :param relative_height: Glyph height / text glyph height
+    """
+    height, width = mask.shape
+    inner = SYMBOL_FEATURE_SIZE - 2
+    scale = inner / float(max(height, width))
+    out_w, out_h = max(1, int(round(width * scale))), max(1, int(round(height * scale)))
+    resized = cv2.resize((mask > 0).astype(np.float32), (out_w, out_h), interpolation=cv2.INTER_AREA)
+    bitmap = np.zeros((SYMBOL_FEATURE_SIZE, SYMBOL_FEATURE_SIZE), np.float32)
+    top, left = (SYMBOL_FEATURE_SIZE - out_h) // 2, (SYMBOL_FEATURE_SIZE - out_w) // 2
+    bitmap[top:top + out_h, left:left + out_w] = resized
+    bitmap = cv2.GaussianBlur(bitmap, (3, 3), SYMBOL_FEATURE_BLUR).ravel()
+    bitmap /= max(1e-6, float(np.linalg.norm(bitmap)))
+    aspect = np.clip(np.log(width / float(height)), -2.5, 2.5)
+    size = np.clip(np.log(max(relative_height, 1e-3)), -3.0, 1.5)
+    return np.concatenate([bitmap, [SYMBOL_ASPECT_WEIGHT * aspect, SYMBOL_SIZE_WEIGHT * size]]).astype(np.float32)
+
+
+def _draw_shape(shape, thickness, slant):
+    """Mask of a stroke description, cropped to its ink"""
+    scale = _TEMPLATE_SCALE
+    width = max(1, int(round(thickness * scale)))
+    canvas = np.zeros((4 * scale, 4 * scale), np.uint8)
+
+    def point(x, y):
+        # Slant around the baseline (y = 1)
+        return ((x + slant * (1.0 - y) + 1.0) * scale, (y + 1.0) * scale)
+
+    for kind, data in shape:
+        if kind == 'line':
+            points = np.array([point(x, y) for x, y in data]) * 16
+            cv2.polylines(canvas, [points.astype(np.int32)], False, 255, width, cv2.LINE_AA, shift=4)
+        elif kind == 'dot':
+            x, y, r = data
+            center = np.array(point(x, y)) * 16
+            cv2.circle(canvas, tuple(int(v) for v in center), int(max(r, thickness * 0.7) * scale * 16), 255, -1,
+                       cv2.LINE_AA, shift=4)
+        else:
+            text, x, y, height = data
+            font_scale = height * scale / 22.0
+            cv2.putText(canvas, text, tuple(int(v) for v in point(x, y + height)), cv2.FONT_HERSHEY_SIMPLEX,
+                        font_scale, 255, max(1, width // 2), cv2.LINE_AA)
+    return _crop_ink(canvas)
+
+
+def _crop_ink(mask):
+    ys, xs = np.nonzero(mask > 127)
+    return mask[ys.min():ys.max() + 1, xs.min():xs.max() + 1]
+
+
+def _hershey_masks(font, thickness):
+    """(char, mask, relative height) for the Hershey-rendered classes of one font"""
+    # Text height for this font: median over letters and digits, as in images
+    heights = []
+    rendered = []
+    font_scale = _TEMPLATE_SCALE / 22.0
+    for char in _HERSHEY_SYMBOLS + _HERSHEY_OTHER:
+        canvas = np.zeros((3 * _TEMPLATE_SCALE, 3 * _TEMPLATE_SCALE), np.uint8)
+        cv2.putText(canvas, char, (_TEMPLATE_SCALE // 2, 2 * _TEMPLATE_SCALE), font, font_scale, 255,
+                    max(1, int(round(thickness * _TEMPLATE_SCALE))), cv2.LINE_AA)
+        if not (canvas > 127).any():
+            continue
+        mask = _crop_ink(canvas)
+        rendered.append((char, mask))
+        if char.isalnum():
+            heights.append(mask.shape[0])
+    text_height = float(np.median(heights))
+    return [(char, mask, mask.shape[0] / text_height) for char, mask in rendered]
+
+
+_templates = None
+
+
+def _template_set():
+    """
+    (features, class index per template, class labels, is-symbol per class),
+    built on first use; templates are sorted by class.
+    """
+    global _templates
+    if _templates is not None:
+        return _templates
+    samples = []
+    for char, shape in SYMBOL_SHAPES.items():
+        for thickness in _TEMPLATE_STROKES:
+            for slant in _TEMPLATE_SLANTS:
+                mask = _draw_shape(shape, thickness, slant)
+                samples.append((char, glyph_features(mask > 127, mask.shape[0] / float(_TEMPLATE_SCALE))))
+    for font in _HERSHEY_FONTS:
+        for thickness in (0.05, 0.1):
+            for char, mask, relative_height in _hershey_masks(font, thickness):
+                samples.append((char, glyph_features(mask > 127, relative_height)))
+
+    labels = sorted({char for char, _ in samples})
+    index = {char: i for i, char in enumerate(labels)}
+    samples.sort(key=lambda sample: index[sample[0]])
+    features = np.stack([feature for _, feature in samples])
+    classes = np.array([index[char] for char, _ in samples])
+    is_symbol = np.array([char in SYMBOL_SHAPES for char in labels])
+    _templates = (features, classes, labels, is_symbol)
+    logger.debug(f"Built {len(samples)} symbol templates for {len(labels)} classes")
+    return _templates
+
+
+def _group_components(stats, candidates, glyph_height):
+    """
+    Group candidate components stacked in one column into glyphs.
+
+    :return: List of arrays of component labels, one per glyph
+    """
+    x, y = stats[candidates, cv2.CC_STAT_LEFT], stats[candidates, cv2.CC_STAT_TOP]
+    w, h = stats[candidates, cv2.CC_STAT_WIDTH], stats[candidates, cv2.CC_STAT_HEIGHT]
+    right, bottom = x + w, y + h
+    parent = list(range(len(candidates)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    # Pairwise tests in row blocks, so memory stays bounded on busy pages
+    block = 1024
+    for start in range(0, len(candidates), block):
+        rows = slice(start, start + block)
+        overlap_x = np.minimum(right[rows, None], right[None, :]) - np.maximum(x[rows, None], x[None, :])
+        gap_y = np.maximum(y[rows, None], y[None, :]) - np.minimum(bottom[rows, None], bottom[None, :])
+        merged_h = np.maximum(bottom[rows, None], bottom[None, :]) - np.minimum(y[rows, None], y[None, :])
+        pairs = (
+            (overlap_x >= 0.5 * np.minimum(w[rows, None], w[None, :])) &
+            (gap_y <= SYMBOL_GROUP_GAP * glyph_height) &
+            (merged_h <= SYMBOL_GROUP_MAX_HEIGHT * glyph_height)
+        )
+        for i, j in zip(*np.nonzero(pairs)):
+            i += start
+            if i < j:
+                root_i, root_j = find(i), find(j)
+                if root_i != root_j:
+                    parent[root_j] = root_i
+
+    groups = {}
+    for i in range(len(candidates)):
+        groups.setdefault(find(i), []).append(candidates[i])
+    return [np.array(members) for members in groups.values()]
+
+
+def detect_symbols(gray, foreground=None):
+    """
+    Math symbols in an image, see the module docstring.
+
+    :param gray: Single-channel image
+    :param foreground: Optional shared foreground mask (PackedMask or array)
+    :return: SymbolDetection, or None if the image has no text or too many
+             candidates to classify (leave it to OCR)
+    """
+    labels, stats, keep = _glyph_components(_ink(gray, foreground))
+    if not keep.any():
+        return None
+    glyph_height = float(np.median(stats[keep, cv2.CC_STAT_HEIGHT]))
+
+    sizes = stats[:, [cv2.CC_STAT_WIDTH, cv2.CC_STAT_HEIGHT]]
+    candidates = np.nonzero(
+        (sizes.max(axis=1) <= SYMBOL_MAX_SIZE * glyph_height) & (stats[:, cv2.CC_STAT_AREA] >= 2)
+    )[0]
+    candidates = candidates[candidates != 0]
+    if len(candidates) > SYMBOL_MAX_CANDIDATES:
+        logger.info(f"{len(candidates)} glyph candidates, leaving symbols to OCR")
+        return None
+
+    boxes, features = [], []
+    for members in _group_components(stats, candidates, glyph_height):
+        x0 = stats[members, cv2.CC_STAT_LEFT].min()
+        y0 = stats[members, cv2.CC_STAT_TOP].min()
+        x1 = (stats[members, cv2.CC_STAT_LEFT] + stats[members, cv2.CC_STAT_WIDTH]).max()
+        y1 = (stats[members, cv2.CC_STAT_TOP] + stats[members, cv2.CC_STAT_HEIGHT]).max()
+        if max(x1 - x0, y1 - y0) < SYMBOL_MIN_SIZE * glyph_height:
+            continue
+        crop = labels[y0:y1, x0:x1]
+        mask = crop == members[0] if len(members) == 1 else np.isin(crop, members)
+        boxes.append((x0, y0, x1, y1))
+        features.append(glyph_features(mask, (y1 - y0) / glyph_height))
+    result = SymbolDetection(candidates=len(boxes), glyph_height=glyph_height)
+    if not boxes:
+        return result
+
+    # Nearest template of every glyph at once, then nearest per class
+    templates, classes, class_labels, is_symbol = _template_set()
+    features = np.stack(features)
+    distances = (
+        (features ** 2).sum(axis=1)[:, None] + (templates ** 2).sum(axis=1)[None, :] -
+        2.0 * features @ templates.T
+    )
+    starts = np.flatnonzero(np.r_[True, classes[1:] != classes[:-1]])
+    per_class = np.minimum.reduceat(distances, starts, axis=1)
+    order = np.argsort(per_class, axis=1)[:, :2]
+    best, second = order[:, 0], order[:, 1]
+    rows = np.arange(len(boxes))
+    best_distance, second_distance = per_class[rows, best], per_class[rows, second]
+
+    accepted = is_symbol[best] & (best_distance <= SYMBOL_MAX_DISTANCE) & \
+        (second_distance - best_distance >= SYMBOL_MIN_MARGIN)
+    ambiguous = ~accepted & (is_symbol[best] | is_symbol[second]) & (best_distance <= SYMBOL_AMBIGUOUS_DISTANCE)
+
+    found = {class_labels[c] for c in best[accepted]}
+    result.symbols = sorted(SYMBOL_ALIASES.get(symbol, symbol) for symbol in found)
+    height, width = gray.shape[:2]
+    pad = int(round(SYMBOL_OCR_PADDING * glyph_height))
+    for i in np.flatnonzero(ambiguous):
+        x0, y0, x1, y1 = boxes[i]
+        x0, y0 = max(0, x0 - pad), max(0, y0 - pad)
+        x1, y1 = min(width, x1 + pad), min(height, y1 + pad)
+        result.ambiguous.append(TextRegion(int(x0), int(y0), int(x1 - x0), int(y1 - y0), glyph_height))
+    logger.debug(f"Symbol detection: {len(boxes)} glyphs, {int(accepted.sum())} symbols, "
+                 f"{int(ambiguous.sum())} ambiguous")
+    return result
+
+
+def detect_math_symbols(gray, pattern, engine=None, deadline=None, foreground=None):
+    """
+    detect_symbols(), with its ambiguous glyphs read by one batched OCR call.
+
+    :param gray: Single-channel image
+    :param pattern: Regex of the symbols to take from the OCR text
+    :param engine: OCR engine name (see utils.ocr_engines), None for Tesseract
+    :param deadline: Optional Deadline; ambiguous glyphs are dropped once it expires
+    :param foreground: Optional shared foreground mask, see detect_symbols()
+    :return: Set of symbols, or None if the detector cannot handle the image
+    """
+    detection = detect_symbols(gray, foreground)
+    if detection is None:
+        return None
+    symbols = set(detection.symbols)
+    if not detection.ambiguous:
+        return symbols
+    if deadline is not None and deadline.expired():
+        logger.warning(f"Deadline reached, skipping OCR of {len(detection.ambiguous)} ambiguous glyphs")
+        return symbols
+    try:
+        for text in ocr_regions(gray, detection.ambiguous, '', engine).texts:
+            symbols.update(re.findall(pattern, text))
+    except Exception as e:
+        logger.warning(f"OCR of ambiguous glyphs failed: {str(e)}")
+    return symbols
@@ -0,0 +1,903 @@
+# image-analysis-service/src/utils/term_index.py
+"""
+Autocomplete over the text of stored diagrams: a front-coded, sorted term
+dictionary with suggestions ranked by how many diagrams contain each term,
+and a trigram index for prefixes with a typo in them.
+
+Terms come from each result's text (`text_result`, or `text` sent with it,
+such as OCR output) and `symbols_result`, NFKC-normalized and lowercased:
+
+- words: runs of letters and digits (with inner ' or -), TERM_MIN_CHARS to
+  TERM_MAX_CHARS long and not all digits
+- labels: whole lines of two to LABEL_MAX_WORDS words, so "cell m"
+  completes to "cell membrane"
+- symbols, as detected
+
+A term's count is the number of stored diagrams containing it.
+
+A snapshot holds every term in sorted (UTF-8 byte) order, in files that are
+memory-mapped rather than read:
+
+- terms-<n>.bin: blocks of TERM_BLOCK terms, front-coded: each term is the
+  length of the prefix it shares with the term before it, the length of the
+  rest, and the rest. The first term of a block shares nothing, so block
+  heads are read directly
+- blocks-<n>.npy: where each block starts
+- counts-<n>.npy, kinds-<n>.npy: each term's count and kinds (word, label
+  and symbol bits)
+- top-<n>.npy, top-prefixes-<n>.json: the TOP_CACHE highest-counted terms
+  of every prefix that starts more than TOP_CACHE_MIN_TERMS terms
+- trigram-keys-<n>.npy, trigram-offsets-<n>.npy, trigram-terms-<n>.npy:
+  per trigram (CRC-32 of three characters, with a start marker before each
+  term), the ids of the one-word terms containing it
+
+A prefix lookup binary-searches the block heads for the first term at or
+after the prefix and for the first after every term starting with it. The
+best of that range come from the top-prefix cache for short prefixes,
+whose range is wide, and from a partition of its counts otherwise. When
+fewer terms than asked complete a one-word prefix, words starting with
+it spelt with one edit (a letter wrong, missing or extra, or two letters
+swapped) are added. An edit changes at most FUZZY_EDIT_TRIGRAMS of the
+prefix's trigrams, so such a word shares the rest: it contains one of the
+rarest FUZZY_EDIT_TRIGRAMS + 1, and only those postings are read. The
+FUZZY_CANDIDATES sharing most (then most counted) are checked letter by
+letter.
+
+Updates leave the snapshot alone. documents-<n>.jsonl gets one line per
+upsert (id and terms) or delete, and count changes since the snapshot are
+kept in memory. Changed terms are searched alongside the snapshot from
+sorted lists, one per power of two of their counts, so a short prefix
+reads its most-counted changes first rather than all of them. After
+INDEX_MERGE_EVERY document changes a new generation is written: snapshot
+plus changes, and the document log compacted to one line per document
+(located by document-ids-<n>.json and document-offsets-<n>.npy).
+index.json names the generation in use and where its compacted log ends;
+later lines are replayed as changes on load. rebuild() writes a
+generation from stored results, extracting terms and encoding the
+snapshot in a process pool.
+"""
+import bisect
+import io
+import json
+import logging
+import mmap
+import multiprocessing
+import os
+import re
+import threading
+import unicodedata
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+
+import numpy as np
+
+import config
+from utils.text_similarity import document_text
+
+logger = logging.getLogger(__name__)
+
+TERM_MIN_CHARS = 2
+TERM_MAX_CHARS = 40
+LABEL_MAX_WORDS = 4
+# Term lengths are stored in one byte
+TERM_MAX_BYTES = 255
+TERM_BLOCK = 16
+# Suggestions per query: most allowed, and cached per wide prefix
+SUGGEST_MAX = 20
+TOP_CACHE = SUGGEST_MAX
+TOP_CACHE_MIN_TERMS = 512
+# Typo-tolerant matches: prefixes this long, at most one edit. An edit
+# changes up to three of a prefix's trigrams (two swapped letters up to
+# four, so those inside a short prefix can be missed)
+FUZZY_MIN_CHARS = 4
+FUZZY_EDIT_TRIGRAMS = 4
+# Candidates, by trigrams shared and count, checked by edit distance
+FUZZY_CANDIDATES = 128
+INDEX_MERGE_EVERY = 16384
+REBUILD_CHUNK = 4096
+
+KIND_WORD = 1
+KIND_LABEL = 2
+KIND_SYMBOL = 4
+_KIND_NAMES = ((KIND_WORD, 'word'), (KIND_LABEL, 'label'), (KIND_SYMBOL, 'symbol'))
+
+_WORD = re.compile(r"[^\W_]+(?:['\-][^\W_]+)*")
+# Before a term's first character, so a trigram can tell a term's start
+_START = '\x02'
+# Sorts after every byte of UTF-8 text: the end of a prefix's range
+_AFTER_PREFIX = b'\xff'
+
+
+@dataclass
+class Suggestion:
+    """A stored term completing (or nearly completing) a prefix"""
+    term: str
+    count: int
+    kinds: int
+    fuzzy: bool = False
+
+    def to_dict(self):
+        return {
+            'term': self.term,
+            'count': self.count,
+            'kinds': [name for bit, name in _KIND_NAMES if self.kinds & bit],
+            'fuzzy': self.fuzzy,
+        }
+
+
+def normalize_prefix(prefix):
+    """A query prefix as terms are stored: NFKC, lowercase, single spaces (a trailing one kept)"""
+    text = unicodedata.normalize('NFKC', prefix).lower()
+    normalized = ' '.join(text.split())
+    if normalized and text[-1:].isspace():
+        normalized += ' '
+    return normalized
+
+
+def document_terms(document):
+    """
+    {term: kind bits} of an analysis result, or of a dict with `text` and
+    `symbols` (see text_similarity.document_text()).
+
+    :raises ValueError: on malformed text or symbols
+    """
+    text, symbols = document_text(document)
+    terms = {}
+    for line in text.splitlines():
+        words = _WORD.findall(unicodedata.normalize('NFKC', line).lower())
+        for word in words:
+            if TERM_MIN_CHARS <= len(word) <= TERM_MAX_CHARS and not word.isdigit():
+                terms[word] = terms.get(word, 0) | KIND_WORD
+        if 2 <= len(words) <= LABEL_MAX_WORDS:
+            label = ' '.join(words)
+            terms[label] = terms.get(label, 0) | KIND_LABEL
+    for symbol in symbols:
+        symbol = ' '.join(unicodedata.normalize('NFKC', str(symbol)).lower().split())
+        if symbol:
+            terms[symbol] = terms.get(symbol, 0) | KIND_SYMBOL
+    return {term: kinds for term, kinds in terms.items() if len(term.encode()) <= TERM_MAX_BYTES}
+
+
+def trigram_keys(term):
+    """CRC-32 of each distinct trigram of a term, with the start marker before it"""
+    padded = _START + term
+    return {zlib.crc32(padded[i:i + 3].encode()) for i in range(len(padded) - 2)}
+
+
+def _one_edit_prefix(prefix, term):
+    """
+    Whether a term starts with the prefix spelt with at most one edit: a
+    letter changed, added or removed, or two letters swapped. A single edit
+    can always be taken at the first letter that differs.
+    """
+    if term.startswith(prefix):
+        return True
+    at = len(os.path.commonprefix([prefix, term]))
+    rest = term[at:]
+    return (rest[1:].startswith(prefix[at + 1:])
+            or rest.startswith(prefix[at + 1:])
+            or rest[1:].startswith(prefix[at:])
+            or (len(prefix) > at + 1 and rest[:2] == prefix[at + 1] + prefix[at]
+                and rest[2:].startswith(prefix[at + 2:])))
+
+
+def _document_chunk(items):
+    """Process-pool task: ({term: documents}, {term: kind bits}, ids and log lines of documents with terms)"""
+    counts, kinds, ids, lines = {}, {}, [], []
+    for item_id, document in items:
+        terms = document_terms(document)
+        if not terms:
+            continue
+        for term, bits in terms.items():
+            counts[term] = counts.get(term, 0) + 1
+            kinds[term] = kinds.get(term, 0) | bits
+        ids.append(item_id)
+        lines.append(json.dumps({'id': item_id, 'terms': terms}).encode() + b"\n")
+    return counts, kinds, ids, lines
+
+
+def _encode_chunk(terms):
+    """
+    Process-pool task: front-coded blocks of sorted terms (a whole number of
+    blocks, except at the end), block starts within them, and the
+    (trigram key, term number) pairs of the chunk.
+    """
+    blob = bytearray()
+    starts = []
+    keys, numbers = [], []
+    previous = b""
+    for number, term in enumerate(terms):
+        encoded = term.encode()
+        if number % TERM_BLOCK == 0:
+            starts.append(len(blob))
+            shared = 0
+        else:
+            shared = len(os.path.commonprefix([previous, encoded]))
+        blob += bytes((shared, len(encoded) - shared)) + encoded[shared:]
+        previous = encoded
+        if ' ' not in term:
+            term_keys = trigram_keys(term)
+            keys.extend(term_keys)
+            numbers.extend([number] * len(term_keys))
+    return bytes(blob), starts, np.array(keys, np.uint32), np.array(numbers, np.uint32)
+
+
+def _pool_map(function, chunks, workers):
+    if workers <= 1 or len(chunks) <= 1:
+        return [function(chunk) for chunk in chunks]
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+        return list(executor.map(function, chunks))
+
+
+def build_snapshot(terms, counts, kinds, workers=1):
+    """
+    Snapshot parts of sorted terms: the front-coded blob and its arrays.
+
+    :param terms: Sorted list of terms
+    :param counts: Documents containing each term
+    :param kinds: Kind bits of each term
+    :param workers: Processes encoding blocks and trigrams
+    :return: (blob bytes, {name: array}, {prefix: row of the top array})
+    """
+    counts = np.asarray(counts, np.uint32)
+    chunk = REBUILD_CHUNK * TERM_BLOCK
+    parts = _pool_map(_encode_chunk, [terms[start:start + chunk] for start in range(0, len(terms), chunk)],
+                      workers)
+    blobs, blocks, keys, term_ids = [], [], [], []
+    offset = 0
+    for number, (blob, starts, chunk_keys, numbers) in enumerate(parts):
+        blobs.append(blob)
+        blocks.append(np.asarray(starts, np.int64) + offset)
+        keys.append(chunk_keys)
+        term_ids.append(numbers + np.uint32(number * chunk))
+        offset += len(blob)
+
+    keys = np.concatenate(keys) if keys else np.zeros(0, np.uint32)
+    term_ids = np.concatenate(term_ids) if term_ids else np.zeros(0, np.uint32)
+    # Stable: each key's term ids stay ascending
+    order = np.argsort(keys, kind='stable')
+    keys, term_ids = keys[order], term_ids[order]
+    unique_keys, firsts = np.unique(keys, return_index=True)
+
+    top_prefixes, top = _top_prefixes(terms, counts)
+    arrays = {
+        'blocks': np.concatenate(blocks) if blocks else np.zeros(0, np.int64),
+        'counts': counts,
+        'kinds': np.asarray(kinds, np.uint8),
+        'top': top,
+        'trigram-keys': unique_keys.astype(np.uint32),
+        'trigram-offsets': np.append(firsts, len(keys)).astype(np.int64),
+        'trigram-terms': term_ids,
+    }
+    return b"".join(blobs), arrays, top_prefixes
+
+
+def _best_ids(counts, first, end, limit):
+    """Ids of the `limit` highest counts in [first, end), best first; equal counts in id (term) order"""
+    counts = np.asarray(counts[first:end], np.int64)
+    if len(counts) > limit:
+        # Every id tied with the cut competes, so that ties go to the first terms
+        cut = -np.partition(-counts, limit - 1)[limit - 1]
+        ids = np.flatnonzero(counts >= cut)
+    else:
+        ids = np.arange(len(counts))
+    ids = ids[np.lexsort((ids, -counts[ids]))][:limit]
+    return first + ids
+
+
+def _top_prefixes(terms, counts):
+    """{prefix: row} and the best TOP_CACHE term ids (-1 padded) of each prefix starting over TOP_CACHE_MIN_TERMS"""
+    prefixes, rows = {}, []
+    length = 1
+    while True:
+        heads = np.array([term[:length] for term in terms]) if terms else np.zeros(0, str)
+        if not len(heads):
+            break
+        starts = np.flatnonzero(np.append(True, heads[1:] != heads[:-1]))
+        ends = np.append(starts[1:], len(heads))
+        wide = np.flatnonzero(ends - starts > TOP_CACHE_MIN_TERMS)
+        if not len(wide):
+            break
+        for i in wide:
+            start, end = int(starts[i]), int(ends[i])
+            prefixes[str(heads[start])] = len(rows)
+            rows.append(_best_ids(counts, start, end, TOP_CACHE))
+        length += 1
+    top = np.full((len(rows), TOP_CACHE), -1, np.int32)
+    for row, best in enumerate(rows):
+        top[row] = best
+    return prefixes, top
+
+
+class _Snapshot:
+    """Read side of one snapshot: sorted terms, counts, kinds, top-prefix cache and trigram postings"""
+
+    def __init__(self, blob=b"", arrays=None, top_prefixes=None):
+        self._blob = blob
+        arrays = arrays or {}
+        self.blocks = arrays.get('blocks', np.zeros(0, np.int64))
+        self.counts = arrays.get('counts', np.zeros(0, np.uint32))
+        self.kinds = arrays.get('kinds', np.zeros(0, np.uint8))
+        self.top = arrays.get('top', np.zeros((0, TOP_CACHE), np.int32))
+        self.trigram_keys = arrays.get('trigram-keys', np.zeros(0, np.uint32))
+        self.trigram_offsets = arrays.get('trigram-offsets', np.zeros(1, np.int64))
+        self.trigram_terms = arrays.get('trigram-terms', np.zeros(0, np.uint32))
+        self.top_prefixes = top_prefixes or {}
+        self.size = len(self.counts)
+
+    @classmethod
+    def load(cls, path):
+        """Memory-map the snapshot files; `path(name, extension)` names them"""
+        arrays = {}
+        for name in ('blocks', 'counts', 'kinds', 'top', 'trigram-keys', 'trigram-offsets', 'trigram-terms'):
+            try:
+                arrays[name] = np.load(path(name, 'npy'), mmap_mode='r')
+            except ValueError:
+                # Some numpy versions cannot map an empty array
+                arrays[name] = np.load(path(name, 'npy'))
+        with open(path('top-prefixes', 'json')) as f:
+            top_prefixes = json.load(f)
+        blob = b""
+        if os.path.getsize(path('terms', 'bin')):
+            with open(path('terms', 'bin'), 'rb') as f:
+                blob = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return cls(blob, arrays, top_prefixes)
+
+    @staticmethod
+    def save(path, blob, arrays, top_prefixes):
+        with open(path('terms', 'bin'), 'wb') as f:
+            f.write(blob)
+        for name, array in arrays.items():
+            np.save(path(name, 'npy'), array)
+        with open(path('top-prefixes', 'json'), 'w') as f:
+            json.dump(top_prefixes, f)
+
+    def close(self):
+        if isinstance(self._blob, mmap.mmap):
+            self._blob.close()
+
+    def _head(self, block):
+        start = int(self.blocks[block])
+        return self._blob[start + 2:start + 2 + self._blob[start + 1]]
+
+    def _block_terms(self, block, count=TERM_BLOCK):
+        """The first `count` encoded terms of a block"""
+        blob = self._blob
+        position = int(self.blocks[block])
+        end = int(self.blocks[block + 1]) if block + 1 < len(self.blocks) else len(blob)
+        terms = []
+        term = b""
+        while position < end and len(terms) < count:
+            shared, length = blob[position], blob[position + 1]
+            term = term[:shared] + blob[position + 2:position + 2 + length]
+            terms.append(term)
+            position += 2 + length
+        return terms
+
+    def term(self, term_id):
+        return self._block_terms(term_id // TERM_BLOCK, term_id % TERM_BLOCK + 1)[-1].decode()
+
+    def terms(self, term_ids):
+        """Terms of several ids, decoding each block once"""
+        needed = {}
+        for term_id in term_ids:
+            block, offset = divmod(term_id, TERM_BLOCK)
+            needed[block] = max(needed.get(block, 0), offset + 1)
+        blocks = {block: self._block_terms(block, count) for block, count in needed.items()}
+        return [blocks[term_id // TERM_BLOCK][term_id % TERM_BLOCK].decode() for term_id in term_ids]
+
+    def iter_terms(self):
+        for block in range(len(self.blocks)):
+            for term in self._block_terms(block):
+                yield term.decode()
+
+    def lower_bound(self, key):
+        """Id of the first term at or after `key` (UTF-8 bytes)"""
+        low, high = 0, len(self.blocks)
+        # Last block whose head is at or before the key
+        while low < high:
+            middle = (low + high) // 2
+            if self._head(middle) <= key:
+                low = middle + 1
+            else:
+                high = middle
+        if low == 0:
+            return 0
+        block = low - 1
+        for offset, term in enumerate(self._block_terms(block)):
+            if term >= key:
+                return block * TERM_BLOCK + offset
+        return min((block + 1) * TERM_BLOCK, self.size)
+
+    def prefix_range(self, prefix):
+        """[first, end) ids of the terms starting with a prefix"""
+        key = prefix.encode()
+        return self.lower_bound(key), self.lower_bound(key + _AFTER_PREFIX)
+
+    def find(self, term):
+        """Id of a term, or None"""
+        term_id = self.lower_bound(term.encode())
+        return term_id if term_id < self.size and self.term(term_id) == term else None
+
+    def best(self, prefix, first, end, limit):
+        """Ids of the `limit` highest-counted terms in [first, end), best first"""
+        if prefix in self.top_prefixes and limit <= TOP_CACHE:
+            ids = np.asarray(self.top[self.top_prefixes[prefix]])
+            return ids[ids >= 0][:limit].tolist()
+        return _best_ids(self.counts, first, end, limit).tolist()
+
+    def postings(self, key):
+        """Sorted ids of the terms containing a trigram key"""
+        position = int(np.searchsorted(self.trigram_keys, key))
+        if position == len(self.trigram_keys) or self.trigram_keys[position] != key:
+            return np.zeros(0, np.uint32)
+        return self.trigram_terms[self.trigram_offsets[position]:self.trigram_offsets[position + 1]]
+
+
+class TermIndex:
+    """
+    Term dictionary and autocomplete over stored diagrams; see the module
+    docstring. Thread-safe.
+
+    :param directory: Where the snapshot and document log are stored, None for memory only
+    :param merge_every: Document changes that trigger a new snapshot
+    :param workers: Processes used to write a snapshot
+    """
+
+    def __init__(self, directory=None, merge_every=INDEX_MERGE_EVERY, workers=1):
+        self.directory = directory
+        self.merge_every = merge_every
+        self.workers = workers
+        self._lock = threading.RLock()
+        self._generation = 0
+        self._stats = {'suggestions': 0, 'fuzzy': 0, 'upserted': 0, 'deleted': 0, 'rebuilds': 0, 'merges': 0}
+        self._snapshot = _Snapshot()
+        self._reset_changes()
+        # Id -> offset of the document's line in the log
+        self._documents = {}
+
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            state = self._read_state()
+            self._generation = state.get('generation', 0)
+            snapshot_bytes = 0
+            if os.path.exists(self._path('terms', 'bin')):
+                self._snapshot = _Snapshot.load(self._path)
+                with open(self._path('document-ids', 'json')) as f:
+                    ids = json.load(f)
+                offsets = np.load(self._path('document-offsets', 'npy')).tolist()
+                self._documents = dict(zip(ids, offsets))
+                snapshot_bytes = state.get('snapshot_bytes', 0)
+            self._open_log()
+            self._replay_log(snapshot_bytes)
+            logger.info(f"Loaded {len(self._documents)} documents and {self._snapshot.size} terms from {directory}"
+                        f" ({len(self._changes)} changed since the snapshot)")
+        else:
+            self._log = self._reader = io.BytesIO()
+
+    def _reset_changes(self):
+        # Count changes since the snapshot, by term, with each changed term's
+        # snapshot count and kinds in _base. _levels[n] holds (sorted) the
+        # changed terms now counted 2**n to 2**(n + 1) - 1
+        self._changes = {}
+        self._levels = []
+        self._base = {}
+        # Snapshot ids of the changed terms it holds
+        self._changed_ids = set()
+        self._changed_kinds = {}
+        # Trigram key -> changed one-word terms missing from the snapshot
+        self._new_trigrams = {}
+        self._pending = 0
+
+    def __len__(self):
+        return len(self._documents)
+
+    # Storage
+
+    def _state_path(self):
+        return os.path.join(self.directory, 'index.json')
+
+    def _path(self, name, extension, generation=None):
+        generation = self._generation if generation is None else generation
+        return os.path.join(self.directory, f"{name}-{generation}.{extension}")
+
+    def _read_state(self):
+        try:
+            with open(self._state_path()) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except ValueError as e:
+            logger.error(f"Unreadable {self._state_path()}, starting from generation 0: {str(e)}")
+            return {}
+
+    def _open_log(self):
+        self._log = open(self._path('documents', 'jsonl'), 'a+b')
+        # Lines are read back through their own handle: the log is append-only,
+        # so whatever it has buffered stays valid
+        self._reader = open(self._path('documents', 'jsonl'), 'rb')
+
+    def _replay_log(self, offset):
+        """Apply the log's lines from an offset (after the snapshot's) as changes"""
+        self._log.seek(offset)
+        for number, line in enumerate(self._log):
+            try:
+                record = json.loads(line)
+                item_id = record['id']
+                terms = None if record.get('deleted') else dict(record['terms'])
+            except (ValueError, KeyError, TypeError):
+                # A torn last line from a crash: that upsert or delete never completed
+                logger.warning(f"Ignoring unreadable line {number + 1} after the term index snapshot")
+                self._log.truncate(offset)
+                break
+            self._apply(self._stored_terms(item_id), terms)
+            if terms is None:
+                self._documents.pop(item_id, None)
+            else:
+                self._documents[item_id] = offset
+            offset += len(line)
+        self._log.seek(0, os.SEEK_END)
+
+    def _stored_terms(self, item_id):
+        """{term: kind bits} of a stored document, read back from the log"""
+        offset = self._documents.get(item_id)
+        if offset is None:
+            return None
+        self._reader.seek(offset)
+        return json.loads(self._reader.readline())['terms']
+
+    def _append_log(self, records):
+        """Write log lines; returns the offset of each"""
+        self._log.seek(0, os.SEEK_END)
+        offsets = []
+        lines = []
+        position = self._log.tell()
+        for record in records:
+            line = json.dumps(record).encode() + b"\n"
+            offsets.append(position)
+            lines.append(line)
+            position += len(line)
+        self._log.write(b"".join(lines))
+        self._log.flush()
+        return offsets
+
+    # Changes since the snapshot
+
+    def _change(self, term, delta, kinds=0):
+        if term in self._changes:
+            before = self._base[term][0] + self._changes[term]
+        else:
+            term_id = self._snapshot.find(term)
+            if term_id is None:
+                self._base[term] = (0, 0)
+                if ' ' not in term:
+                    for key in trigram_keys(term):
+                        self._new_trigrams.setdefault(key, set()).add(term)
+            else:
+                self._base[term] = (int(self._snapshot.counts[term_id]), int(self._snapshot.kinds[term_id]))
+                self._changed_ids.add(term_id)
+            self._changes[term] = 0
+            # Not in a level yet
+            before = 0
+        self._changes[term] += delta
+        after = self._base[term][0] + self._changes[term]
+        if before.bit_length() != after.bit_length():
+            if before:
+                level = self._levels[before.bit_length() - 1]
+                del level[bisect.bisect_left(level, term)]
+            if after:
+                while len(self._levels) < after.bit_length():
+                    self._levels.append([])
+                bisect.insort(self._levels[after.bit_length() - 1], term)
+        if kinds:
+            self._changed_kinds[term] = self._changed_kinds.get(term, 0) | kinds
+
+    def _apply(self, old_terms, new_terms):
+        """Count changes for a document's terms going from old to new (None: absent)"""
+        old_terms, new_terms = old_terms or {}, new_terms or {}
+        for term in old_terms:
+            if term not in new_terms:
+                self._change(term, -1)
+        for term, kinds in new_terms.items():
+            self._change(term, 0 if term in old_terms else 1, kinds)
+        self._pending += 1
+
+    def _current(self, term):
+        """(count, kind bits) of a changed term"""
+        count, kinds = self._base[term]
+        return count + self._changes[term], kinds | self._changed_kinds.get(term, 0)
+
+    def _maintain(self):
+        if self._pending >= self.merge_every:
+            self._merge()
+
+    def _merge(self):
+        """Write a new generation: the snapshot with the changes folded in, and a compacted log"""
+        snapshot = self._snapshot
+        changed = {term: self._current(term) for term in self._changes}
+        terms, counts, kinds = [], [], []
+        merged = iter(sorted(changed))
+        pending = next(merged, None)
+
+        def take(term, count, bits):
+            if count > 0:
+                terms.append(term)
+                counts.append(count)
+                kinds.append(bits)
+
+        for term_id, term in enumerate(snapshot.iter_terms()):
+            while pending is not None and pending < term:
+                take(pending, *changed[pending])
+                pending = next(merged, None)
+            if pending == term:
+                take(term, *changed[term])
+                pending = next(merged, None)
+            else:
+                take(term, int(snapshot.counts[term_id]), int(snapshot.kinds[term_id]))
+        while pending is not None:
+            take(pending, *changed[pending])
+            pending = next(merged, None)
+
+        ids, lines = [], []
+        for item_id, offset in self._documents.items():
+            self._reader.seek(offset)
+            ids.append(item_id)
+            lines.append(self._reader.readline())
+        self._swap_generation(build_snapshot(terms, counts, kinds, self.workers), ids, lines)
+        self._stats['merges'] += 1
+
+    def _swap_generation(self, parts, ids, lines):
+        """Make a snapshot (build_snapshot() parts) and a document log (one line per document) current"""
+        blob, arrays, top_prefixes = parts
+        previous = self._generation
+        self._generation += 1
+        self._snapshot.close()
+        self._log.close()
+        self._reader.close()
+        offsets = np.cumsum([0] + [len(line) for line in lines])
+        if self.directory:
+            _Snapshot.save(self._path, blob, arrays, top_prefixes)
+            with open(self._path('documents', 'jsonl'), 'wb') as f:
+                f.write(b"".join(lines))
+            with open(self._path('document-ids', 'json'), 'w') as f:
+                json.dump(ids, f)
+            np.save(self._path('document-offsets', 'npy'), offsets[:-1])
+            temporary = self._state_path() + '.tmp'
+            with open(temporary, 'w') as f:
+                json.dump({'generation': self._generation, 'snapshot_bytes': int(offsets[-1])}, f)
+            os.replace(temporary, self._state_path())
+            self._remove_generation(previous)
+            self._snapshot = _Snapshot.load(self._path)
+            self._open_log()
+        else:
+            self._snapshot = _Snapshot(blob, arrays, top_prefixes)
+            self._log = self._reader = io.BytesIO(b"".join(lines))
+        self._documents = dict(zip(ids, offsets[:-1].tolist()))
+        self._reset_changes()
+        logger.info(f"Term index generation {self._generation}: {self._snapshot.size} terms, {len(lines)} documents")
+
+    def _remove_generation(self, generation):
+        for name, extension in (('terms', 'bin'), ('blocks', 'npy'), ('counts', 'npy'), ('kinds', 'npy'),
+                                ('top', 'npy'), ('top-prefixes', 'json'), ('trigram-keys', 'npy'),
+                                ('trigram-offsets', 'npy'), ('trigram-terms', 'npy'), ('documents', 'jsonl'),
+                                ('document-ids', 'json'), ('document-offsets', 'npy')):
+            path = self._path(name, extension, generation)
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logger.warning(f"Could not remove old term index file {path}: {str(e)}")
+
+    # Lookup
+
+    def _level_terms(self, number, prefix):
+        """Changed terms of a count level starting with a prefix"""
+        level = self._levels[number]
+        start = bisect.bisect_left(level, prefix)
+        return level[start:bisect.bisect_left(level, prefix + '\U0010ffff', start)]
+
+    def _changed_terms(self, prefix, least):
+        """(term, (count, kind bits)) of changed terms starting with a prefix, from levels counting `least` or more"""
+        for number in range(len(self._levels) - 1, least.bit_length() - 2, -1):
+            for term in self._level_terms(number, prefix):
+                yield term, self._current(term)
+
+    def _prefix_matches(self, prefix, limit):
+        """Suggestions completing a prefix, best first"""
+        snapshot = self._snapshot
+        first, end = snapshot.prefix_range(prefix)
+        read = limit
+        while True:
+            # The snapshot's best that have not changed since
+            ids = snapshot.best(prefix, first, end, read)
+            kept = [term_id for term_id in ids if term_id not in self._changed_ids]
+            if len(kept) >= limit or len(ids) < read:
+                break
+            # Terms not read rank after the last one read: enough if changed terms make up the rest
+            last = (-int(snapshot.counts[ids[-1]]), snapshot.term(ids[-1]))
+            ahead = sum((-count, term) < last for term, (count, _) in self._changed_terms(prefix, -last[0]))
+            if len(kept) + ahead >= limit:
+                break
+            read *= 2
+        kept = kept[:limit]
+        found = {
+            term: (int(snapshot.counts[term_id]), int(snapshot.kinds[term_id]))
+            for term_id, term in zip(kept, snapshot.terms(kept))
+        }
+        # Changed terms a count level at a time, highest first: once `limit`
+        # found terms are counted at least 2**n, lower levels cannot rank
+        kept_counts = sorted(count for count, _ in found.values())
+        changed = 0
+        for number in range(len(self._levels) - 1, -1, -1):
+            for term in self._level_terms(number, prefix):
+                found[term] = self._current(term)
+                changed += 1
+            if changed + len(kept_counts) - bisect.bisect_left(kept_counts, 1 << number) >= limit:
+                break
+        ranked = sorted(found.items(), key=lambda item: (-item[1][0], item[0]))
+        return [Suggestion(term, count, kinds) for term, (count, kinds) in ranked[:limit]]
+
+    def _fuzzy_matches(self, prefix, limit, exclude):
+        """Words starting with the prefix spelt with one edit, highest counted first"""
+        snapshot = self._snapshot
+        keys = sorted(trigram_keys(prefix))
+        needed = max(1, len(keys) - FUZZY_EDIT_TRIGRAMS)
+        postings = sorted((snapshot.postings(key) for key in keys), key=len)
+        rare = [np.asarray(posting) for posting in postings[:len(keys) - needed + 1]]
+        candidates = np.unique(np.concatenate(rare)) if rare else np.zeros(0, np.uint32)
+        shared = np.zeros(len(candidates), np.int64)
+        for posting in postings:
+            if len(posting):
+                positions = np.minimum(np.searchsorted(posting, candidates), len(posting) - 1)
+                shared += np.asarray(posting)[positions] == candidates
+        close = shared >= needed
+        candidates, shared = candidates[close], shared[close]
+        best = np.lexsort((-np.asarray(snapshot.counts[candidates], np.int64), -shared))[:FUZZY_CANDIDATES]
+        found = {}
+        keep = candidates[best].tolist()
+        for term_id, term in zip(keep, snapshot.terms(keep)):
+            if term in self._changes:
+                found[term] = self._current(term)
+            else:
+                found[term] = (int(snapshot.counts[term_id]), int(snapshot.kinds[term_id]))
+        # Words missing from the snapshot
+        new_shared = {}
+        for key in keys:
+            for term in self._new_trigrams.get(key, ()):
+                new_shared[term] = new_shared.get(term, 0) + 1
+        for term, common in new_shared.items():
+            if common >= needed:
+                found[term] = self._current(term)
+
+        ranked = sorted(
+            ((term, values) for term, values in found.items()
+             if values[0] > 0 and term not in exclude and _one_edit_prefix(prefix, term)),
+            key=lambda item: (-item[1][0], item[0])
+        )
+        return [Suggestion(term, count, kinds, fuzzy=True) for term, (count, kinds) in ranked[:limit]]
+
+    # Public API
+
+    def upsert_many(self, items):
+        """
+        Store documents' terms. An existing id is replaced; a document
+        without terms removes it.
+
+        :param items: Iterable of (id, document), where document is an
+                      analysis result or {text, symbols}
+        :return: (number stored, number without terms)
+        :raises ValueError: on a malformed document (nothing is stored)
+        """
+        documents = [(str(item_id), document_terms(document)) for item_id, document in items]
+        with self._lock:
+            records = [{'id': item_id, 'terms': terms} if terms else {'id': item_id, 'deleted': True}
+                       for item_id, terms in documents if terms or item_id in self._documents]
+            offsets = self._append_log(records)
+            for record, offset in zip(records, offsets):
+                item_id = record['id']
+                self._apply(self._stored_terms(item_id), record.get('terms'))
+                if record.get('deleted'):
+                    self._documents.pop(item_id, None)
+                else:
+                    self._documents[item_id] = offset
+            stored = sum(1 for _, terms in documents if terms)
+            self._stats['upserted'] += stored
+            self._maintain()
+            return stored, len(documents) - stored
+
+    def upsert(self, item_id, document):
+        """Store one document's terms; returns False if it has none"""
+        return self.upsert_many([(item_id, document)])[0] == 1
+
+    def delete(self, item_id):
+        """Remove a document's terms; returns False if the id is unknown"""
+        with self._lock:
+            item_id = str(item_id)
+            if item_id not in self._documents:
+                return False
+            self._append_log([{'id': item_id, 'deleted': True}])
+            self._apply(self._stored_terms(item_id), None)
+            del self._documents[item_id]
+            self._stats['deleted'] += 1
+            self._maintain()
+            return True
+
+    def suggest(self, prefix, limit=10, fuzzy=True):
+        """
+        Stored terms completing a prefix, highest counted first, then (if
+        fewer than `limit` and `fuzzy`) terms close to it.
+
+        :param prefix: Text typed so far; normalized like stored terms
+        :param limit: Most suggestions returned, at most SUGGEST_MAX
+        :return: List of Suggestion
+        """
+        prefix = normalize_prefix(prefix)
+        if not prefix:
+            return []
+        limit = min(limit, SUGGEST_MAX)
+        with self._lock:
+            self._stats['suggestions'] += 1
+            found = self._prefix_matches(prefix, limit)
+            if fuzzy and len(found) < limit and len(prefix) >= FUZZY_MIN_CHARS and ' ' not in prefix:
+                self._stats['fuzzy'] += 1
+                found += self._fuzzy_matches(prefix, limit - len(found), {match.term for match in found})
+            return found
+
+    def rebuild(self, items, workers=None):
+        """
+        Replace the whole index with documents from stored results: terms
+        are extracted and the snapshot encoded in a process pool, then the
+        new files are swapped in.
+
+        :param items: Iterable of (id, document); a later item with the same id replaces an earlier one
+        :param workers: Processes to use, None for the index's
+        :return: (number stored, number without terms)
+        :raises ValueError: on a malformed document (the index is left as it was)
+        """
+        workers = workers or self.workers
+        latest = {}
+        for item_id, document in items:
+            latest[str(item_id)] = document
+        documents = list(latest.items())
+        parts = _pool_map(_document_chunk, [documents[start:start + REBUILD_CHUNK]
+                                            for start in range(0, len(documents), REBUILD_CHUNK)], workers)
+        counts, kinds, ids, lines = {}, {}, [], []
+        for chunk_counts, chunk_kinds, chunk_ids, chunk_lines in parts:
+            for term, count in chunk_counts.items():
+                counts[term] = counts.get(term, 0) + count
+            for term, bits in chunk_kinds.items():
+                kinds[term] = kinds.get(term, 0) | bits
+            ids.extend(chunk_ids)
+            lines.extend(chunk_lines)
+        terms = sorted(counts)
+        parts = build_snapshot(terms, [counts[term] for term in terms], [kinds[term] for term in terms], workers)
+
+        with self._lock:
+            self._swap_generation(parts, ids, lines)
+            self._stats['rebuilds'] += 1
+            return len(ids), len(documents) - len(ids)
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, documents=len(self._documents), terms=self._snapshot.size,
+                        changed_terms=len(self._changes), pending_documents=self._pending,
+                        generation=self._generation)
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_term_index():
+    """This process's TermIndex, loaded from config on first use"""
+    global _index
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                _index = TermIndex(
+                    directory=config.TERM_INDEX_DIR or None,
+                    workers=config.TERM_INDEX_WORKERS
+                )
+    return _index
@@ -1,67 +1,112 @@
 # image-analysis-service/src/utils/text_extract.py
 import cv2
 import re
-import pytesseract
 import logging
 import numpy as np
 from PIL import Image
 import traceback
+from utils.deadline import DeadlineExceeded
+from utils.ocr_engines import engine_or_default
+from utils.decode import FULL_GRAY, decode_image, to_gray
+from utils.bitmask import PackedMask, as_array
+from utils.preprocessor import DENOISE_NONE, Preprocessor
+from utils.symbol_detect import detect_math_symbols
+from utils.text_regions import find_text_regions, measure_glyph_height, ocr_regions, ocr_scale, scale_for_ocr
 
 # Configure logging
 logger = logging.getLogger(__name__)
 
-# If using Windows, specify the path to Tesseract (adjust this path if needed)
-# pytesseract.pytesseract.tesseract_cmd = r'C:\Program Files\Tesseract-OCR\tesseract.exe'
+# Variant order used when only some variants can be afforded (see utils/fidelity.py)
+OCR_VARIANT_PRIORITY = ["basic_gray", "otsu", "enhanced", "adaptive_thresh", "denoised", "morph"]
 
-def preprocess_image_for_ocr(image_path):
+# All variants start from grayscale; glyphs need full resolution
+OCR_REQUIREMENT = FULL_GRAY
+
+# Comprehensive regex pattern for mathematical symbols
+MATH_SYMBOLS_PATTERN = r'[+\-*/=≠<>≤≥≈±∓×÷≅≡≢≪≫⊂⊃⊆⊇⊄⊅∈∉∋∌∀∃∄∧∨⊕⊗⊙∪∩∞∂∫∬∭∮∇∆√∛∜∑∏∐△▽□◊⟨⟩⟪⟫⌈⌉⌊⌋⟦⟧⟮⟯‖π∝∞°′″]'
+
+# Extended set for specific mathematical notation
+EXTENDED_SYMBOL_PATTERNS = [
+    r'\\[a-zA-Z]+',  # LaTeX commands
+    r'[a-zA-Z]_\{[a-zA-Z0-9]+\}',  # Subscripts
+    r'[a-zA-Z]\^[a-zA-Z0-9]+',  # Superscripts
+    r'\\frac\{[^}]+\}\{[^}]+\}',  # Fractions
+    r'\\sqrt\{[^}]+\}'  # Square roots
+]
+
+def preprocess_image_for_ocr(image_path, max_variants=None, image=None, preprocessor=None):
     """
     Preprocess image to improve OCR results with multiple approaches.
-    Returns the best processed image for OCR.
+    Returns a list of (method, image) pairs; binary variants are PackedMask
+    objects, unpack them with as_array() before OCR.
+
+    :param image_path: Path to the image file.
+    :param max_variants: Only build the first N variants of OCR_VARIANT_PRIORITY (None for all).
+    :param image: Already decoded grayscale or BGR image (decoded from image_path if None).
+    :param preprocessor: Shared Preprocessor over the image (see DecodedImage.preprocessor());
+                         its cached grayscale plane and chains are reused.
     """
     try:
+        if preprocessor is not None:
+            image = preprocessor.image
         # Read the image
-        image = cv2.imread(image_path)
         if image is None:
-            logger.error(f"Failed to read image at {image_path}")
-            # Try with PIL as fallback
             try:
-                pil_image = Image.open(image_path)
-                image = cv2.cvtColor(np.array(pil_image), cv2.COLOR_RGB2BGR)
-            except Exception as e:
-                logger.error(f"PIL fallback also failed: {str(e)}")
-                return None
+                image = decode_image(image_path, OCR_REQUIREMENT).image
+            except ValueError:
+                logger.error(f"Failed to read image at {image_path}")
+                # Try with PIL as fallback
+                try:
+                    pil_image = Image.open(image_path)
+                    image = cv2.cvtColor(np.array(pil_image), cv2.COLOR_RGB2BGR)
+                except Exception as e:
+                    logger.error(f"PIL fallback also failed: {str(e)}")
+                    return None
+        
+        wanted = set(OCR_VARIANT_PRIORITY[:max_variants] if max_variants else OCR_VARIANT_PRIORITY)
         
         # Create multiple preprocessed versions
         processed_images = []
         
         # 1. Basic grayscale
-        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-        processed_images.append(("basic_gray", gray))
+        if preprocessor is None or not preprocessor.source.is_gray:
+            preprocessor = Preprocessor(to_gray(image))
+        gray = preprocessor.image
+        if "basic_gray" in wanted:
+            processed_images.append(("basic_gray", gray))
         
-        # 2. Grayscale with Gaussian blur to reduce noise
-        blurred = cv2.GaussianBlur(gray, (5, 5), 0)
-        processed_images.append(("blurred", blurred))
+        # 2. Noise-gated denoising; clean images would only repeat basic_gray
+        if "denoised" in wanted and preprocessor.source.denoise_decision().branch != DENOISE_NONE:
+            processed_images.append(("denoised", preprocessor.run(['denoise'])))
         
         # 3. Adaptive thresholding
-        thresh = cv2.adaptiveThreshold(
-            gray, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, 
-            cv2.THRESH_BINARY, 11, 2
-        )
-        processed_images.append(("adaptive_thresh", thresh))
+        if "adaptive_thresh" in wanted:
+            thresh = cv2.adaptiveThreshold(
+                gray, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, 
+                cv2.THRESH_BINARY, 11, 2
+            )
+            # Binary variants are held bit-packed until their OCR pass
+            processed_images.append(("adaptive_thresh", PackedMask.from_array(thresh)))
         
-        # 4. Otsu's thresholding
-        _, otsu = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
-        processed_images.append(("otsu", otsu))
+        # 4. Otsu's thresholding; for bitonal images it splits the two levels,
+        # so the packed decode already is the mask
+        if "otsu" in wanted:
+            packed = preprocessor.packed
+            if packed is not None and packed.low < packed.high:
+                processed_images.append(("otsu", PackedMask(packed.bits, packed.shape)))
+            else:
+                _, otsu = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+                processed_images.append(("otsu", PackedMask.from_array(otsu)))
         
         # 5. Morphological operations
-        kernel = np.ones((1, 1), np.uint8)
-        morph = cv2.morphologyEx(gray, cv2.MORPH_OPEN, kernel)
-        processed_images.append(("morph", morph))
+        if "morph" in wanted:
+            kernel = np.ones((1, 1), np.uint8)
+            morph = cv2.morphologyEx(gray, cv2.MORPH_OPEN, kernel)
+            processed_images.append(("morph", morph))
         
-        # 6. Contrast enhancement
-        clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8))
-        enhanced = clahe.apply(gray)
-        processed_images.append(("enhanced", enhanced))
+        # 6. Contrast enhancement (CLAHE on grayscale, shared with other stages)
+        if "enhanced" in wanted:
+            processed_images.append(("enhanced", preprocessor.run(['enhance_contrast'])))
         
         return processed_images
         
@@ -70,38 +115,73 @@ def preprocess_image_for_ocr(image_path):
         logger.error(traceback.format_exc())
         return None
 
+def _reference_gray(processed_images):
+    """The basic grayscale variant (or the first one); every variant has its geometry"""
+    return as_array(dict(processed_images).get("basic_gray", processed_images[0][1]))
+
+def find_variant_regions(processed_images):
+    """
+    Text regions of the basic grayscale variant, shared by every variant.
+
+    :return: TextRegion list, or None to OCR whole images
+    """
+    try:
+        return find_text_regions(_reference_gray(processed_images))
+    except Exception as e:
+        logger.warning(f"Text region detection failed, using whole-image OCR: {str(e)}")
+        return None
+
+def whole_image_scale(processed_images):
+    """Resize factor for whole-image OCR, from the median glyph height (see ocr_scale())"""
+    try:
+        return ocr_scale(measure_glyph_height(_reference_gray(processed_images)))
+    except Exception as e:
+        logger.warning(f"Glyph height measurement failed, OCR at native scale: {str(e)}")
+        return 1.0
+
 # ✅ Improved Function to Extract Text from Image
-def extract_text(image_path):
+def extract_text(image_path, max_variants=None, deadline=None, image=None, preprocessor=None, engine=None):
     """
-    Extracts textual content from an image using Tesseract OCR with multiple preprocessing approaches.
+    Extracts textual content from an image by OCR with multiple preprocessing approaches.
     
     :param image_path: Path to the image file.
+    :param max_variants: Limit on preprocessing variants tried (None for all).
+    :param deadline: Optional Deadline; remaining variants are skipped once it expires.
+    :param image: Already decoded image, see preprocess_image_for_ocr().
+    :param preprocessor: Shared Preprocessor, see preprocess_image_for_ocr().
+    :param engine: OCR engine name (see utils.ocr_engines), None for Tesseract.
     :return: Best extracted text as a string or an error message.
     """
     try:
+        ocr = engine_or_default(engine)
         # Preprocess the image with multiple approaches
-        processed_images = preprocess_image_for_ocr(image_path)
+        processed_images = preprocess_image_for_ocr(image_path, max_variants, image, preprocessor)
         
         if not processed_images:
             return "No text could be extracted due to image processing error."
         
+        # OCR only the text regions when the image has few of them
+        regions = find_variant_regions(processed_images)
+        scale = 1.0 if regions else whole_image_scale(processed_images)
+        
         # Try all processed images and keep the best result
         best_text = ""
         best_confidence = -1
         best_method = ""
         
         for method, img in processed_images:
+            if deadline is not None and deadline.expired():
+                logger.warning(f"Deadline reached, skipping remaining OCR variants from {method}")
+                break
             try:
-                # Get detailed OCR data to check confidence
-                ocr_data = pytesseract.image_to_data(img, output_type=pytesseract.Output.DICT)
-                
-                # Calculate average confidence of detected text
-                confidences = [conf for conf in ocr_data['conf'] if conf != -1]
-                avg_confidence = np.mean(confidences) if confidences else 0
-                
-                # Extract the text
-                text = pytesseract.image_to_string(img)
-                text = text.strip()
+                if regions:
+                    # One batch for all regions of this variant
+                    region_result = ocr_regions(img, regions, engine=ocr.name)
+                    text, avg_confidence = region_result.text, region_result.confidence
+                else:
+                    # Text and word confidences from one engine call
+                    ocr_result = ocr.read(scale_for_ocr(img, scale))
+                    text, avg_confidence = ocr_result.text.strip(), ocr_result.confidence
                 
                 text_length = len(text.replace(" ", "").replace("\n", ""))
                 
@@ -131,62 +211,104 @@ def extract_text(image_path):
         logger.error(traceback.format_exc())
         return "Text extraction failed due to technical error."
 
+def find_math_symbols(text):
+    """
+    Mathematical symbols and notation in a piece of text (OCR output or
+    text read from a vector file).
+
+    :param text: Text to search
+    :return: Set of matched symbols
+    """
+    symbols = set(re.findall(MATH_SYMBOLS_PATTERN, text))
+    for pattern in EXTENDED_SYMBOL_PATTERNS:
+        symbols.update(re.findall(pattern, text))
+    return symbols
+
+def _ocr_math_symbols(processed_images, deadline, ocr):
+    """
+    Math symbols by OCR of every preprocessing variant plus a whitelisted
+    pass; the fallback of extract_math_symbols().
+
+    :param processed_images: Variants from preprocess_image_for_ocr()
+    :param deadline: Optional Deadline; symbols found so far are returned once it expires.
+    :param ocr: OcrEngine to read with
+    :return: Set of detected symbols
+    """
+    if not processed_images:
+        return set()
+
+    all_symbols = set()
+    regions = find_variant_regions(processed_images)
+    scale = 1.0 if regions else whole_image_scale(processed_images)
+
+    # Try all processed images to find math symbols
+    for method, img in processed_images:
+        if deadline is not None and deadline.expired():
+            logger.warning(f"Deadline reached, skipping remaining symbol variants from {method}")
+            break
+        try:
+            if regions:
+                extracted_text = ocr_regions(img, regions, '--psm 6', ocr.name).text
+            else:
+                extracted_text = ocr.read(scale_for_ocr(img, scale), '--psm 6').text
+            all_symbols.update(find_math_symbols(extracted_text))
+
+        except Exception as e:
+            logger.warning(f"Symbol extraction failed for method {method}: {str(e)}")
+
+    # Additional processing for math-specific OCR
+    try:
+        if deadline is not None:
+            deadline.check("math-specific OCR")
+        # Try math config for Tesseract
+        math_config = r'--psm 6 --oem 3 -c tessedit_char_whitelist=0123456789+-*/()=<>≤≥∞∫∑π{}[]^'
+        if regions:
+            math_text = ocr_regions(processed_images[0][1], regions, math_config, ocr.name).text
+        else:
+            math_text = ocr.read(scale_for_ocr(processed_images[0][1], scale), math_config).text
+        additional_symbols = re.findall(MATH_SYMBOLS_PATTERN, math_text)
+        all_symbols.update(additional_symbols)
+    except DeadlineExceeded:
+        logger.warning("Deadline reached, skipping math-specific OCR pass")
+    except Exception as e:
+        logger.warning(f"Math-specific OCR failed: {str(e)}")
+    return all_symbols
+
 # ✅ Improved Function to Extract Mathematical Symbols
-def extract_math_symbols(image_path):
+def extract_math_symbols(image_path, max_variants=None, deadline=None, image=None, preprocessor=None, engine=None):
     """
-    Extracts mathematical symbols and operators from an image using Tesseract OCR with enhanced detection.
+    Extracts mathematical symbols and operators from an image.
+
+    Glyphs are classified once by the connected-component detector
+    (utils.symbol_detect), and only glyphs it cannot tell apart are OCR'd.
+    Images it cannot handle (no text, or too many candidates) fall back to
+    OCR of the preprocessing variants, see _ocr_math_symbols().
 
     :param image_path: Path to the image file.
+    :param max_variants: Limit on preprocessing variants tried by the OCR fallback (None for all).
+    :param deadline: Optional Deadline; symbols found so far are returned once it expires.
+    :param image: Already decoded image, see preprocess_image_for_ocr().
+    :param preprocessor: Shared Preprocessor, see preprocess_image_for_ocr().
+    :param engine: OCR engine name (see utils.ocr_engines), None for Tesseract.
     :return: List of detected mathematical symbols.
     """
     try:
-        # Preprocess the image with multiple approaches
-        processed_images = preprocess_image_for_ocr(image_path)
-        
-        if not processed_images:
-            return []
-        
-        # Define comprehensive regex pattern for mathematical symbols
-        math_symbols_pattern = r'[+\-*/=≠<>≤≥≈±∓×÷≅≡≢≪≫⊂⊃⊆⊇⊄⊅∈∉∋∌∀∃∄∧∨⊕⊗⊙∪∩∞∂∫∬∭∮∇∆√∛∜∑∏∐△▽□◊⟨⟩⟪⟫⌈⌉⌊⌋⟦⟧⟮⟯‖π∝∞°′″]'
-        
-        # Extended set for specific mathematical notation
-        extended_patterns = [
-            r'\\[a-zA-Z]+',  # LaTeX commands
-            r'[a-zA-Z]_\{[a-zA-Z0-9]+\}',  # Subscripts
-            r'[a-zA-Z]\^[a-zA-Z0-9]+',  # Superscripts
-            r'\\frac\{[^}]+\}\{[^}]+\}',  # Fractions
-            r'\\sqrt\{[^}]+\}'  # Square roots
-        ]
-        
-        all_symbols = set()
-        
-        # Try all processed images to find math symbols
-        for method, img in processed_images:
-            try:
-                extracted_text = pytesseract.image_to_string(img, config='--psm 6')
-                
-                # Find all standard math symbols
-                symbols = re.findall(math_symbols_pattern, extracted_text)
-                all_symbols.update(symbols)
-                
-                # Look for extended patterns
-                for pattern in extended_patterns:
-                    matches = re.findall(pattern, extracted_text)
-                    all_symbols.update(matches)
-                    
-            except Exception as e:
-                logger.warning(f"Symbol extraction failed for method {method}: {str(e)}")
-        
-        # Additional processing for math-specific OCR
-        try:
-            # Try math config for Tesseract
-            math_config = r'--psm 6 --oem 3 -c tessedit_char_whitelist=0123456789+-*/()=<>≤≥∞∫∑π{}[]^'
-            math_text = pytesseract.image_to_string(processed_images[0][1], config=math_config)
-            additional_symbols = re.findall(math_symbols_pattern, math_text)
-            all_symbols.update(additional_symbols)
-        except Exception as e:
-            logger.warning(f"Math-specific OCR failed: {str(e)}")
-        
+        ocr = engine_or_default(engine)
+        if preprocessor is None or not preprocessor.source.is_gray:
+            if preprocessor is not None:
+                image = preprocessor.image
+            if image is None:
+                image = decode_image(image_path, OCR_REQUIREMENT).image
+            preprocessor = Preprocessor(to_gray(image))
+        # Denoised only where the noise gate says so (see utils.preprocessor)
+        gray = preprocessor.run(['denoise'])
+
+        all_symbols = detect_math_symbols(gray, MATH_SYMBOLS_PATTERN, ocr.name, deadline)
+        if all_symbols is None:
+            all_symbols = _ocr_math_symbols(
+                preprocess_image_for_ocr(image_path, max_variants, preprocessor=preprocessor), deadline, ocr
+            )
+
         # Convert set to list for return
         result = list(all_symbols)
         logger.info(f"Extracted {len(result)} unique mathematical symbols")
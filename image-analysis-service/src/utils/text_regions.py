@@ -0,0 +1,341 @@
+# image-analysis-service/src/utils/text_regions.py
+"""
+OCR on text regions instead of whole images.
+
+Text in a diagram covers a small share of the pixels. Glyph-sized
+connected components are closed into words with the same morphology as
+diagram_features.detect_text_regions(), merged into lines, and only those
+boxes are OCRed, as one batch on the OCR engine (utils/ocr_engines.py;
+Tesseract gets them packed onto a sheet, so it starts once per variant)
+and the text is stitched in reading order.
+
+Each crop is rescaled so its median glyph height falls in the range
+Tesseract reads best (ocr_scale()); whole-image OCR uses the median over
+the image the same way.
+
+Images where the regions would cover most of the page (dense text) or
+where no region is found are left to whole-image OCR.
+"""
+import bisect
+import logging
+import re
+from dataclasses import dataclass
+from typing import List
+
+import cv2
+import numpy as np
+
+from utils.bitmask import PackedMask, as_array
+from utils.ocr_engines import get_engine
+
+logger = logging.getLogger(__name__)
+
+# Morphology that joins glyphs into words (shared with detect_text_regions)
+TEXT_CLOSE_KERNEL = (5, 5)
+
+# Glyph components: at least TEXT_MIN_GLYPH_HEIGHT px tall and at most
+# TEXT_MAX_GLYPH_HEIGHT_RATIO of the image height (larger ones are shapes,
+# frames or bars); thin strokes below the minimum are connectors
+TEXT_MIN_GLYPH_HEIGHT = 5
+TEXT_MAX_GLYPH_HEIGHT_RATIO = 0.1
+# Components wider than this many glyph heights are lines, not text
+TEXT_MAX_GLYPH_ASPECT = 15
+# Relative to the median candidate height: components up to
+# TEXT_GLYPH_SCALE are glyphs; up to TEXT_HEADING_SCALE only if at least
+# TEXT_MIN_HEADING_FILL of their box is ink, since taller hollow components
+# are box outlines and frames
+TEXT_GLYPH_SCALE = 2.0
+TEXT_HEADING_SCALE = 4.0
+TEXT_MIN_HEADING_FILL = 0.15
+
+# Boxes on the same line closer than this many line heights are merged
+TEXT_MERGE_GAP = 1.0
+# Background kept around each crop, in pixels
+TEXT_REGION_PADDING = 4
+
+# Above this share of the image, region OCR saves little; OCR the whole image
+TEXT_REGION_MAX_COVERAGE = 0.5
+TEXT_MAX_REGIONS = 400
+# Word boxes before merging into lines: more is a photo or a text page,
+# left to whole-image OCR without merging
+TEXT_MAX_BOXES = 4 * TEXT_MAX_REGIONS
+
+# Tesseract reads best at glyph heights around OCR_TARGET_GLYPH_HEIGHT
+# (median component height, between x-height and cap height). Text
+# taller than OCR_LARGE_GLYPH_HEIGHT is scaled down to it, text shorter
+# than OCR_TINY_GLYPH_HEIGHT scaled up (at most OCR_MAX_UPSCALE); anything
+# in between is read as it is
+OCR_TARGET_GLYPH_HEIGHT = 28
+OCR_LARGE_GLYPH_HEIGHT = 48
+OCR_TINY_GLYPH_HEIGHT = 14
+OCR_MAX_UPSCALE = 4.0
+
+# One line of text per sheet row; the sheet is a uniform block of lines
+TEXT_REGION_PSM = '--psm 6'
+_PSM_RE = re.compile(r'--psm\s+\d+')
+
+
+@dataclass
+class TextRegion:
+    """
+    Box of one line of text, in the coordinates of the image it was found in.
+
+    :param glyph_height: Median height of its glyphs (0 if unknown)
+    """
+    x: int
+    y: int
+    width: int
+    height: int
+    glyph_height: float = 0.0
+
+    @property
+    def area(self):
+        return self.width * self.height
+
+
+def ocr_scale(glyph_height):
+    """Resize factor that brings `glyph_height` into Tesseract's range (1.0 if it is already)"""
+    if not glyph_height or OCR_TINY_GLYPH_HEIGHT <= glyph_height <= OCR_LARGE_GLYPH_HEIGHT:
+        return 1.0
+    return min(OCR_MAX_UPSCALE, OCR_TARGET_GLYPH_HEIGHT / float(glyph_height))
+
+
+def scale_for_ocr(image, factor):
+    """`image` (array or PackedMask) resized by `factor`"""
+    image = as_array(image)
+    if factor == 1.0:
+        return image
+    height, width = image.shape[:2]
+    return cv2.resize(
+        image, (max(1, int(round(width * factor))), max(1, int(round(height * factor)))),
+        interpolation=cv2.INTER_AREA if factor < 1 else cv2.INTER_CUBIC
+    )
+
+
+def close_text_mask(binary):
+    """Join glyphs of a foreground mask into word blobs"""
+    kernel = cv2.getStructuringElement(cv2.MORPH_RECT, TEXT_CLOSE_KERNEL)
+    return cv2.morphologyEx(binary, cv2.MORPH_CLOSE, kernel)
+
+
+def _ink(gray, foreground=None):
+    """Foreground mask with text as the nonzero pixels"""
+    if foreground is not None:
+        binary = as_array(foreground)
+    else:
+        _, binary = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
+    if cv2.countNonZero(binary) > binary.size / 2:
+        # Light text on a dark background
+        binary = cv2.bitwise_not(binary)
+    return binary
+
+
+def _glyph_components(binary):
+    """
+    Connected components of `binary` that look like glyphs.
+
+    :return: (labels, stats, keep) where keep[label] is True for glyphs
+    """
+    _, labels, stats, _ = cv2.connectedComponentsWithStats(binary, connectivity=8)
+    widths, heights = stats[:, cv2.CC_STAT_WIDTH], stats[:, cv2.CC_STAT_HEIGHT]
+    fill = stats[:, cv2.CC_STAT_AREA] / np.maximum(1, widths * heights)
+    max_height = max(TEXT_MIN_GLYPH_HEIGHT, int(binary.shape[0] * TEXT_MAX_GLYPH_HEIGHT_RATIO))
+    keep = (heights >= TEXT_MIN_GLYPH_HEIGHT) & (heights <= max_height) & (widths <= heights * TEXT_MAX_GLYPH_ASPECT)
+    keep[0] = False  # background label
+    if keep.any():
+        # Most candidates are glyphs
+        median = np.median(heights[keep])
+        keep &= (heights <= median * TEXT_GLYPH_SCALE) | (
+            (heights <= median * TEXT_HEADING_SCALE) & (fill >= TEXT_MIN_HEADING_FILL)
+        )
+    return labels, stats, keep
+
+
+def measure_glyph_height(gray, foreground=None):
+    """Median height of the glyphs in an image, or None if it has none"""
+    _, stats, keep = _glyph_components(_ink(gray, foreground))
+    if not keep.any():
+        return None
+    return float(np.median(stats[keep, cv2.CC_STAT_HEIGHT]))
+
+
+def _region_glyph_heights(regions, stats, keep):
+    """Median glyph height inside each region"""
+    heights = stats[keep, cv2.CC_STAT_HEIGHT]
+    centers_x = stats[keep, cv2.CC_STAT_LEFT] + stats[keep, cv2.CC_STAT_WIDTH] / 2
+    centers_y = stats[keep, cv2.CC_STAT_TOP] + heights / 2
+    result = []
+    for region in regions:
+        inside = ((centers_x >= region.x) & (centers_x < region.x + region.width) &
+                  (centers_y >= region.y) & (centers_y < region.y + region.height))
+        result.append(float(np.median(heights[inside])) if inside.any() else 0.0)
+    return result
+
+
+def _same_line(region, other, gap):
+    """Overlap vertically by more than half and closer horizontally than `gap` line heights"""
+    overlap = min(region.y + region.height, other.y + other.height) - max(region.y, other.y)
+    distance = max(region.x, other.x) - min(region.x + region.width, other.x + other.width)
+    return overlap > min(region.height, other.height) / 2 and distance <= gap * max(region.height, other.height)
+
+
+def merge_regions(regions, gap=TEXT_MERGE_GAP):
+    """
+    Merge boxes of words on one line (see _same_line()), in one pass.
+
+    Boxes are bucketed into row bands of the median box height (boxes on
+    one line share a band). Within a band each box is compared only with
+    the boxes within its own reach, `gap` times its height: those starting
+    after its left edge and up to its reach past its right edge, and those
+    ending up to its reach before its left edge. A pair is within the
+    taller box's reach, so every pair is seen, and a tall box costs only
+    its own neighbours. Matching pairs are joined by union-find; each
+    group becomes one box.
+    """
+    regions = list(regions)
+    if len(regions) < 2:
+        return regions
+    band = max(1, int(np.median([region.height for region in regions])))
+    bands = {}
+    for index, region in enumerate(regions):
+        for row in range(region.y // band, (region.y + region.height - 1) // band + 1):
+            bands.setdefault(row, []).append(index)
+
+    parent = list(range(len(regions)))
+
+    def root(index):
+        while parent[index] != index:
+            parent[index] = parent[parent[index]]
+            index = parent[index]
+        return index
+
+    for members in bands.values():
+        by_start = sorted(members, key=lambda index: regions[index].x)
+        starts = [regions[index].x for index in by_start]
+        by_end = sorted(members, key=lambda index: regions[index].x + regions[index].width)
+        ends = [regions[index].x + regions[index].width for index in by_end]
+        for position, index in enumerate(by_start):
+            region = regions[index]
+            reach = gap * region.height
+            after = by_start[position + 1:bisect.bisect_right(starts, region.x + region.width + reach, position + 1)]
+            before = by_end[bisect.bisect_left(ends, region.x - reach):bisect.bisect_left(ends, region.x)]
+            for other in after + before:
+                if _same_line(region, regions[other], gap):
+                    parent[root(other)] = root(index)
+
+    groups = {}
+    for index, region in enumerate(regions):
+        groups.setdefault(root(index), []).append(region)
+    merged = []
+    for group in groups.values():
+        x, y = min(region.x for region in group), min(region.y for region in group)
+        merged.append(TextRegion(
+            x, y,
+            max(region.x + region.width for region in group) - x,
+            max(region.y + region.height for region in group) - y
+        ))
+    return merged
+
+
+def reading_order(regions):
+    """Top to bottom by line, left to right within a line"""
+    ordered = []
+    for region in sorted(regions, key=lambda r: r.y):
+        center = region.y + region.height / 2
+        for line in ordered:
+            if line[0].y <= center <= line[0].y + line[0].height:
+                line.append(region)
+                break
+        else:
+            ordered.append([region])
+    return [region for line in ordered for region in sorted(line, key=lambda r: r.x)]
+
+
+def find_text_regions(gray, foreground=None):
+    """
+    Line boxes of text, in reading order.
+
+    :param gray: Single-channel image
+    :param foreground: Optional shared foreground mask (PackedMask or array)
+    :return: List of TextRegion, or None if whole-image OCR is the better choice
+             (no text found, or text covering most of the image)
+    """
+    labels, stats, keep = _glyph_components(_ink(gray, foreground))
+    glyphs = (keep.astype(np.uint8) * 255)[labels]
+    contours, _ = cv2.findContours(close_text_mask(glyphs), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    boxes = [TextRegion(*cv2.boundingRect(contour)) for contour in contours]
+    boxes = [box for box in boxes if box.width > 3 and box.height >= TEXT_MIN_GLYPH_HEIGHT]
+
+    height, width = gray.shape[:2]
+    # Merging only grows boxes: too many or too much area already is decided here
+    coverage = sum(box.area for box in boxes) / float(width * height)
+    if len(boxes) > TEXT_MAX_BOXES or coverage > TEXT_REGION_MAX_COVERAGE:
+        logger.debug(f"Region OCR not used ({len(boxes)} word boxes, {coverage:.0%} of the image)")
+        return None
+    regions = merge_regions(boxes)
+
+    padded = []
+    for region, glyph_height in zip(regions, _region_glyph_heights(regions, stats, keep)):
+        x, y = max(0, region.x - TEXT_REGION_PADDING), max(0, region.y - TEXT_REGION_PADDING)
+        padded.append(TextRegion(
+            x, y,
+            min(width, region.x + region.width + TEXT_REGION_PADDING) - x,
+            min(height, region.y + region.height + TEXT_REGION_PADDING) - y,
+            glyph_height
+        ))
+
+    coverage = sum(region.area for region in padded) / float(width * height)
+    if not padded or len(padded) > TEXT_MAX_REGIONS or coverage > TEXT_REGION_MAX_COVERAGE:
+        logger.debug(f"Region OCR not used ({len(padded)} regions, {coverage:.0%} of the image)")
+        return None
+    logger.debug(f"Found {len(padded)} text regions covering {coverage:.0%} of the image")
+    return reading_order(padded)
+
+
+def region_crops(image, regions):
+    """
+    Grayscale crops of `regions`, each rescaled by ocr_scale() of its glyph
+    height so it is read at the scale its own glyphs read best. Binary
+    variants (PackedMask) are unpacked region by region.
+    """
+    if isinstance(image, PackedMask):
+        crops = [image.unpack_region(r.x, r.y, r.width, r.height) for r in regions]
+    else:
+        if image.ndim == 3:
+            image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        crops = [image[r.y:r.y + r.height, r.x:r.x + r.width] for r in regions]
+    return [scale_for_ocr(crop, ocr_scale(r.glyph_height)) for crop, r in zip(crops, regions)]
+
+
+@dataclass
+class RegionOcrResult:
+    """Text of each region (in reading order) and the mean word confidence"""
+    texts: List[str]
+    confidence: float
+
+    @property
+    def text(self):
+        return "\n".join(text for text in self.texts if text)
+
+
+def region_config(config=''):
+    """A Tesseract config with its page segmentation mode replaced by TEXT_REGION_PSM"""
+    return " ".join([TEXT_REGION_PSM] + _PSM_RE.sub('', config).split())
+
+
+def ocr_regions(image, regions, config='', engine=None):
+    """
+    OCR only the `regions` of `image`, as one batch on the OCR engine
+    (for Tesseract, one call per sheet of packed crops).
+
+    :param image: Variant to read (array or PackedMask), in the regions' coordinates
+    :param regions: TextRegion list in reading order
+    :param config: Tesseract config; its --psm is replaced, see region_config()
+    :param engine: OCR engine name (see utils.ocr_engines), None for Tesseract
+    :return: RegionOcrResult
+    """
+    results = get_engine(engine).read_lines(region_crops(image, regions), region_config(config))
+    confidences = [word.confidence for result in results for word in result.words if word.confidence >= 0]
+    return RegionOcrResult(
+        [result.text for result in results], float(np.mean(confidences)) if confidences else 0.0
+    )
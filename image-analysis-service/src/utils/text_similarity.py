@@ -0,0 +1,597 @@
+# image-analysis-service/src/utils/text_similarity.py
+"""
+Lookup of diagrams with similar text: MinHash signatures over shingles of
+the OCR text and symbols, searched through an LSH banding index.
+
+Redrawn or recolored copies of a diagram carry the same labels and
+equations but look nothing alike to pixel similarity. Each result's text
+(`text_result`, when the pipeline reads it: vector files, PDF text layers)
+and `symbols_result` are turned into a set of shingles:
+
+- character SHINGLE_CHARS-grams of each line of the text (a label, in a
+  diagram), lowercased, NFKC-normalized and with whitespace collapsed: OCR
+  noise in one letter only changes a few shingles, and labels read in
+  another order of a redrawn diagram change none
+- each detected symbol as a token of its own
+
+The shingles are hashed (CRC-32) and summarized by a MinHash signature of
+MINHASH_PERMUTATIONS values: the minimum of each of as many universal
+hashes (multiply-add-shift, ((a * x + b) mod 2^64) >> 32) over the shingle
+hashes. Two signatures agree in a position with
+probability equal to the Jaccard similarity of the shingle sets, so the
+share of equal positions estimates it.
+
+The signature is cut into LSH_BANDS bands of LSH_ROWS values, and each band
+into a 64-bit key. Two documents of similarity s share at least one band
+key with probability 1 - (1 - s^LSH_ROWS)^LSH_BANDS: about 0.2 at s = 0.3,
+0.9 at s = 0.5 and above 0.99 from s = 0.6. A query looks its keys up in one
+sorted table per band (binary search), then scores the candidates by their
+full signatures; documents inserted since the last table build are scanned
+directly.
+
+Storage under the index directory, named by index.json (replaced last, so
+a crash mid-build keeps the previous files in use):
+
+- signatures-<n>.bin: one row of MINHASH_PERMUTATIONS uint32 per insert,
+  memory-mapped for scoring
+- keys-<n>.jsonl: one line per insert (id, row, metadata) or delete (id),
+  replayed on load; a re-inserted id gets a new row
+- bands-<n>.npy, band-rows-<n>.npy: the band tables (sorted keys and their
+  rows, one line per band), memory-mapped
+
+Deleted rows stay in the files until the next rebuild and are filtered out
+of results. rebuild() replaces everything from an exported result set,
+computing signatures in a process pool and sorting the bands in threads.
+"""
+import io
+import json
+import logging
+import multiprocessing
+import os
+import re
+import threading
+import unicodedata
+import zlib
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass
+
+import numpy as np
+
+import config
+
+logger = logging.getLogger(__name__)
+
+SHINGLE_CHARS = 4
+MINHASH_PERMUTATIONS = 128
+LSH_BANDS = 32
+# Even: band keys are built from the rows read as uint64 pairs
+LSH_ROWS = MINHASH_PERMUTATIONS // LSH_BANDS
+# Fixed so signatures stay comparable across processes and restarts
+MINHASH_SEED = 20240611
+_HASH_A, _HASH_B = np.random.default_rng(MINHASH_SEED).integers(
+    0, 1 << 63, (2, MINHASH_PERMUTATIONS), dtype=np.uint64
+) * np.uint64(2) + np.uint64(1)
+_KEY_MIX = np.uint64(0x9E3779B97F4A7C15)
+
+SIGNATURE_DTYPE = np.dtype('<u4')
+SIGNATURE_BYTES = MINHASH_PERMUTATIONS * SIGNATURE_DTYPE.itemsize
+
+# Band tables are rebuilt when this many inserts are unbanded (or the
+# collection has doubled, for small ones)
+INDEX_MERGE_EVERY = 16384
+# Documents per task of a parallel rebuild; smaller rebuilds run in-process
+REBUILD_CHUNK = 4096
+
+_WHITESPACE = re.compile(r'\s+')
+
+
+@dataclass
+class TextMatch:
+    """A stored document with text similar to a query"""
+    id: str
+    similarity: float
+    meta: dict
+
+    def to_dict(self):
+        return {'id': self.id, 'similarity': round(self.similarity, 4), 'meta': self.meta}
+
+
+def normalize_text(text):
+    return _WHITESPACE.sub(' ', unicodedata.normalize('NFKC', text).lower()).strip()
+
+
+def text_shingles(text='', symbols=()):
+    """Shingle set of a text and its symbols (empty if there is neither)"""
+    shingles = set()
+    for line in (text or '').splitlines():
+        line = normalize_text(line)
+        if not line:
+            continue
+        # Padded so the first and last letters of a label count like the others
+        line = f" {line} "
+        shingles.update('t:' + line[i:i + SHINGLE_CHARS] for i in range(max(1, len(line) - SHINGLE_CHARS + 1)))
+    shingles.update('s:' + normalize_text(str(symbol)) for symbol in symbols if str(symbol).strip())
+    return shingles
+
+
+def minhash_signature(shingles):
+    """MINHASH_PERMUTATIONS uint32 minimums over a shingle set, or None if it is empty"""
+    if not shingles:
+        return None
+    hashes = np.fromiter((zlib.crc32(shingle.encode('utf-8')) for shingle in shingles), np.uint64, len(shingles))
+    # Wraps modulo 2^64 as intended; the high half is the hash
+    values = (hashes[:, None] * _HASH_A + _HASH_B) >> np.uint64(32)
+    return values.min(axis=0).astype(SIGNATURE_DTYPE)
+
+
+def document_text(document):
+    """
+    (text, symbols) of an analysis result, or of a dict with `text` and
+    `symbols`.
+    """
+    text = document.get('text_result', document.get('text')) or ''
+    symbols = document.get('symbols_result', document.get('symbols')) or []
+    if not isinstance(text, str):
+        raise ValueError("text must be a string")
+    if not isinstance(symbols, (list, tuple)):
+        raise ValueError("symbols must be a list")
+    return text, symbols
+
+
+def document_signature(document):
+    """MinHash signature of an analysis result's text and symbols, or None if it has neither"""
+    return minhash_signature(text_shingles(*document_text(document)))
+
+
+def band_keys(signatures):
+    """
+    64-bit key of each band of each signature.
+
+    :param signatures: uint32, n x MINHASH_PERMUTATIONS
+    :return: uint64, n x LSH_BANDS
+    """
+    halves = np.ascontiguousarray(signatures, SIGNATURE_DTYPE).view('<u8').reshape(
+        len(signatures), LSH_BANDS, LSH_ROWS // 2
+    )
+    keys = halves[:, :, 0].copy()
+    for column in range(1, halves.shape[2]):
+        keys = keys * _KEY_MIX ^ halves[:, :, column]
+    return keys
+
+
+def _signature_chunk(documents):
+    """Process-pool task: (signatures, indexed flags) of a list of documents"""
+    signatures = np.zeros((len(documents), MINHASH_PERMUTATIONS), SIGNATURE_DTYPE)
+    indexed = np.zeros(len(documents), bool)
+    for i, document in enumerate(documents):
+        signature = document_signature(document)
+        if signature is not None:
+            signatures[i] = signature
+            indexed[i] = True
+    return signatures, indexed
+
+
+def compute_signatures(documents, workers=None):
+    """
+    Signatures of many documents, in a process pool when there are enough.
+
+    :param workers: Processes to use, None for one per CPU
+    :return: (signatures n x MINHASH_PERMUTATIONS, indexed flags: False for documents without text)
+    """
+    workers = workers or os.cpu_count() or 1
+    if workers == 1 or len(documents) <= REBUILD_CHUNK:
+        return _signature_chunk(documents)
+    chunks = [documents[start:start + REBUILD_CHUNK] for start in range(0, len(documents), REBUILD_CHUNK)]
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+        parts = list(executor.map(_signature_chunk, chunks))
+    return np.concatenate([part[0] for part in parts]), np.concatenate([part[1] for part in parts])
+
+
+def _sorted_bands(keys, rows, workers=1):
+    """Band tables: each band's keys sorted, with their rows (LSH_BANDS x n each)"""
+    sorted_keys = np.empty((LSH_BANDS, len(rows)), np.uint64)
+    sorted_rows = np.empty((LSH_BANDS, len(rows)), np.uint32)
+
+    def sort_band(band):
+        order = np.argsort(keys[:, band], kind='stable')
+        sorted_keys[band] = keys[order, band]
+        sorted_rows[band] = rows[order]
+
+    # numpy sorts without holding the GIL
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        list(executor.map(sort_band, range(LSH_BANDS)))
+    return sorted_keys, sorted_rows
+
+
+class TextSimilarityIndex:
+    """
+    MinHash LSH index of documents' text; see the module docstring.
+    Thread-safe.
+
+    :param directory: Where signatures, ids and band tables are stored, None for memory only
+    :param min_similarity: Default lowest estimated Jaccard similarity returned
+    :param merge_every: Unbanded inserts that trigger a band table build
+    """
+
+    def __init__(self, directory=None, min_similarity=0.5, merge_every=INDEX_MERGE_EVERY):
+        self.directory = directory
+        self.min_similarity = min_similarity
+        self.merge_every = merge_every
+        self._lock = threading.RLock()
+        self._generation = 0
+        self._stats = {'searches': 0, 'inserted': 0, 'deleted': 0, 'rebuilds': 0}
+        self._reset()
+
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            state = self._read_state()
+            self._generation = state.get('generation', 0)
+            self._open_files()
+            self._replay_keys()
+            with open(self._signatures_path(), 'ab') as f:
+                # Rows written for inserts whose key line a crash kept from being recorded
+                f.truncate(self._count * SIGNATURE_BYTES)
+            self._signatures_file = open(self._signatures_path(), 'r+b')
+            banded = state.get('banded_rows', 0)
+            if banded and banded <= self._count and os.path.exists(self._bands_path('bands')):
+                self._band_keys = np.load(self._bands_path('bands'), mmap_mode='r')
+                self._band_rows = np.load(self._bands_path('band-rows'), mmap_mode='r')
+                self._banded = banded
+            self._tail_keys = band_keys(self._signatures()[self._banded:])
+            logger.info(f"Loaded {len(self._rows)} text signatures from {directory}"
+                        f" ({self._count - self._banded} unbanded)")
+        else:
+            self._keys_file = io.BytesIO()
+            self._signatures_file = None
+
+    def _reset(self):
+        self._ids = []
+        self._meta = []
+        self._rows = {}
+        self._alive = np.zeros(0, bool)
+        self._count = 0
+        self._mapped = None
+        self._memory = np.zeros((0, MINHASH_PERMUTATIONS), SIGNATURE_DTYPE)
+        # Band tables cover rows below _banded; later rows' keys are in _tail_keys
+        self._band_keys = np.zeros((LSH_BANDS, 0), np.uint64)
+        self._band_rows = np.zeros((LSH_BANDS, 0), np.uint32)
+        self._banded = 0
+        self._tail_keys = np.zeros((0, LSH_BANDS), np.uint64)
+
+    def __len__(self):
+        return len(self._rows)
+
+    # Storage
+
+    def _state_path(self):
+        return os.path.join(self.directory, 'index.json')
+
+    def _signatures_path(self, generation=None):
+        return os.path.join(self.directory, f"signatures-{self._generation if generation is None else generation}.bin")
+
+    def _keys_path(self, generation=None):
+        return os.path.join(self.directory, f"keys-{self._generation if generation is None else generation}.jsonl")
+
+    def _bands_path(self, name, generation=None):
+        return os.path.join(self.directory, f"{name}-{self._generation if generation is None else generation}.npy")
+
+    def _read_state(self):
+        try:
+            with open(self._state_path()) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except ValueError as e:
+            logger.error(f"Unreadable {self._state_path()}, starting from generation 0: {str(e)}")
+            return {}
+
+    def _write_state(self):
+        temporary = self._state_path() + '.tmp'
+        with open(temporary, 'w') as f:
+            json.dump({'generation': self._generation, 'banded_rows': self._banded}, f)
+        os.replace(temporary, self._state_path())
+
+    def _open_files(self):
+        self._keys_file = open(self._keys_path(), 'a+b')
+
+    def _remove_other_generations(self):
+        current = {os.path.basename(path) for path in (
+            self._signatures_path(), self._keys_path(), self._bands_path('bands'), self._bands_path('band-rows')
+        )}
+        for name in os.listdir(self.directory):
+            if re.match(r'(signatures|keys|bands|band-rows)-\d+\.', name) and name not in current:
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except OSError as e:
+                    logger.warning(f"Could not remove old text index file {name}: {str(e)}")
+
+    def _replay_keys(self):
+        """Rebuild ids, metadata and deletions from the key log"""
+        self._keys_file.seek(0)
+        for number, line in enumerate(self._keys_file):
+            try:
+                record = json.loads(line)
+                item_id = record['id']
+            except (ValueError, KeyError):
+                # A torn last line from a crash: that insert or delete never completed
+                logger.warning(f"Ignoring unreadable line {number + 1} of the text index keys")
+                self._keys_file.truncate(self._keys_file.tell() - len(line))
+                break
+            if record.get('deleted'):
+                self._forget(item_id)
+            else:
+                self._append_rows([item_id], [record.get('meta') or {}])
+
+    def _append_rows(self, ids, metas):
+        """Record new rows for ids, replacing the rows of ids already stored"""
+        needed = self._count + len(ids)
+        if needed > len(self._alive):
+            grown = np.zeros(max(needed, 2 * len(self._alive), 1024), bool)
+            grown[:self._count] = self._alive[:self._count]
+            self._alive = grown
+        self._alive[self._count:needed] = True
+        self._ids.extend(ids)
+        self._meta.extend(metas)
+        start = self._count
+        self._count = needed
+        for offset, item_id in enumerate(ids):
+            # Later duplicates of an id in the same batch win
+            self._forget(item_id)
+            self._rows[item_id] = start + offset
+
+    def _forget(self, item_id):
+        row = self._rows.pop(item_id, None)
+        if row is not None:
+            self._alive[row] = False
+            self._meta[row] = None
+        return row is not None
+
+    def _signatures(self):
+        """Stored signatures, count x MINHASH_PERMUTATIONS (memory-mapped on disk)"""
+        if self._signatures_file is None:
+            return self._memory[:self._count]
+        if self._mapped is None or len(self._mapped) != self._count:
+            self._mapped = None if self._count == 0 else np.memmap(
+                self._signatures_path(), SIGNATURE_DTYPE, mode='r', shape=(self._count, MINHASH_PERMUTATIONS)
+            )
+        return self._mapped if self._mapped is not None else np.zeros((0, MINHASH_PERMUTATIONS), SIGNATURE_DTYPE)
+
+    def _write_signatures(self, signatures):
+        if self._signatures_file is None:
+            needed = self._count + len(signatures)
+            if needed > len(self._memory):
+                grown = np.zeros((max(needed, 2 * len(self._memory), 1024), MINHASH_PERMUTATIONS), SIGNATURE_DTYPE)
+                grown[:self._count] = self._memory[:self._count]
+                self._memory = grown
+            self._memory[self._count:needed] = signatures
+            return
+        self._signatures_file.seek(self._count * SIGNATURE_BYTES)
+        self._signatures_file.write(np.ascontiguousarray(signatures, SIGNATURE_DTYPE).tobytes())
+        self._signatures_file.flush()
+
+    def _write_keys(self, records):
+        if records:
+            self._keys_file.seek(0, os.SEEK_END)
+            self._keys_file.write(b"".join(json.dumps(record).encode() + b"\n" for record in records))
+            self._keys_file.flush()
+
+    # Band tables
+
+    def _build(self, workers=1):
+        """Sort the band keys of every live row into the band tables"""
+        rows = np.flatnonzero(self._alive[:self._count]).astype(np.uint32)
+        keys = band_keys(np.asarray(self._signatures()[rows]))
+        sorted_keys, sorted_rows = _sorted_bands(keys, rows, workers)
+        self._banded = self._count
+        self._tail_keys = np.zeros((0, LSH_BANDS), np.uint64)
+        if not self.directory:
+            self._band_keys, self._band_rows = sorted_keys, sorted_rows
+            return
+        # Written aside and renamed into place; until index.json records the
+        # new row count, a reload just scans the extra rows as unbanded
+        np.save(self._bands_path('bands', 'next'), sorted_keys)
+        np.save(self._bands_path('band-rows', 'next'), sorted_rows)
+        self._band_keys = self._band_rows = None
+        os.replace(self._bands_path('bands', 'next'), self._bands_path('bands'))
+        os.replace(self._bands_path('band-rows', 'next'), self._bands_path('band-rows'))
+        self._write_state()
+        self._band_keys = np.load(self._bands_path('bands'), mmap_mode='r')
+        self._band_rows = np.load(self._bands_path('band-rows'), mmap_mode='r')
+
+    def _maintain(self):
+        unbanded = self._count - self._banded
+        if unbanded and unbanded >= min(self.merge_every, max(1024, self._banded)):
+            self._build()
+
+    def _candidates(self, keys):
+        """Live rows sharing a band key with a query"""
+        found = []
+        if self._banded:
+            for band in range(LSH_BANDS):
+                table = self._band_keys[band]
+                start = int(np.searchsorted(table, keys[band], 'left'))
+                end = int(np.searchsorted(table, keys[band], 'right'))
+                if end > start:
+                    found.append(np.asarray(self._band_rows[band, start:end], np.int64))
+        if len(self._tail_keys):
+            found.append(self._banded + np.flatnonzero((self._tail_keys == keys).any(axis=1)))
+        if not found:
+            return np.zeros(0, np.int64)
+        rows = np.unique(np.concatenate(found))
+        return rows[self._alive[rows]]
+
+    # Public API
+
+    def insert_many(self, items):
+        """
+        Store documents (bulk load): one write per file, then at most one
+        band table build. An existing id is replaced; a document without
+        text removes it.
+
+        :param items: Iterable of (id, document, metadata dict or None), where
+                      document is an analysis result or {text, symbols}
+        :return: (number stored, number without text)
+        :raises ValueError: on a malformed document (nothing is stored)
+        """
+        ids, metas, signatures, empty = [], [], [], []
+        for item_id, document, meta in items:
+            signature = document_signature(document)
+            if signature is None:
+                empty.append(str(item_id))
+                continue
+            ids.append(str(item_id))
+            metas.append(meta or {})
+            signatures.append(signature)
+        return self._store(ids, metas, np.array(signatures, SIGNATURE_DTYPE).reshape(-1, MINHASH_PERMUTATIONS),
+                           empty)
+
+    def _store(self, ids, metas, signatures, empty=()):
+        with self._lock:
+            records = [{'id': item_id, 'deleted': True} for item_id in empty if item_id in self._rows]
+            records += [{'id': item_id, 'row': self._count + i, 'meta': meta}
+                        for i, (item_id, meta) in enumerate(zip(ids, metas))]
+            # Signatures first: a key line never points past the end of the signature file
+            self._write_signatures(signatures)
+            self._write_keys(records)
+            for item_id in empty:
+                self._forget(item_id)
+            self._append_rows(ids, metas)
+            self._tail_keys = np.concatenate([self._tail_keys, band_keys(signatures)])
+            self._stats['inserted'] += len(ids)
+            self._maintain()
+            return len(ids), len(empty)
+
+    def insert(self, item_id, document, meta=None):
+        """Store one document; returns False if it has no text to index"""
+        return self.insert_many([(item_id, document, meta)])[0] == 1
+
+    def delete(self, item_id):
+        """Remove a document; returns False if the id is unknown"""
+        with self._lock:
+            item_id = str(item_id)
+            if item_id not in self._rows:
+                return False
+            self._write_keys([{'id': item_id, 'deleted': True}])
+            self._forget(item_id)
+            self._stats['deleted'] += 1
+            return True
+
+    def signature(self, item_id):
+        """Stored signature of an id, or None"""
+        with self._lock:
+            row = self._rows.get(str(item_id))
+            return None if row is None else np.array(self._signatures()[row])
+
+    def search(self, signature, k=10, exclude_id=None, min_similarity=None):
+        """
+        Stored documents whose text is most similar to a signature's.
+
+        :param exclude_id: Id left out of the results (the query's own)
+        :param min_similarity: Lowest estimated Jaccard similarity returned,
+                               None for the index default
+        :return: List of TextMatch, most similar first
+        """
+        signature = np.asarray(signature, SIGNATURE_DTYPE)
+        if signature.shape != (MINHASH_PERMUTATIONS,):
+            raise ValueError(f"Signature has {signature.size} values, expected {MINHASH_PERMUTATIONS}")
+        min_similarity = self.min_similarity if min_similarity is None else min_similarity
+        with self._lock:
+            self._stats['searches'] += 1
+            rows = self._candidates(band_keys(signature[None])[0])
+            excluded = self._rows.get(str(exclude_id)) if exclude_id is not None else None
+            if excluded is not None:
+                rows = rows[rows != excluded]
+            similarities = (np.asarray(self._signatures()[rows]) == signature).mean(axis=1)
+            order = np.argsort(-similarities, kind='stable')
+            return [
+                TextMatch(self._ids[rows[i]], float(similarities[i]), self._meta[rows[i]])
+                for i in order[:k] if similarities[i] >= min_similarity
+            ]
+
+    def rebuild(self, items, workers=None):
+        """
+        Replace the whole index with documents from an exported result set:
+        signatures are computed in a process pool and the band tables are
+        sorted in threads, then the new files are swapped in.
+
+        :param items: Iterable of (id, document, metadata dict or None); a later
+                      item with the same id replaces an earlier one
+        :param workers: Processes and threads to use, None for one per CPU
+        :return: (number stored, number without text)
+        """
+        workers = workers or os.cpu_count() or 1
+        latest = {}
+        for item_id, document, meta in items:
+            latest[str(item_id)] = (document, meta or {})
+        ids = list(latest)
+        signatures, indexed = compute_signatures([latest[item_id][0] for item_id in ids], workers)
+        kept = [item_id for item_id, ok in zip(ids, indexed) if ok]
+        metas = [latest[item_id][1] for item_id in kept]
+        signatures = signatures[indexed]
+
+        with self._lock:
+            previous = self._generation
+            self._generation += 1
+            self._reset()
+            if self.directory:
+                self._keys_file.close()
+                if self._signatures_file is not None:
+                    self._signatures_file.close()
+                with open(self._signatures_path(), 'wb') as f:
+                    f.write(np.ascontiguousarray(signatures).tobytes())
+                with open(self._keys_path(), 'wb') as f:
+                    f.write(b"".join(
+                        json.dumps({'id': item_id, 'row': row, 'meta': meta}).encode() + b"\n"
+                        for row, (item_id, meta) in enumerate(zip(kept, metas))
+                    ))
+                self._open_files()
+                self._signatures_file = open(self._signatures_path(), 'r+b')
+                self._append_rows(kept, metas)
+            else:
+                self._write_signatures(signatures)
+                self._append_rows(kept, metas)
+            # index.json switches to the new generation only once its band tables exist
+            self._build(workers)
+            if self.directory:
+                self._remove_other_generations()
+            logger.info(f"Rebuilt the text index: {len(kept)} documents, {len(ids) - len(kept)} without text"
+                        f" (generation {previous} -> {self._generation})")
+            self._stats['rebuilds'] += 1
+            return len(kept), len(ids) - len(kept)
+
+    def export_lines(self):
+        """Yield every live document's id, metadata and signature as a JSON line"""
+        with self._lock:
+            rows = np.flatnonzero(self._alive[:self._count])
+        for row in rows:
+            with self._lock:
+                if not self._alive[row]:
+                    continue
+                line = {
+                    'id': self._ids[row],
+                    'meta': self._meta[row],
+                    'signature': self._signatures()[row].tolist(),
+                }
+            yield json.dumps(line) + '\n'
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, documents=len(self._rows), rows=self._count,
+                        unbanded=self._count - self._banded, bands=LSH_BANDS, rows_per_band=LSH_ROWS)
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_text_similarity_index():
+    """This process's TextSimilarityIndex, loaded from config on first use"""
+    global _index
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                _index = TextSimilarityIndex(
+                    directory=config.TEXT_SIMILARITY_DIR or None,
+                    min_similarity=config.TEXT_SIMILARITY_MIN_SIMILARITY
+                )
+    return _index
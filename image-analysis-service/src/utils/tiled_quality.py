@@ -0,0 +1,590 @@
+# image-analysis-service/src/utils/tiled_quality.py
+"""
+Bounded-memory quality analysis for very large images.
+
+The image is processed in full-width horizontal strips. Each metric keeps
+running statistics (count/mean/M2, sums, edge counts, histograms) that are
+merged across strips into the same global values analyze_image_quality()
+reports. Strip height is derived from a memory ceiling.
+
+Pixels come from one of three sources:
+  - uncompressed files (PPM/PGM, BMP, uncompressed TIFF) are read row range
+    by row range straight from disk, so the full image is never resident;
+  - compressed TIFFs stored in strips or tiles are decoded block row by
+    block row, only the blocks covering the rows asked for;
+  - other compressed files are decoded once into a uint8 array (the only
+    full-size allocation). JPEGs too large for the ceiling are decoded at
+    1/2, 1/4 or 1/8 scale by libjpeg and the result carries the scale:
+    blur, sharpness, edge density and detail are per-pixel measures and
+    differ from a full-size analysis. Anything else above the ceiling
+    (PNG, single-strip TIFF) is refused.
+
+Differences to the in-memory path, all small:
+  - the FFT blur term always uses a center crop of FAST_FFT_MAX_SIDE;
+  - Canny hysteresis cannot follow an edge chain further than EDGE_HALO
+    rows into a neighbouring strip;
+  - dominant colors come from an evenly strided pixel sample.
+"""
+import io
+import logging
+import os
+import struct
+
+import cv2
+import numpy as np
+from PIL import Image, TiffImagePlugin
+
+from utils.deadline import check_deadline
+from utils.image_processing import (
+    FAST_FFT_MAX_SIDE,
+    FAST_KMEANS_SAMPLES,
+    calculate_quality_score,
+    get_dominant_colors,
+    mean_log_spectrum,
+)
+
+logger = logging.getLogger(__name__)
+
+# Defaults, overridden by QUALITY_MAX_MEMORY_MB / QUALITY_TILED_MIN_MEGAPIXELS
+DEFAULT_MAX_MEMORY_MB = 512
+DEFAULT_TILED_MIN_MEGAPIXELS = 40
+
+# Rows of context above and below each strip. Covers the 3x3 kernels and
+# lets Canny hysteresis follow edges a little way across the strip border.
+EDGE_HALO = 8
+
+# Approximate peak working set per strip pixel: BGR, gray, float32
+# Laplacian/Sobel/magnitude, the 2x upscale, HSV/LAB and Canny buffers
+BYTES_PER_STRIP_PIXEL = 48
+
+# Added to BYTES_PER_STRIP_PIXEL for compressed TIFFs: PIL's 4-byte pixels,
+# the array copied out of them and libtiff's buffers, measured at ~10 bytes
+# per decoded pixel and not always handed back before the strip is processed
+TIFF_DECODE_BYTES_PER_PIXEL = 10
+
+# Dominant-color sample size in full mode (fast mode uses FAST_KMEANS_SAMPLES)
+TILED_KMEANS_SAMPLES = 100000
+
+# PIL raw modes that can be read directly: bands, conversion to BGR
+RAW_MODES = {
+    'BGR': (3, None),
+    'RGB': (3, cv2.COLOR_RGB2BGR),
+    'L': (1, cv2.COLOR_GRAY2BGR),
+    'BGRX': (4, cv2.COLOR_BGRA2BGR),
+    'BGRA': (4, cv2.COLOR_BGRA2BGR),
+    'RGBX': (4, cv2.COLOR_RGBA2BGR),
+    'RGBA': (4, cv2.COLOR_RGBA2BGR),
+}
+
+# PIL modes of compressed TIFFs decoded block by block: conversion to BGR.
+# Other modes (16-bit, CMYK) convert differently in PIL and OpenCV and go
+# through the one-off decode.
+TIFF_BLOCK_MODES = {
+    '1': cv2.COLOR_GRAY2BGR,
+    'L': cv2.COLOR_GRAY2BGR,
+    'P': cv2.COLOR_RGB2BGR,
+    'LA': cv2.COLOR_GRAY2BGR,
+    'RGB': cv2.COLOR_RGB2BGR,
+    'RGBA': cv2.COLOR_RGB2BGR,
+}
+
+# TIFF tags copied into the single-block-row file handed to libtiff: layout,
+# sample format, compression and its tables. Offsets and counts are rewritten.
+TIFF_DECODE_TAGS = (256, 258, 259, 262, 266, 277, 278, 284, 317, 320, 322, 323, 338, 339, 347, 530, 531, 532)
+TIFF_IMAGE_LENGTH, TIFF_STRIP_OFFSETS, TIFF_STRIP_BYTE_COUNTS = 257, 273, 279
+TIFF_TILE_WIDTH, TIFF_TILE_LENGTH, TIFF_TILE_OFFSETS, TIFF_TILE_BYTE_COUNTS = 322, 323, 324, 325
+TIFF_ROWS_PER_STRIP, TIFF_PLANAR_CONFIGURATION = 278, 284
+TIFF_LONG = 4
+
+MB = 1024 * 1024
+
+
+class RunningMoments:
+    """Per-channel count/mean/M2, merged with Chan's parallel update"""
+
+    def __init__(self, channels=1):
+        self.count = 0
+        self.mean = np.zeros(channels)
+        self.m2 = np.zeros(channels)
+
+    def add(self, values):
+        """Fold in an array of up to 4 channels (mean/std computed by cv2 in float64)"""
+        n = values.shape[0] * values.shape[1]
+        if n == 0:
+            return
+        mean, std = cv2.meanStdDev(values)
+        mean = mean.ravel()[:len(self.mean)]
+        m2 = (std.ravel()[:len(self.mean)] ** 2) * n
+        total = self.count + n
+        delta = mean - self.mean
+        self.mean = self.mean + delta * n / total
+        self.m2 = self.m2 + m2 + delta ** 2 * self.count * n / total
+        self.count = total
+
+    @property
+    def var(self):
+        return self.m2 / self.count if self.count else np.zeros_like(self.m2)
+
+    @property
+    def std(self):
+        return np.sqrt(self.var)
+
+
+class RawRowSource:
+    """Reads row ranges of an uncompressed image straight from the file"""
+
+    def __init__(self, image_path, width, height, segments, bands, conversion):
+        self.kind = 'raw'
+        self.width = width
+        self.height = height
+        self.scale = 1
+        self.resident_bytes = 0
+        self.decode_bytes_per_pixel = 0
+        self._file = open(image_path, 'rb')
+        self._segments = segments
+        self._bands = bands
+        self._conversion = conversion
+
+    @classmethod
+    def open(cls, image_path):
+        """Return a source if the file stores raw full-width rows, else None"""
+        try:
+            with Image.open(image_path) as img:
+                width, height = img.size
+                tiles = list(img.tile)
+        except Exception as e:
+            logger.debug(f"Could not inspect {image_path} for raw access: {str(e)}")
+            return None
+        if not tiles:
+            return None
+
+        segments = []
+        bands = conversion = None
+        for tile in tiles:
+            codec, extents, offset, args = tuple(tile)[:4]
+            if isinstance(args, str):
+                args = (args, 0, 1)
+            rawmode = args[0]
+            if codec != 'raw' or rawmode not in RAW_MODES:
+                return None
+            tile_bands, tile_conversion = RAW_MODES[rawmode]
+            if bands is not None and (tile_bands, tile_conversion) != (bands, conversion):
+                return None
+            bands, conversion = tile_bands, tile_conversion
+            x0, y0, x1, y1 = extents
+            if x0 != 0 or x1 != width:
+                return None
+            stride = args[1] if len(args) > 1 and args[1] else width * bands
+            orientation = args[2] if len(args) > 2 else 1
+            segments.append((y0, y1, offset, stride, orientation))
+        segments.sort()
+        return cls(image_path, width, height, segments, bands, conversion)
+
+    def read(self, y0, y1):
+        """Rows [y0, y1) as a BGR uint8 array"""
+        rows = np.empty((y1 - y0, self.width, self._bands), dtype=np.uint8)
+        row_bytes = self.width * self._bands
+        for seg_y0, seg_y1, offset, stride, orientation in self._segments:
+            a, b = max(y0, seg_y0), min(y1, seg_y1)
+            if a >= b:
+                continue
+            if orientation == 1:
+                start = offset + (a - seg_y0) * stride
+            else:
+                # Bottom-up storage: row seg_y1 - 1 comes first
+                start = offset + (seg_y1 - b) * stride
+            block = np.empty((b - a) * stride, dtype=np.uint8)
+            self._file.seek(start)
+            self._file.readinto(memoryview(block))
+            block = block.reshape(b - a, stride)[:, :row_bytes]
+            if orientation != 1:
+                block = block[::-1]
+            rows[a - y0:b - y0] = block.reshape(b - a, self.width, self._bands)
+        if self._conversion is None:
+            return rows
+        if self._bands == 1:
+            rows = rows[:, :, 0]
+        return cv2.cvtColor(rows, self._conversion)
+
+    def close(self):
+        self._file.close()
+
+
+class TiffBlockSource:
+    """Decodes the strips or tiles of a compressed TIFF that cover a row range"""
+
+    def __init__(self, image_path, decode_tags, width, height, block_width, block_height, offsets, byte_counts):
+        self.kind = 'tiff_blocks'
+        self.width = width
+        self.height = height
+        self.scale = 1
+        # A read decodes up to a block row more on each side than asked for
+        self.resident_bytes = 2 * block_height * width * TIFF_DECODE_BYTES_PER_PIXEL
+        self.decode_bytes_per_pixel = TIFF_DECODE_BYTES_PER_PIXEL
+        self._file = open(image_path, 'rb')
+        self._decode_tags = decode_tags
+        self._tiled = TIFF_TILE_WIDTH in decode_tags
+        self._block_height = block_height
+        self._blocks_across = -(-width // block_width)
+        self._offsets = offsets
+        self._byte_counts = byte_counts
+
+    @classmethod
+    def open(cls, image_path, max_bytes):
+        """Return a source if the file is a TIFF whose block rows fit in `max_bytes`, else None"""
+        try:
+            with Image.open(image_path) as img:
+                if img.format != 'TIFF' or img.mode not in TIFF_BLOCK_MODES:
+                    return None
+                width, height = img.size
+                ifd = img.tag_v2
+                decode_tags = {tag: (ifd[tag], ifd.tagtype[tag]) for tag in TIFF_DECODE_TAGS if tag in ifd}
+                if TIFF_TILE_WIDTH in ifd:
+                    block_width, block_height = ifd[TIFF_TILE_WIDTH], ifd[TIFF_TILE_LENGTH]
+                    offsets, byte_counts = ifd[TIFF_TILE_OFFSETS], ifd[TIFF_TILE_BYTE_COUNTS]
+                else:
+                    block_width, block_height = width, min(height, ifd.get(TIFF_ROWS_PER_STRIP, height))
+                    offsets, byte_counts = ifd[TIFF_STRIP_OFFSETS], ifd[TIFF_STRIP_BYTE_COUNTS]
+                planar = ifd.get(TIFF_PLANAR_CONFIGURATION, 1)
+        except Exception as e:
+            logger.debug(f"Could not inspect {image_path} for block access: {str(e)}")
+            return None
+        if planar != 1 or 2 * block_height * width * TIFF_DECODE_BYTES_PER_PIXEL > max_bytes // 4:
+            # Separate color planes, or a single strip holding most of the image
+            return None
+        if isinstance(offsets, int):
+            offsets, byte_counts = (offsets,), (byte_counts,)
+        return cls(image_path, decode_tags, width, height, block_width, block_height, offsets, byte_counts)
+
+    def _block_row_file(self, first_row, rows):
+        """In-memory TIFF holding only the block rows starting at block row `first_row`"""
+        blocks = range(first_row * self._blocks_across, (first_row + rows) * self._blocks_across)
+        data = []
+        for index in blocks:
+            self._file.seek(self._offsets[index])
+            data.append(self._file.read(self._byte_counts[index]))
+
+        ifd = TiffImagePlugin.ImageFileDirectory_v2(prefix=b'II')
+        for tag, (value, tag_type) in self._decode_tags.items():
+            ifd[tag] = value
+            ifd.tagtype[tag] = tag_type
+        image_length = min(self.height, (first_row + rows) * self._block_height) - first_row * self._block_height
+        offset_tag, count_tag = (
+            (TIFF_TILE_OFFSETS, TIFF_TILE_BYTE_COUNTS) if self._tiled else (TIFF_STRIP_OFFSETS, TIFF_STRIP_BYTE_COUNTS)
+        )
+        positions = np.cumsum([0] + [len(block) for block in data[:-1]]).tolist()
+        for tag, value in ((TIFF_IMAGE_LENGTH, image_length), (count_tag, tuple(len(block) for block in data)),
+                           (offset_tag, tuple(positions))):
+            ifd[tag] = value
+            ifd.tagtype[tag] = TIFF_LONG
+        # The blocks follow the IFD. tobytes() moves StripOffsets past the IFD
+        # itself (where Pillow writes image data); TileOffsets are written as given.
+        directory = ifd.tobytes(8)
+        if self._tiled:
+            ifd[offset_tag] = tuple(8 + len(directory) + position for position in positions)
+            directory = ifd.tobytes(8)
+        return io.BytesIO(b'II*\x00' + struct.pack('<I', 8) + directory + b''.join(data))
+
+    def read(self, y0, y1):
+        """Rows [y0, y1) as a BGR uint8 array"""
+        first_row = y0 // self._block_height
+        rows = -(-y1 // self._block_height) - first_row
+        with Image.open(self._block_row_file(first_row, rows)) as block:
+            conversion = TIFF_BLOCK_MODES[block.mode]
+            if block.mode not in ('L', 'RGB'):
+                block = block.convert('L' if conversion == cv2.COLOR_GRAY2BGR else 'RGB')
+            pixels = np.array(block)
+        if conversion == cv2.COLOR_RGB2BGR:
+            pixels = cv2.cvtColor(pixels, conversion, dst=pixels)
+        else:
+            pixels = cv2.cvtColor(pixels, conversion)
+        top = y0 - first_row * self._block_height
+        return pixels[top:top + y1 - y0]
+
+    def close(self):
+        self._file.close()
+
+
+class ArrayRowSource:
+    """Row ranges of an image decoded into memory once"""
+
+    def __init__(self, image, scale=1):
+        self.kind = 'decoded'
+        self.image = image
+        self.height, self.width = image.shape[:2]
+        self.scale = scale
+        self.resident_bytes = image.nbytes
+        self.decode_bytes_per_pixel = 0
+
+    @classmethod
+    def open(cls, image_path, max_bytes):
+        """
+        Decode the image, at reduced scale if it is a JPEG that would not fit
+        in `max_bytes`. Raises ValueError if the decode cannot fit, rather
+        than exceed the memory ceiling.
+        """
+        scale = 1
+        with Image.open(image_path) as img:
+            width, height = img.size
+            image_format = img.format
+        if image_format == 'JPEG':
+            while scale < 8 and (width // scale) * (height // scale) * 3 > max_bytes:
+                scale *= 2
+        # IMREAD_COLOR decodes to 3 bytes per pixel whatever the file stores
+        decoded_bytes = (width // scale) * (height // scale) * 3
+        if decoded_bytes > max_bytes:
+            raise ValueError(
+                f"{image_format} image of {width}x{height} needs {decoded_bytes // MB} MB decoded, above the "
+                f"{max_bytes // MB} MB the quality memory ceiling leaves for pixels; convert it to an "
+                f"uncompressed file or a TIFF in strips or tiles for bounded analysis"
+            )
+        flags = {
+            1: cv2.IMREAD_COLOR,
+            2: cv2.IMREAD_REDUCED_COLOR_2,
+            4: cv2.IMREAD_REDUCED_COLOR_4,
+            8: cv2.IMREAD_REDUCED_COLOR_8,
+        }[scale]
+        image = cv2.imread(image_path, flags)
+        if image is None:
+            raise ValueError(f"Could not decode image: {image_path}")
+        return cls(image, scale)
+
+    def read(self, y0, y1):
+        return self.image[y0:y1]
+
+    def close(self):
+        self.image = None
+
+
+def open_row_source(image_path, max_bytes):
+    """Raw file access when possible, then TIFF blocks, otherwise a one-off decode"""
+    source = RawRowSource.open(image_path)
+    if source is None:
+        source = TiffBlockSource.open(image_path, max_bytes)
+    if source is not None:
+        return source
+    return ArrayRowSource.open(image_path, max_bytes // 2)
+
+
+def strip_rows_for(width, budget_bytes, bytes_per_pixel=BYTES_PER_STRIP_PIXEL):
+    """Even strip height whose working set fits in `budget_bytes`"""
+    rows = budget_bytes // (max(1, width) * bytes_per_pixel) - 2 * EDGE_HALO
+    return max(2, int(rows) // 2 * 2)
+
+
+class _StripAccumulator:
+    """Running statistics for every metric of analyze_image_quality()"""
+
+    def __init__(self, width, height, scales, sample_step):
+        self.width = width
+        self.height = height
+        self.scales = scales
+        self.sample_step = sample_step
+        self.gray = RunningMoments()
+        self.laplacian = RunningMoments()
+        self.noise = [RunningMoments() for _ in (1.0, 2.0, 3.0)]
+        self.detail = {scale: RunningMoments() for scale in scales if scale != 1.0}
+        self.bgr = RunningMoments(3)
+        self.hsv = RunningMoments(3)
+        self.lab_sum = np.zeros(3)
+        self.gradient_sum = 0.0
+        self.edge_pixels = 0
+        self.histogram = np.zeros((16, 16, 16), dtype=np.float64)
+        self.samples = []
+
+    def add(self, strip, top, y0, y1):
+        """
+        :param strip: BGR rows [y0 - top, y1 + halo) of the image
+        :param top: Number of halo rows above the core rows
+        """
+        core_rows = y1 - y0
+        core = slice(top, top + core_rows)
+        gray = cv2.cvtColor(strip, cv2.COLOR_BGR2GRAY)
+        self.gray.add(gray[core])
+
+        # Laplacian/Sobel of uint8 input are integers, exact in float32
+        laplacian = cv2.Laplacian(gray, cv2.CV_32F)
+        self.laplacian.add(laplacian[core])
+        del laplacian
+        dx = cv2.Sobel(gray, cv2.CV_32F, 1, 0)
+        dy = cv2.Sobel(gray, cv2.CV_32F, 0, 1)
+        self.gradient_sum += cv2.sumElems(cv2.magnitude(dx[core], dy[core]))[0]
+        del dx, dy
+
+        for moments, sigma in zip(self.noise, (1.0, 2.0, 3.0)):
+            # uint8 wrap-around on purpose, matching calculate_noise()
+            diff = cv2.GaussianBlur(gray, (3, 3), sigma) - gray
+            moments.add(diff[core])
+        del diff
+
+        self.edge_pixels += cv2.countNonZero(cv2.Canny(gray, 100, 200)[core])
+
+        for scale, moments in self.detail.items():
+            if scale < 1.0:
+                # y0 is even, so 2x2 blocks never straddle strips
+                scaled = cv2.resize(gray[core], None, fx=scale, fy=scale)
+                moments.add(scaled)
+            else:
+                factor = int(scale)
+                scaled = cv2.resize(gray, None, fx=scale, fy=scale)
+                moments.add(scaled[top * factor:(top + core_rows) * factor])
+            del scaled
+        del gray
+
+        bgr = strip[core]
+        self.bgr.add(bgr)
+        self.hsv.add(cv2.cvtColor(bgr, cv2.COLOR_BGR2HSV))
+        self.lab_sum += np.array(cv2.sumElems(cv2.cvtColor(bgr, cv2.COLOR_BGR2LAB))[:3])
+        self.histogram += cv2.calcHist([bgr], [0, 1, 2], None, [16, 16, 16], [0, 256, 0, 256, 0, 256])
+        if self.sample_step:
+            first = (-y0 * self.width) % self.sample_step
+            self.samples.append(bgr.reshape(-1, 3)[first::self.sample_step].copy())
+
+
+def _histogram_colors(histogram, n_colors=3, bits=4):
+    """get_histogram_colors() on an accumulated 16x16x16 histogram"""
+    counts = histogram.ravel()
+    top = np.argsort(counts)[::-1][:n_colors]
+    top = top[counts[top] > 0]
+    shift = 8 - bits
+    mask = (1 << bits) - 1
+    colors = np.stack([(top >> (2 * bits)) & mask, (top >> bits) & mask, top & mask], axis=1)
+    return ((colors << shift) + (1 << (shift - 1))).astype(np.uint8).tolist()
+
+
+def _fft_blur_term(source):
+    """Mean log spectrum of a centered FAST_FFT_MAX_SIDE crop (as in fast mode)"""
+    half = FAST_FFT_MAX_SIDE // 2
+    crow, ccol = source.height // 2, source.width // 2
+    rows = source.read(max(0, crow - half), min(source.height, crow + half))
+    crop = cv2.cvtColor(rows[:, max(0, ccol - half):ccol + half], cv2.COLOR_BGR2GRAY)
+    return mean_log_spectrum(crop)
+
+
+def analyze_image_quality_tiled(image_path, mode='full', refine_colors=True,
+                                max_memory_mb=DEFAULT_MAX_MEMORY_MB, deadline=None):
+    """
+    Strip-wise analyze_image_quality() with a bounded working set.
+
+    :param image_path: Path to the image file
+    :param mode: 'full' or 'fast' (fast skips the 2x detail scale and samples
+                 fewer pixels for k-means)
+    :param refine_colors: If False, dominant colors come from histogram peaks
+    :param max_memory_mb: Ceiling for decoded pixels plus strip working set
+    :param deadline: Optional Deadline checked after every strip
+    :return: Same structure as analyze_image_quality(), plus a `tiling` entry
+    """
+    fast = mode == 'fast'
+    max_bytes = int(max_memory_mb * MB)
+    source = open_row_source(image_path, max_bytes)
+    try:
+        width, height = source.width, source.height
+        strip_rows = strip_rows_for(
+            width, max_bytes - source.resident_bytes, BYTES_PER_STRIP_PIXEL + source.decode_bytes_per_pixel
+        )
+        sample_target = FAST_KMEANS_SAMPLES if fast else TILED_KMEANS_SAMPLES
+        sample_step = max(1, (width * height) // sample_target) if refine_colors else 0
+        acc = _StripAccumulator(
+            width, height,
+            scales=(0.5, 1.0) if fast else (0.5, 1.0, 2.0),
+            sample_step=sample_step
+        )
+
+        strips = 0
+        for y0 in range(0, height, strip_rows):
+            y1 = min(height, y0 + strip_rows)
+            top = min(EDGE_HALO, y0)
+            strip = source.read(y0 - top, min(height, y1 + EDGE_HALO))
+            acc.add(strip, top, y0, y1)
+            del strip
+            strips += 1
+            check_deadline(deadline, "tiled quality metrics")
+
+        fft_term = _fft_blur_term(source)
+    finally:
+        source.close()
+
+    pixels = width * height
+    gray_std = float(acc.gray.std[0])
+    blur_score = (float(acc.laplacian.var[0]) + fft_term) / 2
+    contrast_score = gray_std
+    hsv_mean = acc.hsv.mean
+    brightness_score = float(hsv_mean[2])
+    noise_level = float(np.mean([moments.std[0] for moments in acc.noise]))
+    sharpness = acc.gradient_sum / pixels
+    edge_density = acc.edge_pixels / pixels
+    detail_stds = [gray_std if scale == 1.0 else float(acc.detail[scale].std[0]) for scale in acc.scales]
+    detail_score = float(np.mean(detail_stds))
+
+    if refine_colors:
+        samples = np.concatenate(acc.samples)
+        dominant_colors = get_dominant_colors(samples.reshape(-1, 1, 3))
+    else:
+        dominant_colors = _histogram_colors(acc.histogram)
+    b_mean, g_mean, r_mean = acc.bgr.mean
+
+    quality_score = calculate_quality_score(
+        blur_score, contrast_score, brightness_score,
+        noise_level, sharpness, edge_density
+    )
+    # Report dimensions of the original file even when JPEG decode was reduced
+    full_width, full_height = width * source.scale, height * source.scale
+    logger.info(
+        f"Tiled quality analysis of {full_width}x{full_height} in {strips} strips "
+        f"of {strip_rows} rows ({source.kind} source, scale 1/{source.scale})"
+    )
+
+    quality_scores = {
+        'overall_quality': quality_score,
+        'blur_score': round(blur_score, 2),
+        'contrast_score': round(contrast_score, 2),
+        'brightness_score': round(brightness_score, 2),
+        'noise_level': round(noise_level, 2),
+        'sharpness': round(sharpness, 2),
+        'edge_density': round(edge_density, 2),
+        'detail_score': round(detail_score, 2)
+    }
+    if source.scale > 1:
+        # Blur, sharpness, edge density and detail were measured on the reduced decode
+        logger.warning(f"Quality of {image_path} measured at 1/{source.scale} scale to fit the memory ceiling")
+        quality_scores['analysis_scale'] = 1 / source.scale
+
+    return {
+        'basic_metrics': {
+            'resolution': f"{full_width}x{full_height}",
+            'aspect_ratio': f"{full_width/full_height:.2f}",
+            'file_size_mb': round(os.path.getsize(image_path) / (1024 * 1024), 2),
+            'dimensions': {
+                'width': full_width,
+                'height': full_height,
+                'megapixels': (full_width * full_height) / 1000000
+            }
+        },
+        'quality_scores': quality_scores,
+        'color_analysis': {
+            'color_distribution': {
+                'mean_rgb': acc.bgr.mean.tolist(),
+                'std_rgb': acc.bgr.std.tolist(),
+                'mean_hsv': hsv_mean.tolist(),
+                'mean_lab': (acc.lab_sum / pixels).tolist()
+            },
+            'color_stats': {
+                'saturation': float(hsv_mean[1]),
+                'value_variance': float(acc.hsv.var[2]),
+                'dominant_colors': dominant_colors,
+                'color_contrast': {
+                    'rg_contrast': abs(r_mean - g_mean),
+                    'rb_contrast': abs(r_mean - b_mean),
+                    'gb_contrast': abs(g_mean - b_mean)
+                }
+            }
+        },
+        'quality_mode': mode,
+        'tiling': {
+            'strips': strips,
+            'strip_rows': strip_rows,
+            'source': source.kind,
+            'decode_scale': source.scale,
+            'max_memory_mb': max_memory_mb
+        }
+    }
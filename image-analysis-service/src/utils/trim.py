@@ -0,0 +1,145 @@
+# image-analysis-service/src/utils/trim.py
+"""
+Crop blank canvas around diagram content.
+
+The background level is taken from the image border; pixels further than
+TRIM_THRESHOLD from it count as content. Row and column projections of that
+mask give the content bounding box, which is padded so 3x3..5x5 kernels at
+the crop edge still see background, as they would in the full image.
+"""
+import logging
+from dataclasses import dataclass
+
+import cv2
+import numpy as np
+
+from utils.bitmask import PackedMask
+
+logger = logging.getLogger(__name__)
+
+# Gray-level distance from the background that counts as content
+TRIM_THRESHOLD = 24
+# Background kept around the content box, in pixels
+TRIM_PADDING = 16
+# Crops that remove less than this share of the pixels are not worth a copy
+TRIM_MIN_GAIN = 0.1
+
+
+@dataclass
+class ContentCrop:
+    """Content box within a frame of full_width x full_height pixels"""
+    x: int
+    y: int
+    width: int
+    height: int
+    full_width: int
+    full_height: int
+
+    @property
+    def area_ratio(self):
+        """Share of the frame inside the crop"""
+        return (self.width * self.height) / (self.full_width * self.full_height)
+
+    def apply(self, image):
+        """The cropped region (a view, not a copy)"""
+        return image[self.y:self.y + self.height, self.x:self.x + self.width]
+
+    def to_original_point(self, x, y):
+        """Map a point from crop coordinates back to the full frame"""
+        return x + self.x, y + self.y
+
+    def to_original_box(self, x, y, width, height):
+        """Map an (x, y, w, h) box from crop coordinates back to the full frame"""
+        return x + self.x, y + self.y, width, height
+
+    def reduced(self, factor):
+        """
+        The same box in the frame reduced `factor` times (as DecodedImage.view
+        reduces it), rounded outwards so no content is cut off
+        """
+        if factor == 1:
+            return self
+        full_width, full_height = max(1, self.full_width // factor), max(1, self.full_height // factor)
+        x, y = self.x // factor, self.y // factor
+        right = min(full_width, -(-(self.x + self.width) // factor))
+        bottom = min(full_height, -(-(self.y + self.height) // factor))
+        return ContentCrop(x, y, max(1, right - x), max(1, bottom - y), full_width, full_height)
+
+    def to_full_density(self, density):
+        """
+        Convert a per-pixel fraction measured on the crop (edge density,
+        foreground share) to the full frame. The trimmed margin holds no
+        content, so it only adds pixels to the denominator.
+        """
+        return density * self.area_ratio
+
+    def to_dict(self):
+        return {
+            'x': self.x,
+            'y': self.y,
+            'width': self.width,
+            'height': self.height,
+            'pixels_removed': round(1 - self.area_ratio, 3)
+        }
+
+
+def background_level(gray):
+    """Median of the outermost rows and columns"""
+    border = np.concatenate([gray[0], gray[-1], gray[:, 0], gray[:, -1]])
+    return int(np.median(border))
+
+
+def _packed_projections(mask, threshold):
+    """Rows and columns holding content of a bitonal image, from its bits"""
+    height, width = mask.shape
+    border = np.concatenate([
+        mask.unpack_region(0, 0, width, 1).ravel(), mask.unpack_region(0, height - 1, width, 1).ravel(),
+        mask.unpack_region(0, 0, 1, height).ravel(), mask.unpack_region(width - 1, 0, 1, height).ravel(),
+    ])
+    background = int(np.median(border))
+    high_is_content = abs(mask.high - background) > threshold
+    low_is_content = abs(mask.low - background) > threshold
+    if high_is_content and low_is_content:
+        # Every pixel is content
+        return np.arange(height), np.arange(width)
+    if not (high_is_content or low_is_content):
+        return np.zeros(0, np.intp), np.zeros(0, np.intp)
+    bits = mask.bits if high_is_content else mask.inverted().bits
+    rows = np.flatnonzero(bits.any(axis=1))
+    cols = np.flatnonzero(np.unpackbits(np.bitwise_or.reduce(bits, axis=0), count=width))
+    return rows, cols
+
+
+def find_content_crop(gray, threshold=TRIM_THRESHOLD, padding=TRIM_PADDING, min_gain=TRIM_MIN_GAIN):
+    """
+    Bounding box of the content plus padding.
+
+    :param gray: Single-channel uint8 image, or the PackedMask of a bitonal
+                 one (measured on its bits, without unpacking)
+    :return: ContentCrop, or None if the image is blank or trimming would
+             remove less than `min_gain` of the pixels
+    """
+    height, width = gray.shape
+    if height <= 2 * padding or width <= 2 * padding:
+        return None
+
+    if isinstance(gray, PackedMask):
+        rows, cols = _packed_projections(gray, threshold)
+    else:
+        difference = cv2.absdiff(gray, background_level(gray))
+        _, content = cv2.threshold(difference, threshold, 1, cv2.THRESH_BINARY)
+        # Projections: any content in each row / column
+        rows = np.flatnonzero(cv2.reduce(content, 1, cv2.REDUCE_MAX))
+        cols = np.flatnonzero(cv2.reduce(content, 0, cv2.REDUCE_MAX))
+    if len(rows) == 0 or len(cols) == 0:
+        return None
+
+    x0 = max(0, int(cols[0]) - padding)
+    y0 = max(0, int(rows[0]) - padding)
+    x1 = min(width, int(cols[-1]) + 1 + padding)
+    y1 = min(height, int(rows[-1]) + 1 + padding)
+    crop = ContentCrop(x0, y0, x1 - x0, y1 - y0, width, height)
+    if crop.area_ratio > 1 - min_gain:
+        return None
+    logger.debug(f"Content crop {crop.to_dict()} of {width}x{height}")
+    return crop
@@ -0,0 +1,204 @@
+# image-analysis-service/src/utils/visual_embedding.py
+"""
+Compact visual embedding of a diagram, for similar-diagram search.
+
+The embedding concatenates three groups, each normalized on its own and
+weighted, then scaled to unit length so the dot product of two embeddings
+is their cosine similarity:
+
+- color: hue histogram of saturated pixels and lightness histogram of
+  gray ink, as shares of the painted area (the background left out)
+- edges: gradient orientation histograms (8 bins over 180 degrees) of the
+  four quadrants of the content, weighted by gradient magnitude
+- components: sizes, aspect ratios and fill ratios of the connected
+  components of the ink, plus their count and the ink share
+
+The diagram type classifier is left out: its Hough transforms cost seconds
+on large photos, while these groups take milliseconds at EMBEDDING_SIDE.
+
+Histograms hold square roots of shares (the Hellinger mapping), so the dot
+product does not let one dominant bin (the background) swamp the rest.
+Everything is computed on the content crop resized to EMBEDDING_SIDE on its
+long side, so margins, resolution and re-encoding barely move the vector.
+"""
+import logging
+import cv2
+import numpy as np
+
+from utils.decode import DecodeRequirement, to_gray
+from utils.deadline import check_deadline
+from utils.diagram_features import otsu_foreground_mask
+from utils.trim import find_content_crop
+
+logger = logging.getLogger(__name__)
+
+# Bump when the layout or the features change; stored vectors of another
+# version are not comparable
+EMBEDDING_VERSION = 2
+EMBEDDING_REQUIREMENT = DecodeRequirement(channels=3, min_long_side=512)
+EMBEDDING_SIDE = 512
+
+# Color: saturated pixels by hue, the rest by lightness
+COLOR_HUE_BINS = 16
+COLOR_GRAY_BINS = 8
+COLOR_MIN_SATURATION = 48
+COLOR_MIN_VALUE = 48
+
+# Edges: orientation bins per quadrant, weakest magnitude counted
+EDGE_ORIENTATION_BINS = 8
+EDGE_GRID = 2
+EDGE_MIN_MAGNITUDE = 40
+
+# Components: log2 of the bounding box long side relative to EMBEDDING_SIDE
+# (1/256 .. 1), width/height ratio (0.25 .. 4) and ink/bounding box area
+COMPONENT_SIZE_BINS = 8
+COMPONENT_ASPECT_BINS = 5
+COMPONENT_FILL_BINS = 4
+COMPONENT_MIN_AREA = 3
+# Counts reach 1.0 at this many components
+COMPONENT_COUNT_SCALE = 2000
+
+# Relative weight of each group in the final vector
+GROUP_WEIGHTS = {'color': 1.0, 'edges': 1.0, 'components': 1.0}
+GROUP_SIZES = {
+    'color': COLOR_HUE_BINS + COLOR_GRAY_BINS,
+    'edges': EDGE_GRID * EDGE_GRID * EDGE_ORIENTATION_BINS,
+    'components': COMPONENT_SIZE_BINS + COMPONENT_ASPECT_BINS + COMPONENT_FILL_BINS + 2,
+}
+EMBEDDING_DIM = sum(GROUP_SIZES.values())
+
+
+def _share_histogram(values, bins, value_range, weights=None, total=None):
+    """Square roots of the share of `total` falling in each bin"""
+    counts, _ = np.histogram(values, bins=bins, range=value_range, weights=weights)
+    total = total if total is not None else counts.sum()
+    return np.sqrt(counts / float(total)) if total else np.zeros(bins)
+
+
+def color_features(image, ink):
+    """
+    Hue histogram of saturated pixels and lightness histogram of gray ink,
+    as shares of the painted area (ink or saturated). The plain background
+    is left out: it would make every light diagram look alike.
+
+    :param ink: uint8 mask, nonzero for ink
+    """
+    ink = ink.ravel() > 0
+    if image.ndim == 2:
+        gray = image.ravel()
+        return np.concatenate([np.zeros(COLOR_HUE_BINS), _share_histogram(gray[ink], COLOR_GRAY_BINS, (0, 256))])
+    hsv = cv2.cvtColor(image, cv2.COLOR_BGR2HSV).reshape(-1, 3)
+    saturated = (hsv[:, 1] >= COLOR_MIN_SATURATION) & (hsv[:, 2] >= COLOR_MIN_VALUE)
+    gray_ink = ink & ~saturated
+    painted = int(np.count_nonzero(saturated)) + int(np.count_nonzero(gray_ink))
+    hue = _share_histogram(hsv[saturated, 0], COLOR_HUE_BINS, (0, 180), total=painted)
+    gray = _share_histogram(hsv[gray_ink, 2], COLOR_GRAY_BINS, (0, 256), total=painted)
+    return np.concatenate([hue, gray])
+
+
+def edge_features(gray):
+    """Magnitude-weighted gradient orientation histograms of the quadrants"""
+    dx = cv2.Sobel(gray, cv2.CV_32F, 1, 0, ksize=3)
+    dy = cv2.Sobel(gray, cv2.CV_32F, 0, 1, ksize=3)
+    magnitude, angle = cv2.cartToPolar(dx, dy, angleInDegrees=True)
+    magnitude[magnitude < EDGE_MIN_MAGNITUDE] = 0
+    total = float(magnitude.sum())
+    height, width = gray.shape
+    cells = []
+    for row in range(EDGE_GRID):
+        for column in range(EDGE_GRID):
+            rows = slice(row * height // EDGE_GRID, (row + 1) * height // EDGE_GRID)
+            columns = slice(column * width // EDGE_GRID, (column + 1) * width // EDGE_GRID)
+            # Orientation of the stroke, not the direction of the gradient
+            orientation = angle[rows, columns].ravel() % 180
+            cells.append(_share_histogram(
+                orientation, EDGE_ORIENTATION_BINS, (0, 180), magnitude[rows, columns].ravel(), total
+            ))
+    return np.concatenate(cells)
+
+
+def component_features(ink):
+    """
+    Size, aspect and fill histograms of the ink's connected components,
+    their count and the ink share.
+
+    :param ink: uint8 mask, nonzero for ink
+    """
+    count, _, stats, _ = cv2.connectedComponentsWithStats(ink, connectivity=8)
+    stats = stats[1:]
+    stats = stats[stats[:, cv2.CC_STAT_AREA] >= COMPONENT_MIN_AREA].astype(np.float64)
+    widths, heights = stats[:, cv2.CC_STAT_WIDTH], stats[:, cv2.CC_STAT_HEIGHT]
+    long_sides = np.maximum(widths, heights)
+    size = np.log2(np.maximum(long_sides, 1) / float(max(ink.shape)))
+    aspect = np.log2(widths / heights) if len(stats) else np.zeros(0)
+    fill = stats[:, cv2.CC_STAT_AREA] / (widths * heights) if len(stats) else np.zeros(0)
+    return np.concatenate([
+        _share_histogram(np.clip(size, -8, -1e-6), COMPONENT_SIZE_BINS, (-8, 0)),
+        _share_histogram(np.clip(aspect, -2, 2), COMPONENT_ASPECT_BINS, (-2, 2)),
+        _share_histogram(fill, COMPONENT_FILL_BINS, (0, 1)),
+        [min(1.0, np.log1p(len(stats)) / np.log1p(COMPONENT_COUNT_SCALE)),
+         np.sqrt(np.count_nonzero(ink) / float(ink.size))],
+    ])
+
+
+def _normalized(vector):
+    norm = float(np.linalg.norm(vector))
+    return vector / norm if norm > 0 else vector
+
+
+def compute_embedding(image, deadline=None):
+    """
+    Visual embedding of a decoded image.
+
+    :param image: BGR or grayscale uint8 array, any size
+    :param deadline: optional Deadline, checked between feature groups
+    :return: dict with `vector` (EMBEDDING_DIM floats, unit length) and `version`
+    :raises DeadlineExceeded: if the deadline passes
+    """
+    crop = find_content_crop(to_gray(image))
+    if crop is not None:
+        image = crop.apply(image)
+    height, width = image.shape[:2]
+    scale = EMBEDDING_SIDE / float(max(height, width))
+    interpolation = cv2.INTER_AREA if scale < 1 else cv2.INTER_LINEAR
+    image = cv2.resize(image, (max(1, int(round(width * scale))), max(1, int(round(height * scale)))),
+                       interpolation=interpolation)
+    gray = to_gray(image)
+    foreground = otsu_foreground_mask(gray)
+    ink = foreground.unpack()
+    check_deadline(deadline, "visual embedding")
+
+    groups = {'color': color_features(image, ink)}
+    check_deadline(deadline, "visual embedding")
+    groups['edges'] = edge_features(gray)
+    check_deadline(deadline, "visual embedding")
+    groups['components'] = component_features(ink)
+    vector = np.concatenate([GROUP_WEIGHTS[name] * _normalized(groups[name]) for name in GROUP_SIZES])
+    return {
+        'version': EMBEDDING_VERSION,
+        'vector': [round(float(v), 5) for v in _normalized(vector)],
+    }
+
+
+def embedding_vector(embedding) -> np.ndarray:
+    """
+    float32 vector of an embedding as returned by compute_embedding(), or of
+    a bare list of floats.
+
+    :raises ValueError: if the version or the length does not match this service's
+    """
+    if isinstance(embedding, dict):
+        version = embedding.get('version', EMBEDDING_VERSION)
+        if version != EMBEDDING_VERSION:
+            raise ValueError(f"embedding version {version}, expected {EMBEDDING_VERSION}")
+        embedding = embedding.get('vector')
+    try:
+        vector = np.asarray(embedding, np.float32)
+    except (TypeError, ValueError):
+        raise ValueError("embedding vector must be a list of numbers")
+    if vector.shape != (EMBEDDING_DIM,):
+        raise ValueError(f"embedding must have {EMBEDDING_DIM} values, got {vector.size}")
+    if not np.all(np.isfinite(vector)):
+        raise ValueError("embedding has non-finite values")
+    return vector
+
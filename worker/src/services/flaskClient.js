@@ -2,21 +2,94 @@ const axios = require('axios');
 const FormData = require('form-data');
 const fs = require('fs');
 
+const JOB_POLL_WAIT_SECONDS = 30;
+const JOB_TIMEOUT_MS = 900000;
+
+const sleep = (ms) => new Promise((resolve) => setTimeout(resolve, ms));
+
+async function submitJob(apiUrl, filePath, filename, format) {
+  const deadline = Date.now() + JOB_TIMEOUT_MS;
+
+  while (true) {
+    const form = new FormData();
+    form.append('image', fs.createReadStream(filePath), {
+      filename,
+      contentType: format || 'image/jpeg',
+    });
+
+    try {
+      const response = await axios.post(`${apiUrl}/jobs`, form, {
+        headers: form.getHeaders(),
+        timeout: 60000,
+        maxContentLength: Infinity,
+        maxBodyLength: Infinity,
+      });
+      return response.data.job_id;
+    } catch (error) {
+      const status = error.response?.status;
+      if ((status === 503 || status === 429) && Date.now() < deadline) {
+        // Queue is full: back off for as long as the service asks
+        const retryAfter = parseInt(error.response.headers['retry-after'], 10) || 5;
+        await sleep(retryAfter * 1000);
+        continue;
+      }
+      throw error;
+    }
+  }
+}
+
 async function analyzeImage(apiUrl, filePath, filename, format) {
-  const form = new FormData();
-  form.append('image', fs.createReadStream(filePath), {
-    filename,
-    contentType: format || 'image/jpeg',
-  });
-
-  const response = await axios.post(`${apiUrl}/analyze`, form, {
-    headers: form.getHeaders(),
-    timeout: 900000,
-    maxContentLength: Infinity,
-    maxBodyLength: Infinity,
-  });
-
-  return response.data;
+  const jobId = await submitJob(apiUrl, filePath, filename, format);
+  const deadline = Date.now() + JOB_TIMEOUT_MS;
+
+  while (Date.now() < deadline) {
+    const response = await axios.get(`${apiUrl}/jobs/${jobId}`, {
+      params: { wait: JOB_POLL_WAIT_SECONDS },
+      timeout: (JOB_POLL_WAIT_SECONDS + 30) * 1000,
+    });
+
+    const job = response.data;
+    if (job.status === 'completed') {
+      return job.result;
+    }
+    if (job.status === 'failed') {
+      throw new Error(`Analysis job ${jobId} failed: ${job.error}`);
+    }
+  }
+
+  throw new Error(`Analysis job ${jobId} did not finish within ${JOB_TIMEOUT_MS / 1000}s`);
+}
+
+// Cloud OCR (Textract) through the analysis service, which pools the client,
+// limits concurrent calls and caches results by image content
+async function extractText(apiUrl, filePath, filename, format) {
+  const deadline = Date.now() + JOB_TIMEOUT_MS;
+
+  while (true) {
+    const form = new FormData();
+    form.append('image', fs.createReadStream(filePath), {
+      filename,
+      contentType: format || 'image/jpeg',
+    });
+
+    try {
+      const response = await axios.post(`${apiUrl}/ocr`, form, {
+        headers: form.getHeaders(),
+        timeout: 120000,
+        maxContentLength: Infinity,
+        maxBodyLength: Infinity,
+      });
+      return response.data.text || '';
+    } catch (error) {
+      const status = error.response?.status;
+      if ((status === 503 || status === 429) && Date.now() < deadline) {
+        const retryAfter = parseInt(error.response.headers['retry-after'], 10) || 5;
+        await sleep(retryAfter * 1000);
+        continue;
+      }
+      throw error;
+    }
+  }
 }
 
-module.exports = { analyzeImage };
+module.exports = { analyzeImage, extractText };
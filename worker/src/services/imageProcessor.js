@@ -4,11 +4,10 @@ const fs = require('fs');
 const { logger } = require('../utils/logger');
 const Diagram = require('../models/Diagram');
 const s3 = require('../config/aws');
-const { analyzeImage } = require('../services/flaskClient');
+const { analyzeImage, extractText } = require('../services/flaskClient');
 const { enqueueMessage } = require('../queues/queueManager');
 const { cleanTempDir } = require('../services/fileService');
 // … other imports …
-const { extractTextFromBuffer } = require("../../textract");
 
 async function processMessage(message) {
   const { diagramId, s3Key } = message;
@@ -46,7 +45,12 @@ async function processMessage(message) {
 
     let awsTextractText = "";
 try {
-  awsTextractText = await extractTextFromBuffer(s3Object.Body);
+  awsTextractText = await extractText(
+    process.env.FLASK_API_URL,
+    tempFilePath,
+    diagram.filename,
+    diagram.file_info?.format
+  );
   logger.info("✅ Textract extracted:", awsTextractText.slice(0, 120));
 } catch (err) {
   logger.warn("❌ Textract failed:", err);